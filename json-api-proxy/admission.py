@@ -0,0 +1,229 @@
+"""
+Admission control for /query and /annotations.
+
+One dashboard with a short refresh and many panels can otherwise occupy
+every request thread and starve all other dashboards. Each request passes
+two gates before it runs:
+
+- a token bucket per client (Grafana dashboard UID, user or org header):
+  `rate` requests per second with bursts up to `burst`; over the limit a
+  request is rejected at once
+- a bounded number of requests in flight: beyond `max_inflight`, requests
+  wait in a queue of at most `max_queue` for up to `queue_timeout`
+  seconds; when the queue is full, or the wait times out, the request is
+  shed
+
+Rejected requests get 429 with a Retry-After estimate. Queries from
+Grafana alert rule evaluation skip the token bucket, are queued ahead of
+dashboard queries and are never shed for a full queue, so alerting keeps
+working while dashboards are throttled.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+PRIORITY_ALERT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_NAMES = {PRIORITY_ALERT: "alert", PRIORITY_NORMAL: "normal"}
+
+
+class Rejected(Exception):
+    """A request turned away; `retry_after` is in whole seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason}, retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token buckets per client key, least recently used evicted past `max_keys`"""
+
+    def __init__(self, rate, burst, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        # key -> [tokens, updated_at]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take one token for `key`; 0.0 if granted, else seconds until one is"""
+        with self._lock:
+            now = self.clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("grant", "granted", "cancelled")
+
+    def __init__(self, grant):
+        self.grant = grant
+        self.granted = False
+        self.cancelled = False
+
+
+class AdmissionController:
+    """
+    Token-bucket limiting plus a bounded priority queue in front of at
+    most `max_inflight` concurrent requests.
+
+    `admit()` is a context manager for threaded servers, `admit_async()`
+    its asyncio counterpart. `on_decision`, if given, is called with
+    (decision, priority): decision is "admitted", "queued",
+    "rate_limited", "queue_full" or "queue_timeout".
+    """
+
+    def __init__(self, limiter=None, max_inflight=4, max_queue=8, queue_timeout=5.0,
+                 clock=time.monotonic, on_decision=None):
+        self.limiter = limiter
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.clock = clock
+        self.on_decision = on_decision
+
+        self.inflight = 0
+        self.waiting = 0
+        self._queue = []
+        self._seq = itertools.count()
+        # Smoothed request duration, for Retry-After estimates
+        self._service_seconds = 1.0
+        self._lock = threading.Lock()
+
+    def _decide(self, decision, priority):
+        if self.on_decision is not None:
+            self.on_decision(decision, priority)
+
+    def _retry_after(self, waiting=None):
+        waiting = self.waiting if waiting is None else waiting
+        return max(1, math.ceil(self._service_seconds * (waiting + 1) / self.max_inflight))
+
+    def _enter(self, key, priority, make_waiter):
+        """None if admitted now, else a queued waiter; raises Rejected"""
+        if priority != PRIORITY_ALERT and self.limiter is not None:
+            wait = self.limiter.acquire(key)
+            if wait > 0:
+                self._decide("rate_limited", priority)
+                raise Rejected("rate limited", max(1, math.ceil(wait)))
+
+        with self._lock:
+            if self.inflight < self.max_inflight and not self.waiting:
+                self.inflight += 1
+                decision = "admitted"
+                waiter = None
+            elif self.waiting >= self.max_queue and priority != PRIORITY_ALERT:
+                decision = "queue_full"
+                retry_after = self._retry_after()
+            else:
+                waiter = make_waiter()
+                heapq.heappush(self._queue, (priority, next(self._seq), waiter))
+                self.waiting += 1
+                decision = "queued"
+
+        self._decide(decision, priority)
+        if decision == "queue_full":
+            raise Rejected("queue full", retry_after)
+        return waiter
+
+    def _cancel(self, waiter):
+        """Withdraw a waiter; True if it was granted a slot in the meantime"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            self.waiting -= 1
+            return False
+
+    def _release(self, elapsed=None):
+        """Hand the slot to the next waiter, or free it"""
+        with self._lock:
+            if elapsed is not None:
+                self._service_seconds += 0.2 * (elapsed - self._service_seconds)
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self.waiting -= 1
+                waiter.grant()
+                return
+            self.inflight -= 1
+
+    def _timed_out(self, priority):
+        self._decide("queue_timeout", priority)
+        return Rejected("queue timeout", self._retry_after())
+
+    @contextmanager
+    def admit(self, key, priority=PRIORITY_NORMAL):
+        """Run the block once admitted; raises Rejected if shed"""
+        event = threading.Event()
+        waiter = self._enter(key, priority, lambda: _Waiter(event.set))
+        if waiter is not None and not event.wait(self.queue_timeout):
+            if not self._cancel(waiter):
+                raise self._timed_out(priority)
+
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self._release(self.clock() - start)
+
+    @asynccontextmanager
+    async def admit_async(self, key, priority=PRIORITY_NORMAL):
+        """admit() for coroutines"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(key, priority, lambda: _Waiter(grant))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not self._cancel(waiter):
+                    # Granted just as the wait expired; give the slot back.
+                    self._release()
+                raise self._timed_out(priority) from None
+            except BaseException:
+                if not self._cancel(waiter):
+                    self._release()
+                raise
+
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self._release(self.clock() - start)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inflight": self.inflight,
+                "waiting": self.waiting,
+                "max_inflight": self.max_inflight,
+                "max_queue": self.max_queue,
+                "service_seconds": round(self._service_seconds, 3),
+            }
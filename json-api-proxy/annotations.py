@@ -0,0 +1,268 @@
+"""
+Grafana annotations from backend anomaly and circuit-breaker events.
+
+Every dashboard's annotation query runs on every refresh, usually over
+overlapping ranges. AnnotationStore keeps the events already fetched in a
+time-sorted index together with the set of time intervals it has fully
+covered, so a query only needs the backend for the part of its range that
+has not been seen yet (normally just the slice since the last refresh)
+and everything else is answered from memory.
+
+Events older than the retention horizon, and the oldest beyond
+`max_events`, are dropped together with their part of the covered
+intervals, so a long-running proxy's memory stays bounded; a query
+reaching back that far asks the backend again.
+
+The store does no I/O: callers ask `plan()` what to fetch, fetch it with
+their own transport (sync or asyncio) and hand the payloads back through
+`ingest_anomalies()` / `ingest_breakers()`.
+"""
+
+import bisect
+import math
+import threading
+
+from timeseries import parse_grafana_time
+
+HOUR_MS = 3_600_000
+
+# Backend payloads are either a list of events or a dict wrapping one.
+_LIST_KEYS = ("anomalies", "circuit_breakers", "breakers", "events", "items", "data")
+_TIME_KEYS = ("timestamp", "detected_at", "time", "created_at",
+              "opened_at", "last_state_change", "last_failure_time")
+_TEXT_KEYS = ("message", "description", "details", "reason")
+_TRIPPED_STATES = {"OPEN", "HALF_OPEN"}
+
+
+class IntervalSet:
+    """Sorted, merged [start, end] intervals of covered time"""
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def add(self, start, end):
+        if end <= start:
+            return
+        lo = bisect.bisect_left(self._ends, start)
+        hi = bisect.bisect_right(self._starts, end)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            end = max(end, self._ends[hi - 1])
+        self._starts[lo:hi] = [start]
+        self._ends[lo:hi] = [end]
+
+    def trim(self, start):
+        """Forget the coverage before `start`"""
+        i = bisect.bisect_right(self._ends, start)
+        del self._starts[:i]
+        del self._ends[:i]
+        if self._starts and self._starts[0] < start:
+            self._starts[0] = start
+
+    def missing(self, start, end):
+        """Gaps of [start, end] not covered, as [(start, end), ...]"""
+        gaps = []
+        cursor = start
+        i = bisect.bisect_right(self._ends, start)
+        while cursor < end and i < len(self._starts):
+            if self._starts[i] > cursor:
+                gaps.append((cursor, min(self._starts[i], end)))
+            cursor = max(cursor, self._ends[i])
+            i += 1
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
+
+    def __iter__(self):
+        return iter(zip(self._starts, self._ends))
+
+
+def _event_list(payload):
+    if isinstance(payload, list):
+        return payload
+    if isinstance(payload, dict):
+        for key in _LIST_KEYS:
+            if isinstance(payload.get(key), list):
+                return payload[key]
+        # {"openrouter": {...}, ...} keyed by provider
+        if payload and all(isinstance(v, dict) for v in payload.values()):
+            return [dict(v, provider=v.get("provider", k)) for k, v in payload.items()]
+    return []
+
+
+def _first(item, keys):
+    for key in keys:
+        if item.get(key) not in (None, ""):
+            return item[key]
+    return None
+
+
+def event_time_ms(item):
+    """Epoch ms of an event from seconds, ms or an ISO string; None if absent"""
+    value = _first(item, _TIME_KEYS)
+    if isinstance(value, (int, float)) and math.isfinite(value):
+        # Seconds until the year 5138; anything larger is already ms.
+        return int(value * 1000) if value < 1e11 else int(value)
+    if isinstance(value, str):
+        return parse_grafana_time(value)
+    return None
+
+
+def _tags(source, item, *keys):
+    tags = [source]
+    for key in keys:
+        value = item.get(key)
+        if value not in (None, ""):
+            tags.append(str(value))
+    return tags
+
+
+class AnnotationStore:
+    """
+    Time-indexed anomaly and circuit-breaker events plus the intervals
+    already fetched. `refresh_ms` is how close to "now" the covered range
+    must reach before the trailing edge is considered current; events
+    older than `retention_ms` and the oldest beyond `max_events` are
+    evicted on the next ingest.
+    """
+
+    def __init__(self, refresh_ms=30_000, retention_ms=7 * 24 * HOUR_MS, max_events=10_000):
+        self.refresh_ms = refresh_ms
+        self.retention_ms = retention_ms
+        self.max_events = max_events
+        self.covered = IntervalSet()
+        self._times = []
+        self._events = []
+        # Dedup key of each event, in the same order as _times / _events
+        self._event_keys = []
+        self._keys = set()
+        self.evicted = 0
+        self._open_breakers = set()
+        self._breakers_polled_at = None
+        self._lock = threading.Lock()
+
+    def plan(self, from_ms, to_ms, now_ms):
+        """
+        What to fetch before answering [from_ms, to_ms]: returns
+        (anomaly_hours, poll_breakers). `anomaly_hours` is the look-back
+        that reaches the oldest uncovered instant (None if the range is
+        covered); the backend's anomaly window always ends at now.
+        """
+        to_ms = min(to_ms, now_ms)
+        with self._lock:
+            gaps = [
+                (start, end) for start, end in self.covered.missing(from_ms, to_ms)
+                # The slice since the last fetch is current for refresh_ms.
+                if not (start > from_ms and end >= to_ms
+                        and now_ms - start < self.refresh_ms)
+            ]
+            poll_breakers = (
+                to_ms > now_ms - self.refresh_ms
+                and (self._breakers_polled_at is None
+                     or now_ms - self._breakers_polled_at >= self.refresh_ms)
+            )
+
+        if not gaps:
+            return None, poll_breakers
+        oldest = gaps[0][0]
+        return max(1, math.ceil((now_ms - oldest) / HOUR_MS)), poll_breakers
+
+    def _add(self, key, time_ms, event):
+        if key in self._keys:
+            return
+        self._keys.add(key)
+        index = bisect.bisect_right(self._times, time_ms)
+        self._times.insert(index, time_ms)
+        self._events.insert(index, event)
+        self._event_keys.insert(index, key)
+
+    def _evict(self, now_ms):
+        """
+        Drop the events (and coverage) before the retention horizon, then
+        the oldest ones while more than max_events are kept. Runs before
+        an ingest, so the events just fetched answer the current query.
+        """
+        cutoff = now_ms - self.retention_ms
+        excess = len(self._times) - self.max_events
+        if excess > 0:
+            cutoff = max(cutoff, self._times[excess - 1] + 1)
+        drop = bisect.bisect_left(self._times, cutoff)
+        if drop:
+            self._keys.difference_update(self._event_keys[:drop])
+            del self._times[:drop]
+            del self._events[:drop]
+            del self._event_keys[:drop]
+            self.evicted += drop
+        self.covered.trim(cutoff)
+
+    def ingest_anomalies(self, payload, hours, now_ms):
+        """Add anomalies fetched with look-back `hours` and mark it covered"""
+        with self._lock:
+            self._evict(now_ms)
+            for item in _event_list(payload):
+                if not isinstance(item, dict):
+                    continue
+                time_ms = event_time_ms(item)
+                if time_ms is None:
+                    continue
+                kind = item.get("type") or item.get("anomaly_type") or "anomaly"
+                provider = item.get("provider")
+                text = _first(item, _TEXT_KEYS) or kind
+                key = ("anomaly", time_ms, kind, provider, text)
+                self._add(key, time_ms, {
+                    "time": time_ms,
+                    "title": f"{kind}: {provider}" if provider else kind,
+                    "text": str(text),
+                    "tags": _tags("anomaly", item, "severity", "provider", "model"),
+                })
+            self.covered.add(now_ms - hours * HOUR_MS, now_ms)
+
+    def ingest_breakers(self, payload, now_ms):
+        """
+        Record circuit-breaker trips from a status snapshot. A breaker
+        becomes an event when it is first seen open (at its own open time
+        if the backend reports one), and again only after closing.
+        """
+        with self._lock:
+            self._evict(now_ms)
+            now_open = set()
+            for item in _event_list(payload):
+                if not isinstance(item, dict):
+                    continue
+                state = str(item.get("state", "")).upper()
+                if state not in _TRIPPED_STATES:
+                    continue
+                breaker = (item.get("provider"), item.get("model"))
+                now_open.add(breaker)
+                if breaker in self._open_breakers:
+                    continue
+                time_ms = event_time_ms(item) or now_ms
+                name = " / ".join(str(part) for part in breaker if part)
+                self._add(("breaker", breaker, time_ms), time_ms, {
+                    "time": time_ms,
+                    "title": f"Circuit breaker {state}: {name}",
+                    "text": str(_first(item, _TEXT_KEYS) or f"{name} circuit breaker {state}"),
+                    "tags": _tags("circuit_breaker", {"state": state, **item},
+                                  "state", "provider", "model"),
+                })
+            self._open_breakers = now_open
+            self._breakers_polled_at = now_ms
+
+    def range(self, from_ms, to_ms, tags=()):
+        """Events in [from_ms, to_ms] carrying every tag in `tags`"""
+        with self._lock:
+            lo = bisect.bisect_left(self._times, from_ms)
+            hi = bisect.bisect_right(self._times, to_ms)
+            events = self._events[lo:hi]
+        wanted = set(tags)
+        return [event for event in events if wanted.issubset(event["tags"])]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "events": len(self._events),
+                "evicted": self.evicted,
+                "covered": [[start, end] for start, end in self.covered],
+                "open_breakers": len(self._open_breakers),
+            }
@@ -9,49 +9,801 @@ Endpoints:
 - GET / - Health check
 - POST /search - Return available metrics
 - POST /query - Query metrics data
-- POST /annotations - Query annotations (not implemented)
+- POST /annotations - Anomaly and circuit-breaker events as annotations
+- POST /tag-keys, /tag-values - Ad-hoc filter labels for provider metrics
+- GET /stream/monitoring - Live provider health and stats as server-sent events
+- GET /metrics - Prometheus metrics for the proxy itself
+
+This module is the Flask (gunicorn) serving mode. asgi.py serves the same
+endpoints on an asyncio event loop; see SERVER_MODE.
 """
 
+import atexit
+import functools
+import hmac
 import os
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import requests
+
+import metrics
+import serialization
+import snapshot
+from admission import PRIORITY_ALERT, PRIORITY_NORMAL, AdmissionController, RateLimiter, Rejected
+from annotations import AnnotationStore
+from cache import ResponseCache
+from livefeed import HEARTBEAT, RETRY, FeedFull, LiveFeed
+from planner import plan_fetches, fetch_key
+from providers import FilterError, ProviderTable, compile_filters
+from registry import MetricRegistry
+from resilience import UpstreamGuard, hedged_call
+from resultcache import ResultCache, assemble, normalize_query, query_dashboard
+from scheduler import PrefetchScheduler, Schedule
+from sharedcache import SharedCache
+from timeseries import TimeSeriesStore, downsample, parse_grafana_time
+from upstream import build_session, pool_stats
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify() through serialization.dumps (orjson when installed)"""
+
+    def dumps(self, obj, **kwargs):
+        return serialization.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return serialization.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            serialization.dumps(obj, default=self.default), mimetype=self.mimetype
+        )
+
+
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 CORS(app)  # Enable CORS for Grafana
 
+# Responses of at least COMPRESS_MIN_BYTES are compressed (brotli or gzip)
+# for clients that accept it; smaller ones are not worth the CPU.
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+
 # Backend API base URL
 API_BASE_URL = os.getenv("API_BASE_URL", "https://api.gatewayz.ai")
 
-# Metric definitions - maps simple names to backend endpoints
-METRIC_ENDPOINTS = {
-    "avg_health_score": {
-        "url": "/api/monitoring/stats/realtime",
-        "params": {"hours": 1},
-        "path": "avg_health_score",
-    },
-    "total_requests": {
-        "url": "/api/monitoring/stats/realtime",
-        "params": {"hours": 1},
-        "path": "total_requests",
-    },
-    "total_cost": {
-        "url": "/api/monitoring/stats/realtime",
-        "params": {"hours": 1},
-        "path": "total_cost",
-    },
-    "error_rate": {
-        "url": "/api/monitoring/error-rates",
-        "params": {"hours": 24},
-        "path": "overall_error_rate",
-    },
+# "sync" serves this Flask app under gunicorn; "asgi" serves asgi.py under
+# uvicorn, which reuses this module's planning code with an async client.
+SERVER_MODE = os.getenv("SERVER_MODE", "sync")
+
+# Backend fetches for one /query run concurrently on a bounded pool, so a
+# query takes roughly as long as its slowest fetch rather than the sum.
+FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", 8))
+QUERY_DEADLINE_SECONDS = float(os.getenv("QUERY_DEADLINE_SECONDS", 15))
+
+fetch_executor = ThreadPoolExecutor(
+    max_workers=FETCH_MAX_WORKERS, thread_name_prefix="backend-fetch"
+)
+
+# Backend calls share one keep-alive session per worker. Connect and read
+# timeouts are separate so an unreachable host fails fast while slow
+# aggregate endpoints still get time to answer.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", FETCH_MAX_WORKERS))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", 0.2))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+
+http_session = build_session(
+    pool_size=HTTP_POOL_SIZE,
+    retries=HTTP_RETRIES,
+    backoff_factor=HTTP_RETRY_BACKOFF,
+)
+
+# Each backend endpoint has a circuit breaker: after
+# BREAKER_FAILURE_THRESHOLD consecutive failures its calls fail fast for
+# BREAKER_RESET_SECONDS and targets are answered from the last-known-good
+# response, marked stale. With HEDGE_ENABLED, a call still running after
+# the endpoint's recent HEDGE_QUANTILE latency is issued a second time.
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", 30))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", 0.95))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", 0.05))
+
+upstream_guard = UpstreamGuard(
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    reset_seconds=BREAKER_RESET_SECONDS,
+    hedge_quantile=HEDGE_QUANTILE,
+    min_hedge_delay=HEDGE_MIN_DELAY_SECONDS,
+    on_state=metrics.observe_breaker_state,
+)
+# Both attempts of a hedged call run here, so a fetch thread can wait on
+# them without starving the fetch pool.
+hedge_executor = ThreadPoolExecutor(
+    max_workers=FETCH_MAX_WORKERS, thread_name_prefix="backend-hedge"
+)
+
+# Admission control for /query and /annotations. Each client (the first of
+# ADMISSION_KEY_HEADERS present) gets RATE_LIMIT_PER_SECOND requests per
+# second with bursts of RATE_LIMIT_BURST. At most ADMISSION_MAX_INFLIGHT
+# requests run at once per process; up to ADMISSION_MAX_QUEUE more wait
+# ADMISSION_QUEUE_TIMEOUT_SECONDS for a slot, and the rest get 429 with
+# Retry-After. Grafana alert evaluation (FromAlert: true) skips the rate
+# limit and the queue bound and is served before dashboard queries, but
+# only when the request also carries ADMISSION_ALERT_TOKEN in
+# ALERT_TOKEN_HEADER (a custom header on the Grafana data source); any
+# client can send FromAlert itself.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_KEY_HEADERS = [
+    header.strip()
+    for header in os.getenv(
+        "ADMISSION_KEY_HEADERS", "X-Dashboard-Uid,X-Grafana-User,X-Grafana-Org-Id"
+    ).split(",")
+    if header.strip()
+]
+ADMISSION_ALERT_TOKEN = os.getenv("ADMISSION_ALERT_TOKEN", "")
+ALERT_TOKEN_HEADER = "X-Alert-Token"
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", 10))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 40))
+# A gunicorn worker runs GUNICORN_THREADS request threads; the event loop
+# in asgi mode holds far more requests open cheaply.
+ASYNC_MODE = SERVER_MODE == "asgi"
+# Buckets live in each process. gunicorn starts WEB_CONCURRENCY workers
+# (set by the Dockerfile), so each gets its share of RATE_LIMIT_* and the
+# limit holds per container rather than per worker.
+ADMISSION_PROCESSES = 1 if ASYNC_MODE else max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", 64 if ASYNC_MODE else 4))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 256 if ASYNC_MODE else 8))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", 5))
+
+admission = AdmissionController(
+    limiter=RateLimiter(
+        RATE_LIMIT_PER_SECOND / ADMISSION_PROCESSES,
+        max(1.0, RATE_LIMIT_BURST / ADMISSION_PROCESSES),
+    ),
+    max_inflight=ADMISSION_MAX_INFLIGHT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    on_decision=metrics.observe_admission,
+)
+
+# Backend responses are cached per (url, params). `ttl` on a metric sets how
+# long its response is fresh; stale entries are served for up to
+# CACHE_STALE_SECONDS more while a background refresh runs.
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 30))
+CACHE_STALE_SECONDS = float(os.getenv("CACHE_STALE_SECONDS", 120))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 256))
+
+# In sync mode the gunicorn workers of one container share fetched
+# responses through a memory-mapped slot table, so each endpoint is
+# fetched once per TTL per container rather than once per worker.
+SHARED_CACHE_ENABLED = os.getenv("SHARED_CACHE_ENABLED", "true").lower() == "true"
+SHARED_CACHE_PATH = os.getenv(
+    "SHARED_CACHE_PATH",
+    "/dev/shm/json-api-proxy-cache" if os.path.isdir("/dev/shm") else "/tmp/json-api-proxy-cache",
+)
+SHARED_CACHE_SLOTS = int(os.getenv("SHARED_CACHE_SLOTS", 64))
+SHARED_CACHE_SLOT_BYTES = int(os.getenv("SHARED_CACHE_SLOT_BYTES", 256 * 1024))
+
+shared_cache = None
+if SHARED_CACHE_ENABLED and SERVER_MODE == "sync":
+    shared_cache = SharedCache(
+        SHARED_CACHE_PATH,
+        slots=SHARED_CACHE_SLOTS,
+        slot_bytes=SHARED_CACHE_SLOT_BYTES,
+        on_lookup=metrics.observe_shared_cache_lookup,
+    )
+
+# Stale-entry refreshes run on their own pool: queued behind fetch
+# workers that wait on them, they would never run. Waiters also give up
+# after CACHE_WAIT_SECONDS and fetch directly.
+CACHE_REFRESH_WORKERS = int(os.getenv("CACHE_REFRESH_WORKERS", 4))
+CACHE_WAIT_SECONDS = float(os.getenv("CACHE_WAIT_SECONDS", QUERY_DEADLINE_SECONDS))
+
+refresh_executor = ThreadPoolExecutor(
+    max_workers=CACHE_REFRESH_WORKERS, thread_name_prefix="cache-refresh"
+)
+
+response_cache = ResponseCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    stale_seconds=CACHE_STALE_SECONDS,
+    refresh_executor=refresh_executor,
+    wait_seconds=CACHE_WAIT_SECONDS,
+    on_lookup=metrics.observe_cache_lookup,
+    shared=shared_cache,
+)
+
+# Every backend refresh records a sample per metric into a ring buffer so
+# /query can answer time ranges with history. 2880 points at 24s is ~19h.
+TIMESERIES_RETENTION_POINTS = int(os.getenv("TIMESERIES_RETENTION_POINTS", 2880))
+
+timeseries_store = TimeSeriesStore(TIMESERIES_RETENTION_POINTS)
+
+# Encoded /query responses are cached for RESULT_CACHE_TTL_SECONDS under
+# the normalized request (sorted targets, range aligned to intervalMs, or
+# to RESULT_CACHE_ALIGN_MS without one), so viewers of one dashboard share
+# a response without fetching or encoding it again.
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", 5))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 512))
+RESULT_CACHE_ALIGN_MS = int(os.getenv("RESULT_CACHE_ALIGN_MS", 1000))
+RESULT_CACHE_MAX_DASHBOARDS = int(os.getenv("RESULT_CACHE_MAX_DASHBOARDS", 100))
+
+result_cache = ResultCache(
+    ttl=RESULT_CACHE_TTL_SECONDS,
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    on_lookup=metrics.observe_result_cache_lookup,
+    max_dashboards=RESULT_CACHE_MAX_DASHBOARDS,
+)
+
+# Each backend endpoint is refreshed in the background every
+# `refresh_interval` seconds (default: 80% of its TTL, so cached responses
+# never go stale), keeping /query on the warm cache.
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_MAX_CONCURRENCY = int(os.getenv("PREFETCH_MAX_CONCURRENCY", 4))
+PREFETCH_JITTER = float(os.getenv("PREFETCH_JITTER", 0.1))
+PREFETCH_MAX_BACKOFF_SECONDS = float(os.getenv("PREFETCH_MAX_BACKOFF_SECONDS", 300))
+
+# The response cache and sampled history are written to SNAPSHOT_PATH every
+# SNAPSHOT_INTERVAL_SECONDS and on shutdown, and read back at startup, so a
+# restart answers from the last state instead of a cold cache. Snapshots
+# older than SNAPSHOT_MAX_AGE_SECONDS are ignored.
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "true").lower() == "true"
+SNAPSHOT_PATH = os.getenv(
+    "SNAPSHOT_PATH",
+    os.path.join("/data" if os.path.isdir("/data") else "/tmp", "json-api-proxy-snapshot.bin"),
+)
+SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_INTERVAL_SECONDS", 60))
+SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", 3600))
+
+# Per-provider metrics all come from one Prometheus exposition endpoint,
+# parsed once per fetch into a ProviderTable (see providers.py).
+PROVIDER_METRICS_URL = "/prometheus/data/metrics"
+PROVIDER_METRICS_TTL = 30
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# Annotations come from backend anomaly and circuit-breaker events. Time
+# ranges already fetched are answered from memory; only the uncovered slice
+# (usually the last refresh interval) is requested from the backend.
+ANOMALIES_URL = "/api/monitoring/anomalies"
+CIRCUIT_BREAKERS_URL = "/api/monitoring/circuit-breakers"
+ANNOTATIONS_REFRESH_SECONDS = float(os.getenv("ANNOTATIONS_REFRESH_SECONDS", 30))
+ANNOTATIONS_DEFAULT_RANGE_MS = 6 * 3_600_000
+ANNOTATIONS_RETENTION_HOURS = float(os.getenv("ANNOTATIONS_RETENTION_HOURS", 168))
+ANNOTATIONS_MAX_EVENTS = int(os.getenv("ANNOTATIONS_MAX_EVENTS", 10_000))
+
+annotation_store = AnnotationStore(
+    refresh_ms=int(ANNOTATIONS_REFRESH_SECONDS * 1000),
+    retention_ms=int(ANNOTATIONS_RETENTION_HOURS * 3_600_000),
+    max_events=ANNOTATIONS_MAX_EVENTS,
+)
+# One annotation update at a time; concurrent dashboards wait for it and
+# are then answered from the index.
+annotation_fetch_lock = threading.Lock()
+
+# Metric definitions - map Grafana target names to backend endpoints. They
+# live in metric_definitions.yml and are reloaded when the file changes,
+# checked at most every METRIC_REGISTRY_POLL_SECONDS.
+METRIC_REGISTRY_PATH = os.getenv(
+    "METRIC_REGISTRY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "metric_definitions.yml"),
+)
+METRIC_REGISTRY_POLL_SECONDS = float(os.getenv("METRIC_REGISTRY_POLL_SECONDS", 5))
+
+
+def apply_registry_change(changed):
+    """Re-plan prefetching and drop history of metrics that changed"""
+    global prefetch_plan, prefetch_ttls
+    timeseries_store.discard(changed)
+    prefetch_plan = sampling_plan()
+    prefetch_ttls = plan_ttls(prefetch_plan)
+    prefetch_schedule.update(prefetch_intervals(prefetch_plan))
+    prefetch_scheduler.wake()
+
+
+metric_registry = MetricRegistry(
+    METRIC_REGISTRY_PATH,
+    table_url=PROVIDER_METRICS_URL,
+    poll_seconds=METRIC_REGISTRY_POLL_SECONDS,
+    on_change=apply_registry_change,
+)
+
+PROVIDER_FETCH_KEY = fetch_key({"url": PROVIDER_METRICS_URL})
+
+
+def fetch_backend(endpoint, params):
+    """
+    Fetch one backend endpoint through its circuit breaker and return its
+    decoded body. Raises CircuitOpenError without a backend call while the
+    breaker is open.
+    """
+    with metrics.track_fetch(endpoint), upstream_guard.call(endpoint):
+        delay = upstream_guard.hedge_delay(endpoint) if HEDGE_ENABLED else None
+        if delay is None:
+            return request_backend(endpoint, params)
+
+        value, winner = hedged_call(
+            lambda: request_backend(endpoint, params), delay, hedge_executor
+        )
+        if winner is not None:
+            metrics.HEDGED_REQUESTS.labels(endpoint, winner).inc()
+        return value
+
+
+def request_backend(endpoint, params):
+    """One backend GET, decoded"""
+    url = f"{API_BASE_URL}{endpoint}"
+    if endpoint == PROVIDER_METRICS_URL:
+        return fetch_provider_table(url, params)
+
+    response = http_session.get(
+        url,
+        params=dict(params),
+        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+    )
+    response.raise_for_status()
+    metrics.BACKEND_RESPONSE_BYTES.labels(endpoint).observe(len(response.content))
+    return response.json()
+
+
+def fetch_provider_table(url, params):
+    """
+    Stream the provider exposition into a ProviderTable line by line, so
+    the body is never held in memory as a whole.
+    """
+    with http_session.get(
+        url,
+        params=dict(params),
+        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        stream=True,
+    ) as response:
+        response.raise_for_status()
+        table = ProviderTable.from_lines(response.iter_lines(chunk_size=STREAM_CHUNK_BYTES))
+    metrics.BACKEND_RESPONSE_BYTES.labels(PROVIDER_METRICS_URL).observe(table.source_bytes)
+    return table
+
+
+def fetch_cached(endpoint, params, ttl=None):
+    """Fetch one backend endpoint through the shared response cache"""
+    return response_cache.get(
+        (endpoint, params),
+        lambda: fetch_backend(endpoint, params),
+        CACHE_TTL_SECONDS if ttl is None else ttl,
+    )
+
+
+def plan_ttls(plan):
+    """Cache TTL per fetch key: the shortest TTL of the metrics sharing it"""
+    return {
+        key: min(config.get("ttl", CACHE_TTL_SECONDS) for _, _, config in metrics)
+        for key, metrics in plan.items()
+    }
+
+
+def fetch_all(keys, deadline_seconds=None, ttls=None):
+    """
+    Fetch every (endpoint, params) key concurrently through the cache.
+
+    Returns a dict of key -> (backend_data, error). Fetches still running
+    when the per-query deadline expires are reported as TimeoutError; they
+    are left to finish in the background rather than blocking the worker.
+    """
+    if deadline_seconds is None:
+        deadline_seconds = QUERY_DEADLINE_SECONDS
+    ttls = ttls or {}
+
+    futures = {
+        fetch_executor.submit(
+            fetch_cached, endpoint, params, ttls.get((endpoint, params))
+        ): (endpoint, params)
+        for endpoint, params in keys
+    }
+    done, _ = wait(futures, timeout=deadline_seconds)
+
+    results = {}
+    for future, key in futures.items():
+        if future not in done:
+            future.cancel()
+            results[key] = (
+                None,
+                TimeoutError(f"query deadline of {deadline_seconds}s exceeded"),
+            )
+        elif future.exception() is not None:
+            results[key] = (None, future.exception())
+        else:
+            results[key] = (future.result(), None)
+
+    return results
+
+
+def prepare_query(data):
+    """
+    Plan a Grafana /query body.
+
+    Targets with sampled history inside the requested range are answered
+    from their ring buffer, downsampled to maxDataPoints / intervalMs.
+    Returns (plan, results): the fetch plan for targets that still need a
+    live backend value, and a dict of position -> series already answered.
+    Raises FilterError for ad-hoc filters that cannot be evaluated, before
+    anything is fetched.
+    """
+    compile_filters(data.get("adhocFilters"))
+    targets = data.get("targets", [])
+    range_data = data.get("range", {})
+    from_ms = parse_grafana_time(range_data.get("from"))
+    to_ms = parse_grafana_time(range_data.get("to"))
+    max_points = data.get("maxDataPoints")
+    interval_ms = data.get("intervalMs")
+
+    metric_registry.maybe_reload()
+    plan, unknown = plan_fetches(targets, metric_registry.metrics)
+    for metric_name in unknown:
+        logger.warning(f"Unknown metric: {metric_name}")
+
+    results = {}
+    if from_ms is None or to_ms is None:
+        return plan, results
+
+    for key in list(plan):
+        live = []
+        for position, metric_name, metric_config in plan[key]:
+            history = timeseries_store.range(metric_name, from_ms, to_ms)
+            if history:
+                results[position] = [{
+                    "target": metric_name,
+                    "datapoints": downsample(history, max_points, interval_ms),
+                }]
+            else:
+                live.append((position, metric_name, metric_config))
+        if live:
+            plan[key] = live
+        else:
+            del plan[key]
+
+    return plan, results
+
+
+def provider_results(table, metric_config, filters, timestamp_ms):
+    """
+    Answer a provider target: one series per provider named after the
+    provider, or the whole table for `provider_table`. Only providers
+    matching the ad-hoc filters are included.
+    """
+    rows = table.select(filters)
+    column = metric_config["column"]
+    if column is None:
+        return [table.as_table(rows)]
+    return [
+        {"target": provider, "datapoints": [[value, timestamp_ms]]}
+        for provider, value in table.column(column, rows)
+    ]
+
+
+def last_known_good(key, cache=None):
+    """
+    (backend_data, age_seconds) of the last successful fetch of `key`, or
+    None. The cache keeps an entry until it is replaced or evicted, so a
+    failed refresh leaves the previous response in place.
+    """
+    return (cache or response_cache).peek(key)
+
+
+def mark_stale(series, age_seconds):
+    """Tag series answered from a last-known-good response"""
+    for item in series:
+        item["meta"] = {"stale": True, "age_seconds": round(age_seconds, 1)}
+    return series
+
+
+def complete_query(plan, fetched, results, filters=None, cache=None):
+    """
+    Add a live datapoint for every planned target from the fetched backend
+    responses and return the series in target order. `filters` are the
+    query's Grafana ad-hoc filters, applied to provider targets.
+
+    A failed fetch is answered from the last-known-good response in
+    `cache` (default: response_cache), with every series marked stale;
+    without one its targets return no datapoints.
+    """
+    for key, metrics_for_key in plan.items():
+        backend_data, error = fetched[key]
+        stale_age = None
+        if error is not None:
+            fallback = last_known_good(key, cache)
+            if fallback is not None:
+                backend_data, stale_age = fallback
+                logger.warning(
+                    f"Serving {key[0]} from a {stale_age:.0f}s old response: {error}"
+                )
+                metrics.STALE_RESPONSES.labels(key[0]).inc()
+                error = None
+
+        # Create datapoint with current timestamp
+        timestamp_ms = int(datetime.now().timestamp() * 1000)
+
+        for position, metric_name, metric_config in metrics_for_key:
+            if error is not None:
+                logger.error(f"Error fetching {metric_name}: {error}")
+                # No datapoint rather than a misleading zero
+                results[position] = [] if "column" in metric_config else [{
+                    "target": metric_name,
+                    "datapoints": [],
+                }]
+                continue
+
+            if "column" in metric_config:
+                results[position] = provider_results(
+                    backend_data, metric_config, filters, timestamp_ms
+                )
+                if stale_age is not None:
+                    mark_stale(results[position], stale_age)
+                continue
+
+            try:
+                value = metric_config["extract"](backend_data)
+            except (TypeError, ValueError) as e:
+                logger.error(f"Error extracting {metric_name}: {e}")
+                value = 0.0
+            logger.info(f"Metric {metric_name}: {value}")
+
+            results[position] = [{
+                "target": metric_name,
+                "datapoints": [[value, timestamp_ms]],
+            }]
+            if stale_age is not None:
+                mark_stale(results[position], stale_age)
+
+    return [series for position in sorted(results) for series in results[position]]
+
+
+def result_lookup(data):
+    """
+    Look a /query body up in the result cache. Returns (data, key, order,
+    body): `data` with its range aligned to the cache key, the key (None
+    with RESULT_CACHE_ENABLED off), the requested target names in order,
+    and the cached response body or None.
+    """
+    if not RESULT_CACHE_ENABLED:
+        return data, None, [target.get("target") for target in data.get("targets", [])], None
+    key, order, data = normalize_query(data, metric_registry.version, RESULT_CACHE_ALIGN_MS)
+    segments = result_cache.get(key, query_dashboard(data))
+    return data, key, order, None if segments is None else assemble(segments, order)
+
+
+def encode_result(data, key, order, fetched, results):
+    """
+    Encode the series complete_query() answered for each target into the
+    response body. The encoded series are cached under `key` unless a
+    fetch failed, so errors and stale fallbacks are not repeated from cache.
+    """
+    targets = data.get("targets", [])
+    segments = {
+        targets[position].get("target"): b",".join(map(serialization.dumps, series))
+        for position, series in results.items()
+    }
+    if key is not None and all(error is None for _, error in fetched.values()):
+        result_cache.put(key, segments)
+    return assemble(segments, order)
+
+
+def sampling_plan():
+    """Fetch plan covering every defined metric"""
+    metrics_by_name = metric_registry.metrics
+    targets = [{"target": name} for name in metrics_by_name]
+    plan, _ = plan_fetches(targets, metrics_by_name)
+    return plan
+
+
+def prefetch_intervals(plan):
+    """Refresh interval per fetch key: the shortest of its metrics"""
+    intervals = {}
+    for key, metrics in plan.items():
+        intervals[key] = min(
+            config.get("refresh_interval", 0.8 * config.get("ttl", CACHE_TTL_SECONDS))
+            for _, _, config in metrics
+        )
+    return intervals
+
+
+def record_samples(plan, fetched):
+    """Record the fetched value of every planned metric into its ring buffer"""
+    timestamp_ms = int(datetime.now().timestamp() * 1000)
+
+    for key, metrics in plan.items():
+        backend_data, error = fetched[key]
+        if error is not None:
+            continue
+        for _, metric_name, metric_config in metrics:
+            if "path" not in metric_config:
+                continue
+            try:
+                value = metric_config["extract"](backend_data)
+            except (TypeError, ValueError):
+                continue
+            timeseries_store.record(metric_name, timestamp_ms, value)
+
+
+prefetch_plan = sampling_plan()
+prefetch_ttls = plan_ttls(prefetch_plan)
+prefetch_schedule = Schedule(
+    prefetch_intervals(prefetch_plan),
+    jitter=PREFETCH_JITTER,
+    max_backoff=PREFETCH_MAX_BACKOFF_SECONDS,
+)
+
+
+def prefetch(key):
+    """Refresh one fetch key into the cache and record its samples"""
+    metric_registry.maybe_reload()
+    endpoint, params = key
+    # Every worker runs the schedule; a refresh another worker made within
+    # this job's interval is taken from the shared tier instead.
+    backend_data = response_cache.refresh(
+        key,
+        lambda: fetch_backend(endpoint, params),
+        prefetch_ttls[key],
+        max_age=prefetch_schedule.interval(key),
+    )
+    record_samples({key: prefetch_plan[key]}, {key: (backend_data, None)})
+    record_prefetch_lag(key)
+
+
+def record_prefetch_lag(key):
+    """Export the scheduler's lag for `key` as a gauge"""
+    lag = prefetch_schedule.stats()[key]["lag_seconds"]
+    metrics.PREFETCH_LAG.labels(key[0]).set(lag)
+
+
+prefetch_scheduler = PrefetchScheduler(
+    prefetch_schedule,
+    prefetch,
+    fetch_executor,
+    max_concurrency=PREFETCH_MAX_CONCURRENCY,
+)
+
+
+def save_snapshot(cache=None):
+    """Write the response cache and sampled history to SNAPSHOT_PATH"""
+    size = snapshot.write(
+        SNAPSHOT_PATH, (cache or response_cache).entries(), timeseries_store.export()
+    )
+    logger.info(f"Wrote {size} byte snapshot to {SNAPSHOT_PATH}")
+
+
+def restore_snapshot(cache=None):
+    """
+    Load SNAPSHOT_PATH into the response cache and history buffers.
+
+    Responses are restored with their real age, but at most just past
+    their TTL: an old response is served immediately while it refreshes
+    instead of the first query waiting on the backend. Prefetch jobs
+    whose responses are still fresh are held back until they are due.
+    """
+    state = snapshot.read(SNAPSHOT_PATH)
+    if state is None:
+        return
+    if state.age > SNAPSHOT_MAX_AGE_SECONDS:
+        logger.info(f"Ignoring {state.age:.0f}s old snapshot {SNAPSHOT_PATH}")
+        return
+
+    cache = cache or response_cache
+    for key, value, age, ttl in state.cache:
+        cache.restore(key, value, ttl, min(age, ttl))
+        if key in prefetch_ttls:
+            prefetch_schedule.defer(key, age)
+
+    defined = metric_registry.metrics
+    for name, (timestamps, values) in state.series.items():
+        if name in defined:
+            timeseries_store.restore(name, timestamps, values)
+
+    logger.info(
+        f"Restored {len(state.cache)} responses and {len(state.series)} series "
+        f"from a {state.age:.0f}s old snapshot"
+    )
+
+
+snapshot_writer = snapshot.SnapshotWriter(save_snapshot, SNAPSHOT_INTERVAL_SECONDS)
+
+# The monitoring tool subscribes to /stream/monitoring instead of polling
+# the backend from every tab: while anyone is subscribed, each process
+# polls LIVE_FEED_SOURCES once per LIVE_FEED_INTERVAL_SECONDS and pushes
+# the changes to all of its viewers. In sync mode every open stream holds
+# a request thread, so LIVE_FEED_MAX_SUBSCRIBERS stays below
+# GUNICORN_THREADS; asgi mode holds streams as coroutines.
+LIVE_FEED_INTERVAL_SECONDS = float(os.getenv("LIVE_FEED_INTERVAL_SECONDS", 10))
+LIVE_FEED_MAX_SUBSCRIBERS = int(os.getenv("LIVE_FEED_MAX_SUBSCRIBERS", 1000 if ASYNC_MODE else 8))
+LIVE_FEED_HEARTBEAT_SECONDS = float(os.getenv("LIVE_FEED_HEARTBEAT_SECONDS", 15))
+LIVE_FEED_SOURCES = {
+    "health": ("/api/monitoring/health", ()),
+    "realtime": ("/api/monitoring/stats/realtime", ()),
 }
+# Provider lists are sent keyed by provider, so deltas carry only the
+# providers that changed.
+LIVE_FEED_INDEX = {"health": "provider"}
+LIVE_FEED_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+live_feed = LiveFeed(
+    LIVE_FEED_SOURCES,
+    lambda endpoint, params: fetch_backend(endpoint, params),
+    interval=LIVE_FEED_INTERVAL_SECONDS,
+    index=LIVE_FEED_INDEX,
+    max_subscribers=LIVE_FEED_MAX_SUBSCRIBERS,
+    on_event=metrics.observe_live_feed_event,
+)
+
+
+def admission_key(header):
+    """Rate-limit key: the first ADMISSION_KEY_HEADERS header present"""
+    for name in ADMISSION_KEY_HEADERS:
+        value = header(name)
+        if value:
+            return f"{name.lower()}={value}"
+    return "anonymous"
+
+
+def admission_priority(header):
+    """
+    Alert rule evaluations are sent by Grafana with `FromAlert: true`. The
+    header is only trusted next to the configured ADMISSION_ALERT_TOKEN;
+    without a token configured, no request is prioritized.
+    """
+    if (header("FromAlert") or "").lower() != "true" or not ADMISSION_ALERT_TOKEN:
+        return PRIORITY_NORMAL
+    token = header(ALERT_TOKEN_HEADER) or ""
+    if hmac.compare_digest(token.encode(), ADMISSION_ALERT_TOKEN.encode()):
+        return PRIORITY_ALERT
+    return PRIORITY_NORMAL
+
+
+def admitted(view):
+    """Run a view through admission control; 429 with Retry-After if shed"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMISSION_ENABLED:
+            return view(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            with admission.admit(admission_key(request.headers.get),
+                                 admission_priority(request.headers.get)):
+                metrics.ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - start)
+                return view(*args, **kwargs)
+        except Rejected as e:
+            response = jsonify({"error": str(e)})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response
+    return wrapper
+
+
+@app.after_request
+def compress_response(response):
+    """Compress the body for the client's Accept-Encoding"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    body, encoding = serialization.encode_body(
+        body, request.headers.get("Accept-Encoding"), COMPRESS_MIN_BYTES
+    )
+    if encoding is not None:
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
 
 
 @app.route("/")
@@ -60,6 +812,38 @@ def health():
     return jsonify({"status": "ok", "message": "JSON API Proxy is running"})
 
 
+@app.route("/debug/pool")
+def debug_pool():
+    """Connection pool, cache and breaker stats for the backend session"""
+    return jsonify({
+        "pool_size": HTTP_POOL_SIZE,
+        "hosts": pool_stats(http_session),
+        "cache": response_cache.stats(),
+        "shared_cache": shared_cache.stats() if shared_cache else None,
+        "annotations": annotation_store.stats(),
+        "breakers": upstream_guard.stats(),
+        "admission": admission.stats(),
+        "result_cache": result_cache.stats(),
+        "live_feed": live_feed.stats(),
+    })
+
+
+@app.route("/debug/scheduler")
+def debug_scheduler():
+    """Prefetch job state: interval, lag, age of last refresh, failures"""
+    return jsonify([
+        {"url": key[0], "params": dict(key[1]), **state}
+        for key, state in prefetch_schedule.stats().items()
+    ])
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus exposition of the proxy's own metrics"""
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
+
 @app.route("/search", methods=["POST"])
 def search():
     """
@@ -68,13 +852,13 @@ def search():
     """
     logger.info("Search request received")
 
-    # Return list of available metrics
-    metrics = list(METRIC_ENDPOINTS.keys())
-
-    return jsonify(metrics)
+    # Return list of available metrics, encoded when the registry loaded
+    metric_registry.maybe_reload()
+    return Response(metric_registry.search_body, mimetype="application/json")
 
 
 @app.route("/query", methods=["POST"])
+@admitted
 def query():
     """
     Query endpoint for fetching metric data.
@@ -87,9 +871,15 @@ def query():
         "range": {
             "from": "2024-01-01T00:00:00.000Z",
             "to": "2024-01-01T12:00:00.000Z"
-        }
+        },
+        "maxDataPoints": 500,
+        "intervalMs": 30000
     }
 
+    Metrics with sampled history inside the range return every sample,
+    downsampled to maxDataPoints / intervalMs. Metrics without history
+    fall back to a single live datapoint at the current time.
+
     Response format:
     [
         {
@@ -98,91 +888,175 @@ def query():
         }
     ]
     """
-    try:
-        data = request.json
-        logger.info(f"Query request: {data}")
+    with metrics.QUERY_INFLIGHT.track_inprogress(), metrics.QUERY_DURATION.time():
+        try:
+            data = request.json
+            logger.info(f"Query request: {data}")
 
-        targets = data.get("targets", [])
-        range_data = data.get("range", {})
+            data, key, order, body = result_lookup(data)
+            if body is None:
+                plan, results = prepare_query(data)
 
-        results = []
+                # One backend call per unique (url, params), issued
+                # concurrently; every metric sharing that endpoint is
+                # extracted from the same response.
+                fetched = fetch_all(plan.keys(), ttls=plan_ttls(plan))
 
-        for target in targets:
-            metric_name = target.get("target")
+                complete_query(plan, fetched, results, data.get("adhocFilters"))
+                body = encode_result(data, key, order, fetched, results)
 
-            if metric_name not in METRIC_ENDPOINTS:
-                logger.warning(f"Unknown metric: {metric_name}")
-                continue
+            metrics.QUERY_RESPONSE_BYTES.observe(len(body))
+            return Response(body, mimetype="application/json")
 
-            metric_config = METRIC_ENDPOINTS[metric_name]
+        except FilterError as e:
+            logger.warning(f"Query rejected: {e}")
+            return jsonify({"error": str(e)}), 400
+        except Exception as e:
+            logger.error(f"Query error: {e}", exc_info=True)
+            metrics.count_error("query", e)
+            return jsonify({"error": str(e)}), 500
 
-            # Build API URL
-            url = f"{API_BASE_URL}{metric_config['url']}"
-            params = metric_config.get("params", {})
 
-            # Make request to backend
-            try:
-                response = requests.get(url, params=params, timeout=10)
-                response.raise_for_status()
-                backend_data = response.json()
+def annotation_request(data):
+    """(from_ms, to_ms, tags, now_ms) for a Grafana /annotations body"""
+    now_ms = int(datetime.now().timestamp() * 1000)
+    range_data = data.get("range") or {}
+    to_ms = parse_grafana_time(range_data.get("to")) or now_ms
+    from_ms = parse_grafana_time(range_data.get("from")) or to_ms - ANNOTATIONS_DEFAULT_RANGE_MS
+    # The annotation query narrows events by tag, e.g. "circuit_breaker openrouter".
+    query = (data.get("annotation") or {}).get("query") or ""
+    return from_ms, to_ms, query.split(), now_ms
 
-                # Extract value using path
-                value = backend_data
-                for key in metric_config["path"].split("."):
-                    value = value.get(key, 0)
 
-                # Convert to float
-                value = float(value) if value is not None else 0.0
+def annotation_results(data, events):
+    """SimpleJSON annotation response for the stored events"""
+    annotation = data.get("annotation")
+    return [{"annotation": annotation, **event} for event in events]
 
-                # Create datapoint with current timestamp
-                timestamp_ms = int(datetime.now().timestamp() * 1000)
 
-                results.append(
-                    {"target": metric_name, "datapoints": [[value, timestamp_ms]]}
-                )
+def update_annotations(from_ms, to_ms, now_ms):
+    """Fetch the anomalies and breaker states the store has not covered yet"""
+    with annotation_fetch_lock:
+        hours, poll_breakers = annotation_store.plan(from_ms, to_ms, now_ms)
+        anomalies = breakers = None
+        if hours is not None:
+            anomalies = fetch_executor.submit(fetch_backend, ANOMALIES_URL, (("hours", hours),))
+        if poll_breakers:
+            breakers = fetch_executor.submit(fetch_backend, CIRCUIT_BREAKERS_URL, ())
 
-                logger.info(f"Metric {metric_name}: {value}")
+        try:
+            if anomalies is not None:
+                annotation_store.ingest_anomalies(anomalies.result(), hours, now_ms)
+        except Exception as e:
+            logger.error(f"Error fetching anomalies: {e}")
+        try:
+            if breakers is not None:
+                annotation_store.ingest_breakers(breakers.result(), now_ms)
+        except Exception as e:
+            logger.error(f"Error fetching circuit breakers: {e}")
 
-            except Exception as e:
-                logger.error(f"Error fetching {metric_name}: {e}")
-                # Return 0 on error
-                timestamp_ms = int(datetime.now().timestamp() * 1000)
-                results.append(
-                    {"target": metric_name, "datapoints": [[0.0, timestamp_ms]]}
-                )
 
-        return jsonify(results)
+@app.route("/annotations", methods=["POST"])
+@admitted
+def annotations():
+    """
+    Anomaly and circuit-breaker trip events inside the dashboard range.
 
-    except Exception as e:
-        logger.error(f"Query error: {e}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+    Expected request format from Grafana:
+    {
+        "range": {"from": "...", "to": "..."},
+        "annotation": {"name": "Anomalies", "query": "anomaly openrouter"}
+    }
 
+    Every word of the annotation query must be one of the event's tags
+    (`anomaly` / `circuit_breaker`, provider, model, severity or state).
+    """
+    data = request.get_json(silent=True) or {}
+    from_ms, to_ms, tags, now_ms = annotation_request(data)
+    update_annotations(from_ms, to_ms, now_ms)
+    return jsonify(annotation_results(data, annotation_store.range(from_ms, to_ms, tags)))
 
-@app.route("/annotations", methods=["POST"])
-def annotations():
+
+def live_events(subscription):
+    """Server-sent event stream for one live feed subscription"""
+    yield RETRY
+    while True:
+        events = subscription.drain()
+        if events:
+            yield b"".join(events)
+        elif not subscription.wait(LIVE_FEED_HEARTBEAT_SECONDS):
+            yield HEARTBEAT
+
+
+@app.route("/stream/monitoring")
+def stream_monitoring():
     """
-    Annotations endpoint (not implemented).
-    Returns empty list.
+    Live provider health and realtime stats (see livefeed.py): a
+    `snapshot` event, then a `delta` merge patch whenever they change.
     """
-    return jsonify([])
+    try:
+        subscription = live_feed.subscribe()
+    except FeedFull as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(int(live_feed.interval))
+        return response
+    metrics.LIVE_FEED_SUBSCRIBERS.inc()
+
+    def close():
+        subscription.close()
+        metrics.LIVE_FEED_SUBSCRIBERS.dec()
+
+    response = Response(
+        live_events(subscription), mimetype="text/event-stream", headers=LIVE_FEED_HEADERS
+    )
+    response.call_on_close(close)
+    return response
+
+
+def provider_table():
+    """The cached provider table, or None if the backend is unreachable"""
+    try:
+        return fetch_cached(*PROVIDER_FETCH_KEY, ttl=PROVIDER_METRICS_TTL)
+    except Exception as e:
+        logger.error(f"Error fetching provider metrics: {e}")
+        return None
+
+
+def tag_key_list(table):
+    return [{"type": "string", "text": key} for key in table.tag_keys()] if table else []
+
+
+def tag_value_list(table, key):
+    return [{"text": value} for value in table.tag_values(key)] if table else []
 
 
 @app.route("/tag-keys", methods=["POST"])
 def tag_keys():
     """
-    Return available tag keys (not implemented).
-    Returns empty list.
+    Return the labels of provider metrics, for Grafana ad-hoc filters.
     """
-    return jsonify([])
+    return jsonify(tag_key_list(provider_table()))
 
 
 @app.route("/tag-values", methods=["POST"])
 def tag_values():
     """
-    Return available tag values (not implemented).
-    Returns empty list.
+    Return the values of one provider metric label.
+
+    Expected request format: {"key": "provider"}
     """
-    return jsonify([])
+    data = request.get_json(silent=True) or {}
+    return jsonify(tag_value_list(provider_table(), data.get("key")))
+
+
+if SNAPSHOT_ENABLED and SERVER_MODE == "sync":
+    restore_snapshot()
+    snapshot_writer.start()
+    atexit.register(snapshot_writer.flush)
+
+if PREFETCH_ENABLED and SERVER_MODE == "sync":
+    prefetch_scheduler.start()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,563 @@
+"""
+ASGI serving mode for the JSON API Proxy.
+
+Same SimpleJSON contract as the Flask app (`/`, `/search`, `/query`,
+`/annotations`, `/tag-keys`, `/tag-values`, `/metrics`, `/debug/pool`,
+`/debug/scheduler`, and the `/stream/monitoring` event stream), served on a
+single asyncio event loop with an async HTTP client. A slow backend call
+only parks a coroutine instead of a gunicorn worker, so one process can
+hold hundreds of in-flight Grafana queries.
+
+Query planning, history lookups and response assembly are shared with
+app.py; only the transport and the cache front-end differ.
+
+Run with:
+    SERVER_MODE=asgi uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+os.environ.setdefault("SERVER_MODE", "asgi")
+
+import app as core  # noqa: E402
+import metrics  # noqa: E402
+import serialization  # noqa: E402
+import snapshot  # noqa: E402
+from admission import Rejected  # noqa: E402
+from cache import AsyncResponseCache  # noqa: E402
+from livefeed import HEARTBEAT, RETRY, FeedFull  # noqa: E402
+from providers import FilterError, ProviderTable  # noqa: E402
+from resilience import hedged_call_async  # noqa: E402
+
+logger = logging.getLogger(__name__)
+# httpx logs every request at INFO; keep the proxy's own logs readable.
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# The event loop multiplexes all in-flight fetches, so the connection
+# limit, not a worker count, bounds backend concurrency.
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", 100))
+ASYNC_HTTP_MAX_KEEPALIVE = int(os.getenv("ASYNC_HTTP_MAX_KEEPALIVE", ASYNC_HTTP_MAX_CONNECTIONS))
+
+response_cache = AsyncResponseCache(
+    max_entries=core.CACHE_MAX_ENTRIES,
+    stale_seconds=core.CACHE_STALE_SECONDS,
+    on_lookup=metrics.observe_cache_lookup,
+)
+
+http_client = None
+
+# Snapshots of this module's cache (see app.restore_snapshot); written from
+# a thread, as the cache's lock is a threading lock.
+snapshot_writer = snapshot.SnapshotWriter(
+    lambda: core.save_snapshot(response_cache), core.SNAPSHOT_INTERVAL_SECONDS
+)
+
+
+def build_client():
+    """Async client with keep-alive pooling and split connect/read timeouts"""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=ASYNC_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_HTTP_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(
+            core.HTTP_READ_TIMEOUT,
+            connect=core.HTTP_CONNECT_TIMEOUT,
+        ),
+        # httpx transports only retry failed connection attempts.
+        transport=httpx.AsyncHTTPTransport(retries=core.HTTP_RETRIES),
+    )
+
+
+def client_pool_stats(client):
+    """
+    Summarise the async client's connection pool, per host as in
+    upstream.pool_stats: `open` connections and the `idle` ones among them
+    """
+    hosts = {}
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    for connection in getattr(pool, "connections", []):
+        origin = getattr(connection, "_origin", None)
+        if origin is None:
+            continue
+        host = f"{origin.scheme.decode()}://{origin.host.decode()}:{origin.port}"
+        stats = hosts.setdefault(host, {"open": 0, "idle": 0})
+        stats["open"] += 1
+        stats["idle"] += connection.is_idle()
+    return hosts
+
+
+async def fetch_backend(endpoint, params):
+    """
+    Fetch one backend endpoint through its circuit breaker (shared with
+    app.py's config) and return its decoded body. A hedge that loses is
+    cancelled.
+    """
+    guard = core.upstream_guard
+    with metrics.track_fetch(endpoint), guard.call(endpoint):
+        delay = guard.hedge_delay(endpoint) if core.HEDGE_ENABLED else None
+        if delay is None:
+            return await request_backend(endpoint, params)
+
+        value, winner = await hedged_call_async(
+            lambda: request_backend(endpoint, params), delay
+        )
+        if winner is not None:
+            metrics.HEDGED_REQUESTS.labels(endpoint, winner).inc()
+        return value
+
+
+async def request_backend(endpoint, params):
+    """One backend GET, decoded"""
+    if endpoint == core.PROVIDER_METRICS_URL:
+        return await fetch_provider_table(endpoint, params)
+
+    response = await http_client.get(
+        f"{core.API_BASE_URL}{endpoint}", params=dict(params)
+    )
+    response.raise_for_status()
+    metrics.BACKEND_RESPONSE_BYTES.labels(endpoint).observe(len(response.content))
+    return response.json()
+
+
+async def fetch_provider_table(endpoint, params):
+    """Stream the provider exposition into a ProviderTable (see app.py)"""
+    table = ProviderTable()
+    async with http_client.stream(
+        "GET", f"{core.API_BASE_URL}{endpoint}", params=dict(params)
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            table.add_line(line)
+    metrics.BACKEND_RESPONSE_BYTES.labels(endpoint).observe(table.source_bytes)
+    return table
+
+
+async def fetch_cached(endpoint, params, ttl=None):
+    """Fetch one backend endpoint through the async response cache"""
+    return await response_cache.get(
+        (endpoint, params),
+        lambda: fetch_backend(endpoint, params),
+        core.CACHE_TTL_SECONDS if ttl is None else ttl,
+    )
+
+
+async def fetch_all(keys, deadline_seconds=None, ttls=None):
+    """
+    Fetch every (endpoint, params) key concurrently through the cache.
+
+    Same contract as app.fetch_all: returns key -> (backend_data, error),
+    with fetches past the per-query deadline reported as TimeoutError.
+    """
+    if deadline_seconds is None:
+        deadline_seconds = core.QUERY_DEADLINE_SECONDS
+    ttls = ttls or {}
+    keys = list(keys)
+    if not keys:
+        return {}
+
+    tasks = {
+        asyncio.ensure_future(fetch_cached(endpoint, params, ttls.get((endpoint, params)))):
+            (endpoint, params)
+        for endpoint, params in keys
+    }
+    done, pending = await asyncio.wait(tasks, timeout=deadline_seconds)
+    for task in pending:
+        task.cancel()
+
+    results = {}
+    for task, key in tasks.items():
+        if task in pending:
+            results[key] = (
+                None,
+                TimeoutError(f"query deadline of {deadline_seconds}s exceeded"),
+            )
+        elif task.exception() is not None:
+            results[key] = (None, task.exception())
+        else:
+            results[key] = (task.result(), None)
+
+    return results
+
+
+async def prefetch(key):
+    """Refresh one fetch key into the cache and record its samples"""
+    core.metric_registry.maybe_reload()
+    endpoint, params = key
+    backend_data = await response_cache.refresh(
+        key, lambda: fetch_backend(endpoint, params), core.prefetch_ttls[key]
+    )
+    core.record_samples({key: core.prefetch_plan[key]}, {key: (backend_data, None)})
+    core.record_prefetch_lag(key)
+
+
+async def run_prefetch_scheduler():
+    """Asyncio runner for app.prefetch_schedule (see scheduler.PrefetchScheduler)"""
+    schedule = core.prefetch_schedule
+    running = set()
+    wake = asyncio.Event()
+
+    async def run_job(key):
+        error = None
+        try:
+            await prefetch(key)
+        except Exception as e:
+            error = e
+            logger.warning(f"Prefetch of {key[0]} failed: {e}")
+        finally:
+            schedule.finished(key, error)
+            wake.set()
+
+    while True:
+        for key in schedule.due(limit=core.PREFETCH_MAX_CONCURRENCY - len(running)):
+            task = asyncio.create_task(run_job(key))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+        wait = schedule.seconds_until_next()
+        try:
+            await asyncio.wait_for(wake.wait(), 1.0 if wait is None else min(wait, 1.0))
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+
+class RawBody:
+    """A pre-encoded response body and its content type"""
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+
+
+# ---------------------------------------------------------------------------
+# Route handlers: each takes the decoded JSON body (or None) and returns
+# (status, payload), where payload is JSON-encoded unless it is a
+# RawBody.
+# ---------------------------------------------------------------------------
+
+
+async def health(body):
+    return 200, {"status": "ok", "message": "JSON API Proxy is running"}
+
+
+async def search(body):
+    core.metric_registry.maybe_reload()
+    return 200, RawBody(core.metric_registry.search_body, "application/json")
+
+
+async def query(body):
+    with metrics.QUERY_INFLIGHT.track_inprogress(), metrics.QUERY_DURATION.time():
+        try:
+            data, key, order, encoded = core.result_lookup(body or {})
+            if encoded is None:
+                plan, results = core.prepare_query(data)
+                fetched = await fetch_all(plan.keys(), ttls=core.plan_ttls(plan))
+                core.complete_query(
+                    plan, fetched, results, data.get("adhocFilters"), cache=response_cache,
+                )
+                encoded = core.encode_result(data, key, order, fetched, results)
+            status = 200
+        except FilterError as e:
+            logger.warning(f"Query rejected: {e}")
+            status, encoded = 400, serialization.dumps({"error": str(e)})
+        except Exception as e:
+            logger.error(f"Query error: {e}", exc_info=True)
+            metrics.count_error("query", e)
+            status, encoded = 500, serialization.dumps({"error": str(e)})
+
+        # Encoded here so the response size is recorded with the query.
+        metrics.QUERY_RESPONSE_BYTES.observe(len(encoded))
+    return status, RawBody(encoded, "application/json")
+
+
+async def prometheus_metrics(body):
+    return 200, RawBody(*metrics.exposition())
+
+
+async def provider_table():
+    try:
+        return await fetch_cached(*core.PROVIDER_FETCH_KEY, ttl=core.PROVIDER_METRICS_TTL)
+    except Exception as e:
+        logger.error(f"Error fetching provider metrics: {e}")
+        return None
+
+
+annotation_fetch_lock = None
+
+
+async def update_annotations(from_ms, to_ms, now_ms):
+    """Async counterpart of app.update_annotations"""
+    global annotation_fetch_lock
+    if annotation_fetch_lock is None:
+        annotation_fetch_lock = asyncio.Lock()
+
+    store = core.annotation_store
+    async with annotation_fetch_lock:
+        hours, poll_breakers = store.plan(from_ms, to_ms, now_ms)
+        anomalies, breakers = await asyncio.gather(
+            fetch_backend(core.ANOMALIES_URL, (("hours", hours),))
+            if hours is not None else asyncio.sleep(0),
+            fetch_backend(core.CIRCUIT_BREAKERS_URL, ()) if poll_breakers else asyncio.sleep(0),
+            return_exceptions=True,
+        )
+
+    for name, result in (("anomalies", anomalies), ("circuit breakers", breakers)):
+        if isinstance(result, Exception):
+            logger.error(f"Error fetching {name}: {result}")
+    if hours is not None and not isinstance(anomalies, Exception):
+        store.ingest_anomalies(anomalies, hours, now_ms)
+    if poll_breakers and not isinstance(breakers, Exception):
+        store.ingest_breakers(breakers, now_ms)
+
+
+async def annotations(body):
+    data = body or {}
+    from_ms, to_ms, tags, now_ms = core.annotation_request(data)
+    await update_annotations(from_ms, to_ms, now_ms)
+    return 200, core.annotation_results(data, core.annotation_store.range(from_ms, to_ms, tags))
+
+
+async def tag_keys(body):
+    return 200, core.tag_key_list(await provider_table())
+
+
+async def tag_values(body):
+    return 200, core.tag_value_list(await provider_table(), (body or {}).get("key"))
+
+
+async def debug_scheduler(body):
+    return 200, [
+        {"url": key[0], "params": dict(key[1]), **state}
+        for key, state in core.prefetch_schedule.stats().items()
+    ]
+
+
+async def debug_pool(body):
+    """Connection pool, cache and breaker stats for the async client (see app.debug_pool)"""
+    return 200, {
+        "pool_size": ASYNC_HTTP_MAX_CONNECTIONS,
+        "max_keepalive": ASYNC_HTTP_MAX_KEEPALIVE,
+        "hosts": client_pool_stats(http_client) if http_client is not None else {},
+        "cache": response_cache.stats(),
+        "shared_cache": core.shared_cache.stats() if core.shared_cache else None,
+        "annotations": core.annotation_store.stats(),
+        "breakers": core.upstream_guard.stats(),
+        "admission": core.admission.stats(),
+        "result_cache": core.result_cache.stats(),
+        "live_feed": core.live_feed.stats(),
+    }
+
+
+ROUTES = {
+    ("GET", "/"): health,
+    ("POST", "/search"): search,
+    ("POST", "/query"): query,
+    ("POST", "/annotations"): annotations,
+    ("POST", "/tag-keys"): tag_keys,
+    ("POST", "/tag-values"): tag_values,
+    ("GET", "/debug/pool"): debug_pool,
+    ("GET", "/debug/scheduler"): debug_scheduler,
+    ("GET", "/metrics"): prometheus_metrics,
+}
+
+# Handlers that pass admission control (see core.admission)
+ADMITTED = {query, annotations}
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+]
+
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def stream_monitoring(scope, receive, send):
+    """
+    Live feed as server-sent events (see app.stream_monitoring), held open
+    until the client disconnects. The feed polls from its own thread and
+    wakes this coroutine through the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    ready = asyncio.Event()
+    try:
+        subscription = core.live_feed.subscribe(lambda: loop.call_soon_threadsafe(ready.set))
+    except FeedFull as e:
+        retry_after = str(int(core.live_feed.interval)).encode()
+        await send_json(send, 503, {"error": str(e)}, headers=[(b"retry-after", retry_after)])
+        return
+    metrics.LIVE_FEED_SUBSCRIBERS.inc()
+
+    disconnected = asyncio.create_task(wait_disconnect(receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                *((name.lower().encode(), value.encode())
+                  for name, value in core.LIVE_FEED_HEADERS.items()),
+                *CORS_HEADERS,
+            ],
+        })
+        await send({"type": "http.response.body", "body": RETRY, "more_body": True})
+        while not disconnected.done():
+            ready.clear()
+            events = subscription.drain()
+            if events:
+                body = b"".join(events)
+            else:
+                woken = asyncio.create_task(ready.wait())
+                done, _ = await asyncio.wait(
+                    {woken, disconnected},
+                    timeout=core.LIVE_FEED_HEARTBEAT_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                woken.cancel()
+                if done:
+                    continue
+                body = HEARTBEAT
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        disconnected.cancel()
+        subscription.close()
+        metrics.LIVE_FEED_SUBSCRIBERS.dec()
+
+
+# Handlers that hold the connection and send the response themselves
+STREAMS = {
+    ("GET", "/stream/monitoring"): stream_monitoring,
+}
+
+
+def request_header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_body(send, status, body, content_type, accept_encoding=None, headers=()):
+    headers = [(b"content-type", content_type.encode()), *headers]
+    if len(body) >= core.COMPRESS_MIN_BYTES:
+        body, encoding = serialization.encode_body(
+            body, accept_encoding, core.COMPRESS_MIN_BYTES
+        )
+        if encoding is not None:
+            headers.append((b"content-encoding", encoding.encode()))
+        headers.append((b"vary", b"Accept-Encoding"))
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            *headers,
+            (b"content-length", str(len(body)).encode()),
+            *CORS_HEADERS,
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, payload, accept_encoding=None, headers=()):
+    await send_body(send, status, serialization.dumps(payload), "application/json",
+                    accept_encoding, headers)
+
+
+async def admit(scope, handler, body):
+    """Run `handler` through admission control; 429 with Retry-After if shed"""
+    header = lambda name: request_header(scope, name.lower().encode())  # noqa: E731
+    start = time.perf_counter()
+    try:
+        async with core.admission.admit_async(core.admission_key(header),
+                                              core.admission_priority(header)):
+            metrics.ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - start)
+            return await handler(body), ()
+    except Rejected as e:
+        return (429, {"error": str(e)}), [(b"retry-after", str(e.retry_after).encode())]
+
+
+async def lifespan(receive, send):
+    global http_client
+    scheduler = None
+
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            http_client = build_client()
+            if core.SNAPSHOT_ENABLED:
+                core.restore_snapshot(response_cache)
+                snapshot_writer.start()
+            if core.PREFETCH_ENABLED:
+                scheduler = asyncio.create_task(run_prefetch_scheduler())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if scheduler is not None:
+                scheduler.cancel()
+            if core.SNAPSHOT_ENABLED:
+                snapshot_writer.stop()
+                await asyncio.to_thread(snapshot_writer.flush)
+            await http_client.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entrypoint"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    if method == "OPTIONS":
+        await send({"type": "http.response.start", "status": 204, "headers": CORS_HEADERS})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    stream = STREAMS.get((method, scope["path"]))
+    if stream is not None:
+        await stream(scope, receive, send)
+        return
+
+    handler = ROUTES.get((method, scope["path"]))
+    if handler is None:
+        await send_json(send, 404, {"error": "not found"})
+        return
+
+    raw = await read_body(receive)
+    try:
+        body = serialization.loads(raw) if raw else None
+    except ValueError:
+        await send_json(send, 400, {"error": "invalid JSON body"})
+        return
+
+    accept_encoding = request_header(scope, b"accept-encoding")
+    if handler in ADMITTED and core.ADMISSION_ENABLED:
+        (status, payload), headers = await admit(scope, handler, body)
+    else:
+        (status, payload), headers = await handler(body), ()
+    if isinstance(payload, RawBody):
+        await send_body(send, status, payload.body, payload.content_type, accept_encoding,
+                        headers)
+    else:
+        await send_json(send, status, payload, accept_encoding, headers)
@@ -0,0 +1,271 @@
+"""
+In-process response cache for backend fetches.
+
+Entries are keyed by the planner's fetch key, (url, sorted params), and
+go through three states:
+
+- fresh: younger than the metric's TTL, served directly
+- stale: past the TTL but inside the stale window, served immediately
+  while a single background refresh is started
+- expired: older than TTL + stale window, refetched before answering
+
+Concurrent misses for one key share a single upstream call (single-flight)
+and the cache is bounded, evicting the least recently used entry first.
+Failed fetches are never cached.
+
+ResponseCache is for threaded servers; AsyncResponseCache is the same
+cache for the asyncio serving mode, where loaders are coroutines. A
+threaded cache can sit on a SharedCache (sharedcache.py) so gunicorn
+workers share backend responses.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+class _Entry:
+    __slots__ = ("value", "fetched_at", "ttl")
+
+    def __init__(self, value, fetched_at, ttl):
+        self.value = value
+        self.fetched_at = fetched_at
+        self.ttl = ttl
+
+
+class ResponseCache:
+    """
+    TTL + LRU cache with stale-while-revalidate and single-flight loads.
+
+    `refresh_executor` runs background refreshes for stale entries; it
+    needs a `submit(fn, *args)` method (a ThreadPoolExecutor works).
+    `on_lookup`, if given, is called with the lookup state of every get()
+    (see _classify), outside the lock. With a `shared` tier, loads first
+    take a value another worker already fetched, if it is within the TTL.
+
+    A caller waiting on another caller's load gives up after
+    `wait_seconds` and calls `loader()` itself, so waiters occupying every
+    thread of a pool cannot starve a refresh queued on that pool.
+    """
+
+    def __init__(self, max_entries=256, stale_seconds=60, refresh_executor=None,
+                 clock=time.monotonic, on_lookup=None, shared=None, wait_seconds=None):
+        self.max_entries = max_entries
+        self.stale_seconds = stale_seconds
+        self.refresh_executor = refresh_executor
+        self.wait_seconds = wait_seconds
+        self.clock = clock
+        self.on_lookup = on_lookup
+        self.shared = shared
+
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0,
+                       "wait_timeouts": 0}
+
+    def _classify(self, key, new_future, can_refresh):
+        """
+        Decide how to answer `key`; must be called with the lock held.
+
+        Returns (state, value, future) where state is "fresh" or "stale"
+        (serve `value`), "refresh" (serve `value` and start a background
+        load into `future`), "lead" (miss; the caller loads into `future`)
+        or "wait" (miss; another caller is already loading into `future`).
+        """
+        entry = self._entries.get(key)
+        age = None if entry is None else self.clock() - entry.fetched_at
+
+        if entry is not None and age < entry.ttl:
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return "fresh", entry.value, None
+
+        if entry is not None and age < entry.ttl + self.stale_seconds:
+            self._entries.move_to_end(key)
+            self._stats["stale"] += 1
+            if key in self._inflight or not can_refresh:
+                return "stale", entry.value, None
+            future = self._inflight[key] = new_future()
+            return "refresh", entry.value, future
+
+        self._stats["misses"] += 1
+        future = self._inflight.get(key)
+        if future is not None:
+            return "wait", None, future
+        future = self._inflight[key] = new_future()
+        return "lead", None, future
+
+    def _store(self, key, value, ttl, age=0.0):
+        """Insert a loaded value and evict LRU entries; lock must be held"""
+        self._entries[key] = _Entry(value, self.clock() - age, ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+        self._inflight.pop(key, None)
+
+    def get(self, key, loader, ttl):
+        """
+        Return the cached value for `key`, loading it with `loader()` if
+        needed. Exceptions raised by the loader propagate to every caller
+        waiting on that load.
+        """
+        with self._lock:
+            state, value, future = self._classify(
+                key, Future, self.refresh_executor is not None
+            )
+
+        if self.on_lookup is not None:
+            self.on_lookup(state)
+        # Upstream work always runs outside the lock.
+        if state == "refresh":
+            self.refresh_executor.submit(self._load, key, loader, ttl, future)
+        if state in ("fresh", "stale", "refresh"):
+            return value
+
+        if state == "lead":
+            self._load(key, loader, ttl, future)
+            return future.result()
+        try:
+            return future.result(timeout=self.wait_seconds)
+        except FutureTimeout:
+            # The load we joined may be queued behind us; fetch directly
+            # without touching the in-flight entry, which still completes.
+            with self._lock:
+                self._stats["wait_timeouts"] += 1
+            return loader()
+
+    def refresh(self, key, loader, ttl, max_age=0):
+        """
+        Load `key` now regardless of local freshness and return the new
+        value. Joins an in-flight load for the key instead of starting
+        another. With a shared tier, a value another worker stored less
+        than `max_age` seconds ago is taken instead of calling `loader`.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+
+        if leader:
+            self._load(key, loader, ttl, future, max_age)
+        return future.result()
+
+    def _load(self, key, loader, ttl, future, max_age=None):
+        """Run one upstream load and publish the result to all waiters"""
+        try:
+            if self.shared is None:
+                value, age = loader(), 0.0
+            else:
+                value, age = self.shared.load(
+                    key, loader, ttl if max_age is None else max_age
+                )
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            self._store(key, value, ttl, age)
+        future.set_result(value)
+
+    def peek(self, key):
+        """
+        (value, age) of the last value loaded for `key`, however old, or
+        None. Not counted as a lookup and does not touch LRU order.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry.value, self.clock() - entry.fetched_at
+
+    def entries(self):
+        """(key, value, age, ttl) of every entry, least recently used first"""
+        with self._lock:
+            now = self.clock()
+            return [(key, entry.value, now - entry.fetched_at, entry.ttl)
+                    for key, entry in self._entries.items()]
+
+    def restore(self, key, value, ttl, age):
+        """Insert a value loaded `age` seconds ago elsewhere (e.g. a snapshot)"""
+        with self._lock:
+            if key not in self._entries:
+                self._store(key, value, ttl, age)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries),
+                        inflight=len(self._inflight))
+
+
+class AsyncResponseCache(ResponseCache):
+    """
+    ResponseCache for asyncio callers.
+
+    `loader` is a coroutine function. Loads run as tasks so a cancelled
+    request never strands other callers waiting on the same key, and
+    stale entries are refreshed by a background task.
+    """
+
+    def __init__(self, max_entries=256, stale_seconds=60, clock=time.monotonic,
+                 on_lookup=None):
+        super().__init__(max_entries=max_entries, stale_seconds=stale_seconds,
+                         clock=clock, on_lookup=on_lookup)
+        self._tasks = set()
+
+    async def get(self, key, loader, ttl):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            state, value, future = self._classify(key, loop.create_future, True)
+
+        if self.on_lookup is not None:
+            self.on_lookup(state)
+        if state in ("refresh", "lead"):
+            task = asyncio.create_task(self._load_async(key, loader, ttl, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        if state == "refresh":
+            # Nobody awaits a background refresh; consume its error.
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if state in ("fresh", "stale", "refresh"):
+            return value
+
+        return await asyncio.shield(future)
+
+    async def refresh(self, key, loader, ttl):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = loop.create_future()
+                task = asyncio.create_task(self._load_async(key, loader, ttl, future))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        return await asyncio.shield(future)
+
+    async def _load_async(self, key, loader, ttl, future):
+        try:
+            value = await loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            if not future.done():
+                future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        with self._lock:
+            self._store(key, value, ttl)
+        if not future.done():
+            future.set_result(value)
@@ -0,0 +1,125 @@
+"""
+Parser for the Prometheus text exposition format.
+
+The backend's /prometheus/data/metrics endpoint serves provider health in
+the same format Prometheus scrapes. The proxy only needs the sample lines:
+
+    name{label="value",...} 1.5 [timestamp]
+
+`# HELP` / `# TYPE` comments and blank lines are skipped.
+
+The endpoint also carries every other backend metric, so the body is read
+as a stream of lines and a SampleFilter drops lines of unwanted families
+with a prefix test before any label parsing or decoding happens.
+"""
+
+import re
+
+_LABEL = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*"((?:[^"\\]|\\.)*)"\s*,?')
+_ESCAPES = {"\\\\": "\\", '\\"': '"', "\\n": "\n"}
+_ESCAPE = re.compile(r'\\[\\"n]')
+
+
+def _unescape(value):
+    if "\\" not in value:
+        return value
+    return _ESCAPE.sub(lambda m: _ESCAPES[m.group(0)], value)
+
+
+def parse_labels(text):
+    """Parse the inside of `{...}` into a dict"""
+    labels = {}
+    pos = 0
+    while pos < len(text):
+        match = _LABEL.match(text, pos)
+        if match is None:
+            raise ValueError(f"malformed labels: {text!r}")
+        labels[match.group(1)] = _unescape(match.group(2))
+        pos = match.end()
+    return labels
+
+
+def parse_line(line):
+    """
+    Parse one sample line into (name, labels, value).
+
+    Returns None for comments and blank lines; raises ValueError for lines
+    that are not valid samples.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+
+    brace = line.find("{")
+    if brace == -1:
+        name, _, rest = line.partition(" ")
+        labels = {}
+    else:
+        close = line.rfind("}")
+        if close < brace:
+            raise ValueError(f"unterminated labels: {line!r}")
+        name = line[:brace]
+        labels = parse_labels(line[brace + 1:close])
+        rest = line[close + 1:]
+
+    fields = rest.split()
+    if not name or not fields:
+        raise ValueError(f"malformed sample: {line!r}")
+    return name, labels, float(fields[0])
+
+
+class SampleFilter:
+    """
+    Precompiled filter for the sample lines of a set of metric families.
+
+    `parse(line)` accepts str or bytes lines (httpx and requests stream
+    different types). Lines of other families, and lines missing any of
+    `required_labels`, are rejected by substring tests on the raw line;
+    only kept lines are decoded and parsed.
+    """
+
+    def __init__(self, families, required_labels=()):
+        self.families = tuple(families)
+        # "name{" or "name " so provider_error_rate does not also match
+        # provider_error_rate_total.
+        prefixes = [f"{name}{sep}" for name in self.families for sep in ("{", " ")]
+        self._prefixes = tuple(prefixes)
+        self._prefixes_bytes = tuple(p.encode() for p in prefixes)
+        self._labels = tuple(f'{label}="' for label in required_labels)
+        self._labels_bytes = tuple(label.encode() for label in self._labels)
+
+    def parse(self, line):
+        """(name, labels, value) for a wanted sample line, else None"""
+        if isinstance(line, bytes):
+            if not line.startswith(self._prefixes_bytes):
+                return None
+            if not all(label in line for label in self._labels_bytes):
+                return None
+            line = line.decode("utf-8", "replace")
+        else:
+            if not line.startswith(self._prefixes):
+                return None
+            if not all(label in line for label in self._labels):
+                return None
+        return parse_line(line)
+
+
+def parse_samples(lines, families=None):
+    """
+    Yield (name, labels, value) for every sample in `lines`, or only for
+    samples of `families` if given.
+    """
+    if families is not None:
+        sample_filter = SampleFilter(families)
+        for line in lines:
+            sample = sample_filter.parse(line)
+            if sample is not None:
+                yield sample
+        return
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "replace")
+        sample = parse_line(line)
+        if sample is not None:
+            yield sample
@@ -0,0 +1,18 @@
+"""
+gunicorn settings for `sync` mode (see the Dockerfile CMD).
+
+Workers share /metrics samples through PROMETHEUS_MULTIPROC_DIR. `livesum`
+gauges such as jsonproxy_query_inflight only drop a worker's samples once
+its pid is marked dead, so a restarted worker (timeout, crash, max
+requests) would otherwise keep reporting its last in-flight counts.
+"""
+
+import os
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    """Drop the exited worker's live gauge samples from the shared directory"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,257 @@
+"""
+Live monitoring feed: one shared backend poll fanned out to every viewer.
+
+The monitoring tool used to poll the backend from each open tab, so
+backend load grew with the number of viewers. The proxy instead polls
+each source once per `interval` while anyone is subscribed and pushes
+the changes to all subscribers as server-sent events:
+
+- `snapshot`: the whole state, sent first on every connection (and again
+  to a subscriber that fell too far behind)
+- `delta`: a JSON merge patch (RFC 7386) against the previous state; keys
+  whose value is `null` were removed
+
+Lists are replaced as a whole by a merge patch, so a source can declare
+an `index` field: each list of objects carrying that field is turned
+into an object keyed by it (e.g. `providers` keyed by `provider`), and a
+change to one provider sends only that provider's changed fields.
+
+Each event is encoded once and the same bytes are queued for every
+subscriber. Polling stops while nobody is subscribed.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Sent first: how long EventSource waits before reconnecting (ms)
+RETRY = b"retry: 5000\n\n"
+# A comment line, sent when there is nothing else to send, so proxies and
+# load balancers do not close an idle stream and dead clients are noticed
+HEARTBEAT = b": keepalive\n\n"
+
+
+class FeedFull(Exception):
+    """The feed already has its maximum number of subscribers"""
+
+
+def index_lists(value, field):
+    """`value` with every list of objects that all carry `field` keyed by it"""
+    if isinstance(value, dict):
+        return {key: index_lists(item, field) for key, item in value.items()}
+    if isinstance(value, list):
+        if value and all(isinstance(item, dict) and field in item for item in value):
+            return {str(item[field]): index_lists(item, field) for item in value}
+        return [index_lists(item, field) for item in value]
+    return value
+
+
+def merge_patch(old, new):
+    """
+    JSON merge patch turning `old` into `new`, or None if they are equal.
+    Both are objects; `null` values in `new` cannot be represented and
+    are sent as removals.
+    """
+    patch = {}
+    for key in old.keys() - new.keys():
+        patch[key] = None
+    for key, value in new.items():
+        previous = old.get(key)
+        if isinstance(value, dict) and isinstance(previous, dict):
+            nested = merge_patch(previous, value)
+            if nested is not None:
+                patch[key] = nested
+        elif key not in old or previous != value:
+            patch[key] = value
+    return patch or None
+
+
+def apply_patch(target, patch):
+    """`target` with a merge patch applied (the client side of `merge_patch`)"""
+    result = dict(target)
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = apply_patch(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def encode_event(event, seq, data):
+    """One server-sent event; the JSON encoding has no newlines"""
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (seq, event.encode(), dumps(data))
+
+
+class Subscription:
+    """
+    Events queued for one viewer. `notify`, if given, is called from the
+    polling thread whenever events are queued (e.g. to wake a coroutine);
+    threaded servers use `wait()` instead.
+    """
+
+    def __init__(self, feed, max_pending, notify=None):
+        self.feed = feed
+        self.max_pending = max_pending
+        self.notify = notify
+        self.lagged = False
+        self._pending = deque()
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def push(self, event):
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                # Too far behind to catch up delta by delta; resync instead.
+                self._pending.clear()
+                self.lagged = True
+            else:
+                self._pending.append(event)
+        self._ready.set()
+        if self.notify is not None:
+            self.notify()
+
+    def wait(self, timeout):
+        """Block until events are queued; False on timeout"""
+        return self._ready.wait(timeout)
+
+    def drain(self):
+        """Encoded events queued since the last call"""
+        with self._lock:
+            self._ready.clear()
+            events = list(self._pending)
+            self._pending.clear()
+            lagged, self.lagged = self.lagged, False
+        if lagged:
+            return [self.feed.snapshot_event()]
+        return events
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class LiveFeed:
+    """
+    Polls `sources` {name: (endpoint, params)} through `fetch(endpoint,
+    params)` every `interval` seconds while it has subscribers, keeping
+    the latest value of each under its name. `index` {name: field}
+    selects the field lists of a source are keyed by.
+
+    `on_event`, if given, is called with (event, size in bytes, number of
+    subscribers it was queued for) for every event sent.
+    """
+
+    def __init__(self, sources, fetch, interval=5.0, index=None, max_subscribers=1000,
+                 max_pending=32, clock=time.time, on_event=None):
+        self.sources = sources
+        self.fetch = fetch
+        self.interval = interval
+        self.index = index or {}
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self.clock = clock
+        self.on_event = on_event
+
+        self.seq = 0
+        self.polls = 0
+        self.updated_at = None
+        self._state = {}
+        self._snapshot = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+
+    def subscribe(self, notify=None):
+        """
+        A Subscription starting with a snapshot of the current state;
+        raises FeedFull past `max_subscribers`.
+        """
+        subscription = Subscription(self, self.max_pending, notify)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise FeedFull(f"{len(self._subscribers)} viewers already subscribed")
+            self._subscribers.add(subscription)
+            self._wake.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="live-feed", daemon=True
+                )
+                self._thread.start()
+        event = self.snapshot_event()
+        subscription.push(event)
+        if self.on_event is not None:
+            self.on_event("snapshot", len(event), 1)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def snapshot_event(self):
+        """The current state as an encoded `snapshot` event"""
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = encode_event("snapshot", self.seq, self._state)
+            return self._snapshot
+
+    def poll(self):
+        """Fetch every source once and publish the changes"""
+        state = {}
+        for name, (endpoint, params) in self.sources.items():
+            try:
+                value = self.fetch(endpoint, params)
+            except Exception as e:
+                logger.warning(f"Live feed poll of {endpoint} failed: {e}")
+                # Keep the last value rather than sending a removal.
+                if name in self._state:
+                    state[name] = self._state[name]
+                continue
+            field = self.index.get(name)
+            state[name] = index_lists(value, field) if field else value
+
+        with self._lock:
+            self.polls += 1
+            self.updated_at = self.clock()
+            patch = merge_patch(self._state, state)
+            if patch is None:
+                return None
+            self.seq += 1
+            self._state = state
+            self._snapshot = None
+            event = encode_event("delta", self.seq, patch)
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            subscription.push(event)
+        if self.on_event is not None:
+            self.on_event("delta", len(event), len(subscribers))
+        return patch
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._subscribers:
+                    self._wake.wait()
+            started = time.monotonic()
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Live feed poll failed: {e}", exc_info=True)
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "seq": self.seq,
+                "polls": self.polls,
+                "updated_at": self.updated_at,
+                "interval": self.interval,
+            }
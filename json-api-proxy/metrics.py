@@ -0,0 +1,191 @@
+"""
+Prometheus instrumentation for the proxy's hot paths.
+
+Exposed on GET /metrics in both serving modes. Under gunicorn each worker
+has its own registry; set PROMETHEUS_MULTIPROC_DIR (the Dockerfile does in
+sync mode) and /metrics aggregates every worker's samples instead of
+whichever worker answered the scrape.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from admission import PRIORITY_NAMES
+from resilience import STATE_VALUES
+
+# Backend payloads range from a few hundred bytes to multi-MB exports.
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+QUERY_DURATION = Histogram(
+    "jsonproxy_query_duration_seconds",
+    "Time to answer a Grafana /query request",
+)
+QUERY_INFLIGHT = Gauge(
+    "jsonproxy_query_inflight",
+    "Grafana /query requests currently being answered",
+    multiprocess_mode="livesum",
+)
+QUERY_RESPONSE_BYTES = Histogram(
+    "jsonproxy_query_response_bytes",
+    "Size of /query response bodies",
+    buckets=SIZE_BUCKETS,
+)
+BACKEND_FETCH_DURATION = Histogram(
+    "jsonproxy_backend_fetch_duration_seconds",
+    "Time to fetch one backend endpoint, including retries",
+    ["endpoint"],
+)
+BACKEND_RESPONSE_BYTES = Histogram(
+    "jsonproxy_backend_response_bytes",
+    "Size of backend response bodies",
+    ["endpoint"],
+    buckets=SIZE_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    "jsonproxy_cache_lookups_total",
+    "Response cache lookups by result (hit, stale, miss)",
+    ["result"],
+)
+SHARED_CACHE_LOOKUPS = Counter(
+    "jsonproxy_shared_cache_lookups_total",
+    "Cross-worker cache loads by result (hit, miss, oversize)",
+    ["result"],
+)
+ERRORS = Counter(
+    "jsonproxy_errors_total",
+    "Errors by stage (fetch, query) and exception class",
+    ["stage", "exception"],
+)
+PREFETCH_LAG = Gauge(
+    "jsonproxy_prefetch_lag_seconds",
+    "How late the last background refresh of an endpoint started",
+    ["endpoint"],
+    multiprocess_mode="max",
+)
+CIRCUIT_BREAKER_STATE = Gauge(
+    "jsonproxy_circuit_breaker_state",
+    "Backend endpoint breaker state (0 closed, 1 open, 2 half-open)",
+    ["endpoint"],
+    multiprocess_mode="max",
+)
+HEDGED_REQUESTS = Counter(
+    "jsonproxy_hedged_requests_total",
+    "Backend calls that were hedged, by which attempt answered first",
+    ["endpoint", "winner"],
+)
+STALE_RESPONSES = Counter(
+    "jsonproxy_stale_responses_total",
+    "Targets answered from the last-known-good response after a failed fetch",
+    ["endpoint"],
+)
+ADMISSION_DECISIONS = Counter(
+    "jsonproxy_admission_decisions_total",
+    "Admission decisions for /query and /annotations "
+    "(admitted, queued, rate_limited, queue_full, queue_timeout)",
+    ["decision", "priority"],
+)
+ADMISSION_QUEUE_WAIT = Histogram(
+    "jsonproxy_admission_queue_wait_seconds",
+    "Time admitted requests spent waiting for a slot",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+RESULT_CACHE_LOOKUPS = Counter(
+    "jsonproxy_result_cache_lookups_total",
+    "Encoded /query response cache lookups by dashboard (bounded, excess "
+    "dashboards as other) and result (hit, miss)",
+    ["dashboard", "result"],
+)
+LIVE_FEED_SUBSCRIBERS = Gauge(
+    "jsonproxy_live_feed_subscribers",
+    "Open /stream/monitoring connections",
+    multiprocess_mode="livesum",
+)
+LIVE_FEED_EVENTS = Counter(
+    "jsonproxy_live_feed_events_total",
+    "Live feed events queued for viewers, by event (snapshot, delta)",
+    ["event"],
+)
+LIVE_FEED_BYTES = Counter(
+    "jsonproxy_live_feed_bytes_total",
+    "Bytes of live feed events queued for viewers, by event",
+    ["event"],
+)
+
+# ResponseCache lookup states -> CACHE_LOOKUPS result label
+_CACHE_RESULTS = {
+    "fresh": "hit",
+    "stale": "stale",
+    "refresh": "stale",
+    "lead": "miss",
+    "wait": "miss",
+}
+
+
+def observe_cache_lookup(state):
+    """ResponseCache `on_lookup` hook"""
+    CACHE_LOOKUPS.labels(_CACHE_RESULTS[state]).inc()
+
+
+def observe_shared_cache_lookup(result):
+    """SharedCache `on_lookup` hook"""
+    SHARED_CACHE_LOOKUPS.labels(result).inc()
+
+
+def observe_breaker_state(endpoint, state):
+    """UpstreamGuard `on_state` hook"""
+    CIRCUIT_BREAKER_STATE.labels(endpoint).set(STATE_VALUES[state])
+
+
+def observe_result_cache_lookup(dashboard, result):
+    """ResultCache `on_lookup` hook"""
+    RESULT_CACHE_LOOKUPS.labels(dashboard, result).inc()
+
+
+def observe_admission(decision, priority):
+    """AdmissionController `on_decision` hook"""
+    ADMISSION_DECISIONS.labels(decision, PRIORITY_NAMES[priority]).inc()
+
+
+def observe_live_feed_event(event, size, receivers):
+    """LiveFeed `on_event` hook"""
+    LIVE_FEED_EVENTS.labels(event).inc(receivers)
+    LIVE_FEED_BYTES.labels(event).inc(size * receivers)
+
+
+def count_error(stage, error):
+    ERRORS.labels(stage, type(error).__name__).inc()
+
+
+@contextmanager
+def track_fetch(endpoint):
+    """Time one backend fetch and count it as an error if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        count_error("fetch", e)
+        raise
+    finally:
+        BACKEND_FETCH_DURATION.labels(endpoint).observe(time.perf_counter() - start)
+
+
+def exposition():
+    """Return (body, content_type) for a /metrics scrape"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,82 @@
+"""
+Request planner for Grafana /query bodies.
+
+Several metrics are served from the same backend endpoint (for example
+avg_health_score, total_requests and total_cost all come from
+/api/monitoring/stats/realtime?hours=1). The planner groups the targets
+of one /query by (url, params) so each unique endpoint is fetched once
+and every requested `path` is pulled out of the shared response.
+
+Metric configs come from the registry (registry.py), which compiles each
+`path` into an extractor up front.
+"""
+
+from collections import OrderedDict
+
+
+def fetch_key(metric_config):
+    """
+    Build a hashable key identifying one backend fetch.
+
+    Params are sorted so {"a": 1, "b": 2} and {"b": 2, "a": 1} share a key.
+    """
+    params = metric_config.get("params", {}) or {}
+    return (metric_config["url"], tuple(sorted(params.items())))
+
+
+def plan_fetches(targets, metric_endpoints):
+    """
+    Group Grafana targets by the backend fetch they need.
+
+    Returns a tuple of (plan, unknown) where `plan` is an ordered mapping
+    of fetch key -> list of (position, metric_name, metric_config), and
+    `unknown` lists target names that have no metric definition.
+    `position` is the index of the target in the request so responses
+    can be returned in the order Grafana asked for them. Duplicate targets
+    for the same metric are kept so every refId gets its own series back.
+    """
+    plan = OrderedDict()
+    unknown = []
+
+    for position, target in enumerate(targets):
+        metric_name = target.get("target")
+        metric_config = metric_endpoints.get(metric_name)
+
+        if metric_config is None:
+            unknown.append(metric_name)
+            continue
+
+        plan.setdefault(fetch_key(metric_config), []).append(
+            (position, metric_name, metric_config)
+        )
+
+    return plan, unknown
+
+
+def compile_path(path):
+    """
+    Compile a dotted `path` into a function that pulls it out of a backend
+    JSON payload as a float. The path is split once here rather than on
+    every request.
+
+    Missing keys and nulls resolve to 0.0, matching the proxy's behaviour
+    before requests were coalesced.
+    """
+    keys = tuple(path.split("."))
+
+    def extract(backend_data):
+        value = backend_data
+        for key in keys:
+            if not isinstance(value, dict):
+                value = None
+                break
+            value = value.get(key, 0)
+
+        return float(value) if value is not None else 0.0
+
+    return extract
+
+
+def extract_value(backend_data, path):
+    """Pull a dotted `path` out of a backend JSON payload (see compile_path)"""
+    return compile_path(path)(backend_data)
@@ -0,0 +1,188 @@
+"""
+Per-provider table built from /prometheus/data/metrics.
+
+One backend fetch of the exposition is parsed once into a table with a row
+per provider and a column per metric family, plus an index of every label
+value to the rows carrying it. /query answers provider targets and
+Grafana ad-hoc filters from the table, and /tag-keys / /tag-values list
+the indexed labels, so a panel covering every provider costs a single
+upstream call per TTL.
+
+The table is filled line by line while the response streams in (see
+`add_line`): lines of other families are skipped before parsing, and each
+column is a flat array of doubles, so memory tracks the number of
+providers rather than the size of the backend payload.
+"""
+
+import math
+import re
+from array import array
+
+from exposition import SampleFilter
+
+# Column -> how several samples for one provider (e.g. one circuit breaker
+# per model) collapse into a single cell. Each keeps the worst value.
+PROVIDER_FAMILIES = {
+    "provider_health_score": min,
+    "provider_circuit_breaker_state": max,
+    "provider_error_rate": max,
+    "provider_availability": min,
+}
+
+PROVIDER_LABEL = "provider"
+
+# Grafana ad-hoc operator -> whether matching rows are kept (True) or
+# dropped (False). `<` and `>` have no meaning for label values.
+FILTER_OPERATORS = {"=": True, "!=": False, "=~": True, "!~": False}
+
+_MISSING = math.nan
+_filters = {}
+
+
+class FilterError(ValueError):
+    """An ad-hoc filter the table cannot evaluate; the client's fault"""
+
+
+def compile_filters(filters):
+    """
+    [(key, keep, value, pattern)] for Grafana ad-hoc filters; `pattern` is
+    the compiled regex of `=~` / `!~` and None for exact matches. Raises
+    FilterError on an unsupported operator or an invalid regex, so a bad
+    filter is rejected rather than answered with the wrong rows.
+    """
+    compiled = []
+    for adhoc in filters or []:
+        operator = adhoc.get("operator", "=")
+        wanted = adhoc.get("value", "")
+        if operator not in FILTER_OPERATORS:
+            raise FilterError(f"unsupported ad-hoc filter operator {operator!r}")
+        pattern = None
+        if operator in ("=~", "!~"):
+            try:
+                pattern = re.compile(wanted)
+            except re.error as e:
+                raise FilterError(f"invalid ad-hoc filter regex {wanted!r}: {e}") from None
+        compiled.append((adhoc.get("key"), FILTER_OPERATORS[operator], wanted, pattern))
+    return compiled
+
+
+def _sample_filter(columns):
+    """SampleFilter for a column set, compiled once per process"""
+    sample_filter = _filters.get(columns)
+    if sample_filter is None:
+        sample_filter = _filters[columns] = SampleFilter(
+            columns, required_labels=(PROVIDER_LABEL,)
+        )
+    return sample_filter
+
+
+class ProviderTable:
+    """Columns of per-provider values with a label -> value -> rows index"""
+
+    def __init__(self, families=None):
+        self.families = families or PROVIDER_FAMILIES
+        self.columns = list(self.families)
+        self.providers = []
+        self.source_bytes = 0
+        self._data = [array("d") for _ in self.columns]
+        self._column_of = {name: i for i, name in enumerate(self.columns)}
+        self._row_of = {}
+        self._index = {}
+        self._filter = _sample_filter(tuple(self.columns))
+
+    @classmethod
+    def from_lines(cls, lines, families=None):
+        """Build a table from an iterable of exposition lines (str or bytes)"""
+        table = cls(families)
+        for line in lines:
+            table.add_line(line)
+        return table
+
+    def add_line(self, line):
+        """Consume one exposition line; unwanted lines cost a prefix test"""
+        self.source_bytes += len(line) + 1
+        sample = self._filter.parse(line)
+        if sample is not None:
+            self.add(*sample)
+
+    def add(self, name, labels, value):
+        """Fold one sample into its provider's cell"""
+        column = self._column_of.get(name)
+        provider = labels.get(PROVIDER_LABEL)
+        if column is None or provider is None:
+            return
+
+        row = self._row(provider)
+        cells = self._data[column]
+        current = cells[row]
+        cells[row] = value if math.isnan(current) else self.families[name](current, value)
+        for key, label_value in labels.items():
+            self._index.setdefault(key, {}).setdefault(label_value, set()).add(row)
+
+    def _row(self, provider):
+        row = self._row_of.get(provider)
+        if row is None:
+            row = self._row_of[provider] = len(self.providers)
+            self.providers.append(provider)
+            for cells in self._data:
+                cells.append(_MISSING)
+        return row
+
+    def tag_keys(self):
+        return sorted(self._index)
+
+    def tag_values(self, key):
+        return sorted(self._index.get(key, {}))
+
+    def select(self, filters=None):
+        """
+        Row numbers matching every Grafana ad-hoc filter, in provider
+        order. Supports the `=`, `!=`, `=~` and `!~` operators; a row
+        matches a label if any of its samples carried that value. Raises
+        FilterError for any other operator or an invalid regex.
+        """
+        rows = set(range(len(self.providers)))
+        for key, keep, wanted, pattern in compile_filters(filters):
+            values = self._index.get(key, {})
+            if pattern is None:
+                matched = values.get(wanted, set())
+            else:
+                matched = set().union(
+                    *(r for v, r in values.items() if pattern.fullmatch(v))
+                )
+            if keep:
+                rows &= matched
+            else:
+                rows -= matched
+
+        return sorted(rows, key=lambda row: self.providers[row])
+
+    def value(self, row, column):
+        """Cell value, or None if the provider has no sample for it"""
+        value = self._data[column][row]
+        return None if math.isnan(value) else value
+
+    def column(self, name, rows):
+        """[(provider, value)] for `rows`, skipping providers without a value"""
+        column = self._column_of[name]
+        cells = self._data[column]
+        return [
+            (self.providers[row], cells[row])
+            for row in rows
+            if not math.isnan(cells[row])
+        ]
+
+    def as_table(self, rows):
+        """SimpleJSON table response for `rows`"""
+        return {
+            "type": "table",
+            "columns": [{"text": PROVIDER_LABEL, "type": "string"}] + [
+                {"text": name, "type": "number"} for name in self.columns
+            ],
+            "rows": [
+                [self.providers[row]] + [
+                    self.value(row, column) for column in range(len(self.columns))
+                ]
+                for row in rows
+            ],
+        }
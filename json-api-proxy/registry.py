@@ -0,0 +1,236 @@
+"""
+Metric definitions loaded from metric_definitions.yml.
+
+Each metric maps a Grafana target name to a backend fetch:
+
+- scalar metrics pull a dotted `path` out of a JSON response
+- provider metrics read a `column` of the provider table (null for the
+  whole table) and must use the provider exposition URL
+
+Definitions are validated when loaded and compiled once: every `path`
+becomes an extractor with its keys already split (planner.compile_path),
+and the /search response is encoded up front.
+
+MetricRegistry re-reads the file when it changes (checked at most every
+`poll_seconds`, from the request path, so every gunicorn worker picks the
+change up on its own). An invalid file is logged and the previous
+definitions stay in force. Cached backend responses are keyed by
+(url, params), so unchanged metrics keep their warm cache entries;
+`on_change` is told which metric names were added, changed or removed.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import serialization
+from planner import compile_path
+from providers import PROVIDER_FAMILIES
+
+try:
+    import yaml
+except ImportError:  # optional: JSON definitions only
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+_FIELDS = {"url", "params", "path", "column", "ttl", "refresh_interval", "description"}
+_SCALARS = (str, int, float, bool)
+
+
+class RegistryError(ValueError):
+    """Metric definitions that cannot be loaded; lists every problem found"""
+
+
+def read_definitions(path):
+    """Parse a YAML or JSON definitions file"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".json"):
+        return json.loads(data)
+    if yaml is None:
+        raise RegistryError(f"{path}: PyYAML is not installed; use a .json file")
+    try:
+        return yaml.safe_load(data)
+    except yaml.YAMLError as e:
+        raise RegistryError(f"{path}: {e}") from e
+
+
+def _positive(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+
+def _validate(name, definition, table_url):
+    """Problems with one metric definition, as a list of messages"""
+    if not isinstance(definition, dict):
+        return [f"{name}: expected a mapping, got {type(definition).__name__}"]
+
+    errors = [f"{name}: unknown field '{field}'" for field in sorted(set(definition) - _FIELDS)]
+    url = definition.get("url")
+    if not isinstance(url, str) or not url.startswith("/"):
+        errors.append(f"{name}: 'url' must be a path starting with '/'")
+
+    params = definition.get("params", {})
+    if params is not None and (
+        not isinstance(params, dict)
+        or not all(isinstance(k, str) and isinstance(v, _SCALARS) for k, v in params.items())
+    ):
+        errors.append(f"{name}: 'params' must map names to scalar values")
+
+    for field in ("ttl", "refresh_interval"):
+        if field in definition and not _positive(definition[field]):
+            errors.append(f"{name}: '{field}' must be a positive number of seconds")
+
+    if ("path" in definition) == ("column" in definition):
+        errors.append(f"{name}: exactly one of 'path' or 'column' is required")
+    elif "path" in definition:
+        path = definition["path"]
+        if not isinstance(path, str) or not all(path.split(".")):
+            errors.append(f"{name}: 'path' must be a dotted key path like 'a.b'")
+    else:
+        column = definition["column"]
+        if column is not None and column not in PROVIDER_FAMILIES:
+            errors.append(
+                f"{name}: 'column' must be null or one of {', '.join(PROVIDER_FAMILIES)}"
+            )
+        if url != table_url:
+            errors.append(f"{name}: provider columns are read from '{table_url}'")
+
+    return errors
+
+
+def compile_metric(definition):
+    """Metric config as used by the planner, with its extractor compiled"""
+    config = {
+        "url": definition["url"],
+        "params": dict(definition.get("params") or {}),
+    }
+    for field in ("ttl", "refresh_interval"):
+        if field in definition:
+            config[field] = definition[field]
+    if "path" in definition:
+        config["path"] = definition["path"]
+        config["extract"] = compile_path(definition["path"])
+    else:
+        config["column"] = definition["column"]
+    return config
+
+
+def compile_definitions(document, table_url):
+    """
+    Validate a parsed definitions document and compile every metric.
+    Raises RegistryError listing all problems.
+    """
+    if not isinstance(document, dict) or not isinstance(document.get("metrics"), dict):
+        raise RegistryError("expected a top-level 'metrics' mapping")
+    definitions = document["metrics"]
+    if not definitions:
+        raise RegistryError("no metrics defined")
+
+    errors = []
+    for name, definition in definitions.items():
+        if not isinstance(name, str) or not name:
+            errors.append(f"{name!r}: metric names must be non-empty strings")
+            continue
+        errors.extend(_validate(name, definition, table_url))
+    if errors:
+        raise RegistryError("\n".join(errors))
+
+    return {name: compile_metric(definition) for name, definition in definitions.items()}
+
+
+class MetricRegistry:
+    """
+    The live metric definitions.
+
+    `metrics` maps name -> compiled config and is replaced as a whole on
+    reload, so a request holding a reference sees one consistent version.
+    `search_body` is the encoded /search response.
+    """
+
+    def __init__(self, path, table_url, poll_seconds=5.0, clock=time.monotonic,
+                 on_change=None):
+        self.path = path
+        self.table_url = table_url
+        self.poll_seconds = poll_seconds
+        self.clock = clock
+        self.on_change = on_change
+
+        self.metrics = {}
+        self.search_body = b"[]"
+        self.version = 0
+        self._signature = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self.load()
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """
+        (Re)load the file and return the names that were added, changed or
+        removed. Raises OSError or RegistryError, leaving the current
+        definitions in place.
+        """
+        signature = self._stat()
+        metrics = compile_definitions(read_definitions(self.path), self.table_url)
+
+        previous = self.metrics
+        changed = {
+            name for name in previous.keys() | metrics.keys()
+            if _comparable(previous.get(name)) != _comparable(metrics.get(name))
+        }
+        # Unchanged metrics keep their config objects (and extractors).
+        self.metrics = {
+            name: config if name in changed else previous[name]
+            for name, config in metrics.items()
+        }
+        self.search_body = serialization.dumps(list(metrics))
+        self._signature = signature
+        self.version += 1
+
+        if self.version > 1:
+            logger.info(f"Reloaded {self.path} (version {self.version}): "
+                        f"{', '.join(sorted(changed)) or 'no metric changes'}")
+            if changed and self.on_change is not None:
+                self.on_change(changed)
+        return changed
+
+    def maybe_reload(self):
+        """
+        Reload if the file changed since the last load. Checks at most
+        once per `poll_seconds`; returns the changed names, or None if
+        nothing was reloaded.
+        """
+        now = self.clock()
+        if self._checked_at is not None and now - self._checked_at < self.poll_seconds:
+            return None
+        if not self._lock.acquire(blocking=False):
+            # Another thread is already checking.
+            return None
+        try:
+            self._checked_at = now
+            try:
+                if self._stat() == self._signature:
+                    return None
+                return self.load()
+            except (OSError, ValueError) as e:
+                logger.error(f"Keeping previous metric definitions; {self.path} is invalid: {e}")
+                # Do not re-parse the same broken file on every check.
+                try:
+                    self._signature = self._stat()
+                except OSError:
+                    pass
+                return None
+        finally:
+            self._lock.release()
+
+
+def _comparable(config):
+    if config is None:
+        return None
+    return {key: value for key, value in config.items() if key != "extract"}
@@ -0,0 +1,257 @@
+"""
+Circuit breakers and hedged requests for backend calls.
+
+When the backend is degraded every fetch would otherwise wait out the
+full read timeout, holding a worker (or a connection slot) per call. Each
+backend endpoint gets a CircuitBreaker instead:
+
+- closed: calls go through; `failure_threshold` consecutive upstream
+  failures open the breaker
+- open: calls fail immediately with CircuitOpenError for `reset_seconds`
+- half-open: one probe call is let through; success closes the breaker,
+  failure opens it for another `reset_seconds`
+
+Only upstream failures count (connection errors, timeouts, 5xx and 429);
+a 4xx means the backend answered, so it counts as a success.
+
+A healthy endpoint can still have a slow tail. With hedging, a call that
+has not returned after the endpoint's recent p95 latency is issued a
+second time and whichever attempt succeeds first wins, so the slowest
+~5% of calls cost at most one extra request each.
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Same encoding as the backend's provider_circuit_breaker_state.
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose breaker is open"""
+
+
+def is_upstream_failure(error):
+    """True unless the backend answered with a client error (4xx other than 429)"""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is None or status >= 500 or status == 429
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker for one endpoint"""
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0, clock=time.monotonic,
+                 on_state=None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.on_state = on_state
+
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set(self, state):
+        self.state = state
+        if self.on_state is not None:
+            self.on_state(state)
+
+    def acquire(self):
+        """Admit one call or raise CircuitOpenError"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN:
+                remaining = self.reset_seconds - (self.clock() - self.opened_at)
+                if remaining > 0:
+                    raise CircuitOpenError(f"circuit open, retry in {remaining:.1f}s")
+                self._set(HALF_OPEN)
+            if self._probing:
+                raise CircuitOpenError("circuit half-open, probe in flight")
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != CLOSED:
+                self._set(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+                self._set(OPEN)
+
+    def release(self):
+        """Give up an admitted call without an outcome (e.g. cancelled)"""
+        with self._lock:
+            self._probing = False
+
+
+class LatencyWindow:
+    """The last `size` call latencies of one endpoint"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+
+    def observe(self, seconds):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def quantile(self, q):
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, math.ceil(q * len(samples)) - 1)]
+
+
+class UpstreamGuard:
+    """
+    Per-endpoint breakers and latency windows.
+
+    Wrap every backend call in `with guard.call(endpoint):`. `on_state`,
+    if given, is called with (endpoint, state) on every breaker
+    transition.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0, hedge_quantile=0.95,
+                 min_hedge_delay=0.05, min_samples=20, clock=time.monotonic,
+                 on_state=None):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.clock = clock
+        self.on_state = on_state
+
+        self._breakers = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, endpoint):
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                on_state = None
+                if self.on_state is not None:
+                    on_state = lambda state: self.on_state(endpoint, state)  # noqa: E731
+                breaker = self._breakers[endpoint] = CircuitBreaker(
+                    self.failure_threshold, self.reset_seconds, self.clock, on_state
+                )
+                self._latencies[endpoint] = LatencyWindow()
+            return breaker
+
+    @contextmanager
+    def call(self, endpoint):
+        """Admit one call through the endpoint's breaker and record its outcome"""
+        breaker = self.breaker(endpoint)
+        breaker.acquire()
+        start = self.clock()
+        try:
+            yield
+        except Exception as e:
+            if is_upstream_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success()
+        self._latencies[endpoint].observe(self.clock() - start)
+
+    def hedge_delay(self, endpoint):
+        """
+        Seconds to wait before hedging a call, or None to not hedge: the
+        breaker is not closed (a probe must stay a single call) or there
+        are too few latency samples yet.
+        """
+        breaker = self.breaker(endpoint)
+        latencies = self._latencies[endpoint]
+        if breaker.state != CLOSED or len(latencies) < self.min_samples:
+            return None
+        return max(self.min_hedge_delay, latencies.quantile(self.hedge_quantile))
+
+    def reset(self):
+        with self._lock:
+            self._breakers.clear()
+            self._latencies.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    "state": breaker.state,
+                    "failures": breaker.failures,
+                    "samples": len(self._latencies[endpoint]),
+                    "p95_seconds": self._latencies[endpoint].quantile(0.95),
+                }
+                for endpoint, breaker in self._breakers.items()
+            }
+
+
+def hedged_call(fn, delay, executor):
+    """
+    Run `fn()` on `executor`; if it has not finished after `delay`
+    seconds, run it a second time. Returns (result, winner): winner is
+    None if no hedge was sent, else "primary" or "hedge" for the first
+    attempt to succeed. The slower attempt is left to finish in the
+    background. Raises the last error if both attempts fail.
+    """
+    first = executor.submit(fn)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result(), None
+
+    second = executor.submit(fn)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result(), "hedge" if future is second else "primary"
+            error = future.exception()
+    raise error
+
+
+async def hedged_call_async(fn, delay):
+    """hedged_call for a coroutine function; the losing attempt is cancelled"""
+    attempts = [asyncio.ensure_future(fn())]
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if done:
+            return attempts[0].result(), None
+
+        attempts.append(asyncio.ensure_future(fn()))
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), "hedge" if task is attempts[1] else "primary"
+                error = task.exception()
+        raise error
+    finally:
+        for task in attempts:
+            task.cancel()
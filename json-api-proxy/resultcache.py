@@ -0,0 +1,154 @@
+"""
+Cache of encoded /query responses, keyed by the normalized request.
+
+Every viewer of a dashboard sends the same /query body except for the
+exact range bounds, which move with the clock. The key is built from:
+
+- the sorted set of target names
+- the range aligned to the query's `intervalMs`: `from` rounded down and
+  `to` rounded up, so requests within one interval share a key
+- maxDataPoints, intervalMs, the ad-hoc filters and the metric registry
+  version (a definitions reload starts a new generation of keys)
+
+A cached result is the encoded series of each target name. The response
+for any target order is assembled by joining those byte segments, so a
+hit costs neither a backend fetch nor any JSON encoding. Lookups are
+counted per dashboard (`dashboardUID` in the body, else `dashboardId`).
+The dashboard comes from the client, so only the first `max_dashboards`
+seen are counted by name; later ones share the "other" bucket.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from timeseries import parse_grafana_time
+
+# Stats bucket for dashboards past ResultCache.max_dashboards
+OTHER_DASHBOARD = "other"
+
+
+def _align(from_ms, to_ms, step_ms):
+    if from_ms is not None:
+        from_ms -= from_ms % step_ms
+    if to_ms is not None:
+        to_ms = -(-to_ms // step_ms) * step_ms
+    return from_ms, to_ms
+
+
+def _filters_key(filters):
+    return tuple(sorted(
+        (str(f.get("key")), str(f.get("operator")), str(f.get("value")))
+        for f in filters or () if isinstance(f, dict)
+    ))
+
+
+def normalize_query(data, version=0, align_ms=1000):
+    """
+    (key, order, normalized) for a Grafana /query body: the cache key, the
+    requested target names in order, and a copy of `data` with its range
+    replaced by the aligned bounds (in epoch ms), so the response built for
+    it is the one cached under `key`. `align_ms` is the step when the
+    body has no `intervalMs`.
+    """
+    order = [target.get("target") for target in data.get("targets") or ()]
+    interval_ms = data.get("intervalMs")
+    step_ms = int(interval_ms) if isinstance(interval_ms, (int, float)) and interval_ms >= 1 \
+        else align_ms
+
+    range_data = data.get("range") or {}
+    from_ms, to_ms = _align(
+        parse_grafana_time(range_data.get("from")),
+        parse_grafana_time(range_data.get("to")),
+        step_ms,
+    )
+    key = (
+        tuple(sorted({str(name) for name in order})),
+        from_ms,
+        to_ms,
+        data.get("maxDataPoints"),
+        interval_ms,
+        _filters_key(data.get("adhocFilters")),
+        version,
+    )
+    normalized = dict(data, range={**range_data, "from": from_ms, "to": to_ms})
+    return key, order, normalized
+
+
+def query_dashboard(data):
+    """Dashboard a /query body came from, for per-dashboard stats"""
+    dashboard = data.get("dashboardUID") or data.get("dashboardId")
+    return str(dashboard) if dashboard else "unknown"
+
+
+def assemble(segments, order):
+    """JSON array of the cached series of every target in `order`"""
+    parts = [segments[name] for name in order if segments.get(name)]
+    return b"[" + b",".join(parts) + b"]"
+
+
+class ResultCache:
+    """
+    TTL + LRU cache of normalized query key -> {target: encoded series}.
+
+    `on_lookup`, if given, is called with (dashboard, "hit" | "miss"),
+    where dashboard is already folded into OTHER_DASHBOARD past the
+    `max_dashboards` bound.
+    """
+
+    def __init__(self, ttl=5.0, max_entries=512, clock=time.monotonic, on_lookup=None,
+                 max_dashboards=100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_dashboards = max_dashboards
+        self.clock = clock
+        self.on_lookup = on_lookup
+
+        # key -> (segments, stored_at)
+        self._entries = OrderedDict()
+        self._dashboards = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, dashboard="unknown"):
+        """The cached segments for `key`, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() - entry[1] >= self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            result = "miss" if entry is None else "hit"
+            if dashboard not in self._dashboards and len(self._dashboards) >= self.max_dashboards:
+                dashboard = OTHER_DASHBOARD
+            counts = self._dashboards.setdefault(dashboard, {"hit": 0, "miss": 0})
+            counts[result] += 1
+
+        if self.on_lookup is not None:
+            self.on_lookup(dashboard, result)
+        return None if entry is None else entry[0]
+
+    def put(self, key, segments):
+        with self._lock:
+            self._entries[key] = (segments, self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dashboards.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "dashboards": {
+                    dashboard: {
+                        **counts,
+                        "hit_ratio": round(counts["hit"] / (counts["hit"] + counts["miss"]), 3),
+                    }
+                    for dashboard, counts in self._dashboards.items()
+                },
+            }
@@ -0,0 +1,218 @@
+"""
+Background prefetch scheduler for backend endpoints.
+
+Every fetch key (url + params) that backs a metric gets a job refreshed on
+its own interval, so /query is answered from the warm cache and panel
+latency stays flat however slow the backend is. Intervals are jittered so
+jobs do not synchronise, concurrent refreshes are capped, and a failing
+endpoint backs off exponentially instead of being hammered.
+
+`Schedule` holds the timing state and is shared by the threaded runner
+used in sync mode and the asyncio runner in asgi.py.
+"""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ("key", "interval", "next_run", "running", "failures",
+                 "last_success", "last_error", "last_lag")
+
+    def __init__(self, key, interval, next_run):
+        self.key = key
+        self.interval = interval
+        self.next_run = next_run
+        self.running = False
+        self.failures = 0
+        self.last_success = None
+        self.last_error = None
+        self.last_lag = 0.0
+
+
+class Schedule:
+    """
+    Timing state for a set of refresh jobs.
+
+    `jitter` is the +/- fraction applied to every interval; failed jobs
+    wait interval * 2**failures, capped at `max_backoff` seconds.
+    """
+
+    def __init__(self, intervals, jitter=0.1, max_backoff=300, clock=time.monotonic,
+                 rng=random.random):
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.rng = rng
+        self._lock = threading.Lock()
+
+        now = clock()
+        # Spread the first runs over a fraction of each interval.
+        self._jobs = {
+            key: _Job(key, interval, now + self._jittered(interval) * self.jitter)
+            for key, interval in intervals.items()
+        }
+
+    def update(self, intervals):
+        """
+        Replace the job set: new keys are scheduled like at startup,
+        existing keys keep their state with the new interval, and missing
+        keys are dropped.
+        """
+        with self._lock:
+            now = self.clock()
+            jobs = {}
+            for key, interval in intervals.items():
+                job = self._jobs.get(key)
+                if job is None:
+                    job = _Job(key, interval, now + self._jittered(interval) * self.jitter)
+                job.interval = interval
+                jobs[key] = job
+            self._jobs = jobs
+
+    def defer(self, key, age):
+        """
+        Hold back a job whose data is already `age` seconds old (restored
+        from a snapshot) until it is due for a refresh.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                job.next_run = max(job.next_run, self.clock() + job.interval - age)
+
+    def _jittered(self, seconds):
+        return seconds * (1 + self.jitter * (2 * self.rng() - 1))
+
+    def due(self, limit=None):
+        """Mark and return up to `limit` due jobs' keys, most overdue first"""
+        with self._lock:
+            now = self.clock()
+            ready = sorted(
+                (job for job in self._jobs.values()
+                 if not job.running and job.next_run <= now),
+                key=lambda job: job.next_run,
+            )
+            if limit is not None:
+                ready = ready[:max(0, limit)]
+            for job in ready:
+                job.running = True
+                job.last_lag = now - job.next_run
+            return [job.key for job in ready]
+
+    def finished(self, key, error=None):
+        """Record a job's outcome and schedule its next run"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None:
+                # Removed by update() while it ran.
+                return
+            now = self.clock()
+            job.running = False
+            if error is None:
+                job.failures = 0
+                job.last_success = now
+                job.last_error = None
+                delay = job.interval
+            else:
+                job.failures += 1
+                job.last_error = f"{type(error).__name__}: {error}"
+                delay = min(job.interval * 2 ** job.failures, self.max_backoff)
+            job.next_run = now + self._jittered(delay)
+
+    def interval(self, key):
+        """Configured (unjittered) interval of a job"""
+        return self._jobs[key].interval
+
+    def seconds_until_next(self):
+        """Time until the next idle job is due (0 if one is overdue)"""
+        with self._lock:
+            pending = [job.next_run for job in self._jobs.values() if not job.running]
+            if not pending:
+                return None
+            return max(0.0, min(pending) - self.clock())
+
+    def stats(self):
+        """
+        Per-job state. `lag_seconds` is how late the job started versus its
+        schedule (or, if it is overdue right now, how overdue it is);
+        `age_seconds` is the time since its last successful refresh.
+        """
+        with self._lock:
+            now = self.clock()
+            result = {}
+            for job in self._jobs.values():
+                overdue = now - job.next_run if not job.running else 0.0
+                result[job.key] = {
+                    "interval_seconds": job.interval,
+                    "lag_seconds": round(max(job.last_lag, overdue, 0.0), 3),
+                    "age_seconds": (None if job.last_success is None
+                                    else round(now - job.last_success, 3)),
+                    "failures": job.failures,
+                    "last_error": job.last_error,
+                    "running": job.running,
+                }
+            return result
+
+
+class PrefetchScheduler:
+    """
+    Runs a Schedule on a daemon thread, refreshing due jobs on `executor`
+    with at most `max_concurrency` refreshes in flight.
+    """
+
+    def __init__(self, schedule, refresh, executor, max_concurrency=4):
+        self.schedule = schedule
+        self.refresh = refresh
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self._running = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="prefetch-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        """Re-check the schedule now (e.g. after Schedule.update)"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._lock:
+                capacity = self.max_concurrency - self._running
+            for key in self.schedule.due(limit=capacity):
+                with self._lock:
+                    self._running += 1
+                self.executor.submit(self._refresh, key)
+
+            wait = self.schedule.seconds_until_next()
+            self._wake.wait(1.0 if wait is None else min(wait, 1.0))
+            self._wake.clear()
+
+    def _refresh(self, key):
+        error = None
+        try:
+            self.refresh(key)
+        except Exception as e:
+            error = e
+            logger.warning(f"Prefetch of {key[0]} failed: {e}")
+        finally:
+            self.schedule.finished(key, error)
+            with self._lock:
+                self._running -= 1
+            self._wake.set()
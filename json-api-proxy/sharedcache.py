@@ -0,0 +1,214 @@
+"""
+Cache tier shared by every gunicorn worker in one container.
+
+ResponseCache is per process, so each worker would fetch every endpoint
+once per TTL. SharedCache sits underneath it: a fixed table of slots in a
+memory-mapped file (on /dev/shm by default) that every worker maps.
+
+- Values are pickled into the slot the key hashes to (direct-mapped; a
+  colliding key simply replaces the previous one).
+- Reads take no lock. Each slot carries a sequence number that writers
+  make odd while they write and even again when done; a reader copies the
+  slot and retries if the sequence changed underneath it (a seqlock).
+- Loads are single-flight across processes: a worker that misses takes a
+  POSIX byte-range lock for the slot, re-checks the slot, and only then
+  calls the backend. Workers missing at the same time wait on the lock
+  and read the leader's value. Byte-range locks belong to the process,
+  so threads of one worker first take an in-process lock for the slot.
+- A file with a different layout is replaced, never truncated: a worker
+  still mapping it would fault on its next read.
+
+Timestamps are wall-clock (time.time), the one clock all workers share.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+_MAGIC = b"JAPXSHM1"
+_HEADER = struct.Struct("<8sII")
+_HEADER_BYTES = 64
+# seq, stored_at, key length, value length
+_SLOT = struct.Struct("<QdII")
+_SEQ = struct.Struct("<Q")
+_READ_RETRIES = 64
+
+logger = logging.getLogger(__name__)
+
+
+class SharedCache:
+    """
+    Shared slot table in the file at `path`.
+
+    The file is created (or replaced, if its geometry differs) by the
+    first process to open it. `on_lookup`, if given, is called with "hit",
+    "miss" or "oversize" for every load().
+    """
+
+    def __init__(self, path, slots=64, slot_bytes=256 * 1024, clock=time.time,
+                 on_lookup=None):
+        self.path = path
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.clock = clock
+        self.on_lookup = on_lookup
+        self.size = _HEADER_BYTES + slots * slot_bytes
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._init_file()
+        self._map = mmap.mmap(self._fd, self.size)
+        # POSIX record locks do not exclude threads of one process, so
+        # writes from this process are also serialised in-process.
+        self._write_lock = threading.Lock()
+        # ...and so are loads: the first thread to unlock a slot's range
+        # would release it for every other thread of the process.
+        self._slot_locks = [threading.Lock() for _ in range(slots)]
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "oversize": 0, "torn_reads": 0}
+
+    def _init_file(self):
+        """
+        Size and stamp the file unless another process already has. A file
+        laid out differently may still be mapped by a running worker, so it
+        is replaced by a new file rather than resized; that worker keeps
+        its old table until it restarts.
+        """
+        expected = _HEADER.pack(_MAGIC, self.slots, self.slot_bytes)
+        while True:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                st = os.fstat(self._fd)
+                if os.stat(self.path).st_ino != st.st_ino:
+                    # Replaced by another process while we waited.
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                elif st.st_size == 0:
+                    os.ftruncate(self._fd, self.size)
+                    os.pwrite(self._fd, expected, 0)
+                    return
+                elif st.st_size == self.size and \
+                        os.pread(self._fd, _HEADER.size, 0) == expected:
+                    return
+                else:
+                    logger.warning(f"Shared cache {self.path} has another layout; replacing it")
+                    fd = self._replace_file(expected)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = fd
+
+    def _replace_file(self, header):
+        """Atomically put an empty, stamped table at self.path; returns its fd"""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(fd, self.size)
+        os.pwrite(fd, header, 0)
+        os.replace(tmp, self.path)
+        return fd
+
+    def _slot(self, key_bytes):
+        index = zlib.crc32(key_bytes) % self.slots
+        return index, _HEADER_BYTES + index * self.slot_bytes
+
+    @staticmethod
+    def _key_bytes(key):
+        return repr(key).encode()
+
+    def get(self, key, max_age):
+        """(value, age) if the slot holds `key` younger than max_age, else None"""
+        key_bytes = self._key_bytes(key)
+        _, offset = self._slot(key_bytes)
+        view = self._map
+
+        for _ in range(_READ_RETRIES):
+            seq = _SEQ.unpack_from(view, offset)[0]
+            if seq & 1:
+                # A writer is mid-update; let it finish.
+                time.sleep(0)
+                continue
+            _, stored_at, key_len, value_len = _SLOT.unpack_from(view, offset)
+            start = offset + _SLOT.size
+            if seq == 0 or _SLOT.size + key_len + value_len > self.slot_bytes:
+                return None
+            stored_key = view[start:start + key_len]
+            value = view[start + key_len:start + key_len + value_len]
+            if _SEQ.unpack_from(view, offset)[0] == seq:
+                break
+        else:
+            with self._stats_lock:
+                self._stats["torn_reads"] += 1
+            return None
+
+        if stored_key != key_bytes:
+            return None
+        age = self.clock() - stored_at
+        if age >= max_age:
+            return None
+        return pickle.loads(value), max(0.0, age)
+
+    def _write(self, offset, key_bytes, data):
+        view = self._map
+        with self._write_lock:
+            seq = _SEQ.unpack_from(view, offset)[0]
+            if seq & 1:
+                # Left odd by a writer that died mid-update.
+                seq += 1
+            _SEQ.pack_into(view, offset, seq + 1)
+            start = offset + _SLOT.size
+            view[start:start + len(key_bytes)] = key_bytes
+            view[start + len(key_bytes):start + len(key_bytes) + len(data)] = data
+            _SLOT.pack_into(view, offset, seq + 1, self.clock(), len(key_bytes), len(data))
+            _SEQ.pack_into(view, offset, seq + 2)
+
+    def load(self, key, loader, max_age):
+        """
+        Return (value, age): the shared value for `key` if it is younger
+        than `max_age`, otherwise a fresh `loader()` result published to
+        every worker. Only one process loads a slot at a time.
+        """
+        hit = self.get(key, max_age)
+        if hit is not None:
+            self._count("hits", "hit")
+            return hit
+
+        key_bytes = self._key_bytes(key)
+        index, offset = self._slot(key_bytes)
+        lock_at = self.size + index
+        with self._slot_locks[index]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, lock_at)
+            try:
+                # Another thread or worker may have loaded it while we waited.
+                hit = self.get(key, max_age)
+                if hit is not None:
+                    self._count("hits", "hit")
+                    return hit
+
+                self._count("misses", "miss")
+                value = loader()
+                data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                if _SLOT.size + len(key_bytes) + len(data) <= self.slot_bytes:
+                    self._write(offset, key_bytes, data)
+                else:
+                    self._count("oversize", "oversize")
+                return value, 0.0
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, lock_at)
+
+    def _count(self, stat, result):
+        with self._stats_lock:
+            self._stats[stat] += 1
+        if self.on_lookup is not None:
+            self.on_lookup(result)
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, slots=self.slots, slot_bytes=self.slot_bytes)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
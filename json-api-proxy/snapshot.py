@@ -0,0 +1,134 @@
+"""
+Warm-start snapshots of the proxy's in-memory state.
+
+After a redeploy the response cache and the sampled history are empty:
+the first queries wait on the backend and history panels start from
+nothing. The proxy periodically writes both to a local file and reads it
+back at startup.
+
+File layout (little-endian):
+
+- header: magic `JAPXSNP1`, written_at (float64 wall-clock seconds),
+  CRC-32 and length of the body
+- body: zlib-compressed pickle of
+  - `cache`: [(key, value, stored_at, ttl)] for the response cache
+  - `series`: {metric: (timestamps, values)} with the ring buffers packed
+    as int64 / float64 arrays (16 bytes per sample before compression)
+
+Timestamps are wall-clock so ages survive the restart. The file is written
+to a temporary name and renamed into place, so a crash mid-write leaves
+the previous snapshot intact; a truncated or corrupt file is ignored.
+"""
+
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"JAPXSNP1"
+# magic, written_at, body crc32, body length
+_HEADER = struct.Struct("<8sdII")
+
+
+class Snapshot:
+    """A loaded snapshot; ages are relative to when it was read"""
+
+    def __init__(self, written_at, cache, series, now):
+        self.written_at = written_at
+        self.age = now - written_at
+        # [(key, value, age, ttl)]
+        self.cache = [(key, value, now - stored_at, ttl) for key, value, stored_at, ttl in cache]
+        # {metric: (timestamps, values)}, unpacked from the arrays' bytes
+        self.series = {
+            name: (array("q", timestamps).tolist(), array("d", values).tolist())
+            for name, (timestamps, values) in series.items()
+        }
+
+
+def encode(cache_entries, series, now):
+    """
+    Snapshot bytes for `cache_entries` [(key, value, age, ttl)] and
+    `series` {metric: (timestamps, values)}
+    """
+    body = zlib.compress(pickle.dumps({
+        "cache": [(key, value, now - age, ttl) for key, value, age, ttl in cache_entries],
+        "series": {
+            name: (array("q", timestamps).tobytes(), array("d", values).tobytes())
+            for name, (timestamps, values) in series.items()
+        },
+    }, protocol=pickle.HIGHEST_PROTOCOL))
+    return _HEADER.pack(_MAGIC, now, zlib.crc32(body), len(body)) + body
+
+
+def decode(data, now):
+    """Snapshot from `encode` output; raises ValueError if it is invalid"""
+    if len(data) < _HEADER.size:
+        raise ValueError("snapshot truncated")
+    magic, written_at, crc, length = _HEADER.unpack_from(data)
+    body = data[_HEADER.size:]
+    if magic != _MAGIC:
+        raise ValueError("not a snapshot file")
+    if len(body) != length or zlib.crc32(body) != crc:
+        raise ValueError("snapshot truncated or corrupt")
+    state = pickle.loads(zlib.decompress(body))
+    return Snapshot(written_at, state["cache"], state["series"], now)
+
+
+def write(path, cache_entries, series, clock=time.time):
+    """Atomically replace the snapshot at `path`; returns its size in bytes"""
+    data = encode(cache_entries, series, clock())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def read(path, clock=time.time):
+    """The snapshot at `path`, or None if there is none or it is unreadable"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        return decode(data, clock())
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+
+
+class SnapshotWriter:
+    """Calls `write()` every `interval` seconds on a daemon thread"""
+
+    def __init__(self, write, interval=60.0):
+        self.write = write
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def flush(self):
+        """Write now, logging rather than raising on failure (e.g. at exit)"""
+        try:
+            self.write()
+        except Exception as e:
+            logger.error(f"Snapshot write failed: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
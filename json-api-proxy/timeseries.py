@@ -0,0 +1,175 @@
+"""
+In-memory history for proxy metrics.
+
+Backend monitoring endpoints only return a current value. Every background
+refresh of an endpoint (see scheduler.py) records a sample, and the proxy
+keeps the last N samples of every
+metric in a fixed-size ring buffer, so /query can answer Grafana time
+ranges with real history instead of a single "now" point.
+"""
+
+import bisect
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class RingBuffer:
+    """Fixed-capacity buffer of (timestamp_ms, value) samples, oldest first"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._timestamps = [0] * capacity
+        self._values = [0.0] * capacity
+        self._start = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def append(self, timestamp_ms, value):
+        with self._lock:
+            # Samples arrive in time order; drop anything older than the
+            # newest sample rather than re-sorting.
+            if self._size and timestamp_ms <= self._last_timestamp():
+                return
+            index = (self._start + self._size) % self.capacity
+            self._timestamps[index] = timestamp_ms
+            self._values[index] = value
+            if self._size < self.capacity:
+                self._size += 1
+            else:
+                self._start = (self._start + 1) % self.capacity
+
+    def _last_timestamp(self):
+        return self._timestamps[(self._start + self._size - 1) % self.capacity]
+
+    def snapshot(self):
+        """Return (timestamps, values) as ordered lists"""
+        with self._lock:
+            end = self._start + self._size
+            if end <= self.capacity:
+                return (self._timestamps[self._start:end],
+                        self._values[self._start:end])
+            wrap = end - self.capacity
+            return (self._timestamps[self._start:] + self._timestamps[:wrap],
+                    self._values[self._start:] + self._values[:wrap])
+
+    def range(self, from_ms, to_ms):
+        """Return [[value, timestamp_ms], ...] with from_ms <= ts <= to_ms"""
+        timestamps, values = self.snapshot()
+        lo = bisect.bisect_left(timestamps, from_ms)
+        hi = bisect.bisect_right(timestamps, to_ms)
+        return [[values[i], timestamps[i]] for i in range(lo, hi)]
+
+    def __len__(self):
+        return self._size
+
+
+class TimeSeriesStore:
+    """One RingBuffer per metric name"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def record(self, metric_name, timestamp_ms, value):
+        buffer = self._buffers.get(metric_name)
+        if buffer is None:
+            with self._lock:
+                buffer = self._buffers.setdefault(metric_name, RingBuffer(self.capacity))
+        buffer.append(timestamp_ms, value)
+
+    def range(self, metric_name, from_ms, to_ms):
+        buffer = self._buffers.get(metric_name)
+        if buffer is None:
+            return []
+        return buffer.range(from_ms, to_ms)
+
+    def discard(self, metric_names):
+        """Drop the history of metrics whose definition changed"""
+        with self._lock:
+            for name in metric_names:
+                self._buffers.pop(name, None)
+
+    def export(self):
+        """{metric: (timestamps, values)} of every buffer"""
+        return {name: buffer.snapshot() for name, buffer in list(self._buffers.items())}
+
+    def restore(self, metric_name, timestamps, values):
+        """Replay saved samples into a metric's buffer, oldest first"""
+        for timestamp_ms, value in zip(timestamps, values):
+            self.record(metric_name, timestamp_ms, value)
+
+    def stats(self):
+        return {name: len(buffer) for name, buffer in list(self._buffers.items())}
+
+
+def downsample(datapoints, max_points=None, interval_ms=None):
+    """
+    Reduce [[value, ts], ...] to at most `max_points` points.
+
+    Points are grouped into buckets at least `interval_ms` wide (Grafana's
+    requested resolution) and each bucket is replaced by its mean value at
+    the bucket's first timestamp.
+    """
+    if len(datapoints) < 2:
+        return datapoints
+
+    span = datapoints[-1][1] - datapoints[0][1]
+    width = interval_ms or 0
+    if max_points and max_points > 0:
+        # span // max_points + 1 guarantees at most max_points buckets
+        width = max(width, span // max_points + 1)
+    if width <= 0:
+        return datapoints
+
+    origin = datapoints[0][1]
+    result = []
+    bucket_id = None
+    total = count = bucket_ts = 0
+    for value, timestamp in datapoints:
+        current = (timestamp - origin) // width
+        if current != bucket_id:
+            if count:
+                result.append([total / count, bucket_ts])
+            bucket_id, bucket_ts, total, count = current, timestamp, 0.0, 0
+        total += value
+        count += 1
+    if count:
+        result.append([total / count, bucket_ts])
+    return result
+
+
+_RELATIVE_TIME = re.compile(r"^now(?:-(\d+)([smhdw]))?$")
+_UNIT_MS = {"s": 1000, "m": 60_000, "h": 3_600_000, "d": 86_400_000, "w": 604_800_000}
+
+
+def parse_grafana_time(value):
+    """
+    Parse a Grafana range bound to epoch ms.
+
+    Accepts ISO 8601 strings (what Grafana sends), epoch milliseconds and
+    the simple relative forms "now" / "now-5m" used in manual curl tests.
+    Returns None for anything else.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if value.isdigit():
+        return int(value)
+
+    relative = _RELATIVE_TIME.match(value)
+    if relative:
+        now_ms = int(time.time() * 1000)
+        amount, unit = relative.groups()
+        return now_ms - int(amount) * _UNIT_MS[unit] if amount else now_ms
+
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
@@ -0,0 +1,83 @@
+"""
+Pooled HTTP session for backend calls.
+
+Module-level `requests.get` opens a fresh connection (and TLS handshake)
+for every call. Each worker instead shares one `requests.Session` whose
+adapter keeps a bounded pool of keep-alive connections per host and
+retries idempotent GETs with exponential backoff.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def build_session(pool_size=10, retries=2, backoff_factor=0.2):
+    """
+    Create a keep-alive session with a connection pool of `pool_size`
+    connections per host. Only GETs are retried, on connection errors and
+    on RETRY_STATUSES; Retry-After from the backend is honoured.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+        pool_block=False,
+    )
+
+    session = requests.Session()
+    session.headers.update({"Connection": "keep-alive"})
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def pool_stats(session):
+    """
+    Summarise the session's connection pools.
+
+    Per host: `open` connections (idle + checked out), `idle` connections
+    waiting in the pool, `created` connections over the pool's lifetime,
+    `requests` sent, and `reused` = requests that did not need a new
+    connection.
+    """
+    hosts = {}
+    seen = set()
+
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+
+            queued = list(pool.pool.queue) if pool.pool is not None else []
+            idle = sum(1 for conn in queued if conn is not None)
+            checked_out = pool.pool.maxsize - len(queued) if pool.pool is not None else 0
+            hosts[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                "open": idle + checked_out,
+                "idle": idle,
+                "created": pool.num_connections,
+                "requests": pool.num_requests,
+                "reused": max(0, pool.num_requests - pool.num_connections),
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+            }
+
+    return hosts
@@ -102,6 +102,22 @@ else
     TEMPO_TARGET="tempo:3200"
 fi
 
+# ============================================================
+# JSON API Proxy Configuration
+# Scrapes the proxy's own /metrics endpoint
+# ============================================================
+
+if [ -n "$JSON_API_PROXY_INTERNAL_URL" ]; then
+    # Use explicitly set JSON_API_PROXY_INTERNAL_URL (from Railway env vars)
+    JSON_API_PROXY_TARGET=$(echo "$JSON_API_PROXY_INTERNAL_URL" | sed 's|http://||')
+elif [ -n "$RAILWAY_ENVIRONMENT" ]; then
+    # Railway production environment - use internal network
+    JSON_API_PROXY_TARGET="json-api-proxy.railway.internal:5050"
+else
+    # Local Docker Compose environment - use Docker service name
+    JSON_API_PROXY_TARGET="json-api-proxy:5050"
+fi
+
 echo "==========================================="
 echo "Prometheus Configuration"
 echo "==========================================="
@@ -112,6 +128,7 @@ echo "MIMIR_TARGET: $MIMIR_TARGET"
 echo "ALERTMANAGER_TARGET: $ALERTMANAGER_TARGET"
 
 echo "TEMPO_TARGET: $TEMPO_TARGET"
+echo "JSON_API_PROXY_TARGET: $JSON_API_PROXY_TARGET"
 echo "RAILWAY_ENVIRONMENT: ${RAILWAY_ENVIRONMENT:-not set (local mode)}"
 echo "==========================================="
 
@@ -153,6 +170,7 @@ sed -e "s|FASTAPI_TARGET|${TARGET}|g" \
     -e "s|MIMIR_TARGET|${MIMIR_TARGET}|g" \
     -e "s|ALERTMANAGER_TARGET|${ALERTMANAGER_TARGET}|g" \
     -e "s|TEMPO_TARGET|${TEMPO_TARGET}|g" \
+    -e "s|JSON_API_PROXY_TARGET|${JSON_API_PROXY_TARGET}|g" \
     /tmp/prometheus.yml.tmp > /etc/prometheus/prometheus.yml
 
 # Show the resulting scrape targets and remote_write for debugging
@@ -0,0 +1,632 @@
+"""
+benchmark_json_api_proxy.py
+Measures /query latency of json-api-proxy against a local stub backend.
+
+The stub serves every backend path with a fixed delay, so no API key or
+network access is needed. Scenarios:
+
+  fanout  N synthetic metrics on N distinct endpoints (the worst case for
+          fan-out) in one /query; compares a serial fetch pool (1 worker)
+          with the concurrent pool, both with the response cache bypassed,
+          and then the concurrent pool with the cache on.
+  load    C concurrent single-target /query requests, each needing its own
+          backend call; compares the Flask app limited to 2 request
+          threads (gunicorn --workers 2) with the ASGI app on one event loop.
+  parse   Offline: parse a synthetic /prometheus/data/metrics payload of
+          up to S series into the provider table, buffered (decode the
+          whole body, parse every sample) versus streamed (line by line,
+          unwanted families dropped by the prefix filter). Reports time
+          and peak traced memory at S/4, S/2 and S series.
+  encode  Offline: serialize a /query response of P datapoints (10 series)
+          the way the proxy used to (stdlib jsonify, no compression) and
+          with the fast encoder plus gzip / brotli. Reports CPU time per
+          response and bytes on the wire.
+  suite   Grafana-like traffic against the real metric definitions: V
+          viewers spread over D dashboards of N panels each reload their
+          dashboard R times, every load sending its panel queries 6 at a
+          time like a browser. Metric and result cache TTLs are cut to
+          --cache-ttl, with no stale window, so blocking backend refreshes
+          (and their errors) are part of the measured traffic. The stub
+          serves realistic monitoring payloads padded to --payload-kib and
+          answers --error-rate of calls with 503. Reports throughput,
+          p50/p95/p99 and peak RSS (median of --repeat runs) and compares
+          them with a stored baseline: exit status 1 on a regression
+          beyond --tolerance, 2 if the baseline was recorded with other
+          parameters.
+
+Usage:
+    python scripts/benchmark_json_api_proxy.py
+    python scripts/benchmark_json_api_proxy.py --targets 6 --latency-ms 200 --iterations 30
+    python scripts/benchmark_json_api_proxy.py --scenario load --concurrency 300
+    python scripts/benchmark_json_api_proxy.py --scenario parse --series 50000
+    python scripts/benchmark_json_api_proxy.py --scenario encode --points 10000
+    python scripts/benchmark_json_api_proxy.py --scenario suite
+    python scripts/benchmark_json_api_proxy.py --scenario suite --update-baseline
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROXY_DIR = os.path.join(os.path.dirname(__file__), "..", "json-api-proxy")
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmark_json_api_proxy_baseline.json")
+
+
+class StubBackend:
+    """
+    GatewayZ monitoring API stand-in with injectable latency, errors and
+    payload size. The monitoring endpoints behind metric_definitions.yml
+    get realistic payloads padded to about `payload_bytes`; any other path
+    answers {"value": 42.0}. `error_rate` of calls get a 503.
+    """
+
+    def __init__(self, latency_ms, error_rate=0.0, payload_bytes=0, seed=1):
+        self.latency = latency_ms / 1000.0
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self.payloads = stub_payloads(payload_bytes)
+        rng = random.Random(seed)
+        lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real backend
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with lock:
+                    stub.calls += 1
+                    failed = rng.random() < stub.error_rate
+                    stub.errors += failed
+                time.sleep(stub.latency)
+                path = self.path.split("?", 1)[0]
+                body, content_type = stub.payloads.get(path, stub.payloads[None])
+                status = 200
+                if failed:
+                    status, body = 503, b'{"detail": "stub error"}'
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            request_queue_size = 1024
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def stub_payloads(payload_bytes):
+    """path -> (body, content type) for the stub; None is every other path"""
+    def padded(payload):
+        # Per-request samples like the real endpoints' detail lists
+        samples, size = [], len(json.dumps(payload))
+        while size < payload_bytes:
+            sample = {"provider": f"provider_{len(samples) % 17}",
+                      "latency_ms": len(samples) % 997, "status": 200}
+            samples.append(sample)
+            size += len(json.dumps(sample)) + 2
+        return json.dumps({**payload, "samples": samples}).encode(), "application/json"
+
+    return {
+        "/api/monitoring/stats/realtime": padded(
+            {"avg_health_score": 92.5, "total_requests": 15234, "total_cost": 12.25}
+        ),
+        "/api/monitoring/error-rates": padded({"overall_error_rate": 0.042}),
+        "/prometheus/data/metrics": (
+            exposition_payload(max(200, payload_bytes // 100)), "text/plain; version=0.0.4"
+        ),
+        None: padded({"value": 42.0}),
+    }
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run(client, body, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = client.post("/query", json=body)
+        samples.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.data
+    return samples
+
+
+def register_metrics(proxy, count):
+    from registry import compile_metric
+
+    names = []
+    for i in range(count):
+        name = f"bench_metric_{i}"
+        proxy.metric_registry.metrics[name] = compile_metric({
+            "url": f"/stub/{i}", "params": {}, "path": "value", "ttl": 0,
+        })
+        names.append(name)
+    return names
+
+
+def query_body(names):
+    return {
+        "targets": [{"target": name, "refId": str(i)} for i, name in enumerate(names)],
+        "range": {"from": "now-1h", "to": "now"},
+    }
+
+
+def print_header():
+    print(f"{'mode':<12}{'p50 (ms)':>12}{'p99 (ms)':>12}{'mean (ms)':>12}{'backend calls':>16}")
+
+
+def print_row(mode, samples, calls):
+    print(f"{mode:<12}{percentile(samples, 50):>12.1f}"
+          f"{percentile(samples, 99):>12.1f}{statistics.mean(samples):>12.1f}"
+          f"{calls:>16}")
+
+
+def fanout(args, proxy, stub):
+    names = register_metrics(proxy, args.targets)
+    body = query_body(names)
+    client = proxy.app.test_client()
+    concurrent_pool = proxy.fetch_executor
+    cache = proxy.response_cache
+
+    print(f"{args.targets} targets x {args.latency_ms:.0f}ms stub latency, "
+          f"{args.iterations} iterations per mode")
+    print_header()
+
+    for mode, pool, ttl in (
+        ("serial", ThreadPoolExecutor(max_workers=1), 0),
+        ("concurrent", concurrent_pool, 0),
+        ("cached", concurrent_pool, 60),
+    ):
+        proxy.fetch_executor = pool
+        cache.clear()
+        cache.stale_seconds = 0 if ttl == 0 else proxy.CACHE_STALE_SECONDS
+        for name in names:
+            proxy.metric_registry.metrics[name]["ttl"] = ttl
+
+        calls_before = stub.calls
+        samples = run(client, body, args.iterations)
+        print_row(mode, samples, stub.calls - calls_before)
+
+    proxy.fetch_executor = concurrent_pool
+
+
+def load(args, proxy, stub):
+    import httpx
+    import asgi
+
+    names = register_metrics(proxy, args.concurrency)
+    proxy.response_cache.stale_seconds = 0
+    asgi.response_cache.stale_seconds = 0
+
+    print(f"{args.concurrency} concurrent single-target queries x "
+          f"{args.latency_ms:.0f}ms stub latency")
+    print(f"{'mode':<12}{'p50 (ms)':>12}{'p99 (ms)':>12}{'wall (ms)':>12}{'backend calls':>16}")
+
+    # Sync: two request threads, the capacity of gunicorn --workers 2.
+    client = proxy.app.test_client()
+
+    def timed_sync(name, submitted):
+        # Measured from submission, so time spent queued for a worker counts.
+        response = client.post("/query", json=query_body([name]))
+        assert response.status_code == 200, response.data
+        return (time.perf_counter() - submitted) * 1000
+
+    calls_before = stub.calls
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=2) as workers:
+        futures = [workers.submit(timed_sync, name, time.perf_counter()) for name in names]
+        samples = [f.result() for f in futures]
+    wall = (time.perf_counter() - start) * 1000
+    print(f"{'sync x2':<12}{percentile(samples, 50):>12.1f}{percentile(samples, 99):>12.1f}"
+          f"{wall:>12.1f}{stub.calls - calls_before:>16}")
+
+    # ASGI: every query in flight at once on one event loop.
+    async def run_asgi():
+        asgi.http_client = asgi.build_client()
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+            async def timed(name):
+                start = time.perf_counter()
+                response = await client.post("/query", json=query_body([name]))
+                assert response.status_code == 200, response.text
+                return (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            samples = await asyncio.gather(*(timed(name) for name in names))
+            wall = (time.perf_counter() - start) * 1000
+        await asgi.http_client.aclose()
+        return samples, wall
+
+    calls_before = stub.calls
+    samples, wall = asyncio.run(run_asgi())
+    print(f"{'asgi':<12}{percentile(samples, 50):>12.1f}{percentile(samples, 99):>12.1f}"
+          f"{wall:>12.1f}{stub.calls - calls_before:>16}")
+
+
+def exposition_payload(series, providers=17):
+    """
+    Synthetic exposition: 4 provider families with one sample per provider
+    and model, padded to `series` samples with latency histogram buckets
+    for other backend families (most of the real endpoint's volume).
+    """
+    lines = []
+    models = max(1, series // 200)
+    for family in ("provider_health_score", "provider_circuit_breaker_state",
+                   "provider_error_rate", "provider_availability"):
+        lines.append(f"# TYPE {family} gauge")
+        for p in range(providers):
+            for m in range(models):
+                lines.append(f'{family}{{provider="provider_{p}",model="model_{m}"}} {p + m / 100}')
+
+    lines.append("# TYPE gatewayz_request_duration_seconds histogram")
+    i = 0
+    while len(lines) < series:
+        lines.append(
+            f'gatewayz_request_duration_seconds_bucket{{provider="provider_{i % providers}",'
+            f'model="model_{i // providers}",endpoint="/v1/chat/completions",le="{i % 12}"}} {i}'
+        )
+        i += 1
+    return ("\n".join(lines) + "\n").encode()
+
+
+def measure(fn, repeats=3):
+    """Best wall time (ms) and peak traced memory (KiB) of fn()"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 1024
+
+
+def parse(args):
+    from exposition import parse_samples
+    from providers import ProviderTable
+
+    def buffered(body):
+        table = ProviderTable()
+        for sample in list(parse_samples(body.decode().splitlines())):
+            table.add(*sample)
+        return table
+
+    def streamed(body):
+        return ProviderTable.from_lines(io.BytesIO(body))
+
+    print(f"{'series':>8}{'payload (KiB)':>15}  {'mode':<10}{'time (ms)':>12}{'peak (KiB)':>12}")
+    for series in (args.series // 4, args.series // 2, args.series):
+        body = exposition_payload(series)
+        for mode, fn in (("buffered", buffered), ("streamed", streamed)):
+            elapsed, peak = measure(lambda: fn(body))
+            print(f"{series:>8}{len(body) / 1024:>15.0f}  {mode:<10}{elapsed:>12.1f}{peak:>12.0f}")
+
+        tables = [buffered(body), streamed(body)]
+        assert tables[0].as_table(tables[0].select()) == tables[1].as_table(tables[1].select())
+
+
+def query_response(points, series=10):
+    """A /query response of `points` history datapoints over `series` series"""
+    per_series = points // series
+    start_ms = 1_700_000_000_000
+    return [
+        {
+            "target": f"metric_{s}",
+            "datapoints": [
+                [95.0 + (i % 500) / 100 + s, start_ms + i * 30_000]
+                for i in range(per_series)
+            ],
+        }
+        for s in range(series)
+    ]
+
+
+def encode(args):
+    import serialization
+    from flask import Flask
+    from flask.json.provider import DefaultJSONProvider
+
+    payload = query_response(args.points)
+    flask_app = Flask("bench")
+    flask_app.json = DefaultJSONProvider(flask_app)
+
+    def stdlib_jsonify():
+        with flask_app.app_context():
+            return flask_app.json.response(payload).get_data()
+
+    def fast(encoding=None):
+        body = serialization.dumps(payload)
+        return serialization.compress(body, encoding) if encoding else body
+
+    modes = [
+        ("jsonify", stdlib_jsonify),
+        (serialization.JSON_ENCODER, fast),
+        (f"{serialization.JSON_ENCODER}+gzip", lambda: fast("gzip")),
+    ]
+    if "br" in serialization.SUPPORTED_ENCODINGS:
+        modes.append((f"{serialization.JSON_ENCODER}+br", lambda: fast("br")))
+
+    print(f"{args.points} datapoints")
+    print(f"{'mode':<16}{'time (ms)':>12}{'bytes':>12}")
+    for mode, fn in modes:
+        elapsed, _ = measure(fn, repeats=10)
+        print(f"{mode:<16}{elapsed:>12.2f}{len(fn()):>12}")
+
+
+def dashboard_panels(names, panels):
+    """Target lists of `panels` panels, 1-3 targets each, cycling over `names`"""
+    result, i = [], 0
+    for panel in range(panels):
+        size = 1 + panel % 3
+        result.append([names[(i + k) % len(names)] for k in range(size)])
+        i += size
+    return result
+
+
+def grafana_query(targets, dashboard_uid, hours=6, interval_ms=30_000):
+    """A /query body as Grafana sends it for a panel over the last `hours`"""
+    now = datetime.now(timezone.utc)
+    start = datetime.fromtimestamp(now.timestamp() - hours * 3600, timezone.utc)
+    return {
+        "targets": [
+            {"target": target, "refId": chr(ord("A") + i), "type": "timeserie"}
+            for i, target in enumerate(targets)
+        ],
+        "range": {
+            "from": start.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "to": now.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+        },
+        "intervalMs": interval_ms,
+        "maxDataPoints": hours * 3600_000 // interval_ms,
+        "dashboardUID": dashboard_uid,
+    }
+
+
+def peak_rss_mib():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def suite_config(args):
+    """Parameters a baseline is only comparable under"""
+    return {
+        "dashboards": args.dashboards,
+        "panels": args.panels,
+        "viewers": args.viewers,
+        "rounds": args.rounds,
+        "latency_ms": args.latency_ms,
+        "error_rate": args.error_rate,
+        "payload_kib": args.payload_kib,
+        "cache_ttl": args.cache_ttl,
+        "refresh_ms": args.refresh_ms,
+        "repeat": args.repeat,
+    }
+
+
+def suite_run(args, proxy):
+    """Drive the traffic and return the measured results"""
+    names = list(proxy.metric_registry.metrics)
+    panels = dashboard_panels(names, args.panels)
+    # Short TTLs and no stale window, so expired responses are refetched
+    # while queries wait, as without the background prefetcher.
+    for config in proxy.metric_registry.metrics.values():
+        config["ttl"] = args.cache_ttl
+    proxy.result_cache.ttl = args.cache_ttl
+    proxy.response_cache.stale_seconds = 0
+    client = proxy.app.test_client()
+    samples, statuses = [], []
+    lock = threading.Lock()
+
+    def load_dashboard(browser, dashboard_uid):
+        def panel_query(targets):
+            start = time.perf_counter()
+            response = client.post("/query", json=grafana_query(targets, dashboard_uid))
+            with lock:
+                samples.append((time.perf_counter() - start) * 1000)
+                statuses.append(response.status_code)
+        list(browser.map(panel_query, panels))
+
+    def viewer(index):
+        dashboard_uid = f"dashboard-{index % args.dashboards}"
+        # Viewers open their dashboards at staggered times.
+        time.sleep(index * args.refresh_ms / 1000 / args.viewers)
+        with ThreadPoolExecutor(max_workers=6) as browser:
+            for _ in range(args.rounds):
+                load_dashboard(browser, dashboard_uid)
+                time.sleep(args.refresh_ms / 1000)
+
+    # One unmeasured load per dashboard, so results are steady state rather
+    # than the first cold fetches.
+    with ThreadPoolExecutor(max_workers=6) as browser:
+        for dashboard in range(args.dashboards):
+            load_dashboard(browser, f"dashboard-{dashboard}")
+    samples.clear()
+    statuses.clear()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.viewers) as viewers:
+        list(viewers.map(viewer, range(args.viewers)))
+    # Think time between reloads is not load on the proxy.
+    busy = time.perf_counter() - start - args.rounds * args.refresh_ms / 1000
+
+    return {
+        "queries": len(samples),
+        "throughput_rps": round(len(samples) / max(busy, 1e-3), 1),
+        "p50_ms": round(percentile(samples, 50), 2),
+        "p95_ms": round(percentile(samples, 95), 2),
+        "p99_ms": round(percentile(samples, 99), 2),
+        "error_rate": round(sum(status != 200 for status in statuses) / len(statuses), 4),
+        "peak_rss_mib": round(peak_rss_mib(), 1),
+    }
+
+
+def check_regressions(results, baseline, tolerance, slack_ms):
+    """Descriptions of every result worse than the baseline allows"""
+    failures = []
+    for metric in ("p50_ms", "p95_ms", "p99_ms"):
+        limit = baseline[metric] * (1 + tolerance) + slack_ms
+        if results[metric] > limit:
+            failures.append(f"{metric} {results[metric]} > {limit:.2f} (baseline {baseline[metric]})")
+    limit = baseline["throughput_rps"] * (1 - tolerance)
+    if results["throughput_rps"] < limit:
+        failures.append(f"throughput_rps {results['throughput_rps']} < {limit:.1f} "
+                        f"(baseline {baseline['throughput_rps']})")
+    limit = baseline["peak_rss_mib"] * (1 + tolerance)
+    if results["peak_rss_mib"] > limit:
+        failures.append(f"peak_rss_mib {results['peak_rss_mib']} > {limit:.1f} "
+                        f"(baseline {baseline['peak_rss_mib']})")
+    limit = baseline["error_rate"] + 0.01
+    if results["error_rate"] > limit:
+        failures.append(f"error_rate {results['error_rate']} > {limit:.4f} "
+                        f"(baseline {baseline['error_rate']})")
+    return failures
+
+
+def suite(args, proxy, stub):
+    config = suite_config(args)
+    print(f"{args.viewers} viewers on {args.dashboards} dashboards x {args.panels} panels, "
+          f"{args.rounds} loads each; stub {args.latency_ms:.0f}ms, "
+          f"{args.error_rate:.0%} errors, {args.payload_kib} KiB payloads; "
+          f"median of {args.repeat} runs")
+
+    # Median of several runs: a run's p99 hinges on a handful of retried
+    # backend errors.
+    runs = []
+    for _ in range(args.repeat):
+        proxy.response_cache.clear()
+        proxy.result_cache.clear()
+        calls_before = stub.calls
+        runs.append(dict(suite_run(args, proxy), backend_calls=stub.calls - calls_before))
+    results = {metric: statistics.median(run[metric] for run in runs) for metric in runs[0]}
+    results["peak_rss_mib"] = max(run["peak_rss_mib"] for run in runs)
+    print(f"{'queries':>8}{'rps':>10}{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}"
+          f"{'errors':>8}{'rss (MiB)':>11}{'backend calls':>15}")
+    print(f"{results['queries']:>8.0f}{results['throughput_rps']:>10.1f}{results['p50_ms']:>10.1f}"
+          f"{results['p95_ms']:>10.1f}{results['p99_ms']:>10.1f}{results['error_rate']:>8.1%}"
+          f"{results['peak_rss_mib']:>11.1f}{results['backend_calls']:>15.0f}")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "config": config,
+                "results": results,
+                "python": platform.python_version(),
+                "recorded": datetime.now(timezone.utc).date().isoformat(),
+            }, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline}; record one with --update-baseline")
+        return 0
+    if baseline["config"] != config:
+        print(f"Baseline {args.baseline} was recorded with {baseline['config']}; "
+              f"rerun with the same parameters or --update-baseline")
+        return 2
+
+    failures = check_regressions(results, baseline["results"], args.tolerance, args.slack_ms)
+    for failure in failures:
+        print(f"REGRESSION: {failure}")
+    if not failures:
+        print(f"No regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scenario", choices=("fanout", "load", "parse", "encode", "suite"),
+                        default="fanout")
+    parser.add_argument("--targets", type=int, default=6, help="fanout: distinct backend endpoints per /query")
+    parser.add_argument("--iterations", type=int, default=20, help="fanout: /query requests per mode")
+    parser.add_argument("--concurrency", type=int, default=200, help="load: simultaneous /query requests")
+    parser.add_argument("--latency-ms", type=float, default=100, help="stub backend latency per call")
+    parser.add_argument("--series", type=int, default=50000, help="parse: samples in the largest payload")
+    parser.add_argument("--points", type=int, default=10000, help="encode: datapoints in the response")
+    parser.add_argument("--dashboards", type=int, default=3, help="suite: distinct dashboards")
+    parser.add_argument("--panels", type=int, default=12, help="suite: panels per dashboard")
+    parser.add_argument("--viewers", type=int, default=12, help="suite: concurrent viewers")
+    parser.add_argument("--rounds", type=int, default=10, help="suite: dashboard loads per viewer")
+    parser.add_argument("--refresh-ms", type=float, default=300, help="suite: pause between a viewer's loads")
+    parser.add_argument("--error-rate", type=float, default=0.02, help="suite: fraction of stub calls failing")
+    parser.add_argument("--payload-kib", type=int, default=64, help="suite: backend payload size")
+    parser.add_argument("--cache-ttl", type=float, default=0.5,
+                        help="suite: TTL of every metric and of cached /query results")
+    parser.add_argument("--repeat", type=int, default=3, help="suite: runs to take the median of")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="suite: baseline results file")
+    parser.add_argument("--update-baseline", action="store_true", help="suite: record the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="suite: allowed relative regression")
+    parser.add_argument("--slack-ms", type=float, default=5.0, help="suite: allowed absolute latency regression")
+    args = parser.parse_args()
+
+    sys.path.insert(0, PROXY_DIR)
+    if args.scenario == "parse":
+        parse(args)
+        return
+    if args.scenario == "encode":
+        encode(args)
+        return
+
+    os.environ["PREFETCH_ENABLED"] = "false"
+    os.environ["SHARED_CACHE_ENABLED"] = "false"
+    os.environ["SNAPSHOT_ENABLED"] = "false"
+    # Measure raw capacity; admission control would shed most of the load.
+    os.environ["ADMISSION_ENABLED"] = "false"
+    import app as proxy
+    logging.getLogger().setLevel(logging.WARNING)
+
+    stub = (StubBackend(args.latency_ms, args.error_rate, args.payload_kib * 1024)
+            if args.scenario == "suite" else StubBackend(args.latency_ms))
+    with stub:
+        proxy.API_BASE_URL = stub.url
+        if args.scenario == "fanout":
+            fanout(args, proxy, stub)
+        elif args.scenario == "load":
+            load(args, proxy, stub)
+        else:
+            sys.exit(suite(args, proxy, stub))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+collapse_rows.py
+Moves the dashboard rows below the fold into collapsed rows, with their
+panels nested under the row, so Grafana only runs those queries when the
+row is expanded.
+
+Every dashboard under grafana/dashboards/** is split into sections at its
+row panels (ordered by position). A section whose row is drawn at or
+below --fold (in grid units from the top, after Grafana floats panels up
+into empty space) is collapsed. Panels above the first
+row that sit below the fold are put in a new collapsed row. Rows that are
+already collapsed keep their panels, and pick up any top-level panels
+laid out under them. Sections above the fold stay expanded, and rows
+below move up to close the gaps.
+
+The JSON text is edited in place (see dashboard_queries.set_member), so
+the hand-formatted dashboards keep their layout apart from the moved
+panels.
+
+The report gives, per dashboard, the queries executed on initial load
+before and after: targets of the panels outside collapsed rows, not
+counting hidden targets or "-- Dashboard --" targets, which reuse
+another panel's results.
+
+Usage:
+    python scripts/collapse_rows.py               # report
+    python scripts/collapse_rows.py --write       # collapse the rows in place
+    python scripts/collapse_rows.py --check       # exit 1 if a row below the fold is expanded
+    python scripts/collapse_rows.py --fold 30
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import dashboard_queries as dq  # noqa: E402
+
+# Grid units visible without scrolling on a 1080p screen: 30px cells with
+# 8px margins, below Grafana's top bar
+FOLD = 24
+
+NEW_ROW_TITLE = "More"
+
+
+def initial_queries(dashboard):
+    """Queries Grafana runs when `dashboard` loads"""
+    count = 0
+    for panel in dashboard.get("panels", []):
+        if panel.get("type") == "row":
+            continue
+        inherited = panel.get("datasource")
+        for target in panel.get("targets") or []:
+            datasource = target.get("datasource") or inherited
+            uid = datasource.get("uid") if isinstance(datasource, dict) else datasource
+            if not target.get("hide") and uid != dq.DASHBOARD["uid"]:
+                count += 1
+    return count
+
+
+class Section:
+    """A row and the top-level panels laid out under it (or the panels above every row)"""
+
+    def __init__(self, row=None):
+        self.row = row
+        self.panels = []
+
+    @property
+    def top(self):
+        return self.row[0]["gridPos"]["y"] if self.row else 0
+
+
+def _y(panel):
+    return panel["gridPos"].get("y", 0)
+
+
+def _bottom(panel):
+    return _y(panel) + panel["gridPos"].get("h", 0)
+
+
+def _indent(text, pos):
+    """Indentation of the line holding `pos`"""
+    line = text.rfind("\n", 0, pos) + 1
+    return re.compile(r" *").match(text, line).group()
+
+
+def _reindent(text, extra):
+    return text.replace("\n", "\n" + extra)
+
+
+def _with_y(text, y):
+    """The panel JSON `text` moved to row `y`"""
+    grid = dq.json_member(text, 0, "gridPos")
+    if grid is None:
+        return dq.set_member(text, 0, "gridPos", json.dumps({"y": y}))
+    value = dq.set_member(text[grid[0]:grid[1]], 0, "y", str(y))
+    return text[:grid[0]] + value + text[grid[1]:]
+
+
+def visual_y(panels):
+    """
+    id(panel) -> the row Grafana draws each panel at: its grid floats
+    panels up into any empty space above them
+    """
+    placed, result = [], {}
+    for panel in sorted(panels, key=lambda p: (_y(p), p["gridPos"].get("x", 0))):
+        grid = panel["gridPos"]
+        x, w = grid.get("x", 0), grid.get("w", 24)
+        y = max([bottom for left, right, bottom in placed if left < x + w and x < right],
+                default=0)
+        result[id(panel)] = y
+        placed.append((x, x + w, y + grid.get("h", 0)))
+    return result
+
+
+def sections(items):
+    """`items` ((panel, text) pairs) grouped into Sections, top to bottom"""
+    ordered = sorted(items, key=lambda item: (_y(item[0]), item[0]["gridPos"].get("x", 0)))
+    result = [Section()]
+    for item in ordered:
+        if item[0].get("type") == "row":
+            result.append(Section(item))
+        else:
+            result[-1].panels.append(item)
+    return result
+
+
+def collapse(text, fold=FOLD):
+    """`text` (a dashboard) with its sections below `fold` collapsed"""
+    dashboard = json.loads(text)
+    root = text.index("{")
+    array = dq.json_member(text, root, "panels")
+    if array is None or text[array[0]] != "[":
+        return text
+    spans = dq.json_children(text, array[0])
+    if not spans:
+        return text
+    items = [(json.loads(text[start:end]), text[start:end]) for start, end in spans]
+    item_indent = _indent(text, spans[0][0])
+    unit = item_indent[len(_indent(text, array[0])):] or "  "
+
+    parts = sections(items)
+    shown = visual_y([panel for panel, _ in items])
+    header = parts[0]
+    below = [item for item in header.panels if shown[id(item[0])] >= fold]
+    if below:
+        header.panels = [item for item in header.panels if shown[id(item[0])] < fold]
+        ids = [p.get("id", 0) for p in dq.iter_panels(dashboard["panels"])]
+        row = {"collapsed": False, "gridPos": {"h": 1, "w": 24, "x": 0, "y": _y(below[0][0])},
+               "id": max(ids, default=0) + 1, "panels": [], "title": NEW_ROW_TITLE,
+               "type": "row"}
+        row_text = _reindent(json.dumps(row, indent=len(unit), ensure_ascii=False),
+                             item_indent)
+        section = Section((row, row_text))
+        section.panels = below
+        parts.insert(1, section)
+        shown[id(row)] = fold
+
+    def collapsed(section):
+        row = section.row[0] if section.row else None
+        return row is not None and (row.get("collapsed") or shown[id(row)] >= fold)
+
+    if not any(collapsed(s) and (s.panels or not s.row[0].get("collapsed")) for s in parts):
+        return text
+
+    new = {}  # id(panel) -> new text, for the items kept at the top level
+    cursor = 0
+    for section in parts:
+        if not collapsed(section):
+            shift = cursor - section.top if section.row else 0
+            for panel, panel_text in ([section.row] if section.row else []) + section.panels:
+                new[id(panel)] = _with_y(panel_text, _y(panel) + shift) if shift else panel_text
+            cursor = max([cursor] + [_bottom(p) + shift for p, _ in
+                                     ([section.row] if section.row else []) + section.panels])
+            continue
+        row, row_text = section.row
+        row_text = _with_y(row_text, cursor)
+        if section.panels or not row.get("collapsed"):
+            row_text = dq.set_member(row_text, 0, "collapsed", "true")
+            nested = dq.json_member(row_text, 0, "panels")
+            kept = [(child, row_text[a:b]) for child, (a, b) in zip(
+                row.get("panels") or [], dq.json_children(row_text, nested[0]) if nested else [])]
+            moved = [(panel, _reindent(panel_text, unit * 2))
+                     for panel, panel_text in section.panels]
+            # A stale nested copy of a panel that is also laid out under the row
+            # would show up twice once expanded
+            kept = [(child, child_text) for child, child_text in kept
+                    if child.get("id") not in {panel.get("id") for panel, _ in moved}]
+            children = sorted(kept + moved, key=lambda c: (_y(c[0]), c[0]["gridPos"].get("x", 0)))
+            # Laid out right under the row, as Grafana saves a collapsed row
+            first = _y(children[0][0]) if children else 0
+            inner = item_indent + unit * 2
+            row_text = dq.set_member(row_text, 0, "panels", "[\n" + inner + (",\n" + inner).join(
+                _with_y(child_text, _y(child) - first + cursor + 1)
+                for child, child_text in children
+            ) + "\n" + item_indent + unit + "]" if children else "[]")
+        new[id(row)] = row_text
+        cursor += 1
+
+    # Keep the original order of the top-level items, new rows last
+    order = [panel for panel, _ in items if id(panel) in new]
+    order += [s.row[0] for s in parts if s.row and id(s.row[0]) in new and
+              all(s.row[0] is not panel for panel, _ in items)]
+    body = "[\n" + item_indent + (",\n" + item_indent).join(new[id(p)] for p in order) + \
+        "\n" + _indent(text, array[0]) + "]"
+    return text[:array[0]] + body + text[array[1]:]
+
+
+def dashboard_files():
+    return sorted(glob.glob(dq.DASHBOARDS_GLOB, recursive=True))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--write", action="store_true", help="rewrite the dashboards in place")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 if any dashboard has an expanded row below the fold")
+    parser.add_argument("--fold", type=int, default=FOLD,
+                        help=f"grid units visible without scrolling (default {FOLD})")
+    args = parser.parse_args(argv)
+
+    print(f"{'dashboard':<58} {'queries on initial load':>24}")
+    changed = []
+    before_total = after_total = 0
+    for path in dashboard_files():
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        new_text = collapse(text, args.fold)
+        before = initial_queries(json.loads(text))
+        after = initial_queries(json.loads(new_text))
+        before_total += before
+        after_total += after
+        print(f"{dq.relpath(path)[-58:]:<58} {before:>11} -> {after:<9}")
+        if new_text != text:
+            changed.append(path)
+            if args.write:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(new_text)
+    print(f"{'total':<58} {before_total:>11} -> {after_total:<9}")
+
+    if args.write:
+        for path in changed:
+            print(f"rewrote {dq.relpath(path)}")
+    elif args.check and changed:
+        print(f"\n{len(changed)} dashboards have expanded rows below the fold; "
+              "run scripts/collapse_rows.py --write")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
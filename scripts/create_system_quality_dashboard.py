@@ -3,10 +3,17 @@ create_system_quality_dashboard.py
 Generates grafana/dashboards/reliability/System-Reliability-Dashboard.json
 8-pillar System Quality dashboard for GatewayZ LGTM stack.
 """
-import json, os
+import json, os, sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import collapse_rows  # noqa: E402
+import dedupe_panel_queries  # noqa: E402
 
 PROM = {"type": "prometheus", "uid": "grafana_prometheus"}
 LOKI = {"type": "loki", "uid": "grafana_loki"}
+# Loki recording rules (loki/rules/) are written to Mimir
+MIMIR = {"type": "prometheus", "uid": "grafana_mimir"}
 
 OUT_PATH = os.path.join(
     os.path.dirname(__file__),
@@ -180,47 +187,6 @@ def logs_panel(pid, title, expr, x, y, w=24, h=8):
     }
 
 
-def loki_timeseries(pid, title, targets, unit, x, y, w=12, h=8):
-    built = []
-    for ref, expr, legend in targets:
-        built.append({
-            "refId": ref,
-            "datasource": LOKI,
-            "expr": expr,
-            "legendFormat": legend,
-            "queryType": "range"
-        })
-    return {
-        "id": pid,
-        "type": "timeseries",
-        "title": title,
-        "datasource": LOKI,
-        "gridPos": {"h": h, "w": w, "x": x, "y": y},
-        "targets": built,
-        "options": {
-            "tooltip": {"mode": "multi", "sort": "desc"},
-            "legend": {
-                "displayMode": "table",
-                "placement": "right",
-                "calcs": ["mean", "max", "lastNotNull"]
-            }
-        },
-        "fieldConfig": {
-            "defaults": {
-                "unit": unit,
-                "color": {"mode": "palette-classic"},
-                "custom": {
-                    "lineWidth": 1,
-                    "fillOpacity": 10,
-                    "showPoints": "never",
-                    "spanNulls": True
-                }
-            },
-            "overrides": []
-        }
-    }
-
-
 panels = []
 
 # ── Header ──────────────────────────────────────────────────────────────────
@@ -248,13 +214,13 @@ Y = 3
 panels.append(row(100, "🛡️  Reliability — SLO Compliance · Error Rate · Exception Tracking", Y))
 Y += 1
 
-err5_expr = ('sum(rate(fastapi_requests_total{status_code=~"5.."}[5m])) / '
-             'clamp_min(sum(rate(fastapi_requests_total[5m])), 0.001)')
-slo_expr = ('(1 - sum(rate(fastapi_requests_total{status_code=~"5.."}[5m])) / '
-            'clamp_min(sum(rate(fastapi_requests_total[5m])), 0.001)) * 100')
-err4_expr = ('sum(rate(fastapi_requests_total{status_code=~"4.."}[5m])) / '
-             'clamp_min(sum(rate(fastapi_requests_total[5m])), 0.001)')
-exc_expr = 'sum(rate(fastapi_exceptions_total[5m])) * 60'
+err5_expr = ('sum(endpoint_status_code:fastapi_requests:rate5m{status_code=~"5.."}) / '
+             'clamp_min(sum(endpoint_status_code:fastapi_requests:rate5m), 0.001)')
+slo_expr = ('(1 - sum(endpoint_status_code:fastapi_requests:rate5m{status_code=~"5.."}) / '
+            'clamp_min(sum(endpoint_status_code:fastapi_requests:rate5m), 0.001)) * 100')
+err4_expr = ('sum(endpoint_status_code:fastapi_requests:rate5m{status_code=~"4.."}) / '
+             'clamp_min(sum(endpoint_status_code:fastapi_requests:rate5m), 0.001)')
+exc_expr = 'sum(exception_type:fastapi_exceptions:rate5m) * 60'
 
 panels.append(stat(101, "5xx Error Rate", err5_expr, "percentunit",
     [{"color": "green", "value": None}, {"color": "yellow", "value": 0.001},
@@ -280,7 +246,7 @@ panels.append(timeseries(106, "SLO Compliance Over Time (% Successful Requests)"
 Y += 8
 
 panels.append(bargauge(107, "Exception Volume by Type",
-    [("A", 'sum by (exception_type) (rate(fastapi_exceptions_total[5m]))', "{{exception_type}}")],
+    [("A", 'exception_type:fastapi_exceptions:rate5m', "{{exception_type}}")],
     "short", 0, Y, w=24, h=6,
     thresholds=[{"color": "green", "value": None}, {"color": "yellow", "value": 0.01},
                 {"color": "red", "value": 0.1}]))
@@ -292,11 +258,11 @@ Y += 6
 panels.append(row(200, "⚡  Performance — Latency · Throughput · Streaming TTFC", Y))
 Y += 1
 
-p50_expr = 'histogram_quantile(0.50, sum(rate(fastapi_requests_duration_seconds_bucket[5m])) by (le))'
-p95_expr = 'histogram_quantile(0.95, sum(rate(fastapi_requests_duration_seconds_bucket[5m])) by (le))'
-p99_expr = 'histogram_quantile(0.99, sum(rate(fastapi_requests_duration_seconds_bucket[5m])) by (le))'
-rps_expr = 'sum(rate(fastapi_requests_total[5m]))'
-ttfc_expr = 'histogram_quantile(0.95, sum(rate(time_to_first_chunk_seconds_bucket[5m])) by (le))'
+p50_expr = 'histogram_quantile(0.50, sum(status_code:fastapi_requests_duration_seconds_bucket:rate5m) by (le))'
+p95_expr = 'histogram_quantile(0.95, sum(status_code:fastapi_requests_duration_seconds_bucket:rate5m) by (le))'
+p99_expr = 'histogram_quantile(0.99, sum(status_code:fastapi_requests_duration_seconds_bucket:rate5m) by (le))'
+rps_expr = 'sum(endpoint_status_code:fastapi_requests:rate5m)'
+ttfc_expr = 'histogram_quantile(0.95, sum(model_provider:time_to_first_chunk_seconds_bucket:rate5m) by (le))'
 
 panels.append(stat(201, "P50 Latency", p50_expr, "s",
     [{"color": "green", "value": None}, {"color": "yellow", "value": 0.2},
@@ -328,7 +294,7 @@ Y += 8
 
 panels.append(timeseries(208, "Inference Latency P95 by Provider",
     [("A",
-      'histogram_quantile(0.95, sum(rate(model_inference_duration_seconds_bucket[5m])) by (le, provider))',
+      'histogram_quantile(0.95, sum(model_provider:model_inference_duration_seconds_bucket:rate5m) by (le, provider))',
       "{{provider}}", None)],
     "s", 0, Y, w=24, h=8))
 Y += 8
@@ -340,11 +306,11 @@ panels.append(row(300, "📈  Scalability — Concurrency · Cache · Token Thro
 Y += 1
 
 inflight_expr = 'sum(fastapi_requests_in_progress)'
-cache_expr = ('sum(rate(catalog_cache_hits_total[5m])) / '
-              'clamp_min(sum(rate(catalog_cache_hits_total[5m])) + '
+cache_expr = ('global:catalog_cache_hits:rate5m / '
+              'clamp_min(global:catalog_cache_hits:rate5m + '
               'sum(rate(catalog_cache_misses_total[5m])), 0.001) * 100')
-tokens_expr = 'sum(rate(tokens_used_total[5m])) * 60'
-infer_rps = 'sum(rate(model_inference_requests_total[5m]))'
+tokens_expr = 'sum(model_provider_token_type:tokens_used:rate5m) * 60'
+infer_rps = 'sum(model_provider_status:model_inference_requests:rate5m)'
 replica_expr = ('sum(rate(read_replica_queries_total{status="success"}[5m])) / '
                 'clamp_min(sum(rate(read_replica_queries_total[5m])), 0.001) * 100')
 
@@ -369,7 +335,7 @@ panels.append(timeseries(306, "In-Flight Request Concurrency Over Time",
     [("A", inflight_expr, "in-flight requests", None)],
     "short", 0, Y, w=12, h=8))
 panels.append(timeseries(307, "Token Throughput by Provider (tokens/min)",
-    [("A", 'sum by (provider) (rate(tokens_used_total[5m])) * 60', "{{provider}}", None)],
+    [("A", 'sum by (provider) (model_provider_token_type:tokens_used:rate5m) * 60', "{{provider}}", None)],
     "short", 12, Y, w=12, h=8))
 Y += 8
 
@@ -384,8 +350,8 @@ Y += 6
 panels.append(row(400, "✅  Availability — Provider Health · Circuit Breakers · Success Rate", Y))
 Y += 1
 
-success_rate = ('(1 - sum(rate(fastapi_requests_total{status_code=~"5.."}[5m])) / '
-                'clamp_min(sum(rate(fastapi_requests_total[5m])), 0.001)) * 100')
+success_rate = ('(1 - sum(endpoint_status_code:fastapi_requests:rate5m{status_code=~"5.."}) / '
+                'clamp_min(sum(endpoint_status_code:fastapi_requests:rate5m), 0.001)) * 100')
 
 panels.append(stat(401, "Overall Request Success Rate", success_rate, "percent",
     [{"color": "red", "value": None}, {"color": "yellow", "value": 95},
@@ -420,11 +386,11 @@ panels.append(row(500, "🔭  Observability — Logs · Exceptions · Pipeline H
 Y += 1
 
 panels.append(loki_stat(501, "ERROR Log Rate (5m)",
-    'sum(rate({app=~"gatewayz.*"} |= "ERROR" [5m]))', "short",
+    'sum(rate({app=~"gatewayz.*", level="ERROR"} [5m]))', "short",
     [{"color": "green", "value": None}, {"color": "yellow", "value": 0.1},
      {"color": "red", "value": 1}], 0, Y))
 panels.append(loki_stat(502, "CRITICAL Log Rate (5m)",
-    'sum(rate({app=~"gatewayz.*"} |= "CRITICAL" [5m]))', "short",
+    'sum(rate({app=~"gatewayz.*", level="CRITICAL"} [5m]))', "short",
     [{"color": "green", "value": None}, {"color": "red", "value": 0.01}], 6, Y))
 panels.append(stat(503, "Unhandled Exceptions / min", exc_expr, "short",
     [{"color": "green", "value": None}, {"color": "yellow", "value": 1},
@@ -436,19 +402,19 @@ panels.append(stat(504, "Loki Log Queue Depth",
 Y += 4
 
 panels.append(timeseries(505, "Exception Rate Over Time by Type",
-    [("A", 'sum by (exception_type) (rate(fastapi_exceptions_total[5m]))',
+    [("A", 'exception_type:fastapi_exceptions:rate5m',
       "{{exception_type}}", None)],
     "short", 0, Y, w=12, h=8))
 
-panels.append(loki_timeseries(506, "Log Volume by Level (INFO / WARNING / ERROR)",
-    [("A", 'sum(rate({app=~"gatewayz.*"} | level="INFO" [5m]))', "INFO"),
-     ("B", 'sum(rate({app=~"gatewayz.*"} | level="WARNING" [5m]))', "WARNING"),
-     ("C", 'sum(rate({app=~"gatewayz.*"} | level=~"ERROR|CRITICAL" [5m]))', "ERROR/CRITICAL")],
-    "short", 12, Y, w=12, h=8))
+panels.append(timeseries(506, "Log Volume by Level (INFO / WARNING / ERROR)",
+    [("A", 'loki:info:rate5m', "INFO", None),
+     ("B", 'loki:warning:rate5m', "WARNING", None),
+     ("C", 'loki:error_critical:rate5m', "ERROR/CRITICAL", None)],
+    "short", 12, Y, w=12, h=8, datasource=MIMIR))
 Y += 8
 
 panels.append(logs_panel(507, "Recent ERROR / CRITICAL Logs",
-    '{app=~"gatewayz.*"} | level=~"ERROR|CRITICAL" | logfmt',
+    '{app=~"gatewayz.*", level=~"ERROR|CRITICAL"} | logfmt',
     0, Y, w=24, h=8))
 Y += 8
 
@@ -496,7 +462,7 @@ panels.append(timeseries(606, "Velocity Mode Activation History",
 Y += 8
 
 panels.append(timeseries(607, "Rate Limit Rejections by Endpoint",
-    [("A", 'sum by (endpoint) (rate(rate_limit_rejections_total[5m]))',
+    [("A", 'endpoint:rate_limit_rejections:rate5m',
       "{{endpoint}}", None)],
     "short", 0, Y, w=24, h=6))
 Y += 6
@@ -507,11 +473,11 @@ Y += 6
 panels.append(row(700, "🔒  Security — Auth Failures · Rate Limits · Velocity Mode", Y))
 Y += 1
 
-auth_rate = ('sum(rate(fastapi_requests_total{status_code=~"401|403"}[5m])) / '
-             'clamp_min(sum(rate(fastapi_requests_total[5m])), 0.001) * 100')
-rl_rate = ('sum(rate(fastapi_requests_total{status_code="429"}[5m])) / '
-           'clamp_min(sum(rate(fastapi_requests_total[5m])), 0.001) * 100')
-rl_rejections = 'sum(rate(rate_limit_rejections_total[5m])) or vector(0)'
+auth_rate = ('sum(endpoint_status_code:fastapi_requests:rate5m{status_code=~"401|403"}) / '
+             'clamp_min(sum(endpoint_status_code:fastapi_requests:rate5m), 0.001) * 100')
+rl_rate = ('sum(endpoint_status_code:fastapi_requests:rate5m{status_code="429"}) / '
+           'clamp_min(sum(endpoint_status_code:fastapi_requests:rate5m), 0.001) * 100')
+rl_rejections = 'sum(endpoint:rate_limit_rejections:rate5m) or vector(0)'
 
 panels.append(stat(701, "Auth Failure Rate (401/403)", auth_rate, "percent",
     [{"color": "green", "value": None}, {"color": "yellow", "value": 1},
@@ -532,17 +498,17 @@ panels.append(stat(704, "Velocity Mode Active",
 Y += 4
 
 panels.append(timeseries(705, "Auth Failure Rate Over Time",
-    [("A", 'sum(rate(fastapi_requests_total{status_code=~"401|403"}[5m]))',
+    [("A", 'sum(endpoint_status_code:fastapi_requests:rate5m{status_code=~"401|403"})',
       "401/403 failures/s", None)],
     "short", 0, Y, w=12, h=8))
 panels.append(timeseries(706, "Rate Limit Rejections Over Time by Endpoint",
-    [("A", 'sum by (endpoint) (rate(rate_limit_rejections_total[5m])) or vector(0)',
+    [("A", 'endpoint:rate_limit_rejections:rate5m or vector(0)',
       "{{endpoint}}", None)],
     "short", 12, Y, w=12, h=8))
 Y += 8
 
 panels.append(logs_panel(707, "Recent Security Warnings",
-    '{app=~"gatewayz.*"} | level="WARNING" | logfmt',
+    '{app=~"gatewayz.*", level="WARNING"} | logfmt',
     0, Y, w=24, h=7))
 Y += 7
 
@@ -608,10 +574,14 @@ dashboard = {
     "links": []
 }
 
+# Pillars below the fold load collapsed, so their queries only run on expand;
+# panels repeating another panel's queries then reuse its results
+text = collapse_rows.collapse(json.dumps(dashboard, indent=2, ensure_ascii=False))
+text = dedupe_panel_queries.dedupe(text)
+
 os.makedirs(os.path.dirname(OUT_PATH), exist_ok=True)
 with open(OUT_PATH, "w", encoding="utf-8") as f:
-    json.dump(dashboard, f, indent=2, ensure_ascii=False)
-    f.write("\n")
+    f.write(text + "\n")
 
 print(f"Written: {OUT_PATH}")
 print(f"Total panels: {len(panels)}")
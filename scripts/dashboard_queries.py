@@ -0,0 +1,496 @@
+"""
+dashboard_queries.py
+Finds every query in the Grafana dashboards and alert rules, and the
+recording rules they could use; shared by the dashboard query tools.
+
+Files are edited in place by replacing the query text only (`replace_expr`),
+so hand-formatted JSON and commented YAML keep their layout.
+"""
+import glob
+import json
+import os
+import re
+
+import yaml
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(__file__), ".."))
+DASHBOARDS_GLOB = os.path.join(ROOT, "grafana", "dashboards", "**", "*.json")
+ALERT_RULES_GLOB = os.path.join(ROOT, "grafana", "provisioning", "alerting", "rules", "*.yml")
+PROMETHEUS_CONFIG = os.path.join(ROOT, "prometheus", "prometheus.yml")
+PROMETHEUS_RULES = os.path.join(ROOT, "prometheus", "recording_rules_baselines.yml")
+LOKI_RULES = os.path.join(ROOT, "loki", "rules", "gatewayz_log_recording_rules.yml")
+TEMPO_CONFIG = os.path.join(ROOT, "tempo", "tempo.yml")
+
+# Recording rules are evaluated by Prometheus and remote-written to Mimir,
+# so queries on either datasource can use them. Loki rules land in Mimir.
+PROMETHEUS_UIDS = {"grafana_prometheus", "grafana_mimir"}
+LOKI_UIDS = {"grafana_loki"}
+# Alert queries without a datasourceUid run on the default datasource
+DEFAULT_UID = "grafana_prometheus"
+# Where Prometheus and Loki recording rules are remote-written
+MIMIR = {"type": "prometheus", "uid": "grafana_mimir"}
+MIXED = {"type": "datasource", "uid": "-- Mixed --"}
+# Reuses the results of another panel on the same dashboard
+DASHBOARD = {"type": "datasource", "uid": "-- Dashboard --"}
+# Metric name prefixes of each Tempo metrics generator processor
+TEMPO_METRIC_PREFIXES = {
+    "span-metrics": "traces_spanmetrics_",
+    "service-graphs": "traces_service_graph_",
+}
+
+
+class Query:
+    """
+    One PromQL or LogQL query: a dashboard panel target or an alert rule's
+    data entry. `target` is the dict holding `expr`, so a tool can edit it.
+    """
+
+    def __init__(self, path, source, title, language, target, panel=None, refresh=None,
+                 uid=None):
+        self.path = path
+        self.source = source
+        self.title = title
+        self.language = language
+        # Datasource uid the query runs on
+        self.uid = uid
+        self.target = target
+        self.panel = panel
+        self.refresh = refresh
+
+    @property
+    def expr(self):
+        return self.target["expr"]
+
+    @property
+    def where(self):
+        if self.panel is not None:
+            name = self.panel.get("title") or f"panel {self.panel.get('id')}"
+        else:
+            name = f"{self.title} ({self.target.get('refId', '')})"
+        return f"{relpath(self.path)} :: {name}"
+
+
+def relpath(path):
+    return os.path.relpath(path, ROOT)
+
+
+def refresh_seconds(text):
+    m = re.fullmatch(r"(\d+)(ms|s|m|h|d)", str(text or ""))
+    if not m:
+        return None
+    return int(m.group(1)) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+
+
+def iter_panels(panels):
+    """Every panel, including those nested in collapsed rows"""
+    for panel in panels or []:
+        yield panel
+        yield from iter_panels(panel.get("panels"))
+
+
+def datasource_language(datasource):
+    """'promql', 'logql' or None for a panel/target datasource reference"""
+    if not isinstance(datasource, dict):
+        return None
+    uid, kind = datasource.get("uid"), datasource.get("type")
+    if uid in PROMETHEUS_UIDS or kind == "prometheus":
+        return "promql"
+    if uid in LOKI_UIDS or kind == "loki":
+        return "logql"
+    return None
+
+
+def load_dashboard(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def dashboard_queries(path, dashboard=None):
+    dashboard = dashboard or load_dashboard(path)
+    refresh = refresh_seconds(dashboard.get("refresh"))
+    queries = []
+    for panel in iter_panels(dashboard.get("panels")):
+        for target in panel.get("targets") or []:
+            datasource = target.get("datasource")
+            if not datasource_language(datasource):
+                datasource = panel.get("datasource")
+            language = datasource_language(datasource)
+            if language and isinstance(target.get("expr"), str) and target["expr"].strip():
+                queries.append(Query(path, "dashboard", dashboard.get("title", ""), language,
+                                     target, panel, refresh, datasource.get("uid")))
+    return queries
+
+
+def alert_queries(path):
+    with open(path, encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    queries = []
+    for group in config.get("groups") or []:
+        interval = refresh_seconds(group.get("interval"))
+        for rule in group.get("rules") or []:
+            for data in rule.get("data") or []:
+                uid = data.get("datasourceUid", DEFAULT_UID)
+                language = datasource_language({"uid": uid})
+                model = data.get("model") or {}
+                if language and isinstance(model.get("expr"), str):
+                    queries.append(Query(path, "alert", rule.get("title", rule.get("uid", "")),
+                                         language, model, None, interval, uid))
+    return queries
+
+
+def all_queries(dashboards=DASHBOARDS_GLOB, alerts=ALERT_RULES_GLOB):
+    queries = []
+    for path in sorted(glob.glob(dashboards, recursive=True)):
+        queries.extend(dashboard_queries(path))
+    for path in sorted(glob.glob(alerts)):
+        queries.extend(alert_queries(path))
+    return queries
+
+
+class RecordingRule:
+    def __init__(self, record, expr, group, interval, path, language="promql"):
+        self.record = record
+        self.expr = expr
+        self.group = group
+        self.interval = interval
+        self.path = path
+        # The language of `expr`; the recorded series are always PromQL
+        self.language = language
+
+
+def recording_rules(path, language="promql"):
+    with open(path, encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    rules = []
+    for group in config.get("groups") or []:
+        interval = refresh_seconds(group.get("interval")) or 60
+        for rule in group.get("rules") or []:
+            if "record" in rule:
+                rules.append(RecordingRule(rule["record"], str(rule["expr"]).strip(),
+                                           group.get("name"), interval, path, language))
+    return rules
+
+
+def scrape_interval(path=PROMETHEUS_CONFIG):
+    """Global Prometheus scrape interval in seconds"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+    except OSError:
+        return 15
+    return refresh_seconds((config.get("global") or {}).get("scrape_interval")) or 15
+
+
+def mimir_only_prefixes(path=TEMPO_CONFIG):
+    """
+    Name prefixes of the metrics only Mimir has: Tempo's metrics generator
+    remote-writes them there, so Prometheus never scrapes them and its
+    recording rules cannot read them.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = yaml.safe_load(f) or {}
+    except OSError:
+        return ()
+    generator = config.get("metrics_generator") or {}
+    if not (generator.get("storage") or {}).get("remote_write"):
+        return ()
+    defaults = (config.get("overrides") or {}).get("defaults") or {}
+    processors = (defaults.get("metrics_generator") or {}).get("processors") or []
+    return tuple(TEMPO_METRIC_PREFIXES[p] for p in processors if p in TEMPO_METRIC_PREFIXES)
+
+
+def _encodings(expr):
+    """Ways `expr` may be spelled in a JSON or YAML file"""
+    yield json.dumps(expr, ensure_ascii=False)
+    yield json.dumps(expr)
+    yield "'" + expr.replace("'", "''") + "'"
+    if "\n" not in expr:
+        yield expr
+
+
+def _block_exprs(text):
+    """
+    (start, content start, content end, indent, value) of each `expr: |`
+    YAML block scalar in `text`
+    """
+    for m in re.finditer(r"^( *)expr: \|(-?)\n", text, re.M):
+        key_indent = len(m.group(1))
+        lines, end = [], m.end()
+        for line in re.finditer(r"(.*)(?:\n|$)", text[m.end():]):
+            body = line.group(1)
+            if line.group(0) == "" or (body.strip() and
+                                       len(body) - len(body.lstrip(" ")) <= key_indent):
+                break
+            lines.append(body)
+            end = m.end() + line.end()
+        while lines and not lines[-1].strip():
+            lines.pop()
+        if not lines:
+            continue
+        indent = len(lines[0]) - len(lines[0].lstrip(" "))
+        value = "\n".join(line[indent:] for line in lines)
+        if m.group(2) != "-":
+            value += "\n"
+        content_end = m.end() + sum(len(line) + 1 for line in lines)
+        yield m.start(), m.end(), min(content_end, end), indent, value
+
+
+def replace_expr(text, old, new):
+    """
+    `text` with every occurrence of the query `old` replaced by `new`,
+    spelled the same way. Raises ValueError if `old` is not found, so the
+    caller can report it instead.
+    """
+    for spelled in _encodings(old):
+        pattern = re.escape(spelled)
+        if spelled[0] not in "\"'":
+            # A plain YAML scalar: only a whole value after `expr:`
+            pattern = r"(?<=expr: )" + pattern + r"(?=\n)"
+        if re.search(pattern, text):
+            if spelled.startswith('"'):
+                replacement = json.dumps(new, ensure_ascii=spelled == json.dumps(old))
+            elif spelled.startswith("'"):
+                replacement = "'" + new.replace("'", "''") + "'"
+            else:
+                replacement = new
+            return re.sub(pattern, lambda m: replacement, text)
+    blocks = [b for b in _block_exprs(text) if b[4] == old]
+    for _, start, end, indent, _ in reversed(blocks):
+        body = "".join(" " * indent + line + "\n" if line else "\n"
+                       for line in new.rstrip("\n").split("\n"))
+        text = text[:start] + body + text[end:]
+    if blocks:
+        return text
+    raise ValueError(f"query not found verbatim: {old[:60]!r}")
+
+
+def apply_rewrites(path, rewrites):
+    """
+    Replace each (old, new, datasource) query in the file at `path`, moving
+    it to `datasource` (a dashboard datasource dict) unless that is None.
+    Returns the queries not found.
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    missed = []
+    for old, new, datasource in rewrites:
+        try:
+            if datasource is not None:
+                if path.endswith(".json"):
+                    text = set_target_datasource(text, old, datasource)
+                else:
+                    text = set_alert_datasource(text, old, datasource["uid"])
+            text = replace_expr(text, old, new)
+        except ValueError:
+            missed.append(old)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return missed
+
+
+def set_alert_datasource(text, expr, uid):
+    """`text` (an alert rule file) with the data entries querying `expr` moved to `uid`"""
+    spans = [(m.start(), m.end()) for spelled in _encodings(expr)
+             for m in re.finditer(r"expr: " + re.escape(spelled), text)]
+    spans += [(start, end) for start, _, end, _, value in _block_exprs(text) if value == expr]
+    if not spans:
+        raise ValueError(f"query not found verbatim: {expr[:60]!r}")
+    for start, stop in sorted(set(spans), reverse=True):
+        # The enclosing `- refId:` list item, up to the next item or outdent
+        item = text.rfind("- refId:", 0, start)
+        indent = item - text.rfind("\n", 0, item) - 1
+        end = re.compile(r"\n {0,%d}\S" % indent).search(text, stop)
+        end = end.start() if end else len(text)
+        body = re.sub(r"(datasourceUid: *)\S+", lambda d: d.group(1) + uid,
+                      text[item:end], count=1)
+        text = text[:item] + body + text[end:]
+    return text
+
+
+# -- datasource edits ------------------------------------------------------------
+#
+# Moving a query onto a recorded series can change its datasource (a Loki
+# query reading a Loki recording rule now queries Mimir). These edit the
+# JSON text in place, like `replace_expr`, using a small scanner to find
+# the target and panel objects around a query. The json_* scanner
+# functions are shared with scripts/collapse_rows.py.
+
+def _skip_string(text, i):
+    """Offset just past the JSON string starting at `i`"""
+    i += 1
+    while text[i] != '"':
+        i += 2 if text[i] == "\\" else 1
+    return i + 1
+
+
+def _containers(text, pos):
+    """Start offsets of the JSON objects and arrays enclosing `pos`"""
+    stack = []
+    i = 0
+    while i < pos:
+        c = text[i]
+        if c == '"':
+            i = _skip_string(text, i)
+            continue
+        if c in "{[":
+            stack.append(i)
+        elif c in "}]":
+            stack.pop()
+        i += 1
+    return stack
+
+
+def json_close(text, start):
+    """Offset just past the object or array opening at `start`"""
+    depth = 0
+    i = start
+    while True:
+        c = text[i]
+        if c == '"':
+            i = _skip_string(text, i)
+            continue
+        if c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+
+
+def json_children(text, start):
+    """(start, end) of each value directly inside the object or array at `start`"""
+    end = json_close(text, start) - 1
+    spans = []
+    i = start + 1
+    while i < end:
+        c = text[i]
+        if c == '"':
+            value_end = _skip_string(text, i)
+        elif c in "{[":
+            value_end = json_close(text, i)
+        else:
+            i += 1
+            continue
+        spans.append((i, value_end))
+        i = value_end
+    return spans
+
+
+def json_member(text, start, key):
+    """(value start, value end) of `key` in the object at `start`, or None"""
+    children = json_children(text, start)
+    encoded = json.dumps(key)
+    for (k_start, k_end), value in zip(children, children[1:]):
+        if text[k_start:k_end] == encoded and text[k_end:value[0]].strip() == ":":
+            return value
+    for m in re.finditer(r'%s\s*:\s*' % re.escape(encoded), text[start:json_close(text, start)]):
+        # A scalar value (number, boolean, null) is not a child span
+        value = start + m.end()
+        if text[value] not in "\"{[" and len(_containers(text, value)) == \
+                len(_containers(text, start)) + 1:
+            return value, re.compile(r"[,}\s]").search(text, value).start()
+    return None
+
+
+def panel_spans(text):
+    """
+    (start, end) of every panel in the dashboard `text`, including those
+    nested in collapsed rows, in file order
+    """
+    def walk(start):
+        array = json_member(text, start, "panels")
+        if array is None or text[array[0]] != "[":
+            return
+        for span in json_children(text, array[0]):
+            if text[span[0]] == "{":
+                yield span
+                yield from walk(span[0])
+
+    yield from walk(text.index("{"))
+
+
+def set_member(text, start, key, value):
+    """
+    `text` with `key` of the object at `start` set to the JSON text
+    `value`, replacing the old value in place or appending the member
+    """
+    member = json_member(text, start, key)
+    if member is not None:
+        return text[:member[0]] + value + text[member[1]:]
+    end = json_close(text, start) - 1
+    last = len(text[:end].rstrip())
+    if last == start + 1:
+        return text[:last] + json.dumps(key) + ": " + value + text[last:]
+    # Laid out like the first member
+    first = re.compile(r"\s*").match(text, start + 1).end()
+    separator = text[start + 1:first] or " "
+    return text[:last] + "," + separator + json.dumps(key) + ": " + value + text[last:]
+
+
+def member_text(text, start, value):
+    """JSON text of `value` as a member of the object at `start`, laid out like its members"""
+    first = re.compile(r"\s*").match(text, start + 1).end()
+    if "\n" not in text[start:first]:
+        return json.dumps(value, ensure_ascii=False)
+    indent = text[text.rfind("\n", 0, first) + 1:first]
+    line = text.rfind("\n", 0, start) + 1
+    outer = re.compile(r" *").match(text, line).group()
+    unit = len(indent) - len(outer) if len(indent) > len(outer) else 2
+    return json.dumps(value, indent=unit, ensure_ascii=False).replace("\n", "\n" + indent)
+
+
+def set_datasource(text, start, datasource):
+    """`text` with the object at `start` given `datasource`, keeping its layout"""
+    member = json_member(text, start, "datasource")
+    if member is not None and text[member[0]] == "{":
+        value, end = member
+        new = text[value:end]
+        for key in ("type", "uid"):
+            new = re.sub(r'("%s"\s*:\s*)"[^"]*"' % key,
+                         lambda m: m.group(1) + json.dumps(datasource[key]), new)
+        return text[:value] + new + text[end:]
+    if member is not None:
+        value, end = member
+        return text[:value] + json.dumps(datasource) + text[end:]
+    # No datasource yet: add it as the first member, laid out like the next one
+    first = re.compile(r"\s*").match(text, start + 1).end()
+    separator = text[start + 1:first] or " "
+    return text[:first] + '"datasource": ' + json.dumps(datasource) + "," + separator \
+        + text[first:]
+
+
+def set_target_datasource(text, expr, datasource):
+    """
+    `text` (a dashboard) with every target querying `expr` moved to
+    `datasource`. A panel left with targets on different datasources is
+    switched to `-- Mixed --`, with its other targets pinned to the
+    datasource they inherited; once all its targets agree again, the panel
+    takes their datasource.
+    """
+    pattern = re.compile(r'"expr"\s*:\s*' + re.escape(json.dumps(expr, ensure_ascii=False)))
+    while True:
+        for m in pattern.finditer(text):
+            stack = _containers(text, m.start())
+            target, panel = stack[-1], stack[-3]
+            panel_json = json.loads(text[panel:json_close(text, panel)])
+            target_json = json.loads(text[target:json_close(text, target)])
+            inherited = panel_json.get("datasource")
+            if (target_json.get("datasource") or inherited or {}).get("uid") != datasource["uid"]:
+                break
+        else:
+            return text
+        # The target first: editing it does not move the panel's offset
+        text = set_datasource(text, target, datasource)
+        targets = json.loads(text[panel:json_close(text, panel)]).get("targets", [])
+        if all((t.get("datasource") or inherited or {}).get("uid") == datasource["uid"]
+               for t in targets):
+            text = set_datasource(text, panel, datasource)
+        elif (inherited or {}).get("uid") != MIXED["uid"]:
+            targets = json_member(text, panel, "targets")[0]
+            for offset, _ in reversed(json_children(text, targets)):
+                if offset != target and inherited \
+                        and json_member(text, offset, "datasource") is None:
+                    text = set_datasource(text, offset, inherited)
+            text = set_datasource(text, panel, MIXED)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+dedupe_panel_queries.py
+Finds panels that run the same queries as another panel on the same
+dashboard, and makes them reuse that panel's results through Grafana's
+"-- Dashboard --" datasource instead of querying again.
+
+A panel reuses a source panel when every one of its targets matches a
+target of the source: same datasource, a semantically equal expression
+(scripts/promql.py), and the same query options (format, exemplars, ...)
+and panel time overrides. The panel then gets one target:
+
+    {"datasource": {"type": "datasource", "uid": "-- Dashboard --"}, "panelId": 15, "refId": "A"}
+
+and, at the front of its transformations:
+
+- filterByRefId, when the source has targets the panel did not run
+- renameByRegex, when the panel named a series differently (constant
+  legends only)
+
+A stat, gauge or bar gauge reducing to the last value may reuse a range
+query for its instant one. Queries using $__interval or $__rate_interval
+are left alone, as their result depends on the panel's width.
+
+The source must be loaded whenever the panel is: a panel outside any
+collapsed row, or one in the same collapsed row. A panel never reuses a
+panel that itself reuses another.
+
+The report gives the queries each dashboard runs per refresh, before and
+after (hidden and "-- Dashboard --" targets excluded).
+
+Usage:
+    python scripts/dedupe_panel_queries.py            # report
+    python scripts/dedupe_panel_queries.py --write    # rewrite the duplicates in place
+    python scripts/dedupe_panel_queries.py --check    # exit 1 if a panel could reuse another
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import collapse_rows  # noqa: E402
+import dashboard_queries as dq  # noqa: E402
+import promql  # noqa: E402
+
+# Target fields compared separately (the query, instant / range, the
+# legend) or that do not change what the query returns
+IGNORED_FIELDS = {"expr", "query", "refId", "datasource", "editorMode", "legendFormat",
+                  "instant", "range", "hide"}
+# Panel fields that change the queries' time range or resolution
+PANEL_QUERY_FIELDS = ("interval", "maxDataPoints", "timeFrom", "timeShift", "hideTimeOverride")
+# Panels that reduce each series to one value
+REDUCING = {"stat", "gauge", "bargauge"}
+AUTO_LEGENDS = (None, "", "__auto")
+
+
+def queries_per_refresh(dashboard):
+    """Queries Grafana runs to refresh every panel of `dashboard`"""
+    rows = [p for p in dashboard.get("panels", []) if p.get("type") == "row"]
+    nested = {"panels": [child for row in rows for child in row.get("panels") or []]}
+    return collapse_rows.initial_queries(dashboard) + collapse_rows.initial_queries(nested)
+
+
+class Target:
+    """A panel target, keyed by what it queries"""
+
+    def __init__(self, panel, target):
+        self.target = target
+        self.ref_id = target.get("refId")
+        self.legend = target.get("legendFormat")
+        self.instant = bool(target.get("instant"))
+        self.range = bool(target.get("range", not self.instant))
+        datasource = target.get("datasource") or panel.get("datasource")
+        self.uid = datasource.get("uid") if isinstance(datasource, dict) else datasource
+        expr = target.get("expr", target.get("query"))
+        self.key = None
+        if not isinstance(expr, str) or "$__interval" in expr or "$__rate_interval" in expr:
+            return
+        try:
+            query = promql.canonical(promql.parse(expr)) if "expr" in target else expr
+        except promql.ParseError:
+            query = expr
+        options = json.dumps({k: v for k, v in target.items() if k not in IGNORED_FIELDS},
+                             sort_keys=True)
+        self.key = (self.uid, query, options)
+
+
+class Panel:
+    """A panel and the collapsed row (id) it loads with, None if it loads with the dashboard"""
+
+    def __init__(self, panel, row=None):
+        self.panel = panel
+        self.id = panel.get("id")
+        self.row = row
+        self.targets = [Target(panel, t) for t in panel.get("targets") or []]
+
+    @property
+    def title(self):
+        return self.panel.get("title") or f"panel {self.id}"
+
+    def can_reuse(self):
+        panel = self.panel
+        return bool(self.targets) and not panel.get("repeat") and all(
+            t.key and not t.target.get("hide") and t.uid != dq.DASHBOARD["uid"]
+            for t in self.targets)
+
+    def can_share(self):
+        return not self.panel.get("repeat") and any(
+            t.key and not t.target.get("hide") for t in self.targets)
+
+    def reduces_to_last(self):
+        options = self.panel.get("options") or {}
+        reduce = options.get("reduceOptions") or {}
+        return self.panel.get("type") in REDUCING and not reduce.get("values") and \
+            set(reduce.get("calcs") or ["lastNotNull"]) <= {"last", "lastNotNull"}
+
+    def names_series(self):
+        """Whether the panel shows or matches series by the names Grafana derives"""
+        panel = self.panel
+        options = panel.get("options") or {}
+        overrides = (panel.get("fieldConfig") or {}).get("overrides") or []
+        return panel.get("type") not in ("stat", "gauge") or len(self.targets) > 1 or \
+            options.get("textMode") not in (None, "auto", "value", "none") or \
+            any((o.get("matcher") or {}).get("id") == "byName" for o in overrides)
+
+    def uses_ref_ids(self):
+        panel = self.panel
+        text = json.dumps([panel.get("fieldConfig"), panel.get("transformations"),
+                           panel.get("options")])
+        return "RefId" in text or "refId" in text
+
+
+class Reuse:
+    """`panel` reusing the results of `source`"""
+
+    def __init__(self, panel, source, pairs):
+        self.panel = panel
+        self.source = source
+        # (panel target, source target), in source order
+        self.pairs = pairs
+
+    def transformations(self):
+        shown = [s for s in self.source.targets if not s.target.get("hide")]
+        used = [s for _, s in self.pairs]
+        result = []
+        if len(used) < len(shown):
+            result.append({"id": "filterByRefId",
+                           "options": {"include": "|".join(s.ref_id for s in used)}})
+        for target, source in self.pairs:
+            if target.legend != source.legend and target.legend not in AUTO_LEGENDS:
+                result.append({"id": "renameByRegex", "options": {
+                    "regex": f"^{re.escape(source.legend)}$", "renamePattern": target.legend}})
+        return result
+
+    def targets(self):
+        return [{"datasource": dq.DASHBOARD, "panelId": self.source.id, "refId": "A"}]
+
+    def describe(self):
+        changes = [t["id"] for t in self.transformations()]
+        return f"{self.panel.title!r} <- {self.source.title!r}" + \
+            (f" ({', '.join(changes)})" if changes else "")
+
+
+def _legend_matches(panel, target, source):
+    if target.legend == source.legend:
+        return True
+    if target.legend in AUTO_LEGENDS:
+        return not panel.names_series()
+    return source.legend not in AUTO_LEGENDS and "{{" not in target.legend + source.legend
+
+
+def _kind_matches(panel, target, source):
+    if (target.instant, target.range) == (source.instant, source.range):
+        return True
+    # The last point of the range query is the value the instant query gives
+    return (target.instant, target.range) == (True, False) and \
+        (source.instant, source.range) == (False, True) and panel.reduces_to_last()
+
+
+def match(panel, source):
+    """A Reuse of `source` by `panel`, or None if some target has no equal in `source`"""
+    if panel.row is not None and source.row not in (None, panel.row):
+        return None
+    if panel.row is None and source.row is not None:
+        return None
+    if any(panel.panel.get(f) != source.panel.get(f) for f in PANEL_QUERY_FIELDS):
+        return None
+    pairs = []
+    free = [s for s in source.targets if s.key and not s.target.get("hide")]
+    for target in panel.targets:
+        found = next((s for s in free if s.key == target.key
+                      and _kind_matches(panel, target, s)
+                      and _legend_matches(panel, target, s)), None)
+        if found is None:
+            return None
+        free.remove(found)
+        pairs.append((target, found))
+    if panel.uses_ref_ids() and any(t.ref_id != s.ref_id for t, s in pairs):
+        return None
+    pairs.sort(key=lambda pair: source.targets.index(pair[1]))
+    return Reuse(panel, source, pairs)
+
+
+def panels(dashboard):
+    result = []
+    for panel in dashboard.get("panels") or []:
+        if panel.get("type") == "row":
+            if panel.get("collapsed") and not panel.get("repeat"):
+                result += [Panel(child, panel.get("id")) for child in panel.get("panels") or []]
+        else:
+            result.append(Panel(panel))
+    return result
+
+
+def find_reuses(dashboard):
+    """Reuses for the panels of `dashboard` that duplicate another panel's queries"""
+    candidates = panels(dashboard)
+    reuses, sources = [], set()
+    reusing = set()
+    for panel in candidates:
+        if panel.id in sources or not panel.can_reuse():
+            continue
+        best = None
+        for source in candidates:
+            if source is panel or source.id in reusing or not source.can_share():
+                continue
+            reuse = match(panel, source)
+            # Prefer the source needing the fewest transformations
+            if reuse and (best is None or len(reuse.transformations()) <
+                          len(best.transformations())):
+                best = reuse
+        if best:
+            reuses.append(best)
+            reusing.add(panel.id)
+            sources.add(best.source.id)
+    return reuses
+
+
+def dedupe(text):
+    """`text` (a dashboard) with the duplicate panels reusing their sources"""
+    reuses = {r.panel.id: r for r in find_reuses(json.loads(text))}
+    # Last first, so an edit does not move the panels still to edit
+    for start, _ in reversed(list(dq.panel_spans(text))):
+        panel = json.loads(text[start:dq.json_close(text, start)])
+        reuse = reuses.get(panel.get("id"))
+        if reuse is None or panel.get("type") == "row":
+            continue
+        text = dq.set_member(text, start, "targets",
+                             dq.member_text(text, start, reuse.targets()))
+        text = dq.set_datasource(text, start, dq.DASHBOARD)
+        transformations = reuse.transformations() + (panel.get("transformations") or [])
+        if transformations:
+            text = dq.set_member(text, start, "transformations",
+                                 dq.member_text(text, start, transformations))
+    return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--write", action="store_true", help="rewrite the dashboards in place")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 if any panel could reuse another panel's queries")
+    args = parser.parse_args(argv)
+
+    changed = []
+    totals = [0, 0]
+    rows = []
+    for path in collapse_rows.dashboard_files():
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        dashboard = json.loads(text)
+        reuses = find_reuses(dashboard)
+        new_text = dedupe(text) if reuses else text
+        before = queries_per_refresh(dashboard)
+        after = queries_per_refresh(json.loads(new_text))
+        totals[0] += before
+        totals[1] += after
+        rows.append(f"{dq.relpath(path)[-58:]:<58} {before:>11} -> {after:<9}")
+        for reuse in reuses:
+            print(f"{dq.relpath(path)} :: {reuse.describe()}")
+        if new_text != text:
+            changed.append(path)
+            if args.write:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(new_text)
+
+    print(f"\n{'dashboard':<58} {'queries per refresh':>24}")
+    print("\n".join(rows))
+    print(f"{'total':<58} {totals[0]:>11} -> {totals[1]:<9}")
+
+    if args.write:
+        for path in changed:
+            print(f"rewrote {dq.relpath(path)}")
+    elif args.check and changed:
+        print(f"\n{len(changed)} dashboards have panels repeating another panel's queries; "
+              "run scripts/dedupe_panel_queries.py --write")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,677 @@
+#!/usr/bin/env python3
+"""
+lint_promql.py
+Query-cost linter for the Grafana dashboards and alert rules.
+
+Every PromQL and LogQL `expr` under grafana/dashboards/** and
+grafana/provisioning/alerting/rules/*.yml is parsed and compared with the
+recording rules in prometheus/recording_rules_baselines.yml and
+loki/rules/gatewayz_log_recording_rules.yml. A sub-expression is rewritten to read a recorded series when:
+
+  exact      it evaluates the same as a rule, e.g.
+             sum by (endpoint) (rate(http_requests_total[5m]))
+               -> traffic:requests_per_second:by_endpoint
+  pushdown   it is a rule's range function over the same selector with
+             extra label matchers, which the recorded series still carries:
+             rate(http_requests_total{status_code=~"5.."}[5m])
+               -> traffic:requests_per_second:rate5m{status_code=~"5.."}
+  reaggregate it is a sum/min/max of a rule's input by a subset of the
+             rule's labels: sum(rate(http_requests_total[5m]))
+               -> sum(traffic:requests_per_second:by_endpoint)
+
+Expressions that have the shape of a rule but differ in metric, matchers,
+range, grouping or constants are reported as near misses with the
+difference, since they cannot be rewritten without changing the result.
+A rewrite leaving the two sides of a ratio or comparison on different
+windows (a 5m rule over a [$__rate_interval] rate) is rejected.
+
+Loki rules are written to Mimir only, so a query rewritten onto one moves
+to the grafana_mimir datasource (or "-- Mixed --" if its panel also has
+targets elsewhere). A LogQL query is only rewritten when no part of it
+still reads logs.
+
+The report estimates, per dashboard, the series and samples read by one
+evaluation of every query before and after the rewrites. Without
+--prometheus-url, series counts use fixed per-metric guesses (see
+`estimate_series`); with it, each selector is counted on the server.
+
+Usage:
+    python scripts/lint_promql.py                 # report
+    python scripts/lint_promql.py --write         # apply the rewrites
+    python scripts/lint_promql.py --check         # exit 1 if any rewrite applies
+    python scripts/lint_promql.py --json          # machine-readable report
+    python scripts/lint_promql.py --prometheus-url http://localhost:9090
+    python scripts/lint_promql.py --rate-interval 5m   # 5m rules serve [$__rate_interval]
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import dashboard_queries as dq  # noqa: E402
+import promql  # noqa: E402
+
+# Range functions whose result keeps every input label, so extra matchers
+# can be applied to the recorded series instead of the raw one
+RANGE_FUNCTIONS = {
+    "rate", "irate", "increase", "delta", "idelta", "deriv", "changes", "resets",
+    "avg_over_time", "min_over_time", "max_over_time", "sum_over_time",
+    "count_over_time", "last_over_time", "present_over_time",
+    # LogQL
+    "bytes_rate", "bytes_over_time",
+}
+# Aggregations that can be computed from partial results of themselves
+REAGGREGATABLE = {"sum", "min", "max"}
+
+# Series-count guesses used without a Prometheus server
+SERIES_PER_METRIC = 50
+BUCKETS_PER_HISTOGRAM = 12
+VALUES_PER_LABEL = 10
+
+
+# -- matching ------------------------------------------------------------------
+
+class RangeCall:
+    """`f(selector[range])`: the unit a recording rule can be pushed into"""
+
+    def __init__(self, fn, name, matchers, stages, range_ms, node, offset=None):
+        self.fn = fn
+        self.name = name
+        self.matchers = matchers
+        # LogQL line filters and parser stages, which must match exactly
+        self.stages = stages
+        self.range_ms = range_ms
+        self.node = node
+        # `[range] offset d`: a rule without one serves it as `record offset d`
+        self.offset = offset
+
+    def key(self):
+        return (self.fn, self.name, tuple(promql.stage_key(s) for s in self.stages),
+                self.range_ms)
+
+
+def range_call(node, rate_interval=None):
+    """
+    The RangeCall `node` is, or None. With `rate_interval` (ms), a
+    [$__rate_interval] range is read as that fixed window. An offset on
+    the range is kept on the call; `@` modifiers are not supported.
+    """
+    node = promql.unparen(node)
+    if node.kind != "call" or node.name not in RANGE_FUNCTIONS or len(node.children) != 1:
+        return None
+    matrix = promql.unparen(node.children[0])
+    if matrix.kind != "matrix" or getattr(matrix, "at", None):
+        return None
+    selector = matrix.children[0]
+    if selector.kind != "selector" or selector.offset or selector.at:
+        return None
+    range_ms = promql.duration_ms(matrix.range)
+    if range_ms is None and matrix.range == "$__rate_interval":
+        range_ms = rate_interval
+    if range_ms is None:
+        return None
+    matchers, stages = promql.stream_filters(selector)
+    return RangeCall(node.name, selector.name, matchers, stages, range_ms, node, matrix.offset)
+
+
+def extra_matchers(rule_call, query_call):
+    """
+    Matchers `query_call` adds to the rule's range call, or None if it is
+    not the same function, metric, pipeline and range with a superset of
+    matchers. The rule itself must read the present, not an offset.
+    """
+    if rule_call is None or query_call is None or rule_call.offset \
+            or rule_call.key() != query_call.key():
+        return None
+    rule_keys = {m.key() for m in rule_call.matchers}
+    if not rule_keys <= {m.key() for m in query_call.matchers}:
+        return None
+    return [m for m in query_call.matchers if m.key() not in rule_keys]
+
+
+def _offset_text(record, matchers, query_call):
+    """Selector of `record` replacing `query_call`, shifted by its offset"""
+    text = promql.selector_text(record, matchers)
+    if query_call is not None and query_call.offset:
+        text += f" offset {query_call.offset}"
+    return text
+
+
+def _metric_family(name):
+    """
+    `name` without its instrumentation prefix and plurals, so the same
+    measurement from two libraries compares equal (http_request_duration_
+    seconds_bucket vs fastapi_requests_duration_seconds_bucket).
+    """
+    if not name:
+        return name
+    parts = name.split("_")
+    return "_".join(p.rstrip("s") for p in parts[1:]) if len(parts) > 2 else name
+
+
+def _skeleton(node):
+    """Shape of an expression, ignoring metrics, matchers, ranges, grouping and scaling"""
+    node = promql.unparen(node)
+    kind = node.kind
+    if kind == "selector":
+        suffix = (node.name or "").rsplit("_", 1)[-1]
+        return ("sel", suffix if suffix in ("bucket", "total", "count", "sum") else "")
+    if kind in ("matrix", "subquery"):
+        return _skeleton(node.children[0])
+    if kind == "agg" and node.name == "sum":
+        return _skeleton(node.children[0])
+    if kind == "binary" and node.op in ("*", "/"):
+        lhs, rhs = (promql.unparen(c) for c in node.children)
+        if rhs.kind == "number":
+            return _skeleton(lhs)
+        if lhs.kind == "number" and node.op == "*":
+            return _skeleton(rhs)
+    if kind == "number":
+        return ("num",)
+    children = tuple(_skeleton(c) for c in node.children)
+    head = getattr(node, "name", None) or getattr(node, "op", None)
+    return (kind, head, children)
+
+
+def _features(node):
+    """What distinguishes two expressions with the same skeleton"""
+    walked = list(promql.walk(node))
+    return {
+        "metrics": sorted(promql.metric_names(node)),
+        "matchers": sorted({m.text for sel, _ in promql.selectors(node) for m in sel.matchers}),
+        "ranges": sorted({promql.format_duration(promql.duration_ms(n.range))
+                          if promql.duration_ms(n.range) else n.range
+                          for n in walked if n.kind in ("matrix", "subquery")}),
+        "grouping": sorted({f"{n.name} {n.grouping} ({', '.join(sorted(n.labels))})"
+                            if n.grouping else n.name for n in walked if n.kind == "agg"}),
+        "constants": sorted({n.text for n in walked if n.kind == "number"}),
+    }
+
+
+class Rule:
+    def __init__(self, recording_rule):
+        self.record = recording_rule.record
+        self.expr = recording_rule.expr
+        self.interval = recording_rule.interval
+        self.group = recording_rule.group
+        self.language = recording_rule.language
+        self.tree = promql.parse(self.expr)
+        self.canonical = promql.canonical(self.tree)
+        self.range_call = range_call(self.tree)
+        self.skeleton = _skeleton(self.tree)
+        self.families = {_metric_family(m) for m in promql.metric_names(self.tree)}
+        top = promql.unparen(self.tree)
+        self.agg = top if top.kind == "agg" and top.name in REAGGREGATABLE \
+            and top.grouping == "by" and len(top.children) == 1 else None
+
+
+class Rewrite:
+    def __init__(self, node, record, kind, text, replace=None):
+        self.node = node
+        self.record = record
+        self.kind = kind
+        self.text = text
+        # Span replaced: the node itself, or its argument for reaggregation
+        self.replace = replace or node
+
+
+class NearMiss:
+    def __init__(self, node, record, differences):
+        self.node = node
+        self.record = record
+        self.differences = differences
+
+
+class RuleIndex:
+    """
+    The recording rules a query can be rewritten to use. `rate_interval`
+    (ms) lets rules with that window replace [$__rate_interval] ranges.
+    Metrics named with a `mimir_only` prefix never reach Prometheus, so
+    PromQL rules reading them would record nothing and are ignored.
+    """
+
+    def __init__(self, recording_rules, rate_interval=None, mimir_only=()):
+        self.rate_interval = rate_interval
+        self.mimir_only = tuple(mimir_only)
+        self.rules = []
+        for recording_rule in recording_rules:
+            try:
+                rule = Rule(recording_rule)
+            except promql.ParseError:
+                continue
+            if rule.language == "promql" and self.reads_mimir_only(rule.tree):
+                continue
+            # A bare selector (e.g. an alias) saves nothing
+            if promql.unparen(rule.tree).kind != "selector":
+                self.rules.append(rule)
+        self.by_record = {rule.record: rule for rule in self.rules}
+        self.by_canonical = {}
+        for rule in self.rules:
+            self.by_canonical.setdefault(rule.canonical, rule)
+
+    def reads_mimir_only(self, node):
+        """True if `node` reads a metric only Mimir has"""
+        return any(name.startswith(self.mimir_only) for name in promql.metric_names(node)) \
+            if self.mimir_only else False
+
+    def candidates(self, node):
+        """Every rewrite applying to `node` itself (not its children)"""
+        found = []
+        rule = self.by_canonical.get(promql.canonical(node))
+        if rule is not None:
+            found.append(Rewrite(node, rule.record, "exact", rule.record))
+
+        query_call = range_call(node, self.rate_interval)
+        if query_call is not None:
+            for rule in self.rules:
+                extras = extra_matchers(rule.range_call, query_call)
+                if extras is not None:
+                    found.append(Rewrite(node, rule.record, "pushdown",
+                                         _offset_text(rule.record, extras, query_call)))
+
+        node = promql.unparen(node)
+        if node.kind == "agg" and node.name in REAGGREGATABLE and len(node.children) == 1 \
+                and (node.grouping or "by") == "by":
+            inner = node.children[0]
+            for rule in self.rules:
+                if rule.agg is None or rule.agg.name != node.name \
+                        or not set(node.labels) <= set(rule.agg.labels):
+                    continue
+                rule_inner = rule.agg.children[0]
+                inner_call = range_call(inner, self.rate_interval)
+                if promql.canonical(inner) == promql.canonical(rule_inner):
+                    extras = []
+                else:
+                    extras = extra_matchers(range_call(rule_inner), inner_call)
+                    if extras is None or not {m.label for m in extras} <= set(rule.agg.labels):
+                        continue
+                found.append(Rewrite(node, rule.record, "reaggregate",
+                                     _offset_text(rule.record, extras, inner_call), inner))
+        return found
+
+    def near_miss(self, node):
+        """The closest rule `node` has the shape of but cannot use, or None"""
+        families = {_metric_family(m) for m in promql.metric_names(node)}
+        if not families:
+            return None
+        skeleton = _skeleton(node)
+        best = None
+        for rule in self.rules:
+            if rule.skeleton != skeleton or rule.families != families:
+                continue
+            theirs, ours = _features(rule.tree), _features(node)
+            differences = {
+                key: (theirs[key], ours[key]) for key in theirs if theirs[key] != ours[key]
+            }
+            if differences and (best is None or len(differences) < len(best.differences)):
+                best = NearMiss(node, rule.record, differences)
+        return best
+
+
+# -- cost estimate --------------------------------------------------------------
+
+class Estimator:
+    """
+    Series and samples one evaluation of a query reads. Raw series are
+    sampled every scrape interval and recorded series every rule interval.
+    """
+
+    def __init__(self, index, scrape_interval, prometheus_url=None):
+        self.index = index
+        self.scrape_ms = scrape_interval * 1000
+        self.prometheus_url = prometheus_url
+        self._counts = {}
+
+    def count(self, selector):
+        """Series matching `selector` on the server, or None"""
+        if not self.prometheus_url or not selector.name:
+            return None
+        matchers = [m for m in selector.matchers if not m.value.startswith(("$", "[["))]
+        query = f"count({promql.selector_text(selector.name, matchers)})"
+        if query not in self._counts:
+            url = self.prometheus_url.rstrip("/") + "/api/v1/query?" + \
+                urllib.parse.urlencode({"query": query})
+            try:
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    result = json.load(response)["data"]["result"]
+                self._counts[query] = int(float(result[0]["value"][1])) if result else 0
+            except Exception as e:
+                print(f"warning: {query}: {e}", file=sys.stderr)
+                self._counts[query] = None
+        return self._counts[query]
+
+    def estimate_series(self, selector):
+        """Series a selector matches: counted, or guessed from its name and matchers"""
+        counted = self.count(selector)
+        if counted is not None:
+            return counted
+        rule = self.index.by_record.get(selector.name)
+        if rule is not None:
+            series = self.output_series(rule.tree)
+        elif selector.name and selector.name.endswith("_bucket"):
+            series = SERIES_PER_METRIC * BUCKETS_PER_HISTOGRAM
+        else:
+            series = SERIES_PER_METRIC
+        for matcher in selector.matchers:
+            if matcher.op == "=" and not matcher.value.startswith(("$", "[[")):
+                series /= VALUES_PER_LABEL
+        return max(1, math.ceil(series))
+
+    def output_series(self, node):
+        """Guess of the number of series an expression returns"""
+        node = promql.unparen(node)
+        if node.kind == "selector":
+            return self.estimate_series(node)
+        if node.kind in ("number", "string", "var"):
+            return 1
+        if node.kind == "agg":
+            inner = self.output_series(node.children[-1])
+            if node.grouping == "without":
+                return inner
+            labels = [label for label in node.labels if label != "le"]
+            grouped = VALUES_PER_LABEL ** len(labels)
+            if "le" in node.labels:
+                grouped *= BUCKETS_PER_HISTOGRAM
+            return min(inner, grouped)
+        if node.kind == "call" and node.name == "histogram_quantile" and len(node.children) == 2:
+            return max(1, self.output_series(node.children[1]) // BUCKETS_PER_HISTOGRAM)
+        if not node.children:
+            return 1
+        return max(self.output_series(child) for child in node.children)
+
+    def cost(self, node, step_ms=None):
+        """(series, samples) read by one evaluation"""
+        series = samples = 0
+
+        def visit(n, range_ms, repeat):
+            nonlocal series, samples
+            if n.kind == "selector":
+                count = self.estimate_series(n) * repeat
+                rule = self.index.by_record.get(n.name)
+                interval = rule.interval * 1000 if rule else self.scrape_ms
+                series += count
+                samples += count * (max(1, range_ms // interval) if range_ms else 1)
+            elif n.kind == "matrix":
+                visit(n.children[0], promql.duration_ms(n.range) or 5 * 60000, repeat)
+            elif n.kind == "subquery":
+                step = promql.duration_ms(n.step) or step_ms or 60000
+                steps = (promql.duration_ms(n.range) or step) // step
+                visit(n.children[0], None, repeat * max(1, steps))
+            else:
+                for child in n.children:
+                    visit(child, range_ms, repeat)
+
+        visit(node, None, 1)
+        return series, samples
+
+
+# -- window check -------------------------------------------------------------------
+
+# Binary operators combining two results sample by sample; and/or/unless
+# only filter by label set, so their operands may use any window
+WINDOWED_OPS = {"+", "-", "*", "/", "%", "^", "==", "!=", ">", "<", ">=", "<=", "atan2"}
+
+
+def windows(node, index):
+    """
+    Ranges `node` reads over: its own [range]s, and those of the recording
+    rules it reads. [$__rate_interval] stays a window of its own.
+    """
+    found = set()
+    for n in promql.walk(node):
+        if n.kind in ("matrix", "subquery"):
+            ms = promql.duration_ms(n.range)
+            found.add(promql.format_duration(ms) if ms else n.range)
+        elif n.kind == "selector" and n.name in index.by_record:
+            found |= windows(index.by_record[n.name].tree, index)
+    return found
+
+
+def mismatched_windows(tree, index):
+    """
+    (lhs windows, rhs windows) of every binary operation in `tree` whose
+    operands read different windows, e.g. a ratio of a 5m recorded rate
+    over a [$__rate_interval] one
+    """
+    mismatched = []
+    for n in promql.walk(tree):
+        if n.kind == "binary" and n.op in WINDOWED_OPS:
+            lhs, rhs = (windows(child, index) for child in n.children)
+            if lhs and rhs and lhs != rhs:
+                mismatched.append((sorted(lhs), sorted(rhs)))
+    return mismatched
+
+
+# -- linting ----------------------------------------------------------------------
+
+class Finding:
+    """The rewrites and near misses of one query"""
+
+    def __init__(self, query):
+        self.query = query
+        self.error = None
+        self.rewrites = []
+        self.near_misses = []
+        # Why the rewrites found were not applied, if they were not
+        self.rejected = None
+        self.new_expr = query.expr
+        # The datasource the rewritten query must move to, if any
+        self.datasource = None
+        self.before = self.after = (0, 0)
+
+
+def lint(query, index, estimator):
+    finding = Finding(query)
+    try:
+        tree = promql.parse(query.expr)
+    except promql.ParseError as e:
+        finding.error = str(e)
+        return finding
+
+    def visit(node, near_miss_found):
+        """Collects the rewrites under `node`; True if there were any"""
+        options = index.candidates(node)
+        if options:
+            best = min(options, key=lambda r: estimator.cost(promql.parse(r.text))[1])
+            finding.rewrites.append(best)
+            return True
+        near_miss = None if near_miss_found else index.near_miss(node)
+        rewritten = False
+        for child in node.children:
+            rewritten |= visit(child, near_miss_found or near_miss is not None)
+        # A near miss containing a rewrite is no longer a fair comparison
+        if near_miss is not None and not rewritten:
+            finding.near_misses.append(near_miss)
+        return rewritten
+
+    visit(tree, False)
+    finding.before = finding.after = estimator.cost(tree)
+    if not finding.rewrites:
+        return finding
+    new_expr = promql.splice(query.expr, [
+        (r.replace.start, r.replace.end, r.text) for r in finding.rewrites
+    ])
+    new_tree = promql.parse(new_expr)
+    if query.language == "logql":
+        if any(sel.name is None for sel, _ in promql.selectors(new_tree)):
+            # Part of the query still reads logs, so it cannot move to Mimir
+            finding.rewrites = []
+            return finding
+    before = mismatched_windows(tree, index)
+    after = mismatched_windows(new_tree, index)
+    if len(after) > len(before):
+        # Rewriting one operand only would divide (or compare) different windows
+        lhs, rhs = after[-1]
+        finding.rejected = (f"operands over {', '.join(lhs)} and {', '.join(rhs)}; "
+                            f"would read {', '.join(r.record for r in finding.rewrites)}")
+        finding.rewrites = []
+        return finding
+    # Loki recording rules are only written to Mimir
+    if (query.language == "logql" or any(
+            index.by_record[r.record].language == "logql" for r in finding.rewrites
+    )) and query.uid != dq.MIMIR["uid"]:
+        finding.datasource = dq.MIMIR
+    finding.new_expr = new_expr
+    finding.after = estimator.cost(new_tree)
+    return finding
+
+
+def lint_all(queries, index, estimator):
+    return [lint(query, index, estimator) for query in queries]
+
+
+def summarize(findings):
+    """Per-file totals: queries, rewritten, series and samples before/after, per minute"""
+    totals = defaultdict(lambda: defaultdict(float))
+    for finding in findings:
+        query = finding.query
+        total = totals[query.path]
+        total["title"] = query.title if query.source == "dashboard" else dq.relpath(query.path)
+        total["source"] = query.source
+        total["queries"] += 1
+        total["rewritten"] += bool(finding.rewrites)
+        total["series_before"] += finding.before[0]
+        total["series_after"] += finding.after[0]
+        total["samples_before"] += finding.before[1]
+        total["samples_after"] += finding.after[1]
+        # Evaluations per minute at the dashboard refresh / alert interval
+        per_minute = 60 / query.refresh if query.refresh else 0
+        total["samples_per_min_before"] += finding.before[1] * per_minute
+        total["samples_per_min_after"] += finding.after[1] * per_minute
+    return totals
+
+
+def report(findings, out=sys.stdout):
+    totals = summarize(findings)
+    print(f"{'file':<58} {'queries':>7} {'rewr':>5} {'series':>15} {'samples/eval':>19}",
+          file=out)
+    for path, t in sorted(totals.items(), key=lambda kv: kv[1]["samples_before"]
+                          - kv[1]["samples_after"], reverse=True):
+        print(f"{dq.relpath(path)[-58:]:<58} {int(t['queries']):>7} {int(t['rewritten']):>5} "
+              f"{int(t['series_before']):>7}->{int(t['series_after']):<7} "
+              f"{int(t['samples_before']):>9}->{int(t['samples_after']):<9}", file=out)
+
+    rewrites = [f for f in findings if f.rewrites]
+    if rewrites:
+        print(f"\nRewrites ({len(rewrites)}):", file=out)
+        for finding in rewrites:
+            kinds = ", ".join(f"{r.kind} {r.record}" for r in finding.rewrites)
+            if finding.datasource:
+                kinds += f"; datasource -> {finding.datasource['uid']}"
+            print(f"  {finding.query.where}  [{kinds}]\n"
+                  f"    - {finding.query.expr}\n    + {finding.new_expr}", file=out)
+
+    near = [(f, n) for f in findings for n in f.near_misses]
+    if near:
+        print(f"\nNear misses ({len(near)}): same shape as a recording rule, different result",
+              file=out)
+        for finding, miss in near:
+            print(f"  {finding.query.where}  ~ {miss.record}", file=out)
+            for key, (theirs, ours) in miss.differences.items():
+                print(f"    {key}: rule {theirs or '-'} vs query {ours or '-'}", file=out)
+
+    rejected = [f for f in findings if f.rejected]
+    if rejected:
+        print(f"\nRejected ({len(rejected)}): rewrite would mix windows", file=out)
+        for finding in rejected:
+            print(f"  {finding.query.where}: {finding.rejected}\n    {finding.query.expr}",
+                  file=out)
+
+    errors = [f for f in findings if f.error]
+    if errors:
+        print(f"\nInvalid queries ({len(errors)}):", file=out)
+        for finding in errors:
+            print(f"  {finding.query.where}: {finding.error}\n    {finding.query.expr}",
+                  file=out)
+
+
+def as_json(findings):
+    return {
+        "files": {dq.relpath(path): {k: v for k, v in t.items()}
+                  for path, t in summarize(findings).items()},
+        "rewrites": [
+            {"file": dq.relpath(f.query.path), "where": f.query.where, "expr": f.query.expr,
+             "new_expr": f.new_expr, "records": [r.record for r in f.rewrites]}
+            for f in findings if f.rewrites
+        ],
+        "near_misses": [
+            {"file": dq.relpath(f.query.path), "where": f.query.where, "record": n.record,
+             "expr": f.query.expr[n.node.start:n.node.end],
+             "differences": {k: {"rule": a, "query": b} for k, (a, b) in n.differences.items()}}
+            for f in findings for n in f.near_misses
+        ],
+        "rejected": [
+            {"file": dq.relpath(f.query.path), "where": f.query.where, "expr": f.query.expr,
+             "reason": f.rejected}
+            for f in findings if f.rejected
+        ],
+        "invalid": [
+            {"file": dq.relpath(f.query.path), "where": f.query.where, "expr": f.query.expr,
+             "error": f.error}
+            for f in findings if f.error
+        ],
+    }
+
+
+def write(findings):
+    """Apply the rewrites to the dashboard and alert rule files; returns the files changed"""
+    by_file = defaultdict(dict)
+    for finding in findings:
+        if finding.rewrites:
+            by_file[finding.query.path][finding.query.expr] = \
+                (finding.query.expr, finding.new_expr, finding.datasource)
+    for path, rewrites in by_file.items():
+        for old in dq.apply_rewrites(path, list(rewrites.values())):
+            print(f"warning: {dq.relpath(path)}: could not rewrite {old!r}", file=sys.stderr)
+    return sorted(by_file)
+
+
+def load_index(paths=(dq.PROMETHEUS_RULES, dq.LOKI_RULES), rate_interval=None):
+    rules = []
+    for path in paths:
+        path = os.path.abspath(path)
+        rules.extend(dq.recording_rules(path, "logql" if path == dq.LOKI_RULES else "promql"))
+    return RuleIndex(rules, rate_interval, dq.mimir_only_prefixes())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--write", action="store_true", help="rewrite the files in place")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 if any query can use a recording rule")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--prometheus-url", help="count series on this server")
+    parser.add_argument("--rules", action="append", help="recording rule file "
+                        "(default: prometheus/recording_rules_baselines.yml and "
+                        "loki/rules/gatewayz_log_recording_rules.yml)")
+    parser.add_argument("--rate-interval", help="let rules with this window (e.g. 5m) "
+                        "replace [$__rate_interval] ranges")
+    args = parser.parse_args(argv)
+
+    index = load_index(args.rules or (dq.PROMETHEUS_RULES, dq.LOKI_RULES),
+                       promql.duration_ms(args.rate_interval))
+    estimator = Estimator(index, dq.scrape_interval(), args.prometheus_url)
+    findings = lint_all(dq.all_queries(), index, estimator)
+
+    if args.json:
+        json.dump(as_json(findings), sys.stdout, indent=2)
+        print()
+    else:
+        report(findings)
+    if args.write:
+        for path in write(findings):
+            print(f"rewrote {dq.relpath(path)}")
+        return 0
+    if args.check and any(f.rewrites for f in findings):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
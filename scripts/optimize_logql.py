@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+"""
+optimize_logql.py
+Rewrites LogQL queries that scan or parse every log line into queries on
+stream labels or Loki recording rules, and estimates the bytes the rest
+still scan.
+
+GatewayZ logs carry their level, service, provider, error_type, ... as
+stream labels (see the header of loki/rules/gatewayz_log_recording_rules.yml),
+so Loki can pick the matching streams from its index instead of reading
+every line:
+
+  level-filter  a line filter on a level name selects the level label
+                  {app=~"gatewayz.*"} |= "ERROR"  ->  {app=~"gatewayz.*", level="ERROR"}
+                  {job="x"} |~ "(?i)error"  ->  {job="x", level=~"(?i)ERROR"}
+  label-stage   a label filter before any parser moves into the selector
+                  {app="gatewayz"} | level="INFO"  ->  {app="gatewayz", level="INFO"}
+  parser        a parser whose only use is filtering on stream labels is dropped
+                  {app="gatewayz"} | logfmt | service != ""  ->  {app="gatewayz", service!=""}
+
+A level-filter rewrite counts the lines logged at that level instead of
+every line containing the word, which is what these panels mean. A parser
+is only dropped from metric queries whose result keeps stream labels only.
+
+The rewritten metric query is then matched against the Loki recording
+rules with scripts/lint_promql.py, reading rate(...[1m]) as
+count_over_time(...[1m]) / 60:
+
+    sum(rate({app="gatewayz"} |= "ERROR" [1m]))  ->  loki:errors:count_per_minute / 60
+
+A rule only serves queries whose stream selector has the same matchers
+(plus any on labels the rule keeps): {app=~"gatewayz.*"} is not
+{app="gatewayz"}, since other apps may match it. A query moved onto a
+recording rule reads Mimir, where the Loki ruler writes.
+
+Metric queries that still read logs are listed with the bytes one
+evaluation scans: the selected streams' volume over the dashboard's time
+range (plus the query range), or over the range for alerts and instant
+queries. Queries parsing every line are marked "parse". Volumes are
+guessed (LOG_BYTES_PER_SECOND, split by label matchers and the known
+level names) unless --loki-url is given, in which case each selector's
+volume over the last hour is read from Loki's index stats.
+
+Usage:
+    python scripts/optimize_logql.py                          # report
+    python scripts/optimize_logql.py --write                  # apply the rewrites
+    python scripts/optimize_logql.py --check                  # exit 1 if any rewrite applies
+    python scripts/optimize_logql.py --loki-url http://localhost:3100
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import dashboard_queries as dq  # noqa: E402
+import lint_promql  # noqa: E402
+import promql  # noqa: E402
+
+# Python's level names, which LokiLogHandler sets as the level label
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+# Every value of a stream label, for splitting guessed log volumes
+KNOWN_VALUES = {"level": LEVELS}
+# Stream labels set by LokiLogHandler and the log shippers
+STREAM_LABELS = {
+    "app", "environment", "env", "job", "service", "level", "logger", "trace_id", "span_id",
+    "path", "method", "provider", "model", "user_id", "error_type",
+}
+PARSERS = {"logfmt", "json", "regexp", "pattern", "unpack"}
+# Stages after which a line filter no longer sees the logged line
+FORMATTERS = {"line_format", "decolorize"}
+# Range functions counting lines, whose rate() is count_over_time() / seconds
+RATE_FUNCTIONS = {"rate": "count_over_time", "bytes_rate": "bytes_over_time"}
+
+# Guessed volume of the gateway's logs, split by each other label matcher
+LOG_BYTES_PER_SECOND = 20000
+# Labels selecting the gateway's logs as a whole rather than a part of them
+SOURCE_LABELS = {"app", "environment", "env", "job", "service"}
+DEFAULT_TIME_RANGE = "6h"
+
+
+# -- label rewrites -------------------------------------------------------------
+
+def level_values(stage, levels=LEVELS):
+    """The levels a `|= "ERROR"` / `|~ "ERROR|CRITICAL"` line filter means, or None"""
+    if len(stage) != 2 or stage[0] not in ("|=", "|~") or stage[1][:1] not in "\"'`":
+        return None
+    text = promql.unquote(stage[1])
+    if stage[0] == "|=":
+        return [text] if text in levels else None
+    ignore_case = text.startswith("(?i)")
+    body = text[4:] if ignore_case else text
+    if body.startswith("(") and body.endswith(")"):
+        body = body[1:-1]
+    found = []
+    for word in body.split("|"):
+        if not re.fullmatch(r"\w+", word):
+            return None
+        level = next((lv for lv in levels
+                      if lv == word or (ignore_case and lv.lower() == word.lower())), None)
+        if level is None:
+            return None
+        found.append(level)
+    return found
+
+
+def level_matcher(stage):
+    """
+    The level label matcher a level line filter becomes, or None. A
+    case-insensitive filter stays case-insensitive: level=~"(?i)ERROR".
+    """
+    levels = level_values(stage)
+    if not levels:
+        return None
+    if stage[0] == "|~" and promql.unquote(stage[1]).startswith("(?i)"):
+        return _matcher_text("level", "=~", "(?i)" + "|".join(levels))
+    if len(levels) == 1:
+        return _matcher_text("level", "=", levels[0])
+    return _matcher_text("level", "=~", "|".join(levels))
+
+
+def _label_stage(stage):
+    return len(stage) == 4 and stage[0] == "|" and stage[2] in promql.MATCH_OPS \
+        and stage[3][:1] in "\"'`"
+
+
+def _matcher_text(label, op, value):
+    return f"{label}{op}{promql.quote(value)}"
+
+
+def rewrite_selector(selector, drop_parser=False):
+    """
+    (new selector text, kinds) for a log selector, or None if nothing
+    applies. `drop_parser`: the caller only uses stream labels of the result.
+    """
+    matchers = [m.text for m in selector.matchers]
+    stages, kinds = [], []
+    # Label filters only test stream labels until the first other stage
+    labels_only, formatted = True, False
+    for stage in selector.pipeline:
+        level = None if formatted else level_matcher(stage)
+        if level:
+            matchers.append(level)
+            kinds.append("level-filter")
+        elif labels_only and _label_stage(stage):
+            matchers.append("".join(stage[1:]))
+            kinds.append("label-stage")
+        else:
+            if stage[0] not in promql.LINE_FILTERS:
+                labels_only = False
+                formatted |= len(stage) > 1 and stage[1] in FORMATTERS
+            stages.append(stage)
+
+    parsers = [s for s in stages if s[0] == "|" and len(s) > 1 and s[1] in PARSERS]
+    if drop_parser and len(parsers) == 1:
+        after = stages[stages.index(parsers[0]) + 1:]
+        # Lines that fail to parse are filtered out by __error__ only
+        if all(s[0] in promql.LINE_FILTERS or (_label_stage(s) and (
+                s[1] in STREAM_LABELS or s[1:] == ("__error__", "=", '""'))) for s in after):
+            matchers += ["".join(s[1:]) for s in after
+                         if _label_stage(s) and s[1] in STREAM_LABELS]
+            stages = [s for s in stages[:stages.index(parsers[0])] + after
+                      if s[0] in promql.LINE_FILTERS]
+            kinds.append("parser")
+    if not kinds:
+        return None
+    text = "{" + ", ".join(matchers) + "}"
+    if stages:
+        text += " " + promql.pipeline_text(stages)
+    return text, kinds
+
+
+def _parents(tree):
+    parents = {}
+    for node in promql.walk(tree):
+        for child in node.children:
+            parents[id(child)] = node
+    return parents
+
+
+def _keeps_stream_labels(matrix, parents):
+    """Whether the range function over `matrix` is aggregated by stream labels only"""
+    call = parents.get(id(matrix))
+    node = parents.get(id(call)) if call is not None and call.kind == "call" else None
+    while node is not None and node.kind == "paren":
+        node = parents.get(id(node))
+    return node is not None and node.kind == "agg" and (node.grouping or "by") == "by" \
+        and set(node.labels) <= STREAM_LABELS
+
+
+def label_rewrite(expr):
+    """(expr with its log selectors rewritten onto stream labels, kinds)"""
+    tree = promql.parse(expr)
+    parents = _parents(tree)
+    replacements, kinds = [], []
+    for selector, _ in promql.selectors(tree):
+        if selector.name is not None:
+            continue
+        matrix = parents.get(id(selector))
+        metric = matrix is not None and matrix.kind == "matrix"
+        rewrite = rewrite_selector(selector, metric and _keeps_stream_labels(matrix, parents))
+        if rewrite:
+            replacements.append((selector.start, selector.end, rewrite[0]))
+            kinds += rewrite[1]
+    return promql.splice(expr, replacements), kinds
+
+
+# -- recording rules --------------------------------------------------------------
+
+def selected_values(matcher, values):
+    """The `values` that `matcher` selects, or None if it uses a template variable"""
+    if matcher.value.startswith(("$", "[[")):
+        return None
+    if matcher.op in ("=", "!="):
+        return [v for v in values if (v == matcher.value) == (matcher.op == "=")]
+    try:
+        pattern = re.compile(matcher.value)
+    except re.error:
+        return None
+    return [v for v in values if bool(pattern.fullmatch(v)) == (matcher.op == "=~")]
+
+
+def normalize(expr):
+    """
+    `expr` with its log selectors' label filters moved into the selector
+    and sum/min/max of rate() read as count_over_time() / seconds, so it
+    compares equal to a recording rule written either way
+    """
+    tree = promql.parse(expr)
+    replacements = []
+    for selector, _ in promql.selectors(tree):
+        if selector.name is not None:
+            continue
+        matchers, stages = promql.stream_filters(selector)
+        text = "{" + ", ".join(sorted(m.text for m in matchers)) + "}"
+        if stages:
+            text += " " + promql.pipeline_text(stages)
+        replacements.append((selector.start, selector.end, text))
+    expr = promql.splice(expr, replacements)
+
+    tree = promql.parse(expr)
+    replacements = []
+    for node in promql.walk(tree):
+        call = promql.unparen(node.children[0]) if node.kind == "agg" \
+            and node.name in lint_promql.REAGGREGATABLE and len(node.children) == 1 else None
+        if call is None or call.kind != "call" or call.name not in RATE_FUNCTIONS \
+                or len(call.children) != 1 or call.children[0].kind != "matrix":
+            continue
+        seconds = (promql.duration_ms(call.children[0].range) or 0) // 1000
+        if not seconds or any(start <= node.start < end for start, end, _ in replacements):
+            continue
+        grouping = f" by ({', '.join(node.labels)}) " if node.labels else ""
+        inner = expr[call.children[0].start:call.children[0].end]
+        text = f"{node.name}{grouping}({RATE_FUNCTIONS[call.name]}({inner})) / {seconds}"
+        replacements.append((node.start, node.end, text if node is tree else f"({text})"))
+    return promql.splice(expr, replacements)
+
+
+def rule_index(rules_path=dq.LOKI_RULES):
+    """The Loki recording rules, with their expressions normalized"""
+    rules = []
+    for rule in dq.recording_rules(rules_path, "logql"):
+        try:
+            expr = normalize(rule.expr)
+        except promql.ParseError:
+            continue
+        rules.append(dq.RecordingRule(rule.record, expr, rule.group, rule.interval,
+                                      rule.path, rule.language))
+    return lint_promql.RuleIndex(rules)
+
+
+# -- bytes scanned ---------------------------------------------------------------
+
+class LogEstimator:
+    """Bytes per second a log selector reads: from Loki's index stats, or guessed"""
+
+    def __init__(self, loki_url=None, known=KNOWN_VALUES):
+        self.known = known
+        self.loki_url = loki_url
+        self._volumes = {}
+
+    def volume(self, selector):
+        """Bytes per second over the last hour on the server, or None"""
+        matchers = [m for m in selector.matchers if not m.value.startswith(("$", "[["))]
+        if not self.loki_url or not matchers:
+            return None
+        query = promql.selector_text(None, matchers)
+        if query not in self._volumes:
+            end = time.time_ns()
+            url = self.loki_url.rstrip("/") + "/loki/api/v1/index/stats?" + \
+                urllib.parse.urlencode({"query": query, "start": end - 3600 * 10**9,
+                                        "end": end})
+            try:
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    self._volumes[query] = json.load(response).get("bytes", 0) / 3600
+            except Exception as e:
+                print(f"warning: {query}: {e}", file=sys.stderr)
+                self._volumes[query] = None
+        return self._volumes[query]
+
+    def bytes_per_second(self, selector):
+        counted = self.volume(selector)
+        if counted is not None:
+            return counted
+        volume = LOG_BYTES_PER_SECOND
+        for matcher in promql.stream_filters(selector)[0]:
+            values = self.known.get(matcher.label)
+            selected = selected_values(matcher, values) if values else None
+            if selected is not None:
+                volume *= len(selected) / len(values)
+            elif matcher.op == "=" and matcher.label not in SOURCE_LABELS \
+                    and not matcher.value.startswith(("$", "[[")):
+                volume /= lint_promql.VALUES_PER_LABEL
+        return volume
+
+    def bytes_scanned(self, tree, time_range_ms, instant=False):
+        """
+        Bytes one evaluation of `tree` reads from Loki over a dashboard
+        time range of `time_range_ms` ($__range)
+        """
+        total = 0
+        for selector, range_ in promql.selectors(tree):
+            if selector.name is not None:
+                continue
+            range_ms = time_range_ms if range_ == "$__range" else promql.duration_ms(range_) or 0
+            span_ms = 0 if instant else time_range_ms
+            total += self.bytes_per_second(selector) * (span_ms + range_ms) / 1000
+        return int(total)
+
+
+def scan_kind(tree):
+    """'parse', 'filter' or 'stream' for the most expensive log selector in `tree`"""
+    kinds = set()
+    for selector, _ in promql.selectors(tree):
+        if selector.name is None:
+            stages = promql.stream_filters(selector)[1]
+            kinds.add("parse" if any(s[0] == "|" and len(s) > 1 and s[1] in PARSERS
+                                     for s in stages)
+                      else "filter" if stages else "stream")
+    return next((k for k in ("parse", "filter", "stream") if k in kinds), None)
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1000 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1000
+
+
+# -- analysis ---------------------------------------------------------------------
+
+class Finding:
+    """The rewrites of one LogQL query and the logs it still reads"""
+
+    def __init__(self, query):
+        self.query = query
+        self.error = None
+        self.kinds = []
+        self.record = None
+        self.new_expr = query.expr
+        self.datasource = None
+        self.metric = False
+        self.scan = None
+        self.before = self.after = 0
+
+
+def _time_range_ms(query, dashboards):
+    """The time range of a query's dashboard, 0 for alerts"""
+    if query.source == "alert":
+        return 0
+    if query.path not in dashboards:
+        dashboards[query.path] = dq.load_dashboard(query.path)
+    start = str((dashboards[query.path].get("time") or {}).get("from", ""))
+    return promql.duration_ms(start[len("now-"):] if start.startswith("now-") else None) \
+        or promql.duration_ms(DEFAULT_TIME_RANGE)
+
+
+def analyze(query, index, estimator, dashboards):
+    finding = Finding(query)
+    try:
+        tree = promql.parse(query.expr)
+        labelled, kinds = label_rewrite(query.expr)
+        normalized = normalize(labelled)
+    except promql.ParseError as e:
+        finding.error = str(e)
+        return finding
+    finding.metric = any(range_ is not None for sel, range_ in promql.selectors(tree)
+                         if sel.name is None)
+    time_range = _time_range_ms(query, dashboards)
+    instant = query.source == "alert" or bool(query.target.get("instant")) \
+        or query.target.get("queryType") == "instant"
+    finding.before = estimator.bytes_scanned(tree, time_range, instant) if finding.metric else 0
+
+    ruled = dq.Query(query.path, query.source, query.title, query.language,
+                     {"expr": normalized}, query.panel, query.refresh, query.uid)
+    lint = lint_promql.lint(ruled, index, lint_promql.Estimator(index, dq.scrape_interval()))
+    if lint.rewrites:
+        finding.kinds = kinds + ["rule"]
+        finding.record = ", ".join(r.record for r in lint.rewrites)
+        finding.new_expr = lint.new_expr
+        finding.datasource = dq.MIMIR if query.uid != dq.MIMIR["uid"] else None
+        return finding
+    finding.kinds = kinds
+    finding.new_expr = labelled
+    new_tree = promql.parse(labelled)
+    if finding.metric:
+        finding.after = estimator.bytes_scanned(new_tree, time_range, instant)
+        finding.scan = scan_kind(new_tree)
+    return finding
+
+
+def analyze_all(queries, index, estimator):
+    dashboards = {}
+    return [analyze(q, index, estimator, dashboards)
+            for q in queries if q.language == "logql"]
+
+
+def report(findings, out=sys.stdout):
+    totals = defaultdict(lambda: [0, 0, 0, 0])
+    for finding in findings:
+        per_minute = 60 / finding.query.refresh if finding.query.refresh else 0
+        total = totals[finding.query.path]
+        total[0] += finding.before
+        total[1] += finding.after
+        total[2] += finding.before * per_minute
+        total[3] += finding.after * per_minute
+    print(f"{'file':<58} {'bytes scanned/eval':>21} {'per minute':>21}", file=out)
+    for path, (before, after, before_min, after_min) in sorted(
+            totals.items(), key=lambda kv: kv[1][2] - kv[1][3], reverse=True):
+        print(f"{dq.relpath(path)[-58:]:<58} {format_bytes(before):>10}->"
+              f"{format_bytes(after):<10} {format_bytes(before_min):>10}->"
+              f"{format_bytes(after_min):<10}", file=out)
+
+    rewrites = [f for f in findings if f.new_expr != f.query.expr]
+    if rewrites:
+        print(f"\nRewrites ({len(rewrites)}):", file=out)
+        for finding in rewrites:
+            kinds = ", ".join(dict.fromkeys(finding.kinds))
+            if finding.record:
+                kinds += f" {finding.record}"
+            if finding.datasource:
+                kinds += f"; datasource -> {finding.datasource['uid']}"
+            print(f"  {finding.query.where}  [{kinds}]\n"
+                  f"    - {finding.query.expr}\n    + {finding.new_expr}", file=out)
+
+    scans = sorted((f for f in findings if f.scan), key=lambda f: -f.after)
+    if scans:
+        parsing = sum(f.scan == "parse" for f in scans)
+        print(f"\nLog scans ({len(scans)}, {parsing} parsing every line): "
+              "metric queries still reading logs", file=out)
+        for finding in scans:
+            print(f"  {finding.scan:<6} {format_bytes(finding.after):>9}/eval  "
+                  f"{finding.query.where}\n    {finding.new_expr}", file=out)
+
+    errors = [f for f in findings if f.error]
+    if errors:
+        print(f"\nInvalid queries ({len(errors)}):", file=out)
+        for finding in errors:
+            print(f"  {finding.query.where}: {finding.error}", file=out)
+
+
+def write(findings):
+    """Apply the rewrites to the dashboard and alert rule files; returns the files changed"""
+    by_file = defaultdict(dict)
+    for finding in findings:
+        if finding.new_expr != finding.query.expr:
+            by_file[finding.query.path][finding.query.expr] = \
+                (finding.query.expr, finding.new_expr, finding.datasource)
+    for path, rewrites in by_file.items():
+        for old in dq.apply_rewrites(path, list(rewrites.values())):
+            print(f"warning: {dq.relpath(path)}: could not rewrite {old!r}", file=sys.stderr)
+    return sorted(by_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--write", action="store_true", help="rewrite the files in place")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 if any query can be rewritten")
+    parser.add_argument("--loki-url", help="read log volumes from this Loki's index stats")
+    args = parser.parse_args(argv)
+
+    findings = analyze_all(dq.all_queries(), rule_index(), LogEstimator(args.loki_url))
+    report(findings)
+    if args.write:
+        for path in write(findings):
+            print(f"rewrote {dq.relpath(path)}")
+        return 0
+    pending = [f for f in findings if f.new_expr != f.query.expr]
+    if args.check and pending:
+        print(f"\n{len(pending)} LogQL queries can read stream labels or recording rules; "
+              "run scripts/optimize_logql.py --write")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
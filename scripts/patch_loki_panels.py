@@ -11,6 +11,16 @@ ROOT = os.path.join(os.path.dirname(__file__), "..")
 LOKI = {"type": "loki", "uid": "grafana_loki"}
 PROMETHEUS = {"type": "prometheus", "uid": "grafana_prometheus"}
 
+
+def collapsed_row(panels):
+    """
+    `panels` (a row followed by its panels) as one collapsed row, so their
+    queries only run when the row is expanded
+    """
+    row, *nested = panels
+    return [dict(row, panels=nested)]
+
+
 # ── A. Infrastructure-Health.json ─────────────────────────────────────────────
 INFRA_PATH = os.path.join(ROOT, "grafana", "dashboards", "infrastructure", "Infrastructure-Health.json")
 with open(INFRA_PATH, "r", encoding="utf-8") as f:
@@ -20,7 +30,7 @@ Y_START = 80  # After last panel (max y+h was 74)
 
 loki_health_panels = [
     {
-        "collapsed": False,
+        "collapsed": True,
         "gridPos": {"h": 1, "w": 24, "x": 0, "y": Y_START},
         "id": 28,
         "title": "Loki Log Ingestion Health",
@@ -129,7 +139,7 @@ loki_health_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'sum(rate({app=~"gatewayz.*"} |= "ERROR" [1m]))',
+            "expr": 'sum(rate({app=~"gatewayz.*", level="ERROR"} [1m]))',
             "legendFormat": "ERROR lines/s",
             "refId": "A"
         }],
@@ -191,19 +201,19 @@ loki_health_panels = [
         "targets": [
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level="INFO" [5m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level="INFO"} [5m]))',
                 "legendFormat": "INFO (good path)",
                 "refId": "A"
             },
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level="WARNING" [5m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level="WARNING"} [5m]))',
                 "legendFormat": "WARNING",
                 "refId": "B"
             },
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level=~"ERROR|CRITICAL" [5m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level=~"ERROR|CRITICAL"} [5m]))',
                 "legendFormat": "ERROR / CRITICAL",
                 "refId": "C"
             }
@@ -214,7 +224,7 @@ loki_health_panels = [
     }
 ]
 
-infra["panels"].extend(loki_health_panels)
+infra["panels"].extend(collapsed_row(loki_health_panels))
 
 with open(INFRA_PATH, "w", encoding="utf-8") as f:
     json.dump(infra, f, indent=2, ensure_ascii=False)
@@ -229,7 +239,7 @@ INCIDENT_Y = 220  # After model availability row (which ends around y=217)
 
 incident_panels = [
     {
-        "collapsed": False,
+        "collapsed": True,
         "gridPos": {"h": 1, "w": 24, "x": 0, "y": INCIDENT_Y},
         "id": 209,
         "title": "Incident Response -- Dual Log + Metric Signals",
@@ -263,7 +273,7 @@ incident_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'sum(rate({app=~"gatewayz.*"} |= "ERROR" [1m]))',
+            "expr": 'sum(rate({app=~"gatewayz.*", level="ERROR"} [1m]))',
             "legendFormat": "ERROR/s",
             "refId": "A"
         }],
@@ -297,7 +307,7 @@ incident_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'sum(rate({app=~"gatewayz.*"} |= "CRITICAL" [1m]))',
+            "expr": 'sum(rate({app=~"gatewayz.*", level="CRITICAL"} [1m]))',
             "legendFormat": "CRITICAL/s",
             "refId": "A"
         }],
@@ -333,7 +343,7 @@ incident_panels = [
         "targets": [
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level=~"ERROR|CRITICAL" [5m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level=~"ERROR|CRITICAL"} [5m]))',
                 "legendFormat": "Log ERROR rate",
                 "refId": "A"
             },
@@ -374,7 +384,7 @@ incident_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'topk(8, sum by (error_type) (count_over_time({app=~"gatewayz.*"} | logfmt | error_type != "" [15m])))',
+            "expr": 'topk(8, sum by (error_type) (count_over_time({app=~"gatewayz.*", error_type!=""} [15m])))',
             "legendFormat": "{{error_type}}",
             "refId": "A",
             "instant": True
@@ -400,7 +410,7 @@ incident_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": '{app=~"gatewayz.*"} | level=~"ERROR|CRITICAL" | logfmt',
+            "expr": '{app=~"gatewayz.*", level=~"ERROR|CRITICAL"} | logfmt',
             "refId": "A"
         }],
         "title": "Live Error Stream -- Real-time ERROR and CRITICAL Logs",
@@ -409,7 +419,7 @@ incident_panels = [
     }
 ]
 
-fgs["panels"].extend(incident_panels)
+fgs["panels"].extend(collapsed_row(incident_panels))
 
 with open(FGS_PATH, "w", encoding="utf-8") as f:
     json.dump(fgs, f, indent=2, ensure_ascii=False)
@@ -421,7 +431,7 @@ with open(ERROR_LOGS_PATH, "r", encoding="utf-8") as f:
     errlogs = json.load(f)
 
 # Find max panel ID and max y
-max_id = max(p.get("id", 0) for p in errlogs["panels"])
+max_id = max(p.get("id", 0) for row in errlogs["panels"] for p in [row] + row.get("panels", []))
 max_y = max((p.get("gridPos", {}).get("y", 0) + p.get("gridPos", {}).get("h", 0)) for p in errlogs["panels"])
 C_Y = max_y + 2
 C_START_ID = max_id + 1
@@ -430,7 +440,7 @@ print(f"Error Logs dashboard: max_id={max_id}, max_y={max_y}, new panels start a
 
 consistency_panels = [
     {
-        "collapsed": False,
+        "collapsed": True,
         "gridPos": {"h": 1, "w": 24, "x": 0, "y": C_Y},
         "id": C_START_ID,
         "title": "Consistency & Reliability -- Positive vs Negative Signal Baseline",
@@ -469,19 +479,19 @@ consistency_panels = [
         "targets": [
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level="INFO" [5m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level="INFO"} [5m]))',
                 "legendFormat": "Positive: INFO (good path)",
                 "refId": "A"
             },
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level="WARNING" [5m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level="WARNING"} [5m]))',
                 "legendFormat": "Negative: WARNING",
                 "refId": "B"
             },
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level=~"ERROR|CRITICAL" [5m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level=~"ERROR|CRITICAL"} [5m]))',
                 "legendFormat": "Negative: ERROR / CRITICAL",
                 "refId": "C"
             }
@@ -509,7 +519,7 @@ consistency_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'sum by (error_type) (rate({app=~"gatewayz.*"} | logfmt | error_type != "" [5m]))',
+            "expr": 'sum by (error_type) (rate({app=~"gatewayz.*", error_type!=""} [5m]))',
             "legendFormat": "{{error_type}}",
             "refId": "A"
         }],
@@ -545,7 +555,7 @@ consistency_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'count(count by (error_type) (count_over_time({app=~"gatewayz.*"} | logfmt | error_type != "" [15m])))',
+            "expr": 'count(count by (error_type) (count_over_time({app=~"gatewayz.*", error_type!=""} [15m])))',
             "legendFormat": "Distinct Error Types",
             "refId": "A"
         }],
@@ -573,13 +583,13 @@ consistency_panels = [
         "targets": [
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level=~"ERROR|CRITICAL" [1m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level=~"ERROR|CRITICAL"} [1m]))',
                 "legendFormat": "Error Rate (1m)",
                 "refId": "A"
             },
             {
                 "datasource": LOKI,
-                "expr": 'sum(rate({app=~"gatewayz.*"} | level="INFO" [1m]))',
+                "expr": 'sum(rate({app=~"gatewayz.*", level="INFO"} [1m]))',
                 "legendFormat": "Recovery (INFO rate)",
                 "refId": "B"
             }
@@ -607,7 +617,7 @@ consistency_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'sum(rate({app=~"gatewayz.*"} | level="INFO" [5m]))',
+            "expr": 'sum(rate({app=~"gatewayz.*", level="INFO"} [5m]))',
             "legendFormat": "Successful log lines/s",
             "refId": "A"
         }],
@@ -645,7 +655,7 @@ consistency_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": '(sum(rate({app=~"gatewayz.*"} | level="INFO" [5m])) / clamp_min(sum(rate({app=~"gatewayz.*"}[5m])), 0.001)) * 100',
+            "expr": '(sum(rate({app=~"gatewayz.*", level="INFO"} [5m])) / clamp_min(sum(rate({app=~"gatewayz.*"}[5m])), 0.001)) * 100',
             "legendFormat": "Log-level Reliability %",
             "refId": "A"
         }],
@@ -669,7 +679,7 @@ consistency_panels = [
         },
         "targets": [{
             "datasource": LOKI,
-            "expr": 'sum by (service) (count_over_time({app=~"gatewayz.*"} | logfmt | service != "" [5m]))',
+            "expr": 'sum by (service) (count_over_time({app=~"gatewayz.*", service!=""} [5m]))',
             "legendFormat": "{{service}}",
             "refId": "A",
             "instant": True
@@ -683,7 +693,7 @@ consistency_panels = [
     }
 ]
 
-errlogs["panels"].extend(consistency_panels)
+errlogs["panels"].extend(collapsed_row(consistency_panels))
 
 with open(ERROR_LOGS_PATH, "w", encoding="utf-8") as f:
     json.dump(errlogs, f, indent=2, ensure_ascii=False)
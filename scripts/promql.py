@@ -0,0 +1,547 @@
+"""
+promql.py
+Small PromQL / LogQL parser shared by the dashboard query tools.
+
+Parses an expression into a tree of Nodes that keep their source span, so
+a tool can compare expressions semantically (`canonical`) and replace a
+sub-expression in place (`splice`) without reformatting the rest of the
+query. Grafana template variables ($__rate_interval, ${var}) are accepted
+wherever a duration, number or label value can appear.
+
+LogQL log selectors (`{app="x"} |= "ERROR" | logfmt`) parse as selectors
+with a `pipeline`: one tuple of tokens per stage.
+"""
+import re
+
+AGGREGATIONS = {
+    "sum", "avg", "min", "max", "count", "group", "stddev", "stdvar",
+    "topk", "bottomk", "quantile", "count_values", "limitk", "limit_ratio",
+}
+# Aggregations whose first argument is a parameter, not the vector
+PARAMETRIC = {"topk", "bottomk", "quantile", "count_values", "limitk", "limit_ratio"}
+
+# Binary operator precedence, lowest first; ^ is right-associative
+PRECEDENCE = {
+    "or": 1,
+    "and": 2, "unless": 2,
+    "==": 3, "!=": 3, "<=": 3, "<": 3, ">=": 3, ">": 3,
+    "+": 4, "-": 4,
+    "*": 5, "/": 5, "%": 5, "atan2": 5,
+    "^": 6,
+}
+COMPARISONS = {"==", "!=", "<=", "<", ">=", ">"}
+# Operators whose operands can be swapped without changing the result
+COMMUTATIVE = {"+", "*", "==", "!="}
+
+LINE_FILTERS = {"|=", "!=", "|~", "!~"}
+MATCH_OPS = {"=", "!=", "=~", "!~"}
+
+DURATION_UNITS = {"ms": 1, "s": 1000, "m": 60000, "h": 3600000,
+                  "d": 86400000, "w": 604800000, "y": 31536000000}
+
+_TOKEN = re.compile(r"""
+    (?P<ws>\s+|\#[^\n]*)
+  | (?P<duration>(?:\d+(?:ms|[smhdwy]))+(?!\w))
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`[^`]*`)
+  | (?P<var>\$\{[^}]*\}|\$\w+|\[\[\w+\]\])
+  | (?P<ident>[A-Za-z_][\w:]*)
+  | (?P<op>\|=|\|~|!~|=~|!=|==|<=|>=|[-+*/%^<>=|@(){}\[\],:])
+""", re.VERBOSE)
+
+
+class ParseError(ValueError):
+    pass
+
+
+class Token:
+    __slots__ = ("kind", "text", "start", "end")
+
+    def __init__(self, kind, text, start, end):
+        self.kind = kind
+        self.text = text
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return f"{self.kind}:{self.text}"
+
+
+def tokenize(source):
+    tokens = []
+    pos = 0
+    while pos < len(source):
+        m = _TOKEN.match(source, pos)
+        if not m:
+            raise ParseError(f"unexpected character {source[pos]!r} at {pos}")
+        kind = m.lastgroup
+        if kind != "ws":
+            tokens.append(Token(kind, m.group(), m.start(), m.end()))
+        pos = m.end()
+    tokens.append(Token("eof", "", len(source), len(source)))
+    return tokens
+
+
+class Node:
+    """
+    One expression node. `kind` is one of number, string, var, selector,
+    matrix, subquery, call, agg, binary, unary, paren; `start`/`end` are
+    its span in the source. Kind-specific fields are plain attributes.
+    """
+
+    def __init__(self, kind, start, end, children=(), **attrs):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.children = list(children)
+        self.__dict__.update(attrs)
+
+    def __repr__(self):
+        return f"Node({self.kind}, {self.start}:{self.end})"
+
+
+def unquote(text):
+    if text[0] == "`":
+        return text[1:-1]
+    body = text[1:-1]
+    return re.sub(r"\\(.)", lambda m: {"n": "\n", "t": "\t"}.get(m.group(1), m.group(1)), body)
+
+
+def quote(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def duration_ms(text):
+    """Milliseconds in a duration like 1h30m, or None for a template variable"""
+    if text is None or not re.fullmatch(r"(?:\d+(?:ms|[smhdwy]))+", text):
+        return None
+    return sum(int(n) * DURATION_UNITS[u] for n, u in re.findall(r"(\d+)(ms|[smhdwy])", text))
+
+
+def format_duration(ms):
+    for unit in ("d", "h", "m", "s"):
+        size = DURATION_UNITS[unit]
+        if ms >= size and ms % size == 0:
+            return f"{ms // size}{unit}"
+    return f"{ms}ms"
+
+
+class Parser:
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def at(self, *texts):
+        return self.peek().text in texts and self.peek().kind in ("op", "ident")
+
+    def expect(self, text):
+        token = self.next()
+        if token.text != text:
+            raise ParseError(f"expected {text!r} at {token.start}, got {token.text!r}")
+        return token
+
+    def parse(self):
+        node = self.expr(0)
+        if self.peek().kind != "eof":
+            token = self.peek()
+            raise ParseError(f"unexpected {token.text!r} at {token.start}")
+        return node
+
+    # -- operators ---------------------------------------------------------
+
+    def binary_op(self):
+        token = self.peek()
+        if token.kind == "op" and token.text in PRECEDENCE:
+            return token.text
+        if token.kind == "ident" and token.text.lower() in PRECEDENCE:
+            return token.text.lower()
+        return None
+
+    def expr(self, min_prec):
+        left = self.unary()
+        while True:
+            op = self.binary_op()
+            if op is None or PRECEDENCE[op] < min_prec:
+                return left
+            self.next()
+            attrs = {"op": op, "bool": False, "matching": None, "match_labels": (),
+                     "group": None, "group_labels": ()}
+            if self.at("bool"):
+                self.next()
+                attrs["bool"] = True
+            if self.at("on", "ignoring"):
+                attrs["matching"] = self.next().text
+                attrs["match_labels"] = self.label_list()
+            if self.at("group_left", "group_right"):
+                attrs["group"] = self.next().text
+                attrs["group_labels"] = self.label_list() if self.at("(") else ()
+            right = self.expr(PRECEDENCE[op] + (0 if op == "^" else 1))
+            left = Node("binary", left.start, right.end, (left, right), **attrs)
+
+    def unary(self):
+        if self.peek().kind == "op" and self.peek().text in ("-", "+"):
+            token = self.next()
+            operand = self.expr(PRECEDENCE["^"])
+            return Node("unary", token.start, operand.end, (operand,), op=token.text)
+        return self.postfix(self.primary())
+
+    def label_list(self):
+        self.expect("(")
+        labels = []
+        while not self.at(")"):
+            token = self.next()
+            if token.kind not in ("ident", "string"):
+                raise ParseError(f"expected label name at {token.start}")
+            labels.append(unquote(token.text) if token.kind == "string" else token.text)
+            if self.at(","):
+                self.next()
+        self.expect(")")
+        return tuple(labels)
+
+    # -- postfix: range, subquery, offset, @ --------------------------------
+
+    def duration(self):
+        token = self.next()
+        if token.kind not in ("duration", "var", "number"):
+            raise ParseError(f"expected duration at {token.start}, got {token.text!r}")
+        return token.text
+
+    def postfix(self, node):
+        while True:
+            if self.at("["):
+                self.next()
+                range_ = self.duration()
+                if self.at(":"):
+                    self.next()
+                    step = None if self.at("]") else self.duration()
+                    end = self.expect("]").end
+                    node = Node("subquery", node.start, end, (node,), range=range_, step=step,
+                                offset=None)
+                else:
+                    end = self.expect("]").end
+                    node = Node("matrix", node.start, end, (node,), range=range_, offset=None)
+            elif self.at("offset"):
+                self.next()
+                sign = self.next().text if self.at("-") else ""
+                token = self.peek()
+                node.offset = sign + self.duration()
+                node.end = token.end
+            elif self.at("@"):
+                self.next()
+                token = self.next()
+                text = token.text
+                if self.at("("):
+                    self.next()
+                    text += "()"
+                    token = self.expect(")")
+                node.at = text
+                node.end = token.end
+            else:
+                return node
+
+    # -- primaries ---------------------------------------------------------
+
+    def primary(self):
+        token = self.peek()
+        if token.kind == "number":
+            self.next()
+            return Node("number", token.start, token.end, value=float(int(token.text, 16))
+                        if token.text[:2].lower() == "0x" else float(token.text), text=token.text)
+        if token.kind == "duration":
+            # A bare duration only appears as a number of seconds (e.g. in
+            # arithmetic with time()); keep it comparable.
+            self.next()
+            return Node("number", token.start, token.end,
+                        value=duration_ms(token.text) / 1000, text=token.text)
+        if token.kind == "string":
+            self.next()
+            return Node("string", token.start, token.end, value=unquote(token.text))
+        if token.kind == "var":
+            self.next()
+            return Node("var", token.start, token.end, value=token.text)
+        if token.text == "(":
+            self.next()
+            inner = self.expr(0)
+            end = self.expect(")").end
+            return Node("paren", token.start, end, (inner,))
+        if token.text == "{":
+            return self.selector(None, token.start)
+        if token.kind == "ident":
+            name = token.text
+            following = self.peek(1).text
+            if name.lower() in AGGREGATIONS and following in ("(", "by", "without"):
+                return self.aggregation()
+            if following == "(":
+                return self.call()
+            if name.lower() in ("inf", "nan"):
+                self.next()
+                return Node("number", token.start, token.end, value=float(name), text=name)
+            self.next()
+            if self.at("{"):
+                return self.selector(name, token.start)
+            return self.log_pipeline(
+                Node("selector", token.start, token.end, name=name, matchers=[], pipeline=[],
+                     offset=None, at=None)
+            )
+        raise ParseError(f"unexpected {token.text!r} at {token.start}")
+
+    def call(self):
+        name_token = self.next()
+        self.expect("(")
+        args = []
+        while not self.at(")"):
+            args.append(self.expr(0))
+            if self.at(","):
+                self.next()
+        end = self.expect(")").end
+        node = Node("call", name_token.start, end, args, name=name_token.text)
+        # LogQL range aggregations over unwrapped values take a grouping
+        if self.at("by", "without"):
+            node.grouping = self.next().text
+            node.labels = self.label_list()
+            node.end = self.tokens[self.pos - 1].end
+        return node
+
+    def aggregation(self):
+        name_token = self.next()
+        grouping, labels = None, ()
+        if self.at("by", "without"):
+            grouping = self.next().text
+            labels = self.label_list()
+        self.expect("(")
+        args = []
+        while not self.at(")"):
+            args.append(self.expr(0))
+            if self.at(","):
+                self.next()
+        end = self.expect(")").end
+        if self.at("by", "without"):
+            grouping = self.next().text
+            labels = self.label_list()
+            end = self.tokens[self.pos - 1].end
+        return Node("agg", name_token.start, end, args, name=name_token.text.lower(),
+                    grouping=grouping, labels=labels)
+
+    def selector(self, name, start):
+        self.expect("{")
+        matchers = []
+        while not self.at("}"):
+            label = self.next()
+            if label.kind not in ("ident", "string"):
+                raise ParseError(f"expected label matcher at {label.start}")
+            label_name = unquote(label.text) if label.kind == "string" else label.text
+            op = self.next()
+            if op.text not in MATCH_OPS:
+                if label.kind == "string" and name is None:
+                    # {"metric_name"} shorthand
+                    self.pos -= 1
+                    name = label_name
+                    if self.at(","):
+                        self.next()
+                    continue
+                raise ParseError(f"expected matcher operator at {op.start}")
+            value = self.next()
+            if value.kind not in ("string", "var"):
+                raise ParseError(f"expected label value at {value.start}")
+            matchers.append(Matcher(
+                label_name, op.text,
+                unquote(value.text) if value.kind == "string" else value.text,
+                self.source[label.start:value.end],
+            ))
+            if self.at(","):
+                self.next()
+        end = self.expect("}").end
+        for matcher in list(matchers):
+            if matcher.label == "__name__" and matcher.op == "=" and name is None:
+                name = matcher.value
+                matchers.remove(matcher)
+        node = Node("selector", start, end, name=name, matchers=matchers, pipeline=[],
+                    offset=None, at=None, braces=True)
+        return self.log_pipeline(node)
+
+    def log_pipeline(self, node):
+        """LogQL stages after a log selector, as token-text tuples"""
+        while True:
+            token = self.peek()
+            if token.kind != "op":
+                return node
+            if token.text in LINE_FILTERS and (token.text in ("|=", "|~")
+                                               or self.peek(1).kind == "string"):
+                stage = [self.next().text]
+                stage.append(self.next().text)
+                while self.at("or") and self.peek(1).kind == "string":
+                    stage.append(self.next().text)
+                    stage.append(self.next().text)
+            elif token.text == "|":
+                stage = [self.next().text]
+                compared = False
+                while True:
+                    t = self.peek()
+                    if t.kind == "eof" or t.text in ("|", "|=", "|~", "[", ")"):
+                        break
+                    if compared and t.text in ("!=", "!~") and self.peek(1).kind == "string" \
+                            and self.tokens[self.pos - 1].kind in ("string", "number", "duration"):
+                        break
+                    if t.text in MATCH_OPS | COMPARISONS:
+                        compared = True
+                    stage.append(self.next().text)
+            else:
+                return node
+            node.pipeline.append(tuple(stage))
+            node.end = self.tokens[self.pos - 1].end
+
+
+class Matcher:
+    __slots__ = ("label", "op", "value", "text")
+
+    def __init__(self, label, op, value, text):
+        self.label = label
+        self.op = op
+        self.value = value
+        self.text = text
+
+    def key(self):
+        return (self.label, self.op, self.value)
+
+    def __repr__(self):
+        return self.text
+
+
+def parse(source):
+    """Root Node of a PromQL or LogQL expression; raises ParseError"""
+    return Parser(source).parse()
+
+
+def walk(node):
+    """Every node of the tree, parents before children"""
+    yield node
+    for child in node.children:
+        yield from walk(child)
+
+
+def unparen(node):
+    while node.kind == "paren":
+        node = node.children[0]
+    return node
+
+
+def _duration_key(text):
+    ms = duration_ms(text)
+    return text if ms is None else ms
+
+
+def stage_key(stage):
+    return tuple(
+        ("s", unquote(part)) if part[:1] in "\"'`" else part for part in stage
+    )
+
+
+def canonical(node):
+    """
+    Hashable form of an expression: equal for expressions that evaluate
+    the same, regardless of spacing, parentheses, matcher or grouping
+    order, `sum(x) by (l)` vs `sum by (l) (x)`, duration spelling (60s vs
+    1m), the operand order of + and *, or whether a LogQL stream label is
+    matched in the selector or by a leading `| label="value"` stage.
+    """
+    node = unparen(node)
+    kind = node.kind
+    if kind == "number":
+        return ("num", repr(node.value))
+    if kind in ("string", "var"):
+        return (kind, node.value)
+    if kind == "selector":
+        matchers, stages = stream_filters(node)
+        return ("sel", node.name, tuple(sorted(m.key() for m in matchers)),
+                tuple(stage_key(s) for s in stages),
+                _duration_key(node.offset), node.at)
+    if kind == "matrix":
+        return ("matrix", canonical(node.children[0]), _duration_key(node.range),
+                _duration_key(node.offset), getattr(node, "at", None))
+    if kind == "subquery":
+        return ("subquery", canonical(node.children[0]), _duration_key(node.range),
+                _duration_key(node.step), _duration_key(node.offset), getattr(node, "at", None))
+    if kind == "call":
+        return ("call", node.name, tuple(canonical(a) for a in node.children),
+                getattr(node, "grouping", None), tuple(sorted(getattr(node, "labels", ()))))
+    if kind == "agg":
+        return ("agg", node.name, node.grouping or "by", tuple(sorted(node.labels)),
+                tuple(canonical(a) for a in node.children))
+    if kind == "unary":
+        inner = canonical(node.children[0])
+        return inner if node.op == "+" else ("neg", inner)
+    if kind == "binary":
+        lhs, rhs = canonical(node.children[0]), canonical(node.children[1])
+        if node.op in COMMUTATIVE and node.group is None and (node.op in ("+", "*") or node.bool):
+            lhs, rhs = sorted((lhs, rhs), key=repr)
+        return ("bin", node.op, node.bool, node.matching, tuple(sorted(node.match_labels)),
+                node.group, tuple(sorted(node.group_labels)), lhs, rhs)
+    raise ValueError(f"unknown node kind {kind}")
+
+
+def selectors(node):
+    """Every selector in the expression, with the range it is read over (or None)"""
+    found = []
+
+    def visit(n, range_):
+        if n.kind == "selector":
+            found.append((n, range_))
+        elif n.kind == "matrix":
+            visit(n.children[0], n.range)
+        else:
+            for child in n.children:
+                visit(child, range_)
+    visit(node, None)
+    return found
+
+
+def metric_names(node):
+    return {sel.name for sel, _ in selectors(node) if sel.name}
+
+
+def stream_filters(selector):
+    """
+    LogQL: (matchers, stages) where the label-filter stages that can only
+    test stream labels (`| level="ERROR"` before any parser or formatting
+    stage) are moved into the matchers, since they select the same lines.
+    """
+    matchers, stages = list(selector.matchers), []
+    labels_only = True
+    for stage in selector.pipeline:
+        if stage[0] in LINE_FILTERS:
+            stages.append(stage)
+        elif labels_only and len(stage) == 4 and stage[2] in MATCH_OPS \
+                and stage[3][:1] in "\"'`":
+            matchers.append(Matcher(stage[1], stage[2], unquote(stage[3]),
+                                    stage[1] + stage[2] + stage[3]))
+        else:
+            labels_only = False
+            stages.append(stage)
+    return matchers, stages
+
+
+def pipeline_text(stages):
+    return " ".join(" ".join(stage) for stage in stages)
+
+
+def splice(source, replacements):
+    """`source` with each (start, end, text) span replaced; spans must not overlap"""
+    for start, end, text in sorted(replacements, reverse=True):
+        source = source[:start] + text + source[end:]
+    return source
+
+
+def selector_text(name, matchers):
+    """`name{matchers}` with the matchers' original spelling"""
+    if not matchers and name:
+        return name
+    return f"{name or ''}{{{', '.join(m.text for m in matchers)}}}"
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+synthesize_recording_rules.py
+Generates recording rules for the aggregations the dashboards and alert
+rules keep recomputing, then rewrites those queries to read them.
+
+Every PromQL and LogQL query is parsed and its aggregations of a range
+function over one selector, e.g.
+
+    sum(rate(fastapi_requests_total{status_code=~"5.."}[5m]))
+    histogram_quantile(0.95, sum by (le) (rate(fastapi_requests_duration_seconds_bucket[5m])))
+    sum(rate({app=~"gatewayz.*"} | level="INFO" [5m]))
+
+are grouped by function, metric (or log pipeline) and range. A group used
+at least --min-uses times, or by a dashboard refreshing every
+--max-refresh or faster, becomes one rule. Label matchers shared by every
+use stay in the rule; matchers that differ between uses (or use template
+variables) become grouping labels instead, so a single rule serves all of
+them:
+
+    sum by (status_code) (rate(fastapi_requests_total[5m]))
+      serves sum(rate(fastapi_requests_total[5m]))
+      and    sum(rate(fastapi_requests_total{status_code=~"5.."}[5m]))
+
+PromQL rules are added to prometheus/recording_rules_baselines.yml and
+LogQL rules to loki/rules/gatewayz_log_recording_rules.yml (each in a
+generated group at the end of the file), and the queries are rewritten
+with scripts/lint_promql.py. Queries moved onto a Loki rule now read
+Mimir, where the Loki ruler writes.
+
+Quantiles are not recorded: histogram_quantile() runs on the recorded
+bucket rates, so one rule serves p50, p95 and p99 alike. Groups needing
+more than --max-labels grouping labels (besides le) are skipped, as the
+rule would record about as many series as it reads.
+
+Panels using [$__rate_interval] are left alone unless --rate-interval
+reads that range as a fixed window; their result then no longer widens
+with the panel's step. Metrics Tempo's metrics generator writes to Mimir
+only are never recorded, since Prometheus evaluates the rules.
+
+Usage:
+    python scripts/synthesize_recording_rules.py            # report
+    python scripts/synthesize_recording_rules.py --write    # add the rules, rewrite queries
+    python scripts/synthesize_recording_rules.py --min-uses 2 --max-refresh 10s
+    python scripts/synthesize_recording_rules.py --rate-interval 5m   # report only
+"""
+import argparse
+import os
+import re
+import sys
+from collections import defaultdict
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import dashboard_queries as dq  # noqa: E402
+import lint_promql  # noqa: E402
+import promql  # noqa: E402
+
+GROUPS = {
+    "promql": (dq.PROMETHEUS_RULES, "dashboard_query_rules"),
+    "logql": (dq.LOKI_RULES, "loki_dashboard_query_rules"),
+}
+
+GROUP_HEADER = """
+  # ============================================================
+  # DASHBOARD QUERY RULES (generated)
+  # ============================================================
+  # Added by scripts/synthesize_recording_rules.py for aggregations
+  # repeated across dashboards and alert rules, which now read these
+  # series instead of recomputing them on every refresh.
+  - name: {name}
+    interval: {interval}
+    rules:
+"""
+
+
+class Use:
+    """One aggregation in one query that a rule could replace"""
+
+    def __init__(self, query, node, call):
+        self.query = query
+        self.node = node
+        self.call = call
+
+    @property
+    def labels(self):
+        return set(self.node.labels)
+
+
+class Candidate:
+    """A recording rule serving a group of uses"""
+
+    def __init__(self, language, agg, uses):
+        self.language = language
+        self.agg = agg
+        self.uses = uses
+        call = uses[0].call
+        common = set.intersection(*({m.key() for m in u.call.matchers} for u in uses))
+        # A matcher on a template variable cannot be evaluated by a rule
+        self.matchers = [m for m in call.matchers
+                         if m.key() in common and not m.value.startswith(("$", "[["))]
+        fixed = {m.key() for m in self.matchers}
+        labels = set()
+        for use in uses:
+            labels |= use.labels
+            labels |= {m.label for m in use.call.matchers if m.key() not in fixed}
+        self.labels = sorted(labels)
+        self.call = call
+        self.record = None
+
+    @property
+    def expr(self):
+        call = self.call
+        selector = promql.selector_text(call.name, self.matchers)
+        if call.stages:
+            selector += " " + promql.pipeline_text(call.stages) + " "
+        inner = f"{call.fn}({selector}[{promql.format_duration(call.range_ms)}])"
+        if self.labels:
+            return f"{self.agg} by ({', '.join(self.labels)}) ({inner})"
+        return f"{self.agg}({inner})"
+
+    def base_name(self):
+        """
+        Prometheus convention level:metric:operations for PromQL; the
+        loki:<domain>:<metric>:<aggregation> convention of the Loki rules
+        file for LogQL
+        """
+        call = self.call
+        window = promql.format_duration(call.range_ms)
+        labels = [label for label in self.labels if label != "le"]
+        agg = "" if self.agg == "sum" else f"{self.agg}_"
+        if self.language == "promql":
+            metric = call.name
+            if call.fn in ("rate", "irate", "increase") and metric.endswith("_total"):
+                metric = metric[:-len("_total")]
+            return f"{'_'.join(labels) or 'global'}:{metric}:{agg}{call.fn}{window}"
+        # Named after the line filters, else the selected values (level="ERROR")
+        texts = [promql.unquote(part) for stage in call.stages
+                 if stage[0] in promql.LINE_FILTERS for part in stage[1::2]]
+        texts = texts or [m.value for m in self.matchers
+                          if m.op in ("=", "=~") and m.label != "app"]
+        words = [w.lower() for text in texts for w in re.findall(r"[A-Za-z]+", text)]
+        domain = "_".join(words[:3]) or "logs"
+        op = f"count_per_{window}" if call.fn == "count_over_time" else f"{call.fn}{window}"
+        by = f"by_{'_'.join(labels)}:" if labels else ""
+        return f"loki:{domain}:{by}{agg}{op}"
+
+    def where(self, width=None):
+        """Use counts per dashboard / alert file, cut to about `width` characters"""
+        counts = defaultdict(int)
+        for use in self.uses:
+            counts[use.query.title if use.query.source == "dashboard"
+                   else os.path.basename(use.query.path)] += 1
+        items = [f"{title} ({n})" if n > 1 else title
+                 for title, n in sorted(counts.items(), key=lambda kv: -kv[1])]
+        shown = items[:1]
+        for item in items[1:]:
+            if width and len(", ".join(shown + [item])) > width:
+                return ", ".join(shown) + f" and {len(items) - len(shown)} more"
+            shown.append(item)
+        return ", ".join(shown)
+
+
+def collect_uses(queries, index):
+    """
+    Aggregations not already served by a recording rule, keyed for
+    grouping. [$__rate_interval] ranges count as index.rate_interval.
+    PromQL over metrics only Mimir has (Tempo's span metrics and service
+    graphs, which panels read on grafana_mimir) is skipped: Prometheus
+    evaluates the rules and never sees those metrics.
+    """
+    uses = defaultdict(list)
+
+    def visit(query, node):
+        if index.candidates(node):
+            return
+        call = None
+        if node.kind == "agg" and node.name in lint_promql.REAGGREGATABLE \
+                and len(node.children) == 1 and node.grouping in (None, "by"):
+            call = lint_promql.range_call(node.children[0], index.rate_interval)
+        if call is not None and query.language == "promql" \
+                and index.reads_mimir_only(call.node):
+            return
+        if call is not None and ":" not in (call.name or "") \
+                and not any("$" in token for stage in call.stages for token in stage):
+            key = (query.language, node.name, call.key())
+            if query.language == "logql":
+                # Loki needs a stream selector: keep uses with different
+                # selectors apart rather than grouping by every label
+                key += (frozenset(m.key() for m in call.matchers),)
+            uses[key].append(Use(query, node, call))
+            return
+        for child in node.children:
+            visit(query, child)
+
+    for query in queries:
+        try:
+            tree = promql.parse(query.expr)
+        except promql.ParseError:
+            continue
+        visit(query, tree)
+    return uses
+
+
+def synthesize(queries, index, min_uses=3, max_refresh=15, max_labels=3):
+    """Candidates worth recording, named and sorted by number of uses"""
+    candidates = []
+    for (language, agg, *_), uses in collect_uses(queries, index).items():
+        fast = any(u.query.source == "dashboard" and u.query.refresh
+                   and u.query.refresh <= max_refresh for u in uses)
+        if len(uses) >= min_uses or fast:
+            candidate = Candidate(language, agg, uses)
+            if len([label for label in candidate.labels if label != "le"]) > max_labels:
+                continue
+            if language == "logql" and not any(
+                    m.op in ("=", "=~") and m.value not in ("", ".*")
+                    for m in candidate.matchers):
+                continue  # no usable stream selector left
+            candidates.append(candidate)
+    candidates.sort(key=lambda c: (-len(c.uses), c.expr))
+
+    taken = set(index.by_record)
+    for candidate in candidates:
+        name = base = candidate.base_name()
+        n = 2
+        while name in taken:
+            name, n = f"{base}_{n}", n + 1
+        candidate.record = name
+        taken.add(name)
+    return candidates
+
+
+def rule_text(candidate):
+    expr = candidate.expr
+    lines = [f"      # {len(candidate.uses)} uses: {candidate.where(70)}",
+             f"      - record: {candidate.record}"]
+    if yaml.safe_load(f"expr: {expr}") == {"expr": expr}:
+        lines.append(f"        expr: {expr}")
+    else:
+        lines += ["        expr: |", f"          {expr}"]
+    return "\n".join(lines) + "\n"
+
+
+def write_rules(path, group, candidates, interval="1m"):
+    """Append the candidates' rules to `group`, the last group in the rule file at `path`"""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    groups = (yaml.safe_load(text) or {}).get("groups") or []
+    names = [g.get("name") for g in groups]
+    if group in names and names[-1] != group:
+        raise SystemExit(f"{dq.relpath(path)}: group {group} must stay the last group")
+    if group not in names:
+        text = text.rstrip("\n") + "\n" + GROUP_HEADER.format(name=group, interval=interval)
+    else:
+        text = text.rstrip("\n") + "\n\n"
+    text += "\n".join(rule_text(c) for c in candidates)
+    # Rules are separated by exactly one blank line, however the group
+    # was edited since the last run.
+    start = text.index(f"- name: {group}\n")
+    text = text[:start] + re.sub(r"\n{3,}", "\n\n", text[start:])
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--write", action="store_true",
+                        help="add the rules and rewrite the queries in place")
+    parser.add_argument("--min-uses", type=int, default=3,
+                        help="record aggregations used at least this often (default 3)")
+    parser.add_argument("--max-refresh", default="15s",
+                        help="record everything on dashboards refreshing this often (default 15s)")
+    parser.add_argument("--max-labels", type=int, default=3,
+                        help="skip rules needing more grouping labels than this (default 3)")
+    parser.add_argument("--rate-interval",
+                        help="read [$__rate_interval] ranges as this window (e.g. 5m)")
+    parser.add_argument("--interval", default="1m", help="evaluation interval of new groups")
+    args = parser.parse_args(argv)
+
+    rate_interval = promql.duration_ms(args.rate_interval)
+    index = lint_promql.load_index(rate_interval=rate_interval)
+    queries = dq.all_queries()
+    candidates = synthesize(queries, index, args.min_uses,
+                            dq.refresh_seconds(args.max_refresh), args.max_labels)
+    if not candidates:
+        print("No repeated aggregations left to record.")
+        return 0
+
+    interval = dq.refresh_seconds(args.interval)
+    while True:
+        rules = [dq.RecordingRule(c.record, c.expr, GROUPS[c.language][1], interval,
+                                  GROUPS[c.language][0], c.language) for c in candidates]
+        new_index = lint_promql.RuleIndex(index_rules(index) + rules, rate_interval,
+                                          index.mimir_only)
+        estimator = lint_promql.Estimator(new_index, dq.scrape_interval())
+        findings = lint_promql.lint_all(queries, new_index, estimator)
+        # Drop rules no query ends up reading (e.g. a LogQL query that
+        # still reads logs elsewhere cannot move to Mimir)
+        used = {r.record for f in findings for r in f.rewrites}
+        if all(c.record in used for c in candidates):
+            break
+        candidates = [c for c in candidates if c.record in used]
+
+    for candidate in candidates:
+        print(f"{candidate.record}  ({len(candidate.uses)} uses: {candidate.where()})\n"
+              f"    {candidate.expr}")
+    print()
+    lint_promql.report([f for f in findings if f.rewrites])
+
+    if args.write:
+        for language, (path, group) in GROUPS.items():
+            chosen = [c for c in candidates if c.language == language]
+            if chosen:
+                write_rules(path, group, chosen, args.interval)
+                print(f"added {len(chosen)} rules to {dq.relpath(path)}")
+        for path in lint_promql.write(findings):
+            print(f"rewrote {dq.relpath(path)}")
+    return 0
+
+
+def index_rules(index):
+    return [dq.RecordingRule(r.record, r.expr, r.group, r.interval, None, r.language)
+            for r in index.rules]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,6 +21,13 @@ pytestmark = pytest.mark.dashboard
 DASHBOARDS_DIR = Path(__file__).parent.parent / "grafana" / "dashboards"
 
 
+def all_panels(dashboard):
+    """Top-level panels and the panels nested in collapsed rows"""
+    for panel in dashboard.get("panels", []):
+        yield panel
+        yield from panel.get("panels", [])
+
+
 @pytest.fixture(scope="session")
 def dashboards():
     """Load all dashboard JSON files (including subdirectories)"""
@@ -101,16 +108,16 @@ class TestPanelConfiguration:
     def test_all_panels_have_required_fields(self, dashboards):
         """Verify all panels have required fields"""
         for dashboard_name, dashboard in dashboards.items():
-            for idx, panel in enumerate(dashboard.get("panels", [])):
+            for idx, panel in enumerate(all_panels(dashboard)):
                 assert "id" in panel, f"{dashboard_name} panel {idx} missing 'id'"
                 assert "type" in panel, f"{dashboard_name} panel {idx} missing 'type'"
                 assert "gridPos" in panel, f"{dashboard_name} panel {idx} missing 'gridPos'"
 
     def test_panel_ids_unique_within_dashboard(self, dashboards):
-        """Verify top-level panel IDs are unique within each dashboard"""
+        """Verify panel IDs, including those in collapsed rows, are unique within each dashboard"""
         import warnings
         for dashboard_name, dashboard in dashboards.items():
-            panel_ids = [p.get("id") for p in dashboard.get("panels", [])]
+            panel_ids = [p.get("id") for p in all_panels(dashboard)]
             seen = set()
             duplicates = []
             for pid in panel_ids:
@@ -130,7 +137,7 @@ class TestPanelConfiguration:
         }
 
         for dashboard_name, dashboard in dashboards.items():
-            for idx, panel in enumerate(dashboard.get("panels", [])):
+            for idx, panel in enumerate(all_panels(dashboard)):
                 panel_type = panel.get("type")
                 assert panel_type in valid_types, \
                     f"{dashboard_name} panel {idx} has invalid type: {panel_type}"
@@ -151,10 +158,10 @@ class TestDatasourceConfiguration:
 
     def test_valid_datasource_uids(self, dashboards):
         """Verify all datasource UIDs are valid"""
-        valid_uids = {"grafana_prometheus", "grafana_loki", "grafana_tempo", "grafana_mimir", "grafana_pyroscope", "-- Grafana --", "-- Mixed --", "grafana", "", None}
+        valid_uids = {"grafana_prometheus", "grafana_loki", "grafana_tempo", "grafana_mimir", "grafana_pyroscope", "-- Grafana --", "-- Mixed --", "-- Dashboard --", "grafana", "", None}
 
         for dashboard_name, dashboard in dashboards.items():
-            for panel in dashboard.get("panels", []):
+            for panel in all_panels(dashboard):
                 # Check panel datasource
                 if "datasource" in panel and panel["datasource"]:
                     ds_uid = panel["datasource"].get("uid")
@@ -170,10 +177,11 @@ class TestDatasourceConfiguration:
             "grafana_mimir": "prometheus",
             "grafana_pyroscope": "grafana-pyroscope-datasource",
             "-- Grafana --": "datasource",
+            "-- Dashboard --": "datasource",
         }
 
         for dashboard_name, dashboard in dashboards.items():
-            for panel in dashboard.get("panels", []):
+            for panel in all_panels(dashboard):
                 if "datasource" in panel and panel["datasource"]:
                     ds = panel["datasource"]
                     ds_uid = ds.get("uid")
@@ -186,6 +194,35 @@ class TestDatasourceConfiguration:
                             assert ds_type == expected_type, \
                                 f"{dashboard_name} datasource type mismatch for UID {ds_uid}"
 
+    def test_dashboard_datasource_reuses_loaded_panels(self, dashboards):
+        """
+        Verify "-- Dashboard --" targets reuse a panel that queries itself
+        and is loaded whenever the reusing panel is (outside collapsed rows,
+        or in the same collapsed row)
+        """
+        for dashboard_name, dashboard in dashboards.items():
+            loads_with = {}
+            for panel in dashboard.get("panels", []):
+                collapsed = panel.get("type") == "row" and panel.get("collapsed")
+                loads_with[panel.get("id")] = (panel, None)
+                for child in panel.get("panels", []):
+                    loads_with[child.get("id")] = (child, panel.get("id") if collapsed else None)
+
+            for panel, row in loads_with.values():
+                for target in panel.get("targets") or []:
+                    datasource = target.get("datasource") or panel.get("datasource") or {}
+                    if datasource.get("uid") != "-- Dashboard --":
+                        continue
+                    title = panel.get("title", "unknown")
+                    assert target.get("panelId") in loads_with, \
+                        f"{dashboard_name} panel '{title}' reuses missing panel {target.get('panelId')}"
+                    source, source_row = loads_with[target["panelId"]]
+                    assert source_row in (None, row), \
+                        f"{dashboard_name} panel '{title}' reuses a panel in another collapsed row"
+                    assert all((t.get("datasource") or source.get("datasource") or {}).get("uid")
+                               != "-- Dashboard --" for t in source.get("targets") or []), \
+                        f"{dashboard_name} panel '{title}' reuses a panel that reuses another"
+
 
 class TestFieldOverrides:
     """Test field override naming conventions"""
@@ -193,7 +230,7 @@ class TestFieldOverrides:
     def test_no_generic_series_names(self, dashboards):
         """Verify no generic 'Series A/B' naming in field overrides"""
         for dashboard_name, dashboard in dashboards.items():
-            for panel in dashboard.get("panels", []):
+            for panel in all_panels(dashboard):
                 overrides = panel.get("fieldConfig", {}).get("overrides", [])
                 for override in overrides:
                     matcher = override.get("matcher", {})
@@ -208,7 +245,7 @@ class TestFieldOverrides:
     def test_field_overrides_have_display_names(self, dashboards):
         """Verify field overrides with displayName property have non-empty values"""
         for dashboard_name, dashboard in dashboards.items():
-            for panel in dashboard.get("panels", []):
+            for panel in all_panels(dashboard):
                 overrides = panel.get("fieldConfig", {}).get("overrides", [])
                 for override in overrides:
                     properties = override.get("properties", [])
@@ -236,7 +273,7 @@ class TestFieldOverrides:
         }
 
         for dashboard_name, dashboard in dashboards.items():
-            for panel in dashboard.get("panels", []):
+            for panel in all_panels(dashboard):
                 field_config = panel.get("fieldConfig", {})
 
                 # Check default units
@@ -271,7 +308,7 @@ class TestFieldOverrides:
         rgba_pattern = re.compile(r"^rgba?\(\s*\d+\s*,\s*\d+\s*,\s*\d+\s*(,\s*[\d.]+\s*)?\)$")
 
         for dashboard_name, dashboard in dashboards.items():
-            for panel in dashboard.get("panels", []):
+            for panel in all_panels(dashboard):
                 field_config = panel.get("fieldConfig", {})
 
                 # Check default thresholds
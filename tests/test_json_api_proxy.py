@@ -0,0 +1,1960 @@
+"""
+JSON API Proxy Tests
+
+Tests for the Grafana SimpleJSON proxy in json-api-proxy/:
+- Request planning (one backend fetch per unique endpoint)
+- /query response shape and target ordering
+- Concurrent backend fan-out and the per-query deadline
+- Response cache (TTL, stale-while-revalidate, single-flight, LRU)
+- Pooled keep-alive backend session
+- Sampled time-series history and downsampling
+- Background prefetch scheduling (jitter, backoff, lag)
+- ASGI serving mode (same contract, event-loop concurrency)
+- Prometheus /metrics instrumentation
+- Per-provider table from /prometheus/data/metrics and ad-hoc filters
+- Streaming, family-filtered exposition parsing
+- Cross-worker shared cache tier
+- Anomaly / circuit-breaker annotations with incremental range fetch
+- Backend circuit breakers, last-known-good fallback and hedged requests
+- Fast JSON encoding and negotiated response compression
+- Hot-reloadable metric registry
+- Admission control: per-client token buckets, bounded priority queue
+- Encoded /query result cache keyed by the normalized request
+- Warm-start snapshots of the response cache and history
+- Live monitoring feed: shared polling, merge-patch deltas, SSE fan-out
+
+The backend is replaced by an in-process fake so these tests run offline.
+
+Run with: pytest tests/test_json_api_proxy.py -v
+"""
+
+import asyncio
+import gzip
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+import pytest
+
+PROXY_DIR = Path(__file__).parent.parent / "json-api-proxy"
+sys.path.insert(0, str(PROXY_DIR))
+
+# No background prefetching from the real backend during tests, no cache
+# shared with other processes or restored from a snapshot, and no
+# admission limits or cached /query results outside the tests that
+# exercise them.
+os.environ["PREFETCH_ENABLED"] = "false"
+os.environ["SHARED_CACHE_ENABLED"] = "false"
+os.environ["ADMISSION_ENABLED"] = "false"
+os.environ["RESULT_CACHE_ENABLED"] = "false"
+os.environ["SNAPSHOT_ENABLED"] = "false"
+
+import app as proxy_app  # noqa: E402
+import asgi as proxy_asgi  # noqa: E402
+from admission import (  # noqa: E402
+    PRIORITY_ALERT, PRIORITY_NORMAL, AdmissionController, RateLimiter, Rejected,
+)
+from annotations import AnnotationStore, IntervalSet  # noqa: E402
+from cache import AsyncResponseCache, ResponseCache  # noqa: E402
+from livefeed import FeedFull, LiveFeed, apply_patch, index_lists, merge_patch  # noqa: E402
+from prometheus_client import REGISTRY  # noqa: E402
+import serialization  # noqa: E402
+from scheduler import Schedule  # noqa: E402
+from sharedcache import SharedCache  # noqa: E402
+from exposition import SampleFilter, parse_line, parse_samples  # noqa: E402
+from planner import plan_fetches, extract_value, fetch_key  # noqa: E402
+from providers import FilterError, ProviderTable  # noqa: E402
+from registry import MetricRegistry, RegistryError, compile_metric  # noqa: E402
+from resultcache import ResultCache, assemble, normalize_query  # noqa: E402
+import snapshot  # noqa: E402
+from resilience import (  # noqa: E402
+    CircuitBreaker, CircuitOpenError, UpstreamGuard, hedged_call, hedged_call_async,
+)
+from timeseries import RingBuffer, TimeSeriesStore, downsample, parse_grafana_time  # noqa: E402
+from upstream import build_session, pool_stats  # noqa: E402
+
+pytestmark = pytest.mark.unit
+
+
+REALTIME_PAYLOAD = {
+    "avg_health_score": 97.5,
+    "total_requests": 1200,
+    "total_cost": 12.25,
+}
+ERROR_RATES_PAYLOAD = {"overall_error_rate": 0.02}
+PROVIDER_EXPOSITION = """\
+# HELP provider_health_score Provider health score (0-100)
+# TYPE provider_health_score gauge
+provider_health_score{provider="openrouter",region="us"} 95.5
+provider_health_score{provider="anthropic",region="us"} 88.3
+provider_health_score{provider="cerebras",region="eu"} 40
+provider_circuit_breaker_state{provider="openrouter",model="gpt-4"} 0
+provider_circuit_breaker_state{provider="openrouter",model="gpt-4o"} 1
+provider_circuit_breaker_state{provider="anthropic",model="claude"} 0
+provider_error_rate{provider="openrouter"} 0.05
+provider_availability{provider="openrouter"} 99.5
+provider_availability{provider="anthropic"} 97
+unrelated_metric{job="x"} 1
+"""
+HOUR_MS = 3_600_000
+NOW_MS = 1_700_000_000_000
+ANOMALIES_PAYLOAD = {"anomalies": [
+    {"type": "cost_spike", "provider": "openrouter", "severity": "high",
+     "timestamp": (NOW_MS - 2 * HOUR_MS) / 1000, "message": "Cost up 300%"},
+    {"type": "error_spike", "provider": "anthropic", "severity": "low",
+     "detected_at": "2023-11-14T21:13:20Z"},
+]}
+BREAKERS_PAYLOAD = [
+    {"provider": "openrouter", "model": "gpt-4o", "state": "OPEN"},
+    {"provider": "anthropic", "model": "claude", "state": "CLOSED"},
+]
+
+
+class FakeResponse:
+    """Minimal stand-in for requests.Response"""
+
+    def __init__(self, payload, status_code=200):
+        self._payload = payload
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def json(self):
+        return self._payload
+
+    @property
+    def text(self):
+        if isinstance(self._payload, str):
+            return self._payload
+        return json.dumps(self._payload)
+
+    @property
+    def content(self):
+        return self.text.encode()
+
+    def iter_lines(self, chunk_size=None):
+        return iter(self.content.splitlines())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    """Start every test with cold caches and closed breakers"""
+    proxy_app.response_cache.clear()
+    proxy_asgi.response_cache.clear()
+    proxy_app.upstream_guard.reset()
+    proxy_app.result_cache.clear()
+    yield
+    proxy_app.response_cache.clear()
+    proxy_asgi.response_cache.clear()
+    proxy_app.upstream_guard.reset()
+    proxy_app.result_cache.clear()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class InlineExecutor:
+    """Runs submitted work immediately so refreshes are deterministic"""
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+@pytest.fixture
+def backend_calls(monkeypatch):
+    """Replace outgoing backend GETs with a recording fake"""
+    calls = []
+    payloads = {
+        "/api/monitoring/stats/realtime": REALTIME_PAYLOAD,
+        "/api/monitoring/error-rates": ERROR_RATES_PAYLOAD,
+        "/prometheus/data/metrics": PROVIDER_EXPOSITION,
+        "/api/monitoring/anomalies": ANOMALIES_PAYLOAD,
+        "/api/monitoring/circuit-breakers": BREAKERS_PAYLOAD,
+    }
+
+    def fake_get(url, params=None, timeout=None, stream=False):
+        calls.append((url, params))
+        path = url[len(proxy_app.API_BASE_URL):]
+        return FakeResponse(payloads[path])
+
+    monkeypatch.setattr(proxy_app.http_session, "get", fake_get)
+    return calls
+
+
+@pytest.fixture
+def client():
+    proxy_app.app.config["TESTING"] = True
+    return proxy_app.app.test_client()
+
+
+def query_body(*names):
+    return {
+        "targets": [
+            {"target": name, "refId": chr(ord("A") + i)} for i, name in enumerate(names)
+        ],
+        "range": {"from": "2024-01-01T00:00:00.000Z", "to": "2024-01-01T01:00:00.000Z"},
+    }
+
+
+class TestRequestPlanner:
+    """Test grouping of targets into unique backend fetches"""
+
+    def test_shared_endpoint_metrics_grouped(self):
+        """Metrics backed by the same url + params share one fetch"""
+        targets = query_body("avg_health_score", "total_requests", "total_cost")["targets"]
+        plan, unknown = plan_fetches(targets, proxy_app.metric_registry.metrics)
+
+        assert unknown == []
+        assert len(plan) == 1
+        (entries,) = plan.values()
+        assert [name for _, name, _ in entries] == [
+            "avg_health_score", "total_requests", "total_cost"
+        ]
+
+    def test_param_order_does_not_split_fetches(self):
+        """Params are compared as a set, not by insertion order"""
+        a = {"url": "/x", "params": {"a": 1, "b": 2}}
+        b = {"url": "/x", "params": {"b": 2, "a": 1}}
+        assert fetch_key(a) == fetch_key(b)
+
+    def test_unknown_metrics_reported(self):
+        """Unknown targets are returned separately and not planned"""
+        plan, unknown = plan_fetches([{"target": "nope"}], proxy_app.metric_registry.metrics)
+        assert plan == {}
+        assert unknown == ["nope"]
+
+    def test_extract_nested_path(self):
+        """Dotted paths walk nested objects and default to 0.0"""
+        assert extract_value({"a": {"b": "3.5"}}, "a.b") == 3.5
+        assert extract_value({"a": {}}, "a.b") == 0.0
+        assert extract_value({"a": None}, "a.b") == 0.0
+
+
+class TestQueryEndpoint:
+    """Test /query against a fake backend"""
+
+    def test_realtime_metrics_fetched_once(self, client, backend_calls):
+        """Three realtime metrics in one panel cost one backend call"""
+        response = client.post(
+            "/query", json=query_body("avg_health_score", "total_requests", "total_cost")
+        )
+        assert response.status_code == 200
+        assert len(backend_calls) == 1
+
+        values = {series["target"]: series["datapoints"][0][0] for series in response.json}
+        assert values == {
+            "avg_health_score": 97.5,
+            "total_requests": 1200.0,
+            "total_cost": 12.25,
+        }
+
+    def test_results_follow_target_order(self, client, backend_calls):
+        """Series come back in the order the targets were requested"""
+        names = ["total_cost", "error_rate", "avg_health_score"]
+        response = client.post("/query", json=query_body(*names))
+
+        assert [series["target"] for series in response.json] == names
+        assert len(backend_calls) == 2
+
+    def test_unknown_targets_skipped(self, client, backend_calls):
+        """Unknown metrics produce no series and no backend call"""
+        response = client.post("/query", json=query_body("does_not_exist"))
+        assert response.status_code == 200
+        assert response.json == []
+        assert backend_calls == []
+
+
+class TestConcurrentFanOut:
+    """Test concurrent backend fetches and the per-query deadline"""
+
+    def test_fetches_run_concurrently(self, monkeypatch):
+        """Query latency tracks the slowest fetch, not the sum"""
+        def slow_fetch(endpoint, params):
+            time.sleep(0.2)
+            return {"value": 1}
+
+        monkeypatch.setattr(proxy_app, "fetch_backend", slow_fetch)
+        keys = [(f"/slow/{i}", ()) for i in range(4)]
+
+        start = time.perf_counter()
+        fetched = proxy_app.fetch_all(keys)
+        elapsed = time.perf_counter() - start
+
+        assert all(error is None for _, error in fetched.values())
+        assert elapsed < 0.6, f"fetches appear serial ({elapsed:.2f}s)"
+
+    def test_deadline_bounds_query_latency(self, monkeypatch):
+        """Fetches past the deadline are reported as timeouts"""
+        def hung_fetch(endpoint, params):
+            time.sleep(1)
+            return {"value": 1}
+
+        monkeypatch.setattr(proxy_app, "fetch_backend", hung_fetch)
+
+        start = time.perf_counter()
+        fetched = proxy_app.fetch_all([("/hung", ())], deadline_seconds=0.1)
+        elapsed = time.perf_counter() - start
+
+        data, error = fetched[("/hung", ())]
+        assert data is None
+        assert isinstance(error, TimeoutError)
+        assert elapsed < 0.5
+
+
+class TestResponseCache:
+    """Test TTL, stale-while-revalidate, single-flight and LRU behaviour"""
+
+    def test_fresh_entries_served_from_cache(self):
+        """A second read inside the TTL does not call the loader"""
+        clock = FakeClock()
+        cache = ResponseCache(clock=clock)
+        loads = []
+
+        for _ in range(3):
+            assert cache.get("k", lambda: loads.append(1) or "v", ttl=30) == "v"
+
+        assert len(loads) == 1
+        assert cache.stats()["hits"] == 2
+
+    def test_stale_entry_served_while_refreshing(self):
+        """Past the TTL the old value is returned and refreshed in the background"""
+        clock = FakeClock()
+        cache = ResponseCache(stale_seconds=60, refresh_executor=InlineExecutor(), clock=clock)
+        cache.get("k", lambda: "old", ttl=30)
+
+        clock.now += 45
+        assert cache.get("k", lambda: "new", ttl=30) == "old"
+        assert cache.get("k", lambda: "unused", ttl=30) == "new"
+        assert cache.stats()["stale"] == 1
+
+    def test_expired_entry_refetched(self):
+        """Past TTL + stale window the caller waits for a fresh value"""
+        clock = FakeClock()
+        cache = ResponseCache(stale_seconds=10, clock=clock)
+        cache.get("k", lambda: "old", ttl=30)
+
+        clock.now += 41
+        assert cache.get("k", lambda: "new", ttl=30) == "new"
+
+    def test_concurrent_misses_share_one_load(self):
+        """Single-flight: many simultaneous misses make one upstream call"""
+        cache = ResponseCache()
+        loads = []
+        release = threading.Event()
+
+        def loader():
+            loads.append(1)
+            release.wait(1)
+            return "v"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get("k", loader, ttl=30)))
+            for _ in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert results == ["v"] * 20
+        assert len(loads) == 1
+
+    def test_waiters_filling_the_refresh_pool_fall_back_to_direct_fetch(self):
+        """Waiters on a refresh queued behind them time out instead of deadlocking"""
+        clock = FakeClock()
+        pool = ThreadPoolExecutor(max_workers=2)
+        cache = ResponseCache(stale_seconds=10, refresh_executor=pool, clock=clock,
+                              wait_seconds=0.1)
+        cache.get("k", lambda: "old", ttl=30)
+        gate = threading.Event()
+        waiters = [pool.submit(lambda: gate.wait(5) and cache.get("k", lambda: "direct", 30))
+                   for _ in range(2)]
+
+        # The refresh is queued behind both waiters, then the entry expires
+        clock.now += 35
+        assert cache.get("k", lambda: "new", ttl=30) == "old"
+        clock.now += 10
+        gate.set()
+
+        # The first to give up frees a thread for the refresh, which may
+        # still answer the other waiter
+        results = [w.result(timeout=5) for w in waiters]
+        assert "direct" in results and set(results) <= {"direct", "new"}
+        assert cache.stats()["wait_timeouts"] >= 1
+        pool.shutdown(wait=True)
+        assert cache.get("k", lambda: "unused", ttl=30) == "new"
+
+    def test_lru_eviction(self):
+        """The least recently used key is evicted once the cache is full"""
+        cache = ResponseCache(max_entries=2)
+        cache.get("a", lambda: 1, ttl=30)
+        cache.get("b", lambda: 2, ttl=30)
+        cache.get("a", lambda: 1, ttl=30)
+        cache.get("c", lambda: 3, ttl=30)
+
+        assert cache.get("a", lambda: "reloaded", ttl=30) == 1
+        assert cache.get("b", lambda: "reloaded", ttl=30) == "reloaded"
+
+    def test_errors_not_cached(self):
+        """A failed load is retried on the next read"""
+        cache = ResponseCache()
+
+        def failing():
+            raise RuntimeError("backend down")
+
+        with pytest.raises(RuntimeError):
+            cache.get("k", failing, ttl=30)
+        assert cache.get("k", lambda: "ok", ttl=30) == "ok"
+
+    def test_repeated_queries_hit_backend_once(self, client, backend_calls):
+        """Many viewers of the same panel share one backend call per TTL"""
+        for _ in range(20):
+            client.post("/query", json=query_body("avg_health_score", "error_rate"))
+
+        assert len(backend_calls) == 2
+
+
+@pytest.fixture
+def local_backend():
+    """Local HTTP/1.1 backend that counts requests and fails the first N"""
+    state = {"requests": 0, "fail_first": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            state["requests"] += 1
+            status = 503 if state["requests"] <= state["fail_first"] else 200
+            body = json.dumps({"value": 1}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+class TestPooledSession:
+    """Test the keep-alive backend session"""
+
+    def test_connections_reused(self, local_backend):
+        """Sequential GETs to one host reuse a single connection"""
+        session = build_session(pool_size=2)
+        for _ in range(5):
+            session.get(local_backend["url"] + "/x", timeout=(1, 1)).raise_for_status()
+
+        (host,) = pool_stats(session).values()
+        assert host["created"] == 1
+        assert host["reused"] == 4
+        assert host["idle"] == 1
+
+    def test_idempotent_get_retried(self, local_backend):
+        """GETs are retried on 503 before surfacing an error"""
+        local_backend["fail_first"] = 2
+        session = build_session(retries=2, backoff_factor=0)
+
+        response = session.get(local_backend["url"] + "/x", timeout=(1, 1))
+        assert response.status_code == 200
+        assert local_backend["requests"] == 3
+
+    def test_debug_pool_endpoint(self, client):
+        """/debug/pool exposes pool and cache stats"""
+        response = client.get("/debug/pool")
+        assert response.status_code == 200
+        assert set(response.json) >= {"pool_size", "hosts", "cache"}
+
+
+class TestTimeSeries:
+    """Test ring buffer history and range queries"""
+
+    def test_ring_buffer_keeps_latest_samples(self):
+        """Once full, the oldest samples are overwritten in order"""
+        buffer = RingBuffer(capacity=3)
+        for ts in range(1, 6):
+            buffer.append(ts * 1000, float(ts))
+
+        assert buffer.snapshot() == ([3000, 4000, 5000], [3.0, 4.0, 5.0])
+        assert buffer.range(3500, 5000) == [[4.0, 4000], [5.0, 5000]]
+
+    def test_out_of_order_samples_dropped(self):
+        """A sample older than the newest one is ignored"""
+        buffer = RingBuffer(capacity=3)
+        buffer.append(2000, 2.0)
+        buffer.append(1000, 1.0)
+        assert buffer.snapshot() == ([2000], [2.0])
+
+    def test_downsample_respects_max_points(self):
+        """Downsampling never returns more than maxDataPoints"""
+        points = [[float(i), i * 1000] for i in range(1000)]
+        for max_points in (1, 7, 100, 999):
+            reduced = downsample(points, max_points=max_points)
+            assert 0 < len(reduced) <= max_points
+
+    def test_downsample_buckets_by_interval(self):
+        """Points inside one interval are averaged"""
+        points = [[1.0, 0], [3.0, 500], [5.0, 1000], [7.0, 1500]]
+        assert downsample(points, interval_ms=1000) == [[2.0, 0], [6.0, 1000]]
+
+    def test_parse_grafana_time(self):
+        """ISO strings, epoch ms and now-relative bounds are accepted"""
+        assert parse_grafana_time("1970-01-01T00:00:01.000Z") == 1000
+        assert parse_grafana_time(1500) == 1500
+        assert abs(parse_grafana_time("now-5m") - (time.time() * 1000 - 300_000)) < 5000
+        assert parse_grafana_time("garbage") is None
+
+    def test_query_serves_history_without_backend(self, client, backend_calls, monkeypatch):
+        """Targets with sampled history in range are answered from memory"""
+        store = TimeSeriesStore(capacity=100)
+        for i in range(10):
+            store.record("avg_health_score", 1_000_000 + i * 30_000, 90.0 + i)
+        monkeypatch.setattr(proxy_app, "timeseries_store", store)
+
+        body = query_body("avg_health_score", "error_rate")
+        body["range"] = {"from": 1_000_000, "to": 1_000_000 + 10 * 30_000}
+        body["maxDataPoints"] = 5
+        response = client.post("/query", json=body)
+
+        history, live = response.json
+        assert history["target"] == "avg_health_score"
+        assert 1 < len(history["datapoints"]) <= 5
+        assert len(live["datapoints"]) == 1
+        assert [url for url, _ in backend_calls] == [
+            proxy_app.API_BASE_URL + "/api/monitoring/error-rates"
+        ]
+
+
+@pytest.fixture
+def asgi_backend(monkeypatch):
+    """Replace the ASGI app's backend fetch with a slow recording fake"""
+    calls = []
+    payloads = {
+        "/api/monitoring/stats/realtime": REALTIME_PAYLOAD,
+        "/api/monitoring/error-rates": ERROR_RATES_PAYLOAD,
+    }
+
+    async def fake_fetch(endpoint, params):
+        calls.append(endpoint)
+        await asyncio.sleep(0.2)
+        if endpoint == proxy_app.PROVIDER_METRICS_URL:
+            return ProviderTable.from_lines(PROVIDER_EXPOSITION.splitlines())
+        return payloads.get(endpoint, {"value": 1.0})
+
+    monkeypatch.setattr(proxy_asgi, "fetch_backend", fake_fetch)
+    return calls
+
+
+@pytest.fixture
+async def asgi_client():
+    transport = httpx.ASGITransport(app=proxy_asgi.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+        yield client
+
+
+class TestAsgiApp:
+    """Test the ASGI serving mode"""
+
+    async def test_same_contract_as_flask(self, asgi_client, asgi_backend):
+        """Health, search and empty endpoints match the Flask app"""
+        assert (await asgi_client.get("/")).json()["status"] == "ok"
+        assert (await asgi_client.post("/search", json={})).json() == list(
+            proxy_app.metric_registry.metrics
+        )
+        assert (await asgi_client.post("/annotations", json={})).json() == []
+        assert {"type": "string", "text": "provider"} in (
+            await asgi_client.post("/tag-keys", json={})
+        ).json()
+        assert (await asgi_client.post("/tag-values", json={"key": "region"})).json() == [
+            {"text": "eu"}, {"text": "us"}
+        ]
+        assert (await asgi_client.post("/nope")).status_code == 404
+
+    async def test_query_coalesces_targets(self, asgi_client, asgi_backend):
+        """/query plans, fetches and orders series like the Flask app"""
+        names = ["total_cost", "error_rate", "avg_health_score"]
+        response = await asgi_client.post("/query", json=query_body(*names))
+
+        assert response.status_code == 200
+        assert [series["target"] for series in response.json()] == names
+        assert response.json()[0]["datapoints"][0][0] == 12.25
+        assert len(asgi_backend) == 2
+
+    async def test_query_rejects_invalid_adhoc_filters(self, asgi_client, asgi_backend):
+        """Unsupported operators are a 400 in ASGI mode too"""
+        body = query_body("total_cost")
+        body["adhocFilters"] = [{"key": "region", "operator": "<", "value": "us"}]
+        response = await asgi_client.post("/query", json=body)
+
+        assert response.status_code == 400
+        assert asgi_backend == []
+
+    async def test_many_queries_in_flight(self, asgi_client, asgi_backend, monkeypatch):
+        """Hundreds of slow queries overlap on one event loop"""
+        for i in range(200):
+            monkeypatch.setitem(
+                proxy_app.metric_registry.metrics, f"load_{i}",
+                compile_metric({"url": f"/load/{i}", "params": {}, "path": "value"}),
+            )
+
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(
+            asgi_client.post("/query", json=query_body(f"load_{i}")) for i in range(200)
+        ))
+        elapsed = time.perf_counter() - start
+
+        assert all(r.status_code == 200 for r in responses)
+        assert len(asgi_backend) == 200
+        assert elapsed < 5, f"queries did not overlap ({elapsed:.1f}s for 200 x 0.2s)"
+
+    async def test_debug_pool_endpoint(self, asgi_client):
+        """/debug/pool is served in ASGI mode too"""
+        response = await asgi_client.get("/debug/pool")
+        assert response.status_code == 200
+        assert set(response.json()) >= {"pool_size", "hosts", "cache", "breakers"}
+
+    async def test_client_pool_stats(self, local_backend):
+        """Keep-alive connections of the async client are counted per host"""
+        client = proxy_asgi.build_client()
+        try:
+            await client.get(local_backend["url"] + "/x")
+            await client.get(local_backend["url"] + "/y")
+            stats = proxy_asgi.client_pool_stats(client)
+        finally:
+            await client.aclose()
+        assert stats == {local_backend["url"]: {"open": 1, "idle": 1}}
+
+    async def test_async_cache_single_flight(self):
+        """Concurrent async misses share one load"""
+        cache = AsyncResponseCache()
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            await asyncio.sleep(0.05)
+            return "v"
+
+        results = await asyncio.gather(*(cache.get("k", loader, ttl=30) for _ in range(50)))
+        assert results == ["v"] * 50
+        assert len(loads) == 1
+
+
+class TestPrefetchScheduler:
+    """Test prefetch job timing and the refresh path"""
+
+    def test_jobs_due_on_their_own_interval(self):
+        """Each key is refreshed on its own interval"""
+        clock = FakeClock()
+        schedule = Schedule({"fast": 10, "slow": 60}, jitter=0, clock=clock)
+
+        assert sorted(schedule.due()) == ["fast", "slow"]
+        schedule.finished("fast")
+        schedule.finished("slow")
+
+        clock.now += 11
+        assert schedule.due() == ["fast"]
+
+    def test_concurrency_limit(self):
+        """due() never hands out more jobs than the free capacity"""
+        schedule = Schedule({i: 10 for i in range(5)}, jitter=0, clock=FakeClock())
+        assert len(schedule.due(limit=2)) == 2
+        assert len(schedule.due(limit=2)) == 2
+        assert len(schedule.due(limit=2)) == 1
+
+    def test_failures_back_off_exponentially(self):
+        """Errors double the delay up to the cap and success resets it"""
+        clock = FakeClock()
+        schedule = Schedule({"k": 10}, jitter=0, max_backoff=35, clock=clock)
+        schedule.due()
+
+        delays = []
+        for _ in range(3):
+            schedule.finished("k", RuntimeError("503"))
+            delays.append(schedule.seconds_until_next())
+            clock.now += delays[-1]
+            schedule.due()
+        assert delays == [20, 35, 35]
+
+        schedule.finished("k")
+        assert schedule.seconds_until_next() == 10
+        assert schedule.stats()["k"]["failures"] == 0
+
+    def test_jitter_stays_in_bounds(self):
+        """Jittered intervals stay within +/- the jitter fraction"""
+        clock = FakeClock()
+        for rng in (lambda: 0.0, lambda: 1.0):
+            schedule = Schedule({"k": 100}, jitter=0.1, clock=clock, rng=rng)
+            schedule.due(limit=0)
+            clock.now += 50
+            schedule.due()
+            schedule.finished("k")
+            assert 90 <= schedule.seconds_until_next() <= 110
+
+    def test_lag_reported(self):
+        """A job started late reports how late it was"""
+        clock = FakeClock()
+        schedule = Schedule({"k": 10}, jitter=0, clock=clock)
+        clock.now += 7
+        schedule.due()
+        assert schedule.stats()["k"]["lag_seconds"] == 7
+
+    def test_prefetch_warms_cache_and_history(self, client, backend_calls, monkeypatch):
+        """A prefetch fills the cache so /query makes no backend call"""
+        store = TimeSeriesStore(capacity=10)
+        monkeypatch.setattr(proxy_app, "timeseries_store", store)
+
+        for key in proxy_app.prefetch_plan:
+            proxy_app.prefetch(key)
+        assert len(backend_calls) == 3
+        assert set(store.stats()) == {
+            name for name, config in proxy_app.metric_registry.metrics.items() if "path" in config
+        }
+
+        client.post("/query", json=query_body("total_cost", "error_rate", "provider_table"))
+        assert len(backend_calls) == 3
+
+    def test_refresh_intervals_beat_ttl(self):
+        """Default refresh intervals are shorter than the metric TTLs"""
+        intervals = proxy_app.prefetch_intervals(proxy_app.prefetch_plan)
+        for key, interval in intervals.items():
+            assert interval < proxy_app.prefetch_ttls[key]
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+class TestProxyMetrics:
+    """Test the Prometheus instrumentation"""
+
+    def test_query_instrumented(self, client, backend_calls):
+        """A /query records latency, fetch latency, sizes and cache lookups"""
+        queries = sample("jsonproxy_query_duration_seconds_count")
+        fetches = sample("jsonproxy_backend_fetch_duration_seconds_count",
+                         endpoint="/api/monitoring/stats/realtime")
+        misses = sample("jsonproxy_cache_lookups_total", result="miss")
+        hits = sample("jsonproxy_cache_lookups_total", result="hit")
+        response_bytes = sample("jsonproxy_query_response_bytes_sum")
+
+        for _ in range(2):
+            client.post("/query", json=query_body("total_cost", "error_rate"))
+
+        assert sample("jsonproxy_query_duration_seconds_count") == queries + 2
+        assert sample("jsonproxy_backend_fetch_duration_seconds_count",
+                      endpoint="/api/monitoring/stats/realtime") == fetches + 1
+        assert sample("jsonproxy_cache_lookups_total", result="miss") == misses + 2
+        assert sample("jsonproxy_cache_lookups_total", result="hit") == hits + 2
+        assert sample("jsonproxy_query_response_bytes_sum") > response_bytes
+        assert sample("jsonproxy_query_inflight") == 0
+
+    def test_errors_counted_by_exception_class(self, client, monkeypatch):
+        """Backend failures are counted per exception class"""
+        def failing_get(url, params=None, timeout=None):
+            raise ConnectionError("backend down")
+
+        monkeypatch.setattr(proxy_app.http_session, "get", failing_get)
+        before = sample("jsonproxy_errors_total", stage="fetch", exception="ConnectionError")
+
+        client.post("/query", json=query_body("total_cost"))
+
+        assert sample("jsonproxy_errors_total", stage="fetch",
+                      exception="ConnectionError") == before + 1
+
+    def test_metrics_endpoint(self, client, backend_calls):
+        """/metrics serves the text exposition format"""
+        client.post("/query", json=query_body("total_cost"))
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.content_type.startswith("text/plain")
+        assert b"jsonproxy_query_duration_seconds_bucket" in response.data
+
+    async def test_asgi_metrics_endpoint(self, asgi_client, asgi_backend):
+        """The ASGI app exposes the same metrics"""
+        queries = sample("jsonproxy_query_duration_seconds_count")
+        await asgi_client.post("/query", json=query_body("total_cost"))
+        response = await asgi_client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert b"jsonproxy_cache_lookups_total" in response.content
+        assert sample("jsonproxy_query_duration_seconds_count") == queries + 1
+
+    def test_gunicorn_child_exit_drops_live_gauges(self, tmp_path, monkeypatch):
+        """An exited worker's livesum samples leave the multiprocess directory"""
+        spec = importlib.util.spec_from_file_location(
+            "gunicorn_conf", PROXY_DIR / "gunicorn.conf.py"
+        )
+        gunicorn_conf = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(gunicorn_conf)
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+        for name in ("gauge_livesum_101.db", "gauge_livesum_202.db", "counter_101.db"):
+            (tmp_path / name).touch()
+
+        gunicorn_conf.child_exit(None, type("Worker", (), {"pid": 101}))
+
+        assert sorted(p.name for p in tmp_path.iterdir()) == [
+            "counter_101.db", "gauge_livesum_202.db",
+        ]
+
+
+def provider_query(*targets, filters=None):
+    body = {"targets": [{"target": name} for name in targets]}
+    if filters is not None:
+        body["adhocFilters"] = filters
+    return body
+
+
+class TestProviderTable:
+    """Test per-provider targets served from one exposition fetch"""
+
+    def test_parse_exposition_lines(self):
+        """Labels (with escapes), bare samples and comments are handled"""
+        assert parse_line('m{a="x",b="q\\"uote"} 1.5 1700000000') == (
+            "m", {"a": "x", "b": 'q"uote'}, 1.5
+        )
+        assert parse_line("up 1") == ("up", {}, 1.0)
+        assert parse_line("# TYPE up gauge") is None
+        with pytest.raises(ValueError):
+            parse_line('m{a="x" 1')
+
+    def test_table_keeps_worst_value_per_provider(self):
+        """Several samples for one provider collapse into one cell"""
+        table = ProviderTable.from_lines(PROVIDER_EXPOSITION.splitlines())
+
+        assert table.providers == ["openrouter", "anthropic", "cerebras"]
+        assert table.column("provider_circuit_breaker_state", table.select()) == [
+            ("anthropic", 0.0), ("openrouter", 1.0)
+        ]
+        assert "job" not in table.tag_keys()
+
+    def test_adhoc_filters(self):
+        """=, != and regex filters select rows through the label index"""
+        table = ProviderTable.from_lines(PROVIDER_EXPOSITION.splitlines())
+
+        def providers(*filters):
+            return [table.providers[row] for row in table.select(list(filters))]
+
+        assert providers({"key": "region", "operator": "=", "value": "us"}) == [
+            "anthropic", "openrouter"
+        ]
+        assert providers({"key": "provider", "operator": "!=", "value": "cerebras"}) == [
+            "anthropic", "openrouter"
+        ]
+        assert providers({"key": "model", "operator": "=~", "value": "gpt-.*"}) == ["openrouter"]
+        assert providers({"key": "region", "operator": "!~", "value": "u.*"}) == ["cerebras"]
+
+    def test_unsupported_operator_and_bad_regex_are_rejected(self):
+        """`<` is not read as negation and an invalid regex is not a crash"""
+        table = ProviderTable.from_lines(PROVIDER_EXPOSITION.splitlines())
+
+        with pytest.raises(FilterError, match="operator '<'"):
+            table.select([{"key": "region", "operator": "<", "value": "us"}])
+        with pytest.raises(FilterError, match="regex"):
+            table.select([{"key": "model", "operator": "=~", "value": "gpt-("}])
+
+    def test_all_provider_targets_share_one_fetch(self, client, backend_calls):
+        """A table plus every per-provider metric costs one backend call"""
+        response = client.post("/query", json=provider_query(
+            "provider_table", "provider_health_score", "provider_error_rate",
+            "provider_availability", "provider_circuit_breaker_state",
+        ))
+
+        assert response.status_code == 200
+        assert len(backend_calls) == 1
+        table, *series = response.json
+        assert table["type"] == "table"
+        assert [row[0] for row in table["rows"]] == ["anthropic", "cerebras", "openrouter"]
+        assert [s["target"] for s in series[:3]] == ["anthropic", "cerebras", "openrouter"]
+        assert series[0]["datapoints"][0][0] == 88.3
+
+    def test_query_applies_adhoc_filters(self, client, backend_calls):
+        """adhocFilters in the /query body narrow provider targets"""
+        response = client.post("/query", json=provider_query(
+            "provider_health_score", "total_cost",
+            filters=[{"key": "provider", "operator": "=", "value": "openrouter"}],
+        ))
+
+        assert [s["target"] for s in response.json] == ["openrouter", "total_cost"]
+
+    def test_query_rejects_invalid_adhoc_filters(self, client, backend_calls):
+        """A filter the table cannot evaluate is a 400, fetched for nothing"""
+        for adhoc in (
+            {"key": "region", "operator": ">", "value": "us"},
+            {"key": "provider", "operator": "!~", "value": "["},
+        ):
+            response = client.post("/query", json=provider_query(
+                "provider_health_score", filters=[adhoc],
+            ))
+
+            assert response.status_code == 400
+            assert "ad-hoc filter" in response.json["error"]
+        assert backend_calls == []
+
+    def test_tag_keys_and_values(self, client, backend_calls):
+        """/tag-keys and /tag-values list the indexed provider labels"""
+        keys = client.post("/tag-keys", json={}).get_json()
+        assert [k["text"] for k in keys] == ["model", "provider", "region"]
+
+        values = client.post("/tag-values", json={"key": "provider"}).get_json()
+        assert values == [{"text": "anthropic"}, {"text": "cerebras"}, {"text": "openrouter"}]
+        assert len(backend_calls) == 1
+
+
+class TestExpositionStreaming:
+    """Test the filtered line-by-line exposition parser"""
+
+    def test_filter_rejects_other_families(self):
+        """Only wanted families with the required labels are parsed"""
+        sample_filter = SampleFilter(["provider_error_rate"], required_labels=("provider",))
+
+        assert sample_filter.parse(b'provider_error_rate{provider="a"} 0.5') == (
+            "provider_error_rate", {"provider": "a"}, 0.5
+        )
+        assert sample_filter.parse('provider_error_rate{provider="a"} 0.5') is not None
+        assert sample_filter.parse(b'provider_error_rate_total{provider="a"} 9') is None
+        assert sample_filter.parse(b'provider_error_rate{model="m"} 1') is None
+        assert sample_filter.parse(b"# TYPE provider_error_rate gauge") is None
+
+    def test_parse_samples_family_filter(self):
+        """parse_samples with families matches the unfiltered parse"""
+        lines = PROVIDER_EXPOSITION.encode().splitlines()
+        everything = list(parse_samples(lines))
+        wanted = list(parse_samples(lines, families=["provider_availability"]))
+
+        assert len(everything) == 10
+        assert wanted == [s for s in everything if s[0] == "provider_availability"]
+
+    def test_table_from_bytes_lines(self):
+        """Tables built from streamed bytes and from text agree"""
+        from_bytes = ProviderTable.from_lines(PROVIDER_EXPOSITION.encode().splitlines())
+        from_text = ProviderTable.from_lines(PROVIDER_EXPOSITION.splitlines())
+
+        assert from_bytes.as_table(from_bytes.select()) == from_text.as_table(from_text.select())
+        assert from_bytes.source_bytes == len(PROVIDER_EXPOSITION.encode())
+
+    async def test_asgi_streams_provider_metrics(self, monkeypatch):
+        """The ASGI fetch parses the exposition from a streamed response"""
+        chunks = [PROVIDER_EXPOSITION.encode()[i:i + 7]
+                  for i in range(0, len(PROVIDER_EXPOSITION), 7)]
+
+        async def body():
+            for chunk in chunks:
+                yield chunk
+
+        def handler(request):
+            return httpx.Response(200, content=body())
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(proxy_asgi, "http_client", client)
+        try:
+            table = await proxy_asgi.fetch_backend(proxy_app.PROVIDER_METRICS_URL, ())
+        finally:
+            await client.aclose()
+
+        assert table.column("provider_health_score", table.select()) == [
+            ("anthropic", 88.3), ("cerebras", 40.0), ("openrouter", 95.5)
+        ]
+
+
+def shared_load_in_child(path, counter_path, results):
+    """Worker body for the cross-process single-flight test"""
+    cache = SharedCache(path, slots=4, slot_bytes=4096)
+
+    def loader():
+        with open(counter_path, "a") as f:
+            f.write("x")
+        time.sleep(0.3)
+        return {"value": os.getpid()}
+
+    value, _ = cache.load(("/api/x", ()), loader, max_age=30)
+    results.put(value["value"])
+
+
+class TestSharedCache:
+    """Test the memory-mapped cache shared by gunicorn workers"""
+
+    def test_values_visible_to_other_mappings(self, tmp_path):
+        """A value stored through one mapping is read through another"""
+        clock = FakeClock()
+        writer = SharedCache(str(tmp_path / "shm"), slots=8, slot_bytes=4096, clock=clock)
+        reader = SharedCache(str(tmp_path / "shm"), slots=8, slot_bytes=4096, clock=clock)
+        key = ("/api/monitoring/error-rates", (("hours", 24),))
+
+        writer.load(key, lambda: ERROR_RATES_PAYLOAD, max_age=30)
+        clock.now += 10
+        assert reader.get(key, max_age=30) == (ERROR_RATES_PAYLOAD, 10)
+        assert reader.get(key, max_age=10) is None
+        assert reader.get(("/other", ()), max_age=30) is None
+
+    def test_colliding_and_oversize_values(self, tmp_path):
+        """Keys sharing a slot replace each other; oversize values are not shared"""
+        cache = SharedCache(str(tmp_path / "shm"), slots=1, slot_bytes=256)
+
+        cache.load("a", lambda: 1, max_age=30)
+        cache.load("b", lambda: 2, max_age=30)
+        assert cache.get("a", max_age=30) is None
+        assert cache.get("b", max_age=30)[0] == 2
+
+        assert cache.load("big", lambda: "x" * 1000, max_age=30) == ("x" * 1000, 0.0)
+        assert cache.get("big", max_age=30) is None
+        assert cache.stats()["oversize"] == 1
+
+    def test_geometry_change_resets_file(self, tmp_path):
+        """Reopening with a different layout starts from an empty table"""
+        old = SharedCache(str(tmp_path / "shm"), slots=4, slot_bytes=1024)
+        old.load("a", lambda: 1, 30)
+        reopened = SharedCache(str(tmp_path / "shm"), slots=8, slot_bytes=1024)
+        assert reopened.get("a", max_age=30) is None
+        # The file is replaced, not truncated under the old mapping
+        assert old.get("a", max_age=30)[0] == 1
+        reopened.load("b", lambda: 2, 30)
+        same = SharedCache(str(tmp_path / "shm"), slots=8, slot_bytes=1024)
+        assert same.get("b", max_age=30)[0] == 2
+
+    def test_threads_of_one_worker_load_once(self, tmp_path):
+        """Byte-range locks do not exclude threads, so the slot lock must"""
+        cache = SharedCache(str(tmp_path / "shm"), slots=4, slot_bytes=4096)
+        loads = []
+
+        def loader():
+            loads.append(1)
+            time.sleep(0.1)
+            return "v"
+
+        threads = [threading.Thread(target=cache.load, args=("k", loader, 30))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(loads) == 1
+        assert cache.stats()["hits"] == 7
+
+    def test_workers_fetch_once(self, tmp_path):
+        """Processes missing at once make a single backend call"""
+        context = multiprocessing.get_context("fork")
+        path, counter = str(tmp_path / "shm"), tmp_path / "calls"
+        counter.write_text("")
+        SharedCache(path, slots=4, slot_bytes=4096)
+        results = context.Queue()
+
+        workers = [
+            context.Process(target=shared_load_in_child, args=(path, str(counter), results))
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+
+        assert counter.read_text() == "x"
+        assert len({results.get(timeout=1) for _ in workers}) == 1
+
+    def test_response_cache_uses_shared_tier(self, tmp_path):
+        """A second worker's cache is filled from the first worker's fetch"""
+        path = str(tmp_path / "shm")
+        first = ResponseCache(shared=SharedCache(path, slots=8, slot_bytes=4096))
+        second = ResponseCache(shared=SharedCache(path, slots=8, slot_bytes=4096))
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return "v"
+
+        assert first.get("k", loader, ttl=30) == "v"
+        assert second.get("k", loader, ttl=30) == "v"
+        assert second.refresh("k", loader, ttl=30, max_age=20) == "v"
+        assert len(loads) == 1
+
+        second.refresh("k", loader, ttl=30)
+        assert len(loads) == 2
+
+
+@pytest.fixture
+def annotation_store(monkeypatch):
+    store = AnnotationStore(refresh_ms=30_000)
+    monkeypatch.setattr(proxy_app, "annotation_store", store)
+    return store
+
+
+def annotation_body(from_ms, to_ms, query=""):
+    return {
+        "range": {"from": from_ms, "to": to_ms},
+        "annotation": {"name": "Events", "query": query},
+    }
+
+
+class TestAnnotations:
+    """Test anomaly and circuit-breaker annotations"""
+
+    def test_interval_set_merges_and_reports_gaps(self):
+        covered = IntervalSet()
+        covered.add(10, 20)
+        covered.add(30, 40)
+        assert covered.missing(0, 50) == [(0, 10), (20, 30), (40, 50)]
+
+        covered.add(15, 35)
+        assert list(covered) == [(10, 40)]
+        assert covered.missing(12, 38) == []
+        assert covered.missing(5, 45) == [(5, 10), (40, 45)]
+
+    def test_overlapping_ranges_fetch_only_new_slice(self):
+        """Refreshes inside the covered range and refresh interval need no fetch"""
+        store = AnnotationStore(refresh_ms=30_000)
+        assert store.plan(NOW_MS - 6 * HOUR_MS, NOW_MS, NOW_MS) == (6, True)
+        store.ingest_anomalies(ANOMALIES_PAYLOAD, 6, NOW_MS)
+        store.ingest_breakers([], NOW_MS)
+
+        # Dashboard refresh 10s later: the uncovered 10s are still current.
+        now = NOW_MS + 10_000
+        assert store.plan(now - 6 * HOUR_MS, now, now) == (None, False)
+        # A narrower, older range is answered from memory.
+        assert store.plan(NOW_MS - 3 * HOUR_MS, NOW_MS - HOUR_MS, now) == (None, False)
+
+        # After the refresh interval only the last hour is requested.
+        now = NOW_MS + 60_000
+        assert store.plan(now - 6 * HOUR_MS, now, now) == (1, True)
+        # Widening the range reaches back to the oldest uncovered instant.
+        assert store.plan(now - 24 * HOUR_MS, now, now)[0] == 24
+
+    def test_old_and_excess_events_are_evicted(self):
+        """Events past the retention horizon or max_events go, with their coverage"""
+        store = AnnotationStore(retention_ms=2 * HOUR_MS, max_events=3)
+        anomalies = [{"timestamp": (NOW_MS - i * HOUR_MS) / 1000, "type": "spike"}
+                     for i in range(4)]
+        store.ingest_anomalies(anomalies, 4, NOW_MS)
+        assert len(store.range(0, NOW_MS)) == 4
+
+        # The next ingest drops what is older than 2h; the 3 left fit max_events.
+        store.ingest_breakers([], NOW_MS)
+        assert [e["time"] for e in store.range(0, NOW_MS)] == [
+            NOW_MS - 2 * HOUR_MS, NOW_MS - HOUR_MS, NOW_MS]
+        assert store.plan(NOW_MS - 3 * HOUR_MS, NOW_MS, NOW_MS)[0] == 3
+
+        # Past max_events, the oldest go first.
+        store.ingest_anomalies([{"timestamp": (NOW_MS - HOUR_MS // 2) / 1000, "type": "dip"}],
+                               1, NOW_MS)
+        store.ingest_breakers([], NOW_MS)
+        assert [e["time"] for e in store.range(0, NOW_MS)] == [
+            NOW_MS - HOUR_MS, NOW_MS - HOUR_MS // 2, NOW_MS]
+        assert store.stats()["evicted"] == 2
+        # An evicted event is fetched again once its range is asked for.
+        assert store.plan(NOW_MS - 2 * HOUR_MS, NOW_MS, NOW_MS)[0] == 2
+
+    def test_breaker_trip_recorded_once_per_opening(self):
+        store = AnnotationStore()
+        store.ingest_breakers(BREAKERS_PAYLOAD, NOW_MS)
+        store.ingest_breakers(BREAKERS_PAYLOAD, NOW_MS + 30_000)
+        events = store.range(0, NOW_MS * 2, ["circuit_breaker"])
+        assert [e["title"] for e in events] == ["Circuit breaker OPEN: openrouter / gpt-4o"]
+        assert events[0]["time"] == NOW_MS
+
+        store.ingest_breakers([], NOW_MS + 60_000)
+        store.ingest_breakers(BREAKERS_PAYLOAD, NOW_MS + 90_000)
+        assert len(store.range(0, NOW_MS * 2, ["circuit_breaker"])) == 2
+
+    def test_annotations_endpoint(self, client, backend_calls, annotation_store, monkeypatch):
+        """Events come back as SimpleJSON annotations, filtered by query tags"""
+        now = int(time.time() * 1000)
+        body = annotation_body(now - 5 * HOUR_MS - HOUR_MS // 2, now, "anomaly")
+        payload = {"anomalies": [{"type": "cost_spike", "provider": "openrouter",
+                                  "timestamp": (now - HOUR_MS) / 1000}]}
+        monkeypatch.setitem(ANOMALIES_PAYLOAD, "anomalies", payload["anomalies"])
+
+        response = client.post("/annotations", json=body)
+        assert response.status_code == 200
+        assert response.json == [{
+            "annotation": body["annotation"],
+            "time": now - HOUR_MS,
+            "title": "cost_spike: openrouter",
+            "text": "cost_spike",
+            "tags": ["anomaly", "openrouter"],
+        }]
+        assert sorted(backend_calls) == [
+            (proxy_app.API_BASE_URL + "/api/monitoring/anomalies", {"hours": 6}),
+            (proxy_app.API_BASE_URL + "/api/monitoring/circuit-breakers", {}),
+        ]
+
+        breakers = client.post("/annotations", json=annotation_body(
+            now - 5 * HOUR_MS, now + 1000, "circuit_breaker openrouter"))
+        assert [a["title"] for a in breakers.json] == ["Circuit breaker OPEN: openrouter / gpt-4o"]
+        assert len(backend_calls) == 2
+
+    async def test_asgi_annotations(self, asgi_client, annotation_store, monkeypatch):
+        calls = []
+
+        async def fake_fetch(endpoint, params):
+            calls.append((endpoint, params))
+            return BREAKERS_PAYLOAD if endpoint == proxy_app.CIRCUIT_BREAKERS_URL else []
+
+        monkeypatch.setattr(proxy_asgi, "fetch_backend", fake_fetch)
+        now = int(time.time() * 1000)
+        body = annotation_body(now - HOUR_MS // 2, now + 1000)
+
+        first = await asgi_client.post("/annotations", json=body)
+        second = await asgi_client.post("/annotations", json=body)
+        assert first.json() == second.json()
+        assert [a["tags"] for a in first.json()] == [
+            ["circuit_breaker", "OPEN", "openrouter", "gpt-4o"]
+        ]
+        assert calls == [
+            (proxy_app.ANOMALIES_URL, (("hours", 1),)),
+            (proxy_app.CIRCUIT_BREAKERS_URL, ()),
+        ]
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.response = FakeResponse({}, status_code)
+
+
+class TestCircuitBreaker:
+    """Test per-endpoint breakers, stale fallback and hedging"""
+
+    def test_opens_after_threshold_and_probes_once(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30, clock=clock)
+        for _ in range(3):
+            breaker.acquire()
+            breaker.record_failure()
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            breaker.acquire()
+
+        clock.now += 30
+        breaker.acquire()
+        assert breaker.state == "half_open"
+        with pytest.raises(CircuitOpenError):
+            breaker.acquire()
+        breaker.record_success()
+        assert breaker.state == "closed"
+
+    def test_client_errors_do_not_trip(self):
+        guard = UpstreamGuard(failure_threshold=1)
+        with pytest.raises(HTTPStatusError):
+            with guard.call("/api/x"):
+                raise HTTPStatusError(404)
+        assert guard.breaker("/api/x").state == "closed"
+
+        with pytest.raises(HTTPStatusError):
+            with guard.call("/api/x"):
+                raise HTTPStatusError(503)
+        assert guard.breaker("/api/x").state == "open"
+
+    def test_hedge_delay_tracks_p95(self):
+        guard = UpstreamGuard(min_samples=20, min_hedge_delay=0.0)
+        clock = iter(range(1000))
+        guard.clock = lambda: next(clock)
+        assert guard.hedge_delay("/api/x") is None
+
+        for _ in range(20):
+            with guard.call("/api/x"):
+                pass
+        assert guard.hedge_delay("/api/x") == 1
+
+    def test_failed_fetch_serves_last_known_good(self, client, backend_calls, monkeypatch):
+        """Targets are answered from the previous response, marked stale"""
+        client.post("/query", json=query_body("total_cost"))
+
+        def failing_get(url, params=None, timeout=None, stream=False):
+            backend_calls.append((url, params))
+            raise ConnectionError("backend down")
+
+        monkeypatch.setattr(proxy_app.http_session, "get", failing_get)
+        expired = proxy_app.response_cache.clock() + 1000
+        monkeypatch.setattr(proxy_app.response_cache, "clock", lambda: expired)
+
+        series = client.post("/query", json=query_body("total_cost", "error_rate")).json
+        assert series[0]["datapoints"][0][0] == 12.25
+        assert series[0]["meta"]["stale"] is True
+        assert series[0]["meta"]["age_seconds"] >= 1000
+        # Never fetched successfully: no datapoint rather than a zero.
+        assert series[1] == {"target": "error_rate", "datapoints": []}
+
+    def test_open_breaker_fails_fast(self, client, backend_calls, monkeypatch):
+        """Once open, queries stop waiting on the backend"""
+        def failing_get(url, params=None, timeout=None, stream=False):
+            backend_calls.append((url, params))
+            raise ConnectionError("backend down")
+
+        monkeypatch.setattr(proxy_app.http_session, "get", failing_get)
+        for _ in range(proxy_app.BREAKER_FAILURE_THRESHOLD + 5):
+            client.post("/query", json=query_body("total_cost"))
+
+        assert len(backend_calls) == proxy_app.BREAKER_FAILURE_THRESHOLD
+        stats = client.get("/debug/pool").json["breakers"]
+        assert stats["/api/monitoring/stats/realtime"]["state"] == "open"
+
+    def test_hedge_answers_slow_call(self):
+        """The second attempt wins when the first is stuck in the tail"""
+        delays = iter([1.0, 0.0])
+
+        def fetch():
+            time.sleep(next(delays))
+            return "ok"
+
+        start = time.monotonic()
+        assert hedged_call(fetch, 0.05, proxy_app.hedge_executor) == ("ok", "hedge")
+        assert time.monotonic() - start < 0.5
+        assert hedged_call(lambda: "fast", 0.05, proxy_app.hedge_executor) == ("fast", None)
+
+    async def test_async_hedge_cancels_loser(self):
+        cancelled = []
+        delays = iter([1.0, 0.0])
+
+        async def fetch():
+            try:
+                await asyncio.sleep(next(delays))
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return "ok"
+
+        assert await hedged_call_async(fetch, 0.05) == ("ok", "hedge")
+        await asyncio.sleep(0)
+        assert cancelled == [True]
+
+
+class TestResponseEncoding:
+    """Test fast JSON encoding and response compression"""
+
+    def test_negotiate_honours_q_values(self, monkeypatch):
+        monkeypatch.setattr(serialization, "SUPPORTED_ENCODINGS", ("br", "gzip"))
+        assert serialization.negotiate("gzip, deflate, br") == "br"
+        assert serialization.negotiate("br;q=0.5, gzip") == "gzip"
+        assert serialization.negotiate("br;q=0, *") == "gzip"
+        assert serialization.negotiate("gzip;q=0, identity") is None
+        assert serialization.negotiate(None) is None
+
+    def test_stdlib_fallback_matches(self, monkeypatch):
+        payload = [{"target": "a", "datapoints": [[1.5, 1700000000000], [None, 1]]}]
+        fast = serialization.dumps(payload)
+        monkeypatch.setattr(serialization, "orjson", None)
+        assert json.loads(serialization.dumps(payload)) == json.loads(fast) == payload
+
+    def test_small_bodies_not_compressed(self):
+        body, encoding = serialization.encode_body(b"[]", "gzip", min_bytes=1024)
+        assert (body, encoding) == (b"[]", None)
+
+    def test_brotli_when_installed(self):
+        brotli = pytest.importorskip("brotli")
+        body = b"x" * 4096
+        compressed, encoding = serialization.encode_body(body, "gzip, br", min_bytes=1)
+        assert encoding == "br"
+        assert brotli.decompress(compressed) == body
+
+    def test_query_response_gzipped(self, client, backend_calls, monkeypatch):
+        monkeypatch.setattr(proxy_app, "COMPRESS_MIN_BYTES", 64)
+        monkeypatch.setattr(serialization, "SUPPORTED_ENCODINGS", ("gzip",))
+        body = query_body("avg_health_score", "total_cost", "provider_table")
+
+        plain = client.post("/query", json=body)
+        compressed = client.post("/query", json=body, headers={"Accept-Encoding": "gzip"})
+
+        assert "Content-Encoding" not in plain.headers
+        assert compressed.headers["Content-Encoding"] == "gzip"
+        assert compressed.headers["Vary"] == "Accept-Encoding"
+        assert len(compressed.data) < len(plain.data)
+        decoded = json.loads(gzip.decompress(compressed.data))
+        assert [series.get("target") for series in decoded] == [
+            series.get("target") for series in plain.json
+        ]
+        assert decoded[2] == plain.json[2]
+
+    async def test_asgi_response_gzipped(self, asgi_client, asgi_backend, monkeypatch):
+        monkeypatch.setattr(proxy_app, "COMPRESS_MIN_BYTES", 64)
+        monkeypatch.setattr(serialization, "SUPPORTED_ENCODINGS", ("gzip",))
+
+        response = await asgi_client.post(
+            "/query", json=query_body("provider_table"), headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.headers["content-encoding"] == "gzip"
+        # httpx decodes the body transparently
+        assert response.json()[0]["type"] == "table"
+
+
+REGISTRY_YAML = """\
+metrics:
+  total_cost:
+    url: /api/monitoring/stats/realtime
+    params: {hours: 1}
+    path: total_cost
+    ttl: 30
+  error_rate:
+    url: /api/monitoring/error-rates
+    params: {hours: 24}
+    path: overall_error_rate
+    ttl: 120
+"""
+
+
+class TestMetricRegistry:
+    """Test metric definitions loaded from YAML/JSON"""
+
+    def test_shipped_definitions(self):
+        metrics = proxy_app.metric_registry.metrics
+        assert set(metrics) == {
+            "avg_health_score", "total_requests", "total_cost", "error_rate",
+            "provider_health_score", "provider_circuit_breaker_state",
+            "provider_error_rate", "provider_availability", "provider_table",
+        }
+        assert metrics["error_rate"]["extract"](ERROR_RATES_PAYLOAD) == 0.02
+        assert metrics["provider_table"]["column"] is None
+
+    def test_validation_lists_every_problem(self, tmp_path):
+        path = tmp_path / "metrics.json"
+        path.write_text(json.dumps({"metrics": {
+            "a": {"url": "api/x", "path": "v"},
+            "b": {"url": "/x", "path": "v", "column": None},
+            "c": {"url": "/x", "column": "nope", "ttl": -1},
+            "d": {"url": "/x", "path": "v", "colour": 1},
+        }}))
+
+        with pytest.raises(RegistryError) as error:
+            MetricRegistry(str(path), table_url="/prometheus/data/metrics")
+        message = str(error.value)
+        assert "a: 'url' must be a path" in message
+        assert "b: exactly one of 'path' or 'column'" in message
+        assert "c: 'column' must be null" in message
+        assert "c: 'ttl' must be a positive number" in message
+        assert "c: provider columns are read from" in message
+        assert "d: unknown field 'colour'" in message
+
+    def test_reload_reports_changes_and_keeps_bad_edits_out(self, tmp_path):
+        path = tmp_path / "metrics.yml"
+        path.write_text(REGISTRY_YAML)
+        clock = FakeClock()
+        changes = []
+        registry = MetricRegistry(str(path), "/prometheus/data/metrics", poll_seconds=5,
+                                  clock=clock, on_change=changes.append)
+        total_cost = registry.metrics["total_cost"]
+
+        path.write_text(REGISTRY_YAML.replace("hours: 24", "hours: 12")
+                        + "  total_requests:\n    url: /api/x\n    path: total_requests\n")
+        assert registry.maybe_reload() == {"error_rate", "total_requests"}
+        # Polled at most every poll_seconds
+        path.write_text("metrics: [")
+        assert registry.maybe_reload() is None
+
+        clock.now += 5
+        assert registry.maybe_reload() is None
+        assert changes == [{"error_rate", "total_requests"}]
+        assert registry.metrics["error_rate"]["params"] == {"hours": 12}
+        assert registry.metrics["total_cost"] is total_cost
+        assert json.loads(registry.search_body) == ["total_cost", "error_rate", "total_requests"]
+
+    def test_reload_keeps_warm_cache(self, client, backend_calls, tmp_path, monkeypatch):
+        """Unchanged metrics stay cached; changed metrics lose their history"""
+        path = tmp_path / "metrics.yml"
+        path.write_text(REGISTRY_YAML)
+        registry = MetricRegistry(str(path), proxy_app.PROVIDER_METRICS_URL, poll_seconds=0,
+                                  on_change=proxy_app.apply_registry_change)
+        store = TimeSeriesStore(capacity=10)
+        monkeypatch.setattr(proxy_app, "metric_registry", registry)
+        monkeypatch.setattr(proxy_app, "timeseries_store", store)
+        monkeypatch.setattr(proxy_app, "prefetch_plan", proxy_app.prefetch_plan)
+        monkeypatch.setattr(proxy_app, "prefetch_ttls", proxy_app.prefetch_ttls)
+        monkeypatch.setattr(proxy_app, "prefetch_schedule", Schedule({}))
+
+        client.post("/query", json=query_body("total_cost", "error_rate"))
+        store.record("total_cost", 1, 1.0)
+        store.record("error_rate", 1, 1.0)
+        assert len(backend_calls) == 2
+
+        path.write_text(REGISTRY_YAML.replace("hours: 24", "hours: 12"))
+        client.post("/query", json=query_body("total_cost", "error_rate"))
+        assert backend_calls[2:] == [
+            (proxy_app.API_BASE_URL + "/api/monitoring/error-rates", {"hours": 12})
+        ]
+        assert set(store.stats()) == {"total_cost"}
+        assert set(proxy_app.prefetch_schedule.stats()) == set(proxy_app.prefetch_plan)
+
+
+class TestAdmissionControl:
+    """Test per-client rate limiting, queueing and load shedding"""
+
+    def test_token_bucket_refills(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=2, burst=3, clock=clock)
+
+        assert [limiter.acquire("a") for _ in range(3)] == [0.0, 0.0, 0.0]
+        assert limiter.acquire("a") == pytest.approx(0.5)
+        assert limiter.acquire("b") == 0.0
+
+        clock.now += 0.5
+        assert limiter.acquire("a") == 0.0
+        assert limiter.acquire("a") > 0
+
+    def test_least_recent_client_evicted(self):
+        limiter = RateLimiter(rate=1, burst=1, max_keys=2, clock=FakeClock())
+        for key in ("a", "b", "a", "c"):
+            limiter.acquire(key)
+        # "b" was evicted and starts again with a full bucket
+        assert limiter.acquire("b") == 0.0
+        assert limiter.acquire("c") > 0
+
+    async def test_queue_sheds_and_alerts_go_first(self):
+        decisions = []
+        controller = AdmissionController(
+            max_inflight=1, max_queue=1, queue_timeout=5,
+            on_decision=lambda decision, priority: decisions.append(decision),
+        )
+        release = asyncio.Event()
+        order = []
+
+        async def request(name, priority=1):
+            async with controller.admit_async(name, priority):
+                order.append(name)
+                await release.wait()
+
+        holder = asyncio.create_task(request("holder"))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(request("dashboard"))
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as shed:
+            await request("overflow")
+        alert = asyncio.create_task(request("alert", PRIORITY_ALERT))
+        await asyncio.sleep(0)
+        assert controller.stats()["waiting"] == 2
+
+        release.set()
+        await asyncio.gather(holder, queued, alert)
+
+        assert shed.value.reason == "queue full"
+        assert shed.value.retry_after >= 1
+        assert order == ["holder", "alert", "dashboard"]
+        assert decisions == ["admitted", "queued", "queue_full", "queued"]
+        assert controller.stats()["inflight"] == 0
+
+    def test_queue_timeout_frees_the_slot(self):
+        controller = AdmissionController(max_inflight=1, max_queue=4, queue_timeout=0.05)
+        holder = controller.admit("a")
+        holder.__enter__()
+
+        with pytest.raises(Rejected) as shed:
+            with controller.admit("b"):
+                pass
+        holder.__exit__(None, None, None)
+
+        assert shed.value.reason == "queue timeout"
+        assert controller.stats()["inflight"] == controller.stats()["waiting"] == 0
+        with controller.admit("b"):
+            assert controller.stats()["inflight"] == 1
+
+    def test_client_key_prefers_dashboard(self):
+        headers = {"X-Grafana-Org-Id": "1", "X-Dashboard-Uid": "abc"}
+        assert proxy_app.admission_key(headers.get) == "x-dashboard-uid=abc"
+        assert proxy_app.admission_key({"X-Grafana-Org-Id": "1"}.get) == "x-grafana-org-id=1"
+        assert proxy_app.admission_key({}.get) == "anonymous"
+
+    def test_alert_priority_needs_the_shared_token(self, monkeypatch):
+        """A bare FromAlert header is spoofable and gets no priority"""
+        alert = {"FromAlert": "true", "X-Alert-Token": "s3cret"}
+        assert proxy_app.admission_priority(alert.get) == PRIORITY_NORMAL
+
+        monkeypatch.setattr(proxy_app, "ADMISSION_ALERT_TOKEN", "s3cret")
+        assert proxy_app.admission_priority(alert.get) == PRIORITY_ALERT
+        assert proxy_app.admission_priority({"FromAlert": "true"}.get) == PRIORITY_NORMAL
+        assert proxy_app.admission_priority(
+            {"FromAlert": "true", "X-Alert-Token": "guess"}.get
+        ) == PRIORITY_NORMAL
+        assert proxy_app.admission_priority({"X-Alert-Token": "s3cret"}.get) == PRIORITY_NORMAL
+
+    @pytest.fixture
+    def limited(self, monkeypatch):
+        """Admission on, two requests of burst per client and no refill"""
+        monkeypatch.setattr(proxy_app, "ADMISSION_ENABLED", True)
+        monkeypatch.setattr(proxy_app, "ADMISSION_ALERT_TOKEN", "s3cret")
+        monkeypatch.setattr(proxy_app, "admission", AdmissionController(
+            limiter=RateLimiter(rate=0.5, burst=2, clock=FakeClock())
+        ))
+
+    def test_rate_limited_query_gets_429(self, client, backend_calls, limited):
+        body = query_body("avg_health_score")
+        busy = {"X-Dashboard-Uid": "busy"}
+
+        assert [client.post("/query", json=body, headers=busy).status_code
+                for _ in range(2)] == [200, 200]
+        response = client.post("/query", json=body, headers=busy)
+
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "2"
+        quiet = {"X-Dashboard-Uid": "quiet"}
+        assert client.post("/query", json=body, headers=quiet).status_code == 200
+        assert client.post(
+            "/query", json=body, headers={**busy, "FromAlert": "true"}
+        ).status_code == 429
+        assert client.post(
+            "/query", json=body, headers={**busy, "FromAlert": "true", "X-Alert-Token": "s3cret"}
+        ).status_code == 200
+        # Health and search are never limited
+        assert client.post("/search", json={}, headers=busy).status_code == 200
+
+    async def test_asgi_rate_limited_query_gets_429(self, asgi_client, asgi_backend, limited):
+        body = query_body("avg_health_score")
+        busy = {"X-Grafana-User": "admin"}
+
+        statuses = [
+            (await asgi_client.post("/query", json=body, headers=busy)).status_code
+            for _ in range(3)
+        ]
+        response = await asgi_client.post("/annotations", json={}, headers=busy)
+
+        assert statuses == [200, 200, 429]
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "2"
+
+
+class TestQueryResultCache:
+    """Test the encoded /query response cache"""
+
+    def test_viewers_in_one_interval_share_a_key(self):
+        body = {**query_body("total_cost", "error_rate"), "intervalMs": 60_000}
+        body["range"] = {"from": 1_699_999_990_000, "to": 1_700_003_590_000}
+        other = {**query_body("error_rate", "total_cost"), "intervalMs": 60_000}
+        other["range"] = {"from": 1_700_000_030_000, "to": 1_700_003_630_000}
+
+        key, order, normalized = normalize_query(body)
+        other_key, other_order, _ = normalize_query(other)
+
+        assert key == other_key
+        assert order == ["total_cost", "error_rate"]
+        assert other_order == ["error_rate", "total_cost"]
+        assert normalized["range"] == {"from": 1_699_999_980_000, "to": 1_700_003_640_000}
+        assert normalize_query({**body, "intervalMs": 30_000})[0] != key
+        assert normalize_query(body, version=2)[0] != key
+
+    def test_assemble_follows_request_order(self):
+        segments = {"a": b'{"target":"a"}', "b": b'{"target":"b"}', "t": b""}
+        assert json.loads(assemble(segments, ["b", "missing", "a", "t", "b"])) == [
+            {"target": "b"}, {"target": "a"}, {"target": "b"},
+        ]
+
+    def test_entries_expire_and_hits_counted_per_dashboard(self):
+        clock = FakeClock()
+        cache = ResultCache(ttl=5, clock=clock)
+        cache.put("k", {"a": b"1"})
+
+        assert cache.get("k", "ops") == {"a": b"1"}
+        clock.now += 5
+        assert cache.get("k", "ops") is None
+        assert cache.get("other", "cost") is None
+
+        assert cache.stats()["dashboards"] == {
+            "ops": {"hit": 1, "miss": 1, "hit_ratio": 0.5},
+            "cost": {"hit": 0, "miss": 1, "hit_ratio": 0.0},
+        }
+
+    def test_dashboards_past_the_bound_are_counted_as_other(self):
+        """Client-supplied dashboard ids cannot grow stats or metric labels"""
+        lookups = []
+        cache = ResultCache(max_dashboards=2, on_lookup=lambda *args: lookups.append(args))
+
+        for dashboard in ("ops", "cost", "ops", *(f"spoof-{i}" for i in range(50))):
+            cache.get("k", dashboard)
+
+        assert set(cache.stats()["dashboards"]) == {"ops", "cost", "other"}
+        assert cache.stats()["dashboards"]["other"]["miss"] == 50
+        assert {dashboard for dashboard, _ in lookups} == {"ops", "cost", "other"}
+
+    @pytest.fixture
+    def prepared(self, monkeypatch):
+        """Result cache on; records every query that had to be planned"""
+        monkeypatch.setattr(proxy_app, "RESULT_CACHE_ENABLED", True)
+        calls = []
+        prepare_query = proxy_app.prepare_query
+
+        def recording(data):
+            calls.append(data)
+            return prepare_query(data)
+
+        monkeypatch.setattr(proxy_app, "prepare_query", recording)
+        return calls
+
+    def test_repeated_query_skips_planning_and_encoding(self, client, backend_calls, prepared):
+        body = {**query_body("total_cost", "provider_health_score"), "dashboardUID": "ops"}
+        swapped = {**query_body("provider_health_score", "total_cost"), "dashboardUID": "ops"}
+
+        first = client.post("/query", json=body)
+        second = client.post("/query", json=swapped)
+
+        assert len(prepared) == 1
+        assert [s["target"] for s in first.json][0] == "total_cost"
+        assert [s["target"] for s in second.json][-1] == "total_cost"
+        assert sorted(map(json.dumps, first.json)) == sorted(map(json.dumps, second.json))
+        assert proxy_app.result_cache.stats()["dashboards"]["ops"]["hit_ratio"] == 0.5
+
+    def test_failed_fetch_not_cached(self, client, backend_calls, prepared, monkeypatch):
+        monkeypatch.setattr(proxy_app, "fetch_backend", lambda *args: 1 / 0)
+        body = query_body("total_cost")
+
+        assert client.post("/query", json=body).json[0]["datapoints"] == []
+        client.post("/query", json=body)
+        assert len(prepared) == 2
+
+    async def test_asgi_serves_cached_result(self, asgi_client, asgi_backend, prepared):
+        body = query_body("total_cost", "error_rate")
+
+        first = await asgi_client.post("/query", json=body)
+        second = await asgi_client.post("/query", json=body)
+
+        assert len(prepared) == 1
+        assert second.content == first.content
+
+
+class TestWarmStartSnapshot:
+    """Test snapshotting and restoring the proxy's state"""
+
+    def test_round_trip_keeps_values_and_ages(self, tmp_path):
+        clock = FakeClock()
+        table = ProviderTable.from_lines(PROVIDER_EXPOSITION.splitlines())
+        key = ("/api/monitoring/stats/realtime", (("hours", 1),))
+        path = str(tmp_path / "snapshot.bin")
+
+        size = snapshot.write(
+            path,
+            [(key, REALTIME_PAYLOAD, 10.0, 30), (proxy_app.PROVIDER_FETCH_KEY, table, 0.0, 30)],
+            {"total_cost": ([1000, 2000], [1.5, 2.5])},
+            clock=clock,
+        )
+        clock.now += 60
+        state = snapshot.read(path, clock=clock)
+
+        assert size == os.path.getsize(path)
+        assert state.age == 60
+        assert state.cache[0] == (key, REALTIME_PAYLOAD, 70.0, 30)
+        assert state.cache[1][1].tag_values("provider") == table.tag_values("provider")
+        assert state.series == {"total_cost": ([1000, 2000], [1.5, 2.5])}
+
+    def test_corrupt_snapshot_ignored(self, tmp_path):
+        path = tmp_path / "snapshot.bin"
+        assert snapshot.read(str(path)) is None
+
+        snapshot.write(str(path), [], {"m": ([1], [1.0])})
+        path.write_bytes(path.read_bytes()[:-4])
+        assert snapshot.read(str(path)) is None
+        path.write_bytes(b"garbage")
+        assert snapshot.read(str(path)) is None
+
+    def test_defer_holds_back_fresh_jobs(self):
+        clock = FakeClock()
+        schedule = Schedule({"fresh": 30, "old": 30}, jitter=0, clock=clock)
+        schedule.defer("fresh", age=10)
+        schedule.defer("old", age=45)
+
+        assert schedule.due() == ["old"]
+        clock.now += 20
+        assert schedule.due() == ["fresh"]
+
+    @pytest.fixture
+    def restart(self, tmp_path, monkeypatch):
+        """Snapshot the proxy, then simulate a restart with empty state"""
+        monkeypatch.setattr(proxy_app, "SNAPSHOT_PATH", str(tmp_path / "snapshot.bin"))
+        monkeypatch.setattr(proxy_app, "timeseries_store", TimeSeriesStore(100))
+
+        def restart():
+            proxy_app.save_snapshot()
+            proxy_app.response_cache.clear()
+            monkeypatch.setattr(proxy_app, "timeseries_store", TimeSeriesStore(100))
+            proxy_app.restore_snapshot()
+        return restart
+
+    def test_restart_answers_from_snapshot(self, client, backend_calls, restart):
+        body = query_body("total_cost", "provider_health_score")
+        now_ms = int(time.time() * 1000)
+        body["range"] = {"from": now_ms - HOUR_MS, "to": now_ms}
+        proxy_app.timeseries_store.record("total_cost", now_ms - 1000, 7.5)
+
+        before = client.post("/query", json=body).json
+        calls = len(backend_calls)
+        restart()
+        after = client.post("/query", json=body).json
+
+        assert len(backend_calls) == calls
+        assert after[0]["datapoints"] == [[7.5, now_ms - 1000]]
+        assert [(s["target"], s["datapoints"][0][0]) for s in after[1:]] == [
+            (s["target"], s["datapoints"][0][0]) for s in before[1:]
+        ]
+
+    def test_old_snapshot_ignored(self, client, backend_calls, restart, monkeypatch):
+        client.post("/query", json=query_body("total_cost"))
+        monkeypatch.setattr(proxy_app, "SNAPSHOT_MAX_AGE_SECONDS", -1)
+        restart()
+        assert proxy_app.response_cache.entries() == []
+
+
+HEALTH_PAYLOAD = {"providers": [
+    {"provider": "openrouter", "health_score": 95, "status": "healthy"},
+    {"provider": "anthropic", "health_score": 88, "status": "healthy"},
+]}
+
+
+def sse_events(chunk):
+    """(event, id, data) of each server-sent event in `chunk`"""
+    events = []
+    for block in chunk.decode().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in fields:
+            events.append((fields["event"], int(fields["id"]), json.loads(fields["data"])))
+    return events
+
+
+class TestLiveFeed:
+    """Test the shared live monitoring feed and its event stream"""
+
+    @pytest.fixture
+    def feed(self, monkeypatch):
+        """A feed on fake sources, polled by the test (its thread polls once)"""
+        payloads = {"/health": json.loads(json.dumps(HEALTH_PAYLOAD)), "/realtime": {"rps": 1}}
+        calls = []
+
+        def fetch(endpoint, params):
+            calls.append(endpoint)
+            return json.loads(json.dumps(payloads[endpoint]))
+
+        feed = LiveFeed(
+            {"health": ("/health", ()), "realtime": ("/realtime", ())},
+            fetch, interval=3600, index={"health": "provider"}, max_subscribers=3,
+        )
+        feed.payloads, feed.calls = payloads, calls
+        monkeypatch.setattr(proxy_app, "live_feed", feed)
+        return feed
+
+    def started(self, feed):
+        """Subscribe once and wait for the feed thread's first poll"""
+        subscription = feed.subscribe()
+        deadline = time.monotonic() + 5
+        while feed.polls < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return subscription
+
+    def test_merge_patch_round_trip(self):
+        old = index_lists(HEALTH_PAYLOAD, "provider")
+        new = json.loads(json.dumps(old))
+        new["providers"]["openrouter"]["health_score"] = 60
+        del new["providers"]["anthropic"]
+        new["updated"] = "now"
+
+        patch = merge_patch(old, new)
+        assert patch == {
+            "providers": {"openrouter": {"health_score": 60}, "anthropic": None},
+            "updated": "now",
+        }
+        assert apply_patch(old, patch) == new
+        assert merge_patch(new, new) is None
+
+    def test_one_poll_fans_out_to_every_viewer(self, feed):
+        first = self.started(feed)
+        viewers = [feed.subscribe() for _ in range(2)]
+        assert feed.calls == ["/health", "/realtime"]
+
+        feed.payloads["/health"]["providers"][1]["health_score"] = 40
+        feed.poll()
+        assert len(feed.calls) == 4
+
+        for subscription in (first, *viewers):
+            (event, seq, data), = sse_events(subscription.drain()[-1])
+            assert (event, seq) == ("delta", 2)
+            assert data == {"health": {"providers": {"anthropic": {"health_score": 40}}}}
+        with pytest.raises(FeedFull):
+            feed.subscribe()
+
+    def test_lagging_viewer_resynced_with_snapshot(self, feed):
+        subscription = self.started(feed)
+        subscription.max_pending = 2
+        for score in range(3):
+            feed.payloads["/realtime"]["rps"] = score + 10
+            feed.poll()
+
+        (event, seq, data), = sse_events(b"".join(subscription.drain()))
+        assert (event, seq) == ("snapshot", feed.seq)
+        assert data["realtime"] == {"rps": 12}
+        assert data["health"]["providers"]["openrouter"]["health_score"] == 95
+
+    def test_failed_source_keeps_last_value(self, feed):
+        self.started(feed)
+        del feed.payloads["/realtime"]
+        assert feed.poll() is None
+
+    def test_stream_endpoint(self, client, feed):
+        self.started(feed)
+        response = client.get("/stream/monitoring", buffered=False)
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+        assert "Content-Encoding" not in response.headers
+
+        chunks = iter(response.response)
+        assert next(chunks) == b"retry: 5000\n\n"
+        (event, _, data), = sse_events(next(chunks))
+        assert event == "snapshot"
+        assert set(data["health"]["providers"]) == {"openrouter", "anthropic"}
+
+        feed.payloads["/health"]["providers"][0]["status"] = "degraded"
+        feed.poll()
+        (event, _, data), = sse_events(next(chunks))
+        assert data == {"health": {"providers": {"openrouter": {"status": "degraded"}}}}
+
+        response.close()
+        assert feed.stats()["subscribers"] == 1
+
+    def test_stream_full_gets_503(self, client, feed):
+        for _ in range(3):
+            feed.subscribe()
+        response = client.get("/stream/monitoring")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "3600"
+
+    async def test_asgi_stream_ends_on_disconnect(self, feed):
+        self.started(feed)
+        sent = []
+        left = asyncio.Event()
+
+        async def receive():
+            if not left.is_set():
+                await left.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if b"event: snapshot" in message.get("body", b""):
+                left.set()
+
+        await asyncio.wait_for(proxy_asgi.stream_monitoring({}, receive, send), 5)
+        assert dict(sent[0]["headers"])[b"content-type"] == b"text/event-stream"
+        assert feed.stats()["subscribers"] == 1
@@ -0,0 +1,493 @@
+"""
+Tests for the dashboard query tools in scripts/
+
+Tests validate:
+- PromQL / LogQL parsing and semantic comparison (scripts/promql.py)
+- In-place query replacement in JSON and YAML (scripts/dashboard_queries.py)
+- Recording-rule rewrites and near misses (scripts/lint_promql.py)
+- Recording-rule synthesis for repeated aggregations (scripts/synthesize_recording_rules.py)
+- Collapsing dashboard rows below the fold (scripts/collapse_rows.py)
+- Panels reusing another panel's queries (scripts/dedupe_panel_queries.py)
+- LogQL rewrites onto stream labels and Loki recording rules (scripts/optimize_logql.py)
+- Every dashboard and alert query already uses the recording rules it can
+- Every dashboard row below the fold is already collapsed
+- No dashboard panel repeats another panel's queries
+- No LogQL query filters lines or parses for what a stream label or Loki rule gives
+
+Run with: pytest tests/test_query_tools.py -v
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+import yaml
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
+
+import collapse_rows  # noqa: E402
+import dashboard_queries as dq  # noqa: E402
+import dedupe_panel_queries as dedupe  # noqa: E402
+import lint_promql  # noqa: E402
+import optimize_logql  # noqa: E402
+import promql  # noqa: E402
+import synthesize_recording_rules as synth  # noqa: E402
+
+
+def rule(record, expr, interval=60):
+    return dq.RecordingRule(record, expr, "test", interval, "test.yml")
+
+
+@pytest.fixture
+def index():
+    return lint_promql.RuleIndex([
+        rule("traffic:rate5m", "rate(http_requests_total[5m])"),
+        rule("traffic:by_endpoint", "sum by (endpoint) (rate(http_requests_total[5m]))"),
+        rule("latency:p95",
+             "histogram_quantile(0.95, rate(http_request_duration_seconds_bucket[5m]))"),
+    ])
+
+
+def lint(expr, index):
+    query = dq.Query("dashboard.json", "dashboard", "Test", "promql", {"expr": expr}, {}, 30)
+    return lint_promql.lint(query, index, lint_promql.Estimator(index, 15))
+
+
+class TestPromQLParser:
+    """Test parsing and canonical comparison of expressions"""
+
+    @pytest.mark.parametrize("a, b", [
+        ('sum(rate(x{a="b",c=~"d"}[5m])) by (le)', 'sum by (le) (rate(x{c=~"d", a="b"}[300s]))'),
+        ("(a + b) * 2", "2 * (b + a)"),
+        ('{__name__="up", job="api"}', 'up{job="api"}'),
+        ('rate({app="x"} | level="INFO" [5m])', 'rate({app="x", level="INFO"}[5m])'),
+    ])
+    def test_equivalent_expressions_are_canonical_equal(self, a, b):
+        assert promql.canonical(promql.parse(a)) == promql.canonical(promql.parse(b))
+
+    @pytest.mark.parametrize("a, b", [
+        ("a - b", "b - a"),
+        ("sum by (le) (x)", "sum by (job) (x)"),
+        ("rate(x[5m])", "rate(x[1m])"),
+    ])
+    def test_different_expressions_are_not_equal(self, a, b):
+        assert promql.canonical(promql.parse(a)) != promql.canonical(promql.parse(b))
+
+    @pytest.mark.parametrize("expr", [
+        "histogram_quantile(0.95, sum(rate(x_bucket{job=~\"$job\"}[$__rate_interval])) by (le))",
+        "max_over_time(rate(x[5m])[1h:1m] offset 1d)",
+        "a / on(instance) group_left(version) b > bool 1",
+        'sum(count_over_time({app=~"gatewayz.*"} |= "ERROR" | logfmt | level != "" [5m]))',
+    ])
+    def test_parses_dashboard_syntax(self, expr):
+        promql.parse(expr)
+
+    def test_rejects_invalid_grouping(self):
+        with pytest.raises(promql.ParseError):
+            promql.parse("connection_pool_active_connections by (pool_name)")
+
+    def test_splice_replaces_spans_only(self):
+        expr = 'sum(rate(x[5m]))  /  sum(rate(y[5m]))'
+        call = promql.parse(expr).children[0].children[0]
+        assert promql.splice(expr, [(call.start, call.end, "x:rate5m")]) == \
+            "sum(x:rate5m)  /  sum(rate(y[5m]))"
+
+
+class TestReplaceExpr:
+    """Test query replacement keeps the surrounding file untouched"""
+
+    def test_json_string(self):
+        text = '{ "expr": "sum(rate(x{a=\\"b\\"}[5m]))", "legendFormat": "x" }'
+        new = dq.replace_expr(text, 'sum(rate(x{a="b"}[5m]))', 'sum(x:rate5m{a="b"})')
+        assert new == '{ "expr": "sum(x:rate5m{a=\\"b\\"})", "legendFormat": "x" }'
+
+    def test_yaml_single_quoted(self):
+        text = "  # keep me\n  expr: 'sum(rate(x[5m])) > 1'\n"
+        new = dq.replace_expr(text, "sum(rate(x[5m])) > 1", "sum(x:rate5m) > 1")
+        assert new == "  # keep me\n  expr: 'sum(x:rate5m) > 1'\n"
+
+    def test_yaml_block_scalar(self):
+        text = "      expr: |\n        sum(\n          rate(x[5m])\n        )\n      for: 5m\n"
+        new = dq.replace_expr(text, "sum(\n  rate(x[5m])\n)\n", "sum(\n  x:rate5m\n)\n")
+        assert new == "      expr: |\n        sum(\n          x:rate5m\n        )\n      for: 5m\n"
+
+    def test_target_moved_to_other_datasource_makes_panel_mixed(self):
+        loki = {"type": "loki", "uid": "grafana_loki"}
+        text = json.dumps({"panels": [{"datasource": loki, "targets": [
+            {"expr": "sum(rate({app=\"a\"}[5m]))", "refId": "A"},
+            {"expr": "sum(rate({app=\"b\"}[5m]))", "refId": "B"},
+        ]}]}, indent=2)
+        text = dq.set_target_datasource(text, 'sum(rate({app="a"}[5m]))', dq.MIMIR)
+        panel = json.loads(text)["panels"][0]
+        assert panel["datasource"] == dq.MIXED
+        assert [t["datasource"] for t in panel["targets"]] == [dq.MIMIR, loki]
+
+        text = dq.set_target_datasource(text, 'sum(rate({app="b"}[5m]))', dq.MIMIR)
+        assert json.loads(text)["panels"][0]["datasource"] == dq.MIMIR
+
+    def test_missing_query_raises(self):
+        with pytest.raises(ValueError):
+            dq.replace_expr('{"expr": "up"}', "down", "up")
+
+
+class TestRecordingRuleRewrites:
+    """Test which queries are rewritten to recorded series"""
+
+    def test_exact_match(self, index):
+        finding = lint("sum(rate(http_requests_total[5m])) by (endpoint) > 10", index)
+        assert finding.new_expr == "traffic:by_endpoint > 10"
+
+    def test_pushdown_keeps_extra_matchers(self, index):
+        finding = lint('rate(http_requests_total{status_code=~"5.."}[5m])', index)
+        assert finding.new_expr == 'traffic:rate5m{status_code=~"5.."}'
+
+    def test_reaggregation_by_subset_of_labels(self, index):
+        finding = lint("sum(rate(http_requests_total[5m]))", index)
+        assert finding.new_expr == "sum(traffic:by_endpoint)"
+        assert finding.after[1] < finding.before[1]
+
+    def test_no_rewrite_when_result_would_change(self, index):
+        for expr in (
+            "rate(http_requests_total[1m])",
+            "rate(http_requests_total[5m] @ 1700000000)",
+            "irate(http_requests_total{status_code=~\"5..\"}[5m])",
+            "histogram_quantile(0.95, sum by (le) "
+            "(rate(http_request_duration_seconds_bucket[5m])))",
+        ):
+            finding = lint(expr, index)
+            assert finding.new_expr == expr, expr
+
+    def test_offset_moves_onto_the_recorded_series(self, index):
+        finding = lint("rate(http_requests_total[5m] offset 1h)", index)
+        assert finding.new_expr == "traffic:rate5m offset 1h"
+        # Both sides of a ratio against the past read the same rule
+        finding = lint("sum(rate(http_requests_total[5m]))"
+                       " / sum(rate(http_requests_total[5m] offset 1h))", index)
+        assert finding.new_expr == "sum(traffic:by_endpoint) / sum(traffic:by_endpoint offset 1h)"
+
+    def test_near_miss_reports_difference(self, index):
+        finding = lint("histogram_quantile(0.95, sum by (le) "
+                       "(rate(fastapi_requests_duration_seconds_bucket[5m])))", index)
+        assert [m.record for m in finding.near_misses] == ["latency:p95"]
+        assert set(finding.near_misses[0].differences) == {"metrics", "grouping"}
+
+    def test_rewrite_of_one_operand_onto_another_window_is_rejected(self):
+        index = lint_promql.RuleIndex([
+            rule("edge:failed:rate5m", "sum by (edge) (rate(failed_total[5m]))"),
+        ], rate_interval=5 * 60000)
+        expr = ("sum by (edge) (rate(failed_total[$__rate_interval]))"
+                " / sum by (edge) (rate(requests_total[$__rate_interval]))")
+        finding = lint(expr, index)
+        assert finding.new_expr == expr and not finding.rewrites
+        assert "5m" in finding.rejected and "$__rate_interval" in finding.rejected
+        # Both operands on 5m windows may still use the rule
+        finding = lint("sum by (edge) (rate(failed_total[5m]))"
+                       " / sum by (edge) (rate(requests_total[5m]))", index)
+        assert finding.new_expr == "edge:failed:rate5m / sum by (edge) (rate(requests_total[5m]))"
+
+    def test_rules_on_mimir_only_metrics_are_ignored(self):
+        index = lint_promql.RuleIndex([
+            rule("edge:failed:rate5m",
+                 "sum by (edge) (rate(traces_service_graph_failed_total[5m]))"),
+        ], mimir_only=("traces_service_graph_",))
+        assert not index.rules
+        assert not lint("sum by (edge) (rate(traces_service_graph_failed_total[5m]))",
+                        index).rewrites
+
+
+class TestSynthesis:
+    """Test which repeated aggregations become recording rules"""
+
+    def synthesize(self, *exprs, **kwargs):
+        queries = [dq.Query("dashboard.json", "dashboard", "Test", "promql", {"expr": e}, {}, 30)
+                   for e in exprs]
+        return synth.synthesize(queries, lint_promql.RuleIndex([]), **kwargs)
+
+    def test_varying_matchers_become_grouping_labels(self):
+        [candidate] = self.synthesize(
+            'sum(rate(x_total{job="api", code=~"5.."}[5m]))',
+            'sum(rate(x_total{job="api"}[5m]))',
+            'sum by (route) (rate(x_total{job="api", code="429"}[5m]))',
+        )
+        assert candidate.expr == 'sum by (code, route) (rate(x_total{job="api"}[5m]))'
+        assert candidate.record == "code_route:x:rate5m"
+
+    def test_below_threshold_or_too_many_labels_is_skipped(self):
+        assert not self.synthesize("sum(rate(x_total[5m]))", "sum(rate(x_total[5m]))")
+        assert not self.synthesize("sum by (a, b, c, d) (rate(x_total[5m]))", min_uses=1)
+
+    def test_different_ranges_are_different_rules(self):
+        candidates = self.synthesize(*["sum(rate(x_total[5m]))"] * 3,
+                                     *["sum(rate(x_total[1h]))"] * 3)
+        assert {c.record for c in candidates} == {"global:x:rate5m", "global:x:rate1h"}
+
+    def test_mimir_only_metrics_are_skipped(self):
+        queries = [dq.Query("dashboard.json", "dashboard", "Test", "promql", {"expr": e}, {}, 30)
+                   for e in ["sum(rate(traces_spanmetrics_calls_total[5m]))"] * 3]
+        index = lint_promql.RuleIndex([], mimir_only=dq.TEMPO_METRIC_PREFIXES.values())
+        assert not synth.synthesize(queries, index)
+        assert synth.synthesize(queries, lint_promql.RuleIndex([]))
+
+    def test_written_group_keeps_one_blank_line_between_rules(self, tmp_path):
+        path = tmp_path / "rules.yml"
+        path.write_text("groups:\n  - name: base\n    rules:\n      - record: a\n        expr: up\n")
+        [first] = self.synthesize(*["sum(rate(x_total[5m]))"] * 3)
+        [second] = self.synthesize(*["sum(rate(y_total[5m]))"] * 3)
+
+        synth.write_rules(path, "generated", [first])
+        path.write_text(path.read_text() + "\n\n")
+        synth.write_rules(path, "generated", [second])
+
+        text = path.read_text()
+        assert "\n\n\n" not in text
+        assert "x_total[5m]))\n\n      # 3 uses" in text
+        [_, group] = yaml.safe_load(text)["groups"]
+        assert [r["record"] for r in group["rules"]] == ["global:x:rate5m", "global:y:rate5m"]
+
+
+def panel(id, y, h=8, x=0, w=24, **fields):
+    return dict({"id": id, "gridPos": {"h": h, "w": w, "x": x, "y": y}, "type": "timeseries",
+                 "targets": [{"expr": f"up{{id=\"{id}\"}}", "refId": "A"}]}, **fields)
+
+
+def row(id, y, **fields):
+    return dict({"id": id, "gridPos": {"h": 1, "w": 24, "x": 0, "y": y}, "type": "row",
+                 "title": f"Row {id}", "collapsed": False, "panels": []}, **fields)
+
+
+class TestCollapseRows:
+    """Test which panels move into collapsed rows"""
+
+    def collapse(self, *panels, fold=collapse_rows.FOLD):
+        text = json.dumps({"title": "Test", "panels": list(panels)}, indent=2)
+        return json.loads(collapse_rows.collapse(text, fold))["panels"]
+
+    def test_rows_below_the_fold_are_collapsed(self):
+        panels = self.collapse(panel(1, 0), row(2, 8), panel(3, 9, h=20), row(4, 40),
+                               panel(5, 41), panel(6, 41, x=12, w=12))
+        assert [(p["id"], p["gridPos"]["y"]) for p in panels] == [(1, 0), (2, 8), (3, 9), (4, 29)]
+        assert panels[3]["collapsed"] is True
+        assert [(p["id"], p["gridPos"]["y"]) for p in panels[3]["panels"]] == [(5, 30), (6, 30)]
+
+    def test_gaps_in_the_layout_do_not_push_rows_below_the_fold(self):
+        panels = self.collapse(panel(1, 0), row(2, 100), panel(3, 101))
+        assert [p["id"] for p in panels] == [1, 2, 3]
+        assert not panels[1]["collapsed"]
+
+    def test_header_panels_below_the_fold_get_a_new_row(self):
+        panels = self.collapse(panel(1, 0, h=20), panel(2, 20), panel(3, 28), panel(4, 36))
+        assert [p["id"] for p in panels] == [1, 2, 5]
+        assert panels[2]["title"] == collapse_rows.NEW_ROW_TITLE
+        assert [p["id"] for p in panels[2]["panels"]] == [3, 4]
+
+    def test_collapsed_rows_keep_their_panels(self):
+        text = json.dumps({"panels": [panel(1, 0), row(2, 8, collapsed=True,
+                                                         panels=[panel(3, 9)])]}, indent=2)
+        assert collapse_rows.collapse(text) == text
+
+    def test_initial_queries_skip_collapsed_hidden_and_dashboard_targets(self):
+        dashboard = {"panels": [
+            panel(1, 0),
+            panel(2, 0, targets=[{"expr": "up", "hide": True}]),
+            panel(3, 0, datasource=dq.DASHBOARD, targets=[{"panelId": 1}]),
+            row(4, 8, collapsed=True, panels=[panel(5, 9)]),
+        ]}
+        assert collapse_rows.initial_queries(dashboard) == 1
+
+
+def target(ref_id, expr, legend=None, **fields):
+    return dict({"expr": expr, "legendFormat": legend, "refId": ref_id}, **fields)
+
+
+class TestDedupePanelQueries:
+    """Test which panels reuse another panel's queries"""
+
+    def dedupe(self, *panels):
+        text = json.dumps({"title": "Test", "panels": list(panels)}, indent=2)
+        return {p["id"]: p for p in dq.iter_panels(json.loads(dedupe.dedupe(text))["panels"])}
+
+    def test_stat_reuses_one_line_of_a_timeseries(self):
+        graph = panel(1, 0, targets=[target("A", "sum(rate(x_total[5m]))", "All"),
+                                     target("B", 'sum(rate(x_total{code="500"}[5m]))', "5xx")])
+        stat = panel(2, 8, type="stat",
+                     targets=[target("A", 'sum(rate(x_total{code = "500"}[5m]))', "Errors")])
+        panels = self.dedupe(graph, stat)
+        assert panels[1] == graph
+        assert panels[2]["datasource"] == dq.DASHBOARD
+        assert panels[2]["targets"] == [{"datasource": dq.DASHBOARD, "panelId": 1, "refId": "A"}]
+        assert panels[2]["transformations"] == [
+            {"id": "filterByRefId", "options": {"include": "B"}},
+            {"id": "renameByRegex", "options": {"regex": "^5xx$", "renamePattern": "Errors"}},
+        ]
+
+    def test_instant_query_reuses_range_query_only_when_reduced_to_last_value(self):
+        graph = panel(1, 0, targets=[target("A", "sum(x)")])
+        last = panel(2, 8, type="stat", targets=[target("A", "sum(x)", instant=True)])
+        mean = panel(3, 8, type="stat", targets=[target("A", "sum(x)", instant=True)],
+                     options={"reduceOptions": {"calcs": ["mean"]}})
+        panels = self.dedupe(graph, last, mean)
+        assert panels[2]["targets"][0]["panelId"] == 1
+        assert panels[3] == mean
+
+    def test_source_must_load_with_the_panel(self):
+        top = panel(1, 0, targets=[target("A", "sum(x)")])
+        nested = panel(3, 2, targets=[target("A", "sum(x)")])
+        other = panel(5, 3, targets=[target("A", "sum(y)")])
+        panels = self.dedupe(row(2, 1, collapsed=True, panels=[nested]),
+                             row(4, 2, collapsed=True, panels=[other]), top,
+                             panel(6, 8, targets=[target("A", "sum(y)")]))
+        assert panels[3]["targets"][0]["panelId"] == 1
+        assert panels[1]["targets"][0]["expr"] == "sum(x)"
+        assert panels[6]["targets"][0]["expr"] == "sum(y)"
+
+    def test_differently_templated_legends_or_step_dependent_queries_are_kept(self):
+        graph = panel(1, 0, targets=[target("A", "sum by (p) (x)", "{{p}}"),
+                                     target("B", "sum(rate(y[$__rate_interval]))")])
+        panels = self.dedupe(graph,
+                             panel(2, 8, targets=[target("A", "sum by (p) (x)", "{{p}} p95")]),
+                             panel(3, 8, targets=[target("A", "sum(rate(y[$__rate_interval]))")]))
+        assert all("expr" in panels[i]["targets"][0] for i in (2, 3))
+
+
+LOKI_RULES = """
+groups:
+  - name: test
+    interval: 1m
+    rules:
+      - record: loki:errors:count_per_minute
+        expr: sum(count_over_time({app="gatewayz", level="ERROR"}[1m]))
+      - record: loki:logs:by_level:count_per_5m
+        expr: sum by (level) (count_over_time({app="gatewayz"}[5m]))
+"""
+
+
+class TestOptimizeLogQL:
+    """Test LogQL rewrites onto stream labels and Loki rules, and the bytes left to scan"""
+
+    def analyze(self, expr, tmp_path):
+        path = tmp_path / "rules.yml"
+        path.write_text(LOKI_RULES)
+        query = dq.Query("alerts.yml", "alert", "Test", "logql", {"expr": expr},
+                         uid="grafana_loki")
+        return optimize_logql.analyze(query, optimize_logql.rule_index(str(path)),
+                                      optimize_logql.LogEstimator(), {})
+
+    @pytest.mark.parametrize("stage, levels", [
+        (("|=", '"ERROR"'), ["ERROR"]),
+        (("|~", '"(?i)error|critical"'), ["ERROR", "CRITICAL"]),
+        (("|=", '"timeout"'), None),
+        (("!=", '"ERROR"'), None),
+    ])
+    def test_level_line_filters(self, stage, levels):
+        assert optimize_logql.level_values(stage) == levels
+
+    @pytest.mark.parametrize("expr, new, kinds", [
+        ('sum(rate({app="x"} |= "ERROR" [5m]))',
+         'sum(rate({app="x", level="ERROR"} [5m]))', ["level-filter"]),
+        # A case-insensitive filter keeps matching any spelling of the level
+        ('sum(count_over_time({job=~".*x.*"} |~ "(?i)ERROR" [5m]))',
+         'sum(count_over_time({job=~".*x.*", level=~"(?i)ERROR"} [5m]))', ["level-filter"]),
+        ('{app="x"} |~ "(?i)error|critical"',
+         '{app="x", level=~"(?i)ERROR|CRITICAL"}', ["level-filter"]),
+        ('{app="x"} | level=~"ERROR|CRITICAL" | logfmt',
+         '{app="x", level=~"ERROR|CRITICAL"} | logfmt', ["label-stage"]),
+        ('sum by (service) (count_over_time({app="x"} | logfmt | service != "" [5m]))',
+         'sum by (service) (count_over_time({app="x", service!=""} [5m]))', ["parser"]),
+    ])
+    def test_label_rewrites(self, expr, new, kinds):
+        assert optimize_logql.label_rewrite(expr) == (new, kinds)
+
+    @pytest.mark.parametrize("expr", [
+        # Groups by a parsed label, or only filters on a log query
+        'sum by (status) (count_over_time({app="x"} | logfmt | service != "" [5m]))',
+        '{app="x"} | logfmt | service != ""',
+        # The line filter sees the formatted line
+        'sum(rate({app="x"} | line_format "{{.msg}}" |= "ERROR" [5m]))',
+    ])
+    def test_parsers_and_formatted_lines_are_kept(self, expr):
+        assert optimize_logql.label_rewrite(expr) == (expr, [])
+
+    def test_rules_match_the_same_selector_only(self, tmp_path):
+        finding = self.analyze('sum(rate({app="gatewayz"} |= "ERROR" [1m]))', tmp_path)
+        assert finding.new_expr == "loki:errors:count_per_minute / 60"
+        assert finding.kinds == ["level-filter", "rule"]
+        assert finding.datasource == dq.MIMIR
+        # gatewayz.* also selects other apps (gatewayz-api), or other spellings
+        for expr, new in (
+            ('sum(rate({app=~"gatewayz.*"} |= "ERROR" [1m]))',
+             'sum(rate({app=~"gatewayz.*", level="ERROR"} [1m]))'),
+            ('sum(rate({app="gatewayz"} |~ "(?i)ERROR" [1m]))',
+             'sum(rate({app="gatewayz", level=~"(?i)ERROR"} [1m]))'),
+        ):
+            finding = self.analyze(expr, tmp_path)
+            assert finding.new_expr == new
+            assert finding.datasource is None
+
+    def test_rate_reaggregates_a_rule_by_level(self, tmp_path):
+        finding = self.analyze('sum(rate({app="gatewayz"} |= "CRITICAL" [5m]))', tmp_path)
+        assert finding.new_expr == \
+            'sum(loki:logs:by_level:count_per_5m{level="CRITICAL"}) / 300'
+
+    def test_bytes_scanned(self, tmp_path):
+        estimator = optimize_logql.LogEstimator()
+        every = estimator.bytes_scanned(promql.parse('count_over_time({app="x"}[1h])'), 0)
+        assert every == optimize_logql.LOG_BYTES_PER_SECOND * 3600
+        errors = estimator.bytes_scanned(
+            promql.parse('count_over_time({app="x", level="ERROR"}[1h])'), 0)
+        assert errors == every // len(optimize_logql.LEVELS)
+        # A range query reads its range at every step of the dashboard's time range
+        assert estimator.bytes_scanned(
+            promql.parse('count_over_time({app="x"}[1h])'), 3600_000) == 2 * every
+
+        finding = self.analyze(
+            'sum by (status) (count_over_time({app="x"} | logfmt [1h]))', tmp_path)
+        assert (finding.scan, finding.after) == ("parse", every)
+
+
+class TestRepositoryQueries:
+    """Test the dashboards and alert rules against the repository's recording rules"""
+
+    def test_no_pending_rewrites(self):
+        """Every query that can read a recorded series already does"""
+        index = lint_promql.load_index()
+        estimator = lint_promql.Estimator(index, dq.scrape_interval())
+        pending = [
+            f"{f.query.where}: {f.query.expr} -> {f.new_expr}"
+            for f in lint_promql.lint_all(
+                dq.all_queries(), index, estimator
+            )
+            if f.rewrites
+        ]
+        assert not pending, "Run scripts/lint_promql.py --write:\n" + "\n".join(pending)
+
+    def test_rows_below_the_fold_are_collapsed(self):
+        """Panels below the fold only run their queries once their row is expanded"""
+        expanded = []
+        for path in collapse_rows.dashboard_files():
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            if collapse_rows.collapse(text) != text:
+                expanded.append(dq.relpath(path))
+        assert not expanded, "Run scripts/collapse_rows.py --write:\n" + "\n".join(expanded)
+
+    def test_no_panel_repeats_another_panels_queries(self):
+        """Panels running the same queries as another panel reuse its results"""
+        pending = []
+        for path in collapse_rows.dashboard_files():
+            with open(path, encoding="utf-8") as f:
+                dashboard = json.load(f)
+            pending += [f"{dq.relpath(path)} :: {r.describe()}"
+                        for r in dedupe.find_reuses(dashboard)]
+        assert not pending, "Run scripts/dedupe_panel_queries.py --write:\n" + "\n".join(pending)
+
+    def test_no_pending_logql_rewrites(self):
+        """LogQL queries select by stream label rather than filtering or parsing lines"""
+        pending = [
+            f"{f.query.where}: {f.query.expr} -> {f.new_expr}"
+            for f in optimize_logql.analyze_all(
+                dq.all_queries(), optimize_logql.rule_index(),
+                optimize_logql.LogEstimator())
+            if f.new_expr != f.query.expr
+        ]
+        assert not pending, "Run scripts/optimize_logql.py --write:\n" + "\n".join(pending)
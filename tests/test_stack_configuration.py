@@ -386,6 +386,24 @@ class TestMimirConfiguration:
         static_configs = mimir_job.get("static_configs", [])
         assert len(static_configs) > 0, "Mimir job missing static_configs"
 
+    def test_prometheus_json_api_proxy_scrape_job(self, repo_root):
+        """Test Prometheus scrapes the JSON API proxy's own metrics"""
+        prom_config = repo_root / "prometheus" / "prometheus.yml"
+
+        with open(prom_config) as f:
+            config = yaml.safe_load(f)
+
+        scrape_configs = config.get("scrape_configs", [])
+        proxy_job = next(
+            (job for job in scrape_configs if job.get("job_name") == "json_api_proxy"),
+            None
+        )
+
+        assert proxy_job is not None, "JSON API proxy scrape job not found"
+        assert proxy_job.get("metrics_path") == "/metrics"
+        static_configs = proxy_job.get("static_configs", [])
+        assert len(static_configs) > 0, "JSON API proxy job missing static_configs"
+
     def test_grafana_mimir_datasource_exists(self, repo_root):
         """Test Grafana has Mimir datasource configured"""
         datasource_file = repo_root / "grafana" / "provisioning" / "datasources" / "mimir.yml"